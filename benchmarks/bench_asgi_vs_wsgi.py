@@ -0,0 +1,168 @@
+# Compares the Flask app (under a gunicorn sync worker) with the ASGI app (under uvicorn)
+#   when every POST needs a (slow) DCS user token lookup
+
+"""
+tX Enqueue WSGI vs ASGI benchmark
+
+Starts:
+    a stub DCS server which takes DCS_DELAY_SECONDS to answer each user token lookup,
+    gunicorn with one sync worker (like our Dockerfiles) serving the Flask app,
+    uvicorn (one process) serving the ASGI app,
+and then POSTs the same payloads (each with a different user token) to each server
+    with the given number of concurrent requests in flight.
+
+Usage (from the repo root):
+    python3 benchmarks/bench_asgi_vs_wsgi.py [number_of_requests] [concurrency]
+
+Unless REDIS_HOSTNAME is set, each server uses its own in-process fakeredis
+    (via create_wsgi_app() and create_asgi_app() below).
+
+Needs gunicorn, uvicorn, httpx and fakeredis.
+"""
+
+# Python imports
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from os import environ, getenv
+from pathlib import Path
+from statistics import median
+from time import perf_counter, sleep
+import asyncio
+import json
+import subprocess
+import sys
+import threading
+
+# Library (PyPI) imports
+import httpx
+
+
+DEFAULT_NUMBER_OF_REQUESTS = 500
+DEFAULT_CONCURRENCY = 100
+DCS_DELAY_SECONDS = 0.05
+WSGI_PORT, ASGI_PORT = 8011, 8012
+BENCHMARKS_DIR = Path(__file__).resolve().parent
+ENQUEUE_DIR = BENCHMARKS_DIR.parent / 'tXenqueue'
+PAYLOAD_FILEPATH = BENCHMARKS_DIR.parent / 'tests' / 'Resources' / 'tx_payload.json'
+
+
+class SlowDCSHandler(BaseHTTPRequestHandler):
+    def do_GET(self) -> None:
+        sleep(DCS_DELAY_SECONDS)
+        body = json.dumps({'login': 'benchmark_user'}).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args) -> None:
+        pass
+# end of SlowDCSHandler class
+
+
+def create_fake_redis_backends(redis_server):
+    from fakeredis import FakeStrictRedis
+    from tx_enqueue_backends import EnqueueBackends
+    from tx_enqueue_main import our_queue_names, enqueue_job_stats_prefix, logger
+    return EnqueueBackends('fakeredis', our_queue_names, enqueue_job_stats_prefix, logger,
+                            redis_connection=FakeStrictRedis(server=redis_server))
+# end of create_fake_redis_backends function
+
+
+def create_wsgi_app():
+    from fakeredis import FakeServer
+    from tx_enqueue_main import create_app
+    return create_app(create_fake_redis_backends(FakeServer()))
+# end of create_wsgi_app function
+
+
+def create_asgi_app():
+    from fakeredis import FakeServer, FakeAsyncRedis
+    from tx_enqueue_asgi import EnqueueASGIApp
+    redis_server = FakeServer()
+    return EnqueueASGIApp(create_fake_redis_backends(redis_server),
+                            async_redis_connection=FakeAsyncRedis(server=redis_server))
+# end of create_asgi_app function
+
+
+def start_in_thread(server) -> None:
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+
+def start_server_process(command_args, port:int, env) -> subprocess.Popen:
+    server_process = subprocess.Popen(command_args, cwd=ENQUEUE_DIR, env=env,
+                                        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    for _ in range(200):
+        try:
+            if httpx.get(f'http://127.0.0.1:{port}/ready/').status_code == 200:
+                return server_process
+        except httpx.HTTPError:
+            pass
+        sleep(0.1)
+    server_process.terminate()
+    raise RuntimeError(f"{command_args[0]} didn't become ready on port {port}")
+# end of start_server_process function
+
+
+async def post_payloads(port:int, payloads, concurrency:int) -> dict:
+    latencies = []
+    semaphore = asyncio.Semaphore(concurrency)
+    limits = httpx.Limits(max_connections=concurrency)
+    async with httpx.AsyncClient(base_url=f'http://127.0.0.1:{port}', limits=limits, timeout=300) as client:
+        async def post_one(payload) -> int:
+            async with semaphore:
+                start_time = perf_counter()
+                response = await client.post('/', json=payload, headers={'Host': 'git.door43.org'})
+                latencies.append(1000 * (perf_counter() - start_time))
+                return response.status_code
+        start_time = perf_counter()
+        status_codes = await asyncio.gather(*(post_one(payload) for payload in payloads))
+        elapsed_seconds = perf_counter() - start_time
+    latencies.sort()
+    return {'requests_per_second': len(payloads) / elapsed_seconds,
+            'median_ms': median(latencies), 'p99_ms': latencies[int(0.99 * (len(latencies) - 1))],
+            'failed': sum(status_code != 200 for status_code in status_codes)}
+# end of post_payloads function
+
+
+def main() -> None:
+    number_of_requests = int(sys.argv[1]) if len(sys.argv) > 1 else DEFAULT_NUMBER_OF_REQUESTS
+    concurrency = int(sys.argv[2]) if len(sys.argv) > 2 else DEFAULT_CONCURRENCY
+
+    dcs_server = ThreadingHTTPServer(('127.0.0.1', 0), SlowDCSHandler)
+    start_in_thread(dcs_server)
+    dcs_domain = f'http://127.0.0.1:{dcs_server.server_address[1]}'
+    # NOTE: All of our payloads have the same repo_owner so turn off the per-submitter rate limit
+    env = dict(environ, QUEUE_PREFIX='dev-', PYTHONPATH=f'{ENQUEUE_DIR}:{BENCHMARKS_DIR}', ADMISSION_RATE_PER_MINUTE='0',
+                DCS_URL=dcs_domain)
+    if getenv('REDIS_HOSTNAME'):
+        wsgi_app, asgi_app, asgi_factory_args = 'tx_enqueue_main:app', 'tx_enqueue_asgi:app', []
+    else:
+        wsgi_app, asgi_app, asgi_factory_args = 'bench_asgi_vs_wsgi:create_wsgi_app()', \
+                                                'bench_asgi_vs_wsgi:create_asgi_app', ['--factory']
+
+    with open(PAYLOAD_FILEPATH, 'rt') as payload_file:
+        base_payload = json.load(payload_file)
+    servers = {'wsgi (gunicorn sync worker)': (['gunicorn', '--bind', f'127.0.0.1:{WSGI_PORT}', wsgi_app], WSGI_PORT),
+               'asgi (uvicorn)': (['uvicorn', '--host', '127.0.0.1', '--port', str(ASGI_PORT), '--no-access-log']
+                                    + asgi_factory_args + [asgi_app], ASGI_PORT),
+               }
+    print(f"{number_of_requests} POSTs ({concurrency} concurrent) with a {1000*DCS_DELAY_SECONDS:.0f}ms DCS user lookup each:")
+    for server_name, (command_args, port) in servers.items():
+        # Use new tokens for each server so that every lookup misses the DCS user cache
+        payloads = [dict(base_payload, job_id=f'bench_{port}_{n}', dcs_domain=dcs_domain,
+                            user_token=f'{port}{n:036d}') for n in range(number_of_requests)]
+        server_process = start_server_process(command_args, port, env)
+        try:
+            result = asyncio.run(post_payloads(port, payloads, concurrency))
+        finally:
+            server_process.terminate()
+            server_process.wait()
+        print(f"  {server_name:>28}: {result['requests_per_second']:7.1f} requests/s, "
+              f"median {result['median_ms']:7.1f}ms, p99 {result['p99_ms']:7.1f}ms, {result['failed']} failed")
+    dcs_server.shutdown()
+# end of main function
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,87 @@
+# Measures the Redis bytes of each queued job and its encode/decode cost
+#   for each of the job encodings in tx_enqueue_codec
+
+"""
+tX Enqueue job encoding micro-benchmark
+
+Usage (from the repo root):
+    PYTHONPATH="tXenqueue/" python3 benchmarks/bench_job_encoding.py [number_of_runs]
+
+For a realistic job (and one with many options), reports the bytes of the rq job data
+    and of the whole rq job hash, and (in microseconds) the median time to encode the job dict
+    into the rq job hash and to decode it again (as tx_job_handler would).
+"""
+
+# Python imports
+from datetime import datetime, timedelta
+from statistics import median
+from time import perf_counter
+import json
+import sys
+
+# Library (PyPI) imports
+from fakeredis import FakeStrictRedis
+from rq import Queue
+from rq.job import Job
+
+# Local imports
+from tx_enqueue_codec import JOB_ENCODINGS, JobCodec, decode_job_dict
+import tx_enqueue_redis
+
+
+DEFAULT_NUMBER_OF_RUNS = 5_000
+JOB_KWARGS = {'job_id': 'tx_job_handler_priority_Door43_en_obs_master_1', 'timeout': '10800s',
+                'result_ttl': 60*60*24, 'failure_ttl': 60*60*24*7}
+
+
+def get_job_dicts():
+    with open('tests/Resources/tx_payload.json', 'rt') as payload_file:
+        payload_dict = json.load(payload_file)
+    queued_at = datetime.utcnow()
+    realistic_job_dict = dict(payload_dict, success=True, status='queued', queue_name='tx_job_handler_priority',
+                tx_job_queued_at=queued_at, expires_at=queued_at + timedelta(days=1),
+                eta=queued_at + timedelta(seconds=300), output=f"https://cdn.door43.org/tx/job/{payload_dict['job_id']}.zip",
+                user_token='0123456789abcdef0123456789abcdef01234567', tx_retry_count=0)
+    return {
+        'realistic': realistic_job_dict,
+        'many options': dict(realistic_job_dict, output_format='pdf',
+                            options={f'option_{n}': f'value {n}' for n in range(200)}),
+        }
+# end of get_job_dicts function
+
+
+def time_median(function, number_of_runs:int) -> float:
+    times = []
+    for _ in range(number_of_runs):
+        start_time = perf_counter()
+        function()
+        times.append(1_000_000 * (perf_counter() - start_time))
+    return median(times)
+# end of time_median function
+
+
+def main() -> None:
+    number_of_runs = int(sys.argv[1]) if len(sys.argv) > 1 else DEFAULT_NUMBER_OF_RUNS
+    queue = Queue('tx_job_handler_priority', connection=FakeStrictRedis())
+
+    print(f"Redis bytes and encode/decode times over {number_of_runs:,} runs:")
+    for job_name, job_dict in get_job_dicts().items():
+        for encoding in JOB_ENCODINGS:
+            tx_enqueue_redis.job_codec = JobCodec(encoding)
+            def encode():
+                return tx_enqueue_redis.create_job(queue, job_dict, **JOB_KWARGS).to_dict()
+            job_hash = encode()
+            def decode():
+                job = Job(JOB_KWARGS['job_id'], connection=queue.connection)
+                job.restore({key.encode('utf-8'): value if isinstance(value, bytes) else str(value).encode('utf-8')
+                                for key, value in job_hash.items()})
+                return decode_job_dict(job.args[0])
+            assert decode() == job_dict
+            hash_bytes = sum(len(key) + len(value if isinstance(value, bytes) else str(value)) for key, value in job_hash.items())
+            print(f"  {job_name:>12} {encoding or 'pickled dict':>12}: {len(job_hash['data']):5,} data bytes, {hash_bytes:5,} job bytes, "
+                  f"encode {time_median(encode, number_of_runs):6.1f}µs, decode {time_median(decode, number_of_runs):6.1f}µs")
+# end of main function
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,251 @@
+# Measures the throughput (and where the time goes) of the Flask app under gunicorn
+#   with a realistic mix of payloads, so that it can be compared between commits
+
+"""
+tX Enqueue load test
+
+Starts:
+    a stub DCS server (which takes --dcs-delay-ms to answer each user token lookup),
+    a stub statsd server (UDP) which collects the stage timers sent by the app,
+    gunicorn (with --workers sync workers, like our Dockerfiles) serving the Flask app
+        with its own in-process fakeredis (unless REDIS_HOSTNAME is set)
+        and a stub CloudWatch log handler (via the same bounded queue as the real one),
+and then POSTs --requests payloads (a seeded random mix of the PAYLOAD_MIX kinds)
+    with --concurrency requests in flight.
+
+Usage (from the repo root):
+    python3 benchmarks/bench_load.py [--requests 2000] [--concurrency 20] [--json-output results.json]
+
+Reports requests/second, the status codes and latency percentiles (in ms) of each kind of payload,
+    and the percentiles of each stage of job_receiver (from the statsd timers).
+The report (and the --json-output) has a fixed layout so that runs can be diffed.
+
+Needs gunicorn, httpx, statsd and fakeredis.
+"""
+
+# Python imports
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from os import environ, getenv
+from pathlib import Path
+from random import Random
+from socketserver import ThreadingUDPServer, BaseRequestHandler
+from time import perf_counter, sleep
+import argparse
+import asyncio
+import json
+import logging
+import subprocess
+import threading
+
+# Library (PyPI) imports
+import httpx
+
+
+DEFAULT_NUMBER_OF_REQUESTS = 2_000
+DEFAULT_CONCURRENCY = 20
+DEFAULT_DCS_DELAY_MS = 20
+DEFAULT_SEED = 43
+PORT = 8013
+BENCHMARKS_DIR = Path(__file__).resolve().parent
+ENQUEUE_DIR = BENCHMARKS_DIR.parent / 'tXenqueue'
+PAYLOAD_FILEPATH = BENCHMARKS_DIR.parent / 'tests' / 'Resources' / 'tx_payload.json'
+PERCENTILES = 50, 90, 99
+
+# Kind of payload: weight
+PAYLOAD_MIX = {'priority': 50, 'branch': 15, 'pdf': 15, 'token': 10, 'invalid': 10}
+
+
+class StubDCSHandler(BaseHTTPRequestHandler):
+    delay_seconds = DEFAULT_DCS_DELAY_MS / 1000
+
+    def do_GET(self) -> None:
+        sleep(self.delay_seconds)
+        body = json.dumps({'login': 'load_test_user'}).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args) -> None:
+        pass
+# end of StubDCSHandler class
+
+
+class StubStatsdHandler(BaseRequestHandler):
+    """
+    Collects statsd timers (name:value|ms) into the server's timings dict.
+    """
+    def handle(self) -> None:
+        for line in self.request[0].decode('utf-8').splitlines():
+            name, _, value_and_type = line.partition(':')
+            value, _, stat_type = value_and_type.partition('|')
+            if stat_type == 'ms':
+                with self.server.lock: # type: ignore[attr-defined]
+                    self.server.timings.setdefault(name, []).append(float(value)) # type: ignore[attr-defined]
+# end of StubStatsdHandler class
+
+
+def create_app_for_load_test():
+    """
+    Called (as a gunicorn app factory) in each worker.
+    """
+    from statsd import StatsClient
+    from tx_enqueue_backends import EnqueueBackends
+    from tx_enqueue_logging import AsyncLogHandler
+    from tx_enqueue_main import create_app, create_backends, our_queue_names, our_lane_queue_names, \
+                                    enqueue_job_stats_prefix, logger
+    logger.addHandler(AsyncLogHandler(logging.NullHandler)) # Our stub CloudWatch
+    stats_client = StatsClient(host='127.0.0.1', port=int(environ['LOAD_TEST_STATSD_PORT']))
+    if getenv('REDIS_HOSTNAME'):
+        backends = create_backends()
+        backends._stats_client = stats_client
+    else:
+        from fakeredis import FakeStrictRedis
+        backends = EnqueueBackends('fakeredis', our_queue_names, enqueue_job_stats_prefix, logger,
+                                    redis_connection=FakeStrictRedis(), stats_client=stats_client,
+                                    lane_queue_names=our_lane_queue_names)
+    return create_app(backends)
+# end of create_app_for_load_test function
+
+
+def make_payloads(number_of_requests:int, seed:int, dcs_domain:str):
+    """
+    Returns a list of (kind, payload) with each kind chosen (reproducibly) using PAYLOAD_MIX.
+    """
+    with open(PAYLOAD_FILEPATH, 'rt') as payload_file:
+        base_payload = json.load(payload_file)
+    random = Random(seed)
+    kinds = random.choices(list(PAYLOAD_MIX), weights=list(PAYLOAD_MIX.values()), k=number_of_requests)
+    payloads = []
+    for n, kind in enumerate(kinds):
+        # NOTE: Each payload is different so that none are de-duplicated
+        payload = dict(base_payload, job_id=f'load_test_{seed}_{n}', commit_hash=f'{seed:04d}{n:06d}',
+                        dcs_domain=dcs_domain)
+        if kind == 'branch':
+            payload.update(repo_ref=f'branch_{n}', identifier=f'unfoldingWord/en_obs/branch_{n}')
+        elif kind == 'pdf':
+            payload.update(output_format='pdf', options={'page_size': 'A4', 'toc_levels': 2})
+        elif kind == 'token':
+            payload['user_token'] = f'{seed:04d}{n:036d}' # A new token so that the DCS user cache misses
+        elif kind == 'invalid':
+            del payload['repo_owner']
+        payloads.append((kind, payload))
+    return payloads
+# end of make_payloads function
+
+
+def get_percentiles(values) -> dict:
+    values = sorted(values)
+    if not values:
+        return {f'p{percentile}': None for percentile in PERCENTILES}
+    return {f'p{percentile}': round(values[int(percentile / 100 * (len(values) - 1))], 3) for percentile in PERCENTILES}
+# end of get_percentiles function
+
+
+async def post_payloads(payloads, concurrency:int) -> dict:
+    results = [] # (kind, status code, latency ms)
+    semaphore = asyncio.Semaphore(concurrency)
+    limits = httpx.Limits(max_connections=concurrency)
+    async with httpx.AsyncClient(base_url=f'http://127.0.0.1:{PORT}', limits=limits, timeout=300) as client:
+        async def post_one(kind, payload) -> None:
+            async with semaphore:
+                start_time = perf_counter()
+                response = await client.post('/', json=payload, headers={'Host': 'git.door43.org'})
+                results.append((kind, response.status_code, 1000 * (perf_counter() - start_time)))
+        start_time = perf_counter()
+        await asyncio.gather(*(post_one(kind, payload) for kind, payload in payloads))
+        elapsed_seconds = perf_counter() - start_time
+
+    kinds_dict = {}
+    for kind in PAYLOAD_MIX:
+        kind_results = [result for result in results if result[0] == kind]
+        status_codes:dict = {}
+        for _kind, status_code, _latency in kind_results:
+            status_codes[str(status_code)] = status_codes.get(str(status_code), 0) + 1
+        kinds_dict[kind] = dict(requests=len(kind_results), status_codes=dict(sorted(status_codes.items())),
+                                **get_percentiles([latency for _kind, _status_code, latency in kind_results]))
+    return {'requests_per_second': round(len(payloads) / elapsed_seconds, 1),
+            'latency_ms': get_percentiles([latency for _kind, _status_code, latency in results]),
+            'kinds': kinds_dict}
+# end of post_payloads function
+
+
+def start_in_thread(server) -> None:
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Load test the tX Enqueue Flask app")
+    parser.add_argument('--requests', type=int, default=DEFAULT_NUMBER_OF_REQUESTS)
+    parser.add_argument('--concurrency', type=int, default=DEFAULT_CONCURRENCY)
+    parser.add_argument('--workers', type=int, default=1, help="Number of gunicorn sync workers")
+    parser.add_argument('--dcs-delay-ms', type=float, default=DEFAULT_DCS_DELAY_MS)
+    parser.add_argument('--seed', type=int, default=DEFAULT_SEED)
+    parser.add_argument('--json-output', help="Also write the results to this JSON file")
+    args = parser.parse_args()
+
+    StubDCSHandler.delay_seconds = args.dcs_delay_ms / 1000
+    dcs_server = ThreadingHTTPServer(('127.0.0.1', 0), StubDCSHandler)
+    start_in_thread(dcs_server)
+    statsd_server = ThreadingUDPServer(('127.0.0.1', 0), StubStatsdHandler)
+    statsd_server.timings, statsd_server.lock = {}, threading.Lock() # type: ignore[attr-defined]
+    start_in_thread(statsd_server)
+
+    # NOTE: No workers take our jobs so turn off the queue depth (and per-submitter) limits
+    env = dict(environ, PYTHONPATH=f'{ENQUEUE_DIR}:{BENCHMARKS_DIR}',
+                LOAD_TEST_STATSD_PORT=str(statsd_server.server_address[1]),
+                DCS_URL=f'http://127.0.0.1:{dcs_server.server_address[1]}',
+                ADMISSION_RATE_PER_MINUTE='0', MAX_QUEUE_DEPTH='1000000000', MAX_QUEUE_DEPTH_WITHOUT_WORKERS='1000000000')
+    command_args = ['gunicorn', '--bind', f'127.0.0.1:{PORT}', '--workers', str(args.workers),
+                    'bench_load:create_app_for_load_test()']
+    server_process = subprocess.Popen(command_args, cwd=ENQUEUE_DIR, env=env,
+                                        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        for _ in range(200):
+            try:
+                if httpx.get(f'http://127.0.0.1:{PORT}/ready/').status_code == 200:
+                    break
+            except httpx.HTTPError:
+                pass
+            sleep(0.1)
+        else:
+            raise RuntimeError(f"gunicorn didn't become ready on port {PORT}")
+        payloads = make_payloads(args.requests, args.seed, f'http://127.0.0.1:{dcs_server.server_address[1]}')
+        results = asyncio.run(post_payloads(payloads, args.concurrency))
+    finally:
+        server_process.terminate()
+        server_process.wait()
+    sleep(0.2) # Let the last statsd packets arrive
+    dcs_server.shutdown()
+    statsd_server.shutdown()
+
+    stage_timings = {name.rsplit('.', 1)[-1]: timings for name, timings in sorted(statsd_server.timings.items()) # type: ignore[attr-defined]
+                        if '.job_receiver.stages.' in name}
+    results = dict(settings={'requests': args.requests, 'concurrency': args.concurrency, 'workers': args.workers,
+                                'dcs_delay_ms': args.dcs_delay_ms, 'seed': args.seed,
+                                'redis': 'REDIS_HOSTNAME' if getenv('REDIS_HOSTNAME') else 'fakeredis'},
+                    **results,
+                    stages_ms={stage_name: dict(count=len(timings), **get_percentiles(timings))
+                                for stage_name, timings in stage_timings.items()})
+
+    settings = results['settings']
+    print(f"Load test: {settings['requests']} POSTs, {settings['concurrency']} concurrent, {settings['workers']} worker(s), "
+          f"{settings['dcs_delay_ms']}ms DCS lookups, {settings['redis']}, seed {settings['seed']}")
+    print(f"  {'all':>10}: {results['requests_per_second']:8.1f} requests/s  "
+          + '  '.join(f"{name} {value:8.2f}ms" for name, value in results['latency_ms'].items()))
+    for kind, kind_dict in results['kinds'].items():
+        print(f"  {kind:>10}: {kind_dict['requests']:6} requests {json.dumps(kind_dict['status_codes']):>24}  "
+              + '  '.join(f"p{percentile} {kind_dict[f'p{percentile}'] or 0:8.2f}ms" for percentile in PERCENTILES))
+    print("  job_receiver stages:")
+    for stage_name, stage_dict in results['stages_ms'].items():
+        print(f"  {stage_name:>10}: {stage_dict['count']:6} timings{'':26}"
+              + '  '.join(f"p{percentile} {stage_dict[f'p{percentile}']:8.3f}ms" for percentile in PERCENTILES))
+    if args.json_output:
+        with open(args.json_output, 'wt') as json_file:
+            json.dump(results, json_file, indent=2, sort_keys=True)
+# end of main function
+
+
+if __name__ == '__main__':
+    main()
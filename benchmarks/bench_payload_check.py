@@ -0,0 +1,96 @@
+# Measures the cost of parsing and checking realistic and adversarial payloads
+#   (so that the validation cost of our internet-facing endpoint stays bounded)
+
+"""
+tX Enqueue payload check micro-benchmark
+
+Usage (from the repo root):
+    PYTHONPATH="tXenqueue/" python3 benchmarks/bench_payload_check.py [number_of_runs]
+
+Reports (in microseconds) the median time to json.loads() and check_tx_payload()
+    each payload (all of which fit within MAX_PAYLOAD_BYTES).
+"""
+
+# Python imports
+from statistics import median
+from time import perf_counter
+import json
+import logging
+import sys
+
+# Local imports
+from check_posted_tx_payload import MAX_PAYLOAD_BYTES, check_tx_payload
+
+
+DEFAULT_NUMBER_OF_RUNS = 2_000
+DOOR43_HEADERS = {'Host': 'git.door43.org'}
+
+
+def fill(make_item, base_payload) -> dict:
+    """
+    Returns base_payload with as many items from make_item(n) added as fit within MAX_PAYLOAD_BYTES.
+    """
+    payload, n = dict(base_payload), 0
+    while True:
+        key, value = make_item(n)
+        payload[key] = value
+        if len(json.dumps(payload)) > MAX_PAYLOAD_BYTES:
+            del payload[key]
+            return payload
+        n += 1
+# end of fill function
+
+
+def get_payload_bodies():
+    with open('tests/Resources/tx_payload.json', 'rt') as payload_file:
+        realistic_payload = json.load(payload_file)
+    with_options = dict(realistic_payload, output_format='pdf',
+                        options={'columns': 2, 'css': 'x', 'language': 'en', 'page_size': 'A4', 'toc_levels': 2})
+    many_options = dict(realistic_payload, options=fill(lambda n: (f'option_{n}', n), {}))
+    # Keep a little room for the rest of the payload
+    many_options['options'] = dict(list(many_options['options'].items())[:-len(realistic_payload)*2])
+    return {
+        'realistic': json.dumps(realistic_payload),
+        'realistic (with options)': json.dumps(with_options),
+        'many unknown fields': json.dumps(fill(lambda n: (f'field_{n}', n), realistic_payload)),
+        'many unknown options': json.dumps(many_options),
+        'long string values': json.dumps(dict(realistic_payload, resource_type='x'*20_000, identifier='y'*40_000)),
+        'wrong value types': json.dumps(dict(realistic_payload, resource_type=list(range(4_000)),
+                                        user_token={str(n): n for n in range(2_000)}, options=[0]*4_000)),
+        'missing fields': json.dumps({'something': 'anything'}),
+        'deeply nested': '[' * (MAX_PAYLOAD_BYTES//2) + ']' * (MAX_PAYLOAD_BYTES//2),
+        }
+# end of get_payload_bodies function
+
+
+def parse_and_check(body:str, logger) -> bool:
+    try:
+        payload_json = json.loads(body)
+    except (ValueError, RecursionError):
+        return False
+    return check_tx_payload(payload_json, DOOR43_HEADERS, logger)[0]
+# end of parse_and_check function
+
+
+def main() -> None:
+    number_of_runs = int(sys.argv[1]) if len(sys.argv) > 1 else DEFAULT_NUMBER_OF_RUNS
+    logger = logging.getLogger('bench_payload_check')
+    logger.addHandler(logging.NullHandler()) # Measure the log formatting but not the output
+    logger.propagate = False
+    logger.setLevel(logging.INFO)
+
+    print(f"Parse and check times over {number_of_runs:,} runs (max payload is {MAX_PAYLOAD_BYTES:,} bytes):")
+    for payload_name, body in get_payload_bodies().items():
+        times = []
+        for _ in range(number_of_runs):
+            start_time = perf_counter()
+            result = parse_and_check(body, logger)
+            times.append(1_000_000 * (perf_counter() - start_time))
+        times.sort()
+        print(f"  {payload_name:>25} ({len(body):6,} bytes, {'valid' if result else 'invalid'}): "
+              f"median {median(times):8.1f}µs, p99 {times[int(0.99*(len(times)-1))]:8.1f}µs")
+# end of main function
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,65 @@
+# Measures how long tx_enqueue_main takes to import and how long a new app takes to boot
+#   (so that gunicorn worker startup time can be compared between commits)
+
+"""
+tX Enqueue startup benchmark
+
+Each run uses a fresh Python interpreter (like a new gunicorn worker).
+
+Usage (from the repo root):
+    PYTHONPATH="tXenqueue/" python3 benchmarks/bench_startup.py [number_of_runs]
+
+Reports (in milliseconds):
+    import: time to import tx_enqueue_main (which also creates the module-level app)
+    create_app: time to create another app
+    first_ready: time for the first GET of the readiness endpoint
+        (only meaningful if REDIS_HOSTNAME points to a running Redis instance)
+"""
+
+# Python imports
+from statistics import median
+import json
+import subprocess
+import sys
+
+
+DEFAULT_NUMBER_OF_RUNS = 10
+
+RUN_ONCE_CODE = '''
+import json, sys, time
+start_time = time.perf_counter()
+import tx_enqueue_main
+imported_time = time.perf_counter()
+flask_app = tx_enqueue_main.create_app()
+created_time = time.perf_counter()
+response = flask_app.test_client().get('/' + tx_enqueue_main.READY_URL_SEGMENT)
+ready_time = time.perf_counter()
+print('BENCHMARK_RESULT', json.dumps({'import': 1000 * (imported_time - start_time),
+                'create_app': 1000 * (created_time - imported_time),
+                'first_ready': 1000 * (ready_time - created_time),
+                'ready_status': response.status_code}), file=sys.stderr)
+'''
+
+
+def run_once() -> dict:
+    completed_process = subprocess.run([sys.executable, '-c', RUN_ONCE_CODE],
+                                        capture_output=True, text=True, check=True)
+    # NOTE: Our logger writes to stdout so we write our result to stderr
+    for line in completed_process.stderr.splitlines():
+        if line.startswith('BENCHMARK_RESULT '):
+            return json.loads(line[len('BENCHMARK_RESULT '):])
+    raise RuntimeError(f"No benchmark result in {completed_process.stderr!r}")
+# end of run_once function
+
+
+def main() -> None:
+    number_of_runs = int(sys.argv[1]) if len(sys.argv) > 1 else DEFAULT_NUMBER_OF_RUNS
+    results = [run_once() for _ in range(number_of_runs)]
+    print(f"tx_enqueue_main startup over {number_of_runs} runs (ready status {results[-1]['ready_status']}):")
+    for measure_name in ('import', 'create_app', 'first_ready'):
+        times = sorted(result[measure_name] for result in results)
+        print(f"  {measure_name:<12} median {median(times):9.2f} ms  min {times[0]:9.2f} ms  max {times[-1]:9.2f} ms")
+# end of main function
+
+if __name__ == '__main__':
+    main()
@@ -1,9 +1,13 @@
 # This code adapted by RJH Sept 2018 from door43-enqueue-job
 #       and from tx-manager/client_webhook/ClientWebhookHandler
 
-from typing import Dict, Tuple, Any
+from typing import Any, Callable, Dict, FrozenSet, List, Optional, Tuple
 from os import getenv
 
+from tx_enqueue_dcs import get_dcs_user
+from tx_enqueue_timing import timed_stage
+from tx_enqueue_health import NAGIOS_PING_MESSAGE
+
 
 # NOTE: The following are currently only used to log warnings -- they are not strictly enforced here
 COMPULSORY_FIELDNAMES = 'job_id', \
@@ -28,17 +32,127 @@ KNOWN_RESOURCE_SUBJECTS = ('Generic_Markdown',
 KNOWN_INPUT_FORMATS = 'md', 'usfm', 'txt', 'tsv',
 KNOWN_OUTPUT_FORMATS = 'docx', 'html', 'pdf',
 
-
+DCS_USER_TOKEN_LENGTH = 40
+MAX_PAYLOAD_BYTES = 64 * 1024 # Larger POSTs are rejected before the JSON is parsed
+MAX_PAYLOAD_WARNINGS = 10 # Further warnings are just counted
+MAX_REPORTED_NAME_LENGTH = 40 # Unexpected fieldnames are truncated to this in warnings
+MAX_REPORTED_TOKEN_LENGTH = 6 # Only the start of (unknown) user tokens is reported
 # Get the redis URL from the environment, otherwise use a local test instance
 redis_hostname = getenv('REDIS_HOSTNAME', 'redis')
 # Use this to detect test mode (coz logs will go into a separate AWS CloudWatch stream)
 debug_mode_flag = getenv('DEBUG_MODE', False)
 
 
-def check_posted_tx_payload(request, logger) -> Tuple[bool, Dict[str,Any]]:
+def shorten(some_value:Any, max_length:int=MAX_REPORTED_NAME_LENGTH) -> str:
+    """
+    Returns the value as a string, truncated (for safely including in error and warning messages).
+    """
+    some_string = some_value if isinstance(some_value, str) else repr(some_value)
+    return some_string if len(some_string) <= max_length else f'{some_string[:max_length]}…'
+# end of shorten function
+
+
+class TxPayloadValidator:
+    """
+    Checks a tX payload dict in a single pass over its fields
+        (using frozensets compiled once from the above field lists).
+
+    Collects lists of error and warning messages rather than logging each one.
+    """
+
+    def __init__(self, compulsory_fieldnames:Tuple[str, ...]=COMPULSORY_FIELDNAMES,
+                        optional_fieldnames:Tuple[str, ...]=OPTIONAL_FIELDNAMES,
+                        option_subfieldnames:Tuple[str, ...]=OPTION_SUBFIELDNAMES,
+                        max_warnings:int=MAX_PAYLOAD_WARNINGS) -> None:
+        self.compulsory_fieldnames = compulsory_fieldnames
+        self.compulsory_fieldname_set = frozenset(compulsory_fieldnames)
+        self.optional_fieldname_set = frozenset(optional_fieldnames)
+        self.option_subfieldname_set = frozenset(option_subfieldnames)
+        # Fieldname: (known values, description) -- unknown values only give warnings
+        self.known_values:Dict[str, Tuple[FrozenSet[str], str]] = {
+                        'resource_type': (frozenset(KNOWN_RESOURCE_SUBJECTS), 'resource type'),
+                        'input_format': (frozenset(KNOWN_INPUT_FORMATS), 'input format'),
+                        'output_format': (frozenset(KNOWN_OUTPUT_FORMATS), 'output format'),
+                        }
+        self.max_warnings = max_warnings
+
+    def validate(self, payload_json:Dict[str,Any]) -> Tuple[List[str], List[str]]:
+        """
+        Returns a 2-tuple:
+            a list of error messages (the payload is invalid if there are any)
+            a list of (at most max_warnings+1) warning messages
+        """
+        compulsory_errors:Dict[str,str] = {}
+        other_errors:List[str] = []
+        warnings:List[str] = []
+        num_compulsory_fields = num_warnings = 0
+        for fieldname, value in payload_json.items():
+            if fieldname in self.compulsory_fieldname_set:
+                num_compulsory_fields += 1
+                if not value:
+                    compulsory_errors[fieldname] = f'Empty {fieldname} field'
+                elif not isinstance(value, str):
+                    compulsory_errors[fieldname] = f'Invalid {fieldname} field (expected a string)'
+                elif fieldname in self.known_values:
+                    known_values, description = self.known_values[fieldname]
+                    if value not in known_values:
+                        num_warnings += 1
+                        if num_warnings <= self.max_warnings:
+                            warnings.append(f"Unknown '{shorten(value)}' {description}")
+            elif fieldname in self.optional_fieldname_set:
+                if fieldname == 'user_token':
+                    if not isinstance(value, str) or len(value) != DCS_USER_TOKEN_LENGTH:
+                        other_errors.append(f"Invalid DCS user token '{shorten(value)}'")
+                elif fieldname == 'options':
+                    if not isinstance(value, dict):
+                        other_errors.append('Invalid options field (expected a JSON object)')
+                        continue
+                    for some_option_fieldname in value:
+                        if some_option_fieldname not in self.option_subfieldname_set:
+                            num_warnings += 1
+                            if num_warnings <= self.max_warnings:
+                                warnings.append(f'Unexpected {shorten(some_option_fieldname)} option field')
+            else: # Unknown fieldnames just make interface debugging easier
+                num_warnings += 1
+                if num_warnings <= self.max_warnings:
+                    warnings.append(f'Unexpected {shorten(fieldname)} field')
+
+        errors = []
+        if compulsory_errors or num_compulsory_fields < len(self.compulsory_fieldnames):
+            # Report these in the order of our list
+            for compulsory_fieldname in self.compulsory_fieldnames:
+                if compulsory_fieldname not in payload_json:
+                    errors.append(f'Missing {compulsory_fieldname}')
+                elif compulsory_fieldname in compulsory_errors:
+                    errors.append(compulsory_errors[compulsory_fieldname])
+        errors.extend(other_errors)
+        if num_warnings > self.max_warnings:
+            warnings.append(f'(and {num_warnings-self.max_warnings:,} more warnings)')
+        return errors, warnings
+# end of TxPayloadValidator class
+
+
+tx_payload_validator = TxPayloadValidator()
+
+
+def check_payload_size(content_length:Optional[int], max_bytes:int=MAX_PAYLOAD_BYTES) -> Optional[Dict[str,Any]]:
+    """
+    Checks the declared length of a POST body (before it's read and parsed).
+
+    Returns an error dict if it's too large, else None.
+    """
+    if content_length is not None and content_length > max_bytes:
+        return {'error': f'Payload too large ({content_length:,} bytes) — maximum is {max_bytes:,} bytes'}
+    return None
+# end of check_payload_size function
+
+
+def check_posted_tx_payload(request, logger,
+                get_user:Callable[[str],Optional[Dict[str,Any]]]=get_dcs_user) -> Tuple[bool, Dict[str,Any]]:
     """
     Accepts POSTed conversion request.
         Parameter is a rq request object
+        get_user looks up DCS user tokens (see check_tx_payload)
 
     Returns a 2-tuple:
         True or False if payload checks out
@@ -52,68 +166,75 @@ def check_posted_tx_payload(request, logger) -> Tuple[bool, Dict[str,Any]]:
         return False, {'error': 'No payload found. You must submit a POST request'}
 
     # Get the json payload and check it
-    payload_json = request.get_json()
-    logger.info(f"tX payload is {payload_json}")
-
-    # Check for a test ping from Nagios
+    try:
+        with timed_stage('parse'):
+            payload_json = request.get_json()
+    except RecursionError:
+        logger.error("tX payload is nested too deeply")
+        return False, {'error': 'Payload is nested too deeply'}
+    logger.info("tX payload is %s", payload_json, extra={'payload_dump': True}) # Sampled and truncated by PayloadDumpFilter
+
+    # Check for a test ping from Nagios (NOTE: Those with an empty body are already answered by job_receiver)
     if 'User-Agent' in request.headers and 'nagios-plugins' in request.headers['User-Agent'] \
     and not payload_json:
-        return False, {'error': "This appears to be a Nagios ping for service availability testing."}
-
-    # Warn on existence of unknown fieldnames (just makes interface debugging easier)
-    for some_fieldname in payload_json:
-        if some_fieldname not in ALL_FIELDNAMES:
-            logger.warning(f'Unexpected {some_fieldname} field in tX payload')
-
-    # Issue errors for non-existence of compulsory fieldnames and abort
-    error_list = []
-    for compulsory_fieldname in COMPULSORY_FIELDNAMES:
-        if compulsory_fieldname not in payload_json:
-            logger.error(f'Missing {compulsory_fieldname} in tX payload')
-            error_list.append(f'Missing {compulsory_fieldname}')
-        elif not payload_json[compulsory_fieldname]:
-            logger.error(f'Empty {compulsory_fieldname} field in tX payload')
-            error_list.append(f'Empty {compulsory_fieldname} field')
-    if error_list:
-        return False, {'error': ', '.join(error_list)}
+        return False, {'error': NAGIOS_PING_MESSAGE}
+
+    return check_tx_payload(payload_json, request.headers, logger, get_user)
+# end of check_posted_tx_payload
+
 
-    # NOTE: We only treat unknown values as warnings -- the job handler has the authoritative list
-    if payload_json['resource_type'] not in KNOWN_RESOURCE_SUBJECTS:
-        logger.warning(f"Unknown '{payload_json['resource_type']}' resource type in tX payload")
-    if payload_json['input_format'] not in KNOWN_INPUT_FORMATS:
-        logger.warning(f"Unknown '{payload_json['input_format']}' input format in tX payload")
-    if payload_json['output_format'] not in KNOWN_OUTPUT_FORMATS:
-        logger.warning(f"Unknown '{payload_json['output_format']}' output format in tX payload")
+def check_tx_payload(payload_json, request_headers, logger,
+                get_user:Callable[[str],Optional[Dict[str,Any]]]=get_dcs_user) -> Tuple[bool, Dict[str,Any]]:
+    """
+    Checks an already-parsed conversion request payload (dict).
+        request_headers are those of the POST that delivered the payload
+            (used to check the source of requests without a user token).
+        get_user returns the DCS user dict for a user token
+            (or an empty dict if unknown, or None if it couldn't be checked).
 
-    if 'options' in payload_json:
-        for some_option_fieldname in payload_json['options']:
-            if some_option_fieldname not in OPTION_SUBFIELDNAMES:
-                logger.warning(f'Unexpected {some_option_fieldname} option field in tX payload')
+    Used directly for each item of a batch POST.
+
+    Returns a 2-tuple:
+        True or False if payload checks out
+        The payload that was checked or error dict
+    """
+    if not isinstance(payload_json, dict):
+        logger.error(f"Expected a JSON object but got {type(payload_json).__name__}")
+        return False, {'error': 'Payload must be a JSON object'}
+
+    with timed_stage('validate'):
+        error_list, warning_list = tx_payload_validator.validate(payload_json)
+    if warning_list:
+        logger.warning(f"tX payload warnings: {'; '.join(warning_list)}")
+    if error_list:
+        logger.error(f"Invalid tX payload: {'; '.join(error_list)}")
+        return False, {'error': ', '.join(error_list)}
 
     if 'user_token' in payload_json: # now optional
-        # Check the DCS user token
-        if len(payload_json['user_token']) != 40:
-            logger.error(f"Invalid DCS user token '{payload_json['user_token']}' in tX payload")
-            return False, {'error': f"Invalid DCS user token '{payload_json['user_token']}'"}
-        user = get_dcs_user(payload_json['user_token'])
-        logger.info(f"Found DCS user: {user}")
+        # Check the DCS user token (the validator has already checked its length)
+        with timed_stage('dcs_lookup'):
+            user = get_user(payload_json['user_token'])
+        if not isinstance(user, dict):
+            return False, {'error': "Unable to check DCS user token"}
+        logger.info(f"Found DCS user: {user.get('login', user)}")
         if not user:
-            logger.error(f"Unknown DCS user token '{payload_json['user_token']}' in tX payload")
-            return False, {'error': f"Unknown DCS user token '{payload_json['user_token']}'"}
+            masked_token = shorten(payload_json['user_token'], MAX_REPORTED_TOKEN_LENGTH)
+            logger.error(f"Unknown DCS user token '{masked_token}' in tX payload")
+            return False, {'error': f"Unknown DCS user token '{masked_token}'"}
     else: # no Gitea user token
         # Check the source of the request -- must be door43.org
         # print("Request headers:", request.headers)
-        # if 'Host' in request.headers \
-        if request.headers['Host'] == 'door43.org' \
-        or request.headers['Host'].endswith('.door43.org'):
-            logger.info(f"Accepted request from {request.headers['Host']}")
+        request_host = request_headers.get('Host', '')
+        if request_host == 'door43.org' \
+        or request_host.endswith('.door43.org'):
+            logger.info(f"Accepted request from {request_host}")
         elif debug_mode_flag \
-        and request.headers['Host'] in ['127.0.0.1:80', 'tx-enqueue-job_proxy_1:80', 'txproxy:80']:
-            logger.info(f"Accepted DEBUG request from {request.headers['Host']}")
+        and request_host in ['127.0.0.1:80', 'tx-enqueue-job_proxy_1:80', 'txproxy:80']:
+            logger.info(f"Accepted DEBUG request from {request_host}")
         else:
-            logger.error(f"No Gitea user token; rejected request from {request.headers['Host']}")
+            logger.error(f"No Gitea user token; rejected request from {request_host!r}")
             return False, {'error': f"Missing Gitea user token in '{payload_json}'"}
 
     logger.info(f"tX payload for {payload_json['input_format']}➞{payload_json['output_format']} seems ok")
     return True, payload_json
-# end of check_posted_tx_payload
+# end of check_tx_payload
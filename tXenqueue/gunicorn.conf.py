@@ -0,0 +1,19 @@
+# Added so that our background threads are started in each gunicorn worker
+#   (rather than only when the first request happens to need Redis)
+
+"""
+gunicorn settings (read from the current folder by gunicorn)
+
+NOTE: create_app() doesn't start the backends when loaded by gunicorn
+        because with --preload it's loaded in the master (and threads don't survive the fork).
+"""
+
+
+def post_worker_init(worker) -> None:
+    """
+    Called by gunicorn (in each worker) once the worker has loaded our app.
+    """
+    backends = getattr(worker.wsgi, 'extensions', {}).get('tx_enqueue_backends')
+    if backends is not None:
+        backends.start()
+# end of post_worker_init function
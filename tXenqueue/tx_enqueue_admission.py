@@ -0,0 +1,172 @@
+# Added so that one noisy submitter (or a stalled job handler) can't flood our queues
+
+"""
+tX Enqueue admission control
+
+Before a new job is queued, we check:
+    the depth of its queue (lane) using the latest sample from tx_enqueue_metrics
+        (with a much lower limit if no job handler workers are running),
+    and the token buckets of its submitter (the repo_owner, and the user_token if any).
+
+Token buckets are kept in Redis (so they're shared between processes)
+    and are checked and updated atomically by a Lua script.
+    A job is only admitted if all of its submitter buckets have a token.
+
+Rejected jobs get a 429 response with a Retry-After header,
+    and are counted (shed) by reason.
+"""
+
+# Python imports
+from typing import Any, Callable, Dict, List, Optional, Tuple
+from hashlib import sha256
+from math import ceil
+from time import time
+import threading
+
+
+# NOTE: The per-submitter limits are off by default as door43 re-renders (e.g., of a whole organisation)
+#   come from one repo_owner (without a user_token) in bulk
+ADMISSION_RATE_PER_MINUTE = 0.0 # Jobs per submitter (after the burst is used up) -- zero turns it off
+ADMISSION_BURST = 60 # Jobs that a submitter can POST at once
+MAX_QUEUE_DEPTH = 1_000 # Jobs waiting in any one of our queues
+MAX_QUEUE_DEPTH_WITHOUT_WORKERS = 100 # Jobs waiting in a queue which has no workers
+QUEUE_FULL_RETRY_AFTER_SECONDS = 60
+ADMISSION_KEY_PREFIX = 'tx:admission:'
+
+RATE_LIMITED, QUEUE_FULL = 'rate_limited', 'queue_full'
+
+# KEYS are the bucket keys, ARGV are capacity, rate (tokens per second), now (seconds), and cost
+# Returns {1 if admitted else 0, seconds until there'd be enough tokens (as a string)}
+TOKEN_BUCKET_SCRIPT = """
+local capacity, rate, now, cost = tonumber(ARGV[1]), tonumber(ARGV[2]), tonumber(ARGV[3]), tonumber(ARGV[4])
+local all_tokens, retry_after = {}, 0
+for i, key in ipairs(KEYS) do
+    local bucket = redis.call('HMGET', key, 'tokens', 'updated_at')
+    local tokens = tonumber(bucket[1]) or capacity
+    local updated_at = tonumber(bucket[2]) or now
+    tokens = math.min(capacity, tokens + math.max(0, now - updated_at) * rate)
+    if tokens < cost then
+        retry_after = math.max(retry_after, (cost - tokens) / rate)
+    end
+    all_tokens[i] = tokens
+end
+local admitted = retry_after == 0 and 1 or 0
+for i, key in ipairs(KEYS) do
+    local tokens = all_tokens[i]
+    if admitted == 1 then tokens = tokens - cost end
+    redis.call('HSET', key, 'tokens', tokens, 'updated_at', now)
+    redis.call('EXPIRE', key, math.ceil(capacity / rate) + 1)
+end
+return {admitted, tostring(retry_after)}
+"""
+
+
+def get_submitter_keys(payload_dict:Dict[str,Any]) -> List[str]:
+    """
+    Returns the Redis keys of the token buckets for the submitter(s) of a checked payload.
+    """
+    submitter_keys = [f"{ADMISSION_KEY_PREFIX}owner:{payload_dict['repo_owner'].lower()}"]
+    if 'user_token' in payload_dict: # NOTE: Tokens are hashed before being used as keys
+        submitter_keys.append(f"{ADMISSION_KEY_PREFIX}token:{sha256(payload_dict['user_token'].encode('utf-8')).hexdigest()}")
+    return submitter_keys
+# end of get_submitter_keys function
+
+
+class AdmissionController:
+    """
+    Decides whether new jobs can be queued (see above).
+
+    shed_counts are the numbers of jobs rejected (by reason) by this process.
+    """
+
+    def __init__(self, rate_per_minute:float=ADMISSION_RATE_PER_MINUTE, burst:int=ADMISSION_BURST,
+                        max_queue_depth:int=MAX_QUEUE_DEPTH,
+                        max_queue_depth_without_workers:int=MAX_QUEUE_DEPTH_WITHOUT_WORKERS) -> None:
+        self.rate_per_minute = rate_per_minute
+        self.burst = burst
+        self.max_queue_depth = max_queue_depth
+        self.max_queue_depth_without_workers = max_queue_depth_without_workers
+        self.shed_counts = {RATE_LIMITED:0, QUEUE_FULL:0}
+        self._lock = threading.Lock()
+
+    def check_queue_depth(self, queue_metrics:Dict[str,Any], num_jobs:int=1) -> Optional[Dict[str,Any]]:
+        """
+        Checks the latest sampled metrics (from QueueMetricsSampler.get_metrics) for a queue.
+
+        Returns a rejection dict if the queue is too deep, else None.
+        """
+        queue_length = queue_metrics.get('queue_length')
+        if queue_length is None: # No sample yet
+            return None
+        max_queue_depth = self.max_queue_depth_without_workers if queue_metrics.get('worker_count') == 0 \
+                            else self.max_queue_depth
+        if queue_length + num_jobs <= max_queue_depth:
+            return None
+        return self.reject(QUEUE_FULL, f"Queue is full ({queue_length:,} jobs waiting)", QUEUE_FULL_RETRY_AFTER_SECONDS)
+
+    def check_queue_depths(self, queue_names:List[str], get_metrics:Callable[[str], Dict[str,Any]]) \
+                                        -> List[Optional[Dict[str,Any]]]:
+        """
+        Checks the queue depth for each of several new jobs (e.g., from a batch)
+            allowing for the earlier (admitted) jobs going into the same queue.
+
+        Returns a rejection dict (or None if admitted) for each.
+        """
+        num_admitted:Dict[str,int] = {}
+        rejection_dicts = []
+        for queue_name in queue_names:
+            rejection_dict = self.check_queue_depth(get_metrics(queue_name), num_admitted.get(queue_name, 0) + 1)
+            if rejection_dict is None:
+                num_admitted[queue_name] = num_admitted.get(queue_name, 0) + 1
+            rejection_dicts.append(rejection_dict)
+        return rejection_dicts
+
+    def reject(self, reason:str, message:str, retry_after:float) -> Dict[str,Any]:
+        """
+        Counts a rejected job and returns its rejection dict.
+        """
+        with self._lock:
+            self.shed_counts[reason] += 1
+        return {'error': message, 'status': 'rejected', 'reason': reason, 'retry_after': max(1, ceil(retry_after))}
+
+    def _get_script_args(self, cost:int) -> List[Any]:
+        return [self.burst, self.rate_per_minute / 60, time(), cost]
+
+    def _get_bucket_result(self, submitter_keys:List[str], script_result) -> Optional[Dict[str,Any]]:
+        admitted, retry_after = script_result
+        if admitted:
+            return None
+        return self.reject(RATE_LIMITED, f"Too many jobs from {submitter_keys[0].rsplit(':', 1)[-1]}", float(retry_after))
+
+    def take_tokens(self, connection, submitters:List[Tuple[List[str], int]]) -> List[Optional[Dict[str,Any]]]:
+        """
+        Tries to take the given number of tokens from each list of submitter buckets
+            (all in one pipelined round trip).
+
+        Returns a rejection dict (or None if admitted) for each.
+        """
+        if self.rate_per_minute <= 0 or not submitters:
+            return [None for _submitter in submitters]
+        script = connection.register_script(TOKEN_BUCKET_SCRIPT)
+        with connection.pipeline(transaction=False) as pipeline:
+            for submitter_keys, cost in submitters:
+                script(keys=submitter_keys, args=self._get_script_args(cost), client=pipeline)
+            script_results = pipeline.execute()
+        return [self._get_bucket_result(submitter_keys, script_result)
+                for (submitter_keys, _cost), script_result in zip(submitters, script_results)]
+
+    async def take_tokens_async(self, async_connection, submitters:List[Tuple[List[str], int]]) \
+                                        -> List[Optional[Dict[str,Any]]]:
+        """
+        asyncio version of take_tokens()
+        """
+        if self.rate_per_minute <= 0 or not submitters:
+            return [None for _submitter in submitters]
+        script = async_connection.register_script(TOKEN_BUCKET_SCRIPT)
+        async with async_connection.pipeline(transaction=False) as pipeline:
+            for submitter_keys, cost in submitters:
+                await script(keys=submitter_keys, args=self._get_script_args(cost), client=pipeline)
+            script_results = await pipeline.execute()
+        return [self._get_bucket_result(submitter_keys, script_result)
+                for (submitter_keys, _cost), script_result in zip(submitters, script_results)]
+# end of AdmissionController class
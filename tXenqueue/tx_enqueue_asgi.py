@@ -0,0 +1,445 @@
+# Added as an alternative (asyncio) way to serve the same endpoints as tx_enqueue_main.py
+
+"""
+tX Enqueue Job ASGI app
+
+Serves the same job_receiver (/), batch (/batch/) and readiness (/ready/) contract
+    as the Flask app in tx_enqueue_main.py, but using asyncio so that one slow
+    DCS user token lookup or Redis stall doesn't block any other callers.
+    Jobs are enqueued with redis.asyncio and DCS lookups are done with httpx.
+
+The Flask (WSGI) app is still the default. To use this instead:
+    pip3 install --requirement requirements-asgi.txt
+    uvicorn --host 0.0.0.0 --port 8010 tx_enqueue_asgi:app
+"""
+
+# Python imports
+from typing import Any, Dict, List, Optional, Tuple
+from time import time
+import json
+
+# Library (PyPI) imports
+from rq import Queue
+from werkzeug.datastructures import Headers
+
+# Local imports
+from check_posted_tx_payload import MAX_PAYLOAD_BYTES, check_payload_size, check_posted_tx_payload, check_tx_payload
+from tx_enqueue_backends import EnqueueBackends
+from tx_enqueue_dcs import DCS_TIMEOUT_SECONDS, dcs_user_cache, get_cached_dcs_user
+from tx_enqueue_failed import FAILED_JOB_TTL
+from tx_enqueue_helpers import json_default
+from tx_enqueue_admission import get_submitter_keys
+from tx_enqueue_timing import PROMETHEUS_CONTENT_TYPE, stage_recorder, timed_stage
+from tx_enqueue_redis import create_job, enqueue_jobs_async, get_async_redis_connection
+from tx_enqueue_health import HEALTH_CACHE_SECONDS, NAGIOS_PING_MESSAGE, get_health_probe_name, is_probe_body
+from tx_enqueue_scaling import SCALING_INTERVAL_SECONDS
+from tx_enqueue_main import WEBHOOK_URL_SEGMENT, BATCH_URL_SEGMENT, READY_URL_SEGMENT, METRICS_URL_SEGMENT, SCALING_URL_SEGMENT, \
+                            HEALTH_URL_SEGMENT, \
+                            MAX_BATCH_SIZE, MAX_BATCH_BYTES, TIMED_ENDPOINTS, prometheus_metrics_flag, \
+                            JOB_TIMEOUT, JOB_RESULT_TTL, prefix, prefixed_our_name, enqueue_job_stats_prefix, \
+                            logger, redis_hostname, job_deduplicator, admission_controller, create_backends, get_our_queue_name, build_our_response_dict, \
+                            prefetch_source, scaling_advisor
+
+
+class ASGIRequest:
+    """
+    Just enough of a Flask request for check_posted_tx_payload().
+    """
+
+    def __init__(self, method:str, path:str, headers:Headers, data:bytes) -> None:
+        self.method = method
+        self.path = path
+        self.headers = headers
+        self.data = data
+        self._json:Any = None
+        self._json_parsed = False
+
+    def get_json(self, silent:bool=False) -> Any:
+        if not self._json_parsed:
+            self._json_parsed = True
+            try:
+                with timed_stage('parse'):
+                    self._json = json.loads(self.data) if self.data else None
+            except (ValueError, RecursionError) as e:
+                if not silent:
+                    raise ValueError(f"Invalid JSON: {e}") from e
+        return self._json
+
+    def __repr__(self) -> str:
+        return f"<ASGIRequest '{self.path}' [{self.method}]>"
+# end of ASGIRequest class
+
+
+class EnqueueASGIApp:
+    """
+    ASGI app serving the same endpoints as the Flask app in tx_enqueue_main.py.
+    """
+
+    def __init__(self, backends:Optional[EnqueueBackends]=None, async_redis_connection=None,
+                        http_client=None) -> None:
+        self.backends = backends if backends is not None else create_backends()
+        if self.backends.shard_ring is not None:
+            raise ValueError("REDIS_SHARD_HOSTNAMES isn't supported by the ASGI app yet")
+        if self.backends.spool is not None and self.backends.spool.enabled:
+            # NOTE: Jobs would be lost (rather than spooled) while Redis is unavailable
+            raise ValueError("SPOOL_DIRECTORY isn't supported by the ASGI app yet")
+        self._async_redis_connection = async_redis_connection
+        self.http_client = http_client # A shared httpx.AsyncClient for DCS lookups
+        self._own_http_client = False
+        self._health_result:Optional[Tuple[int, Dict[str,Any]]] = None # The latest cached readiness check
+        self._health_checked_at = 0.0
+        # Path: (method, handler, max body bytes, stats name)
+        self.routes = {'/'+WEBHOOK_URL_SEGMENT: ('POST', self.job_receiver, MAX_PAYLOAD_BYTES, 'posts'),
+                        '/'+BATCH_URL_SEGMENT: ('POST', self.batch_job_receiver, MAX_BATCH_BYTES, 'batches'),
+                        '/'+READY_URL_SEGMENT: ('GET', self.readiness_check, MAX_PAYLOAD_BYTES, 'ready'),
+                        '/'+SCALING_URL_SEGMENT: ('GET', self.scaling_advice, MAX_PAYLOAD_BYTES, 'scaling'),
+                        '/'+HEALTH_URL_SEGMENT: ('GET', self.health_check, MAX_PAYLOAD_BYTES, 'health'),
+                        }
+        if prometheus_metrics_flag:
+            self.routes['/'+METRICS_URL_SEGMENT] = ('GET', self.prometheus_metrics, MAX_PAYLOAD_BYTES, 'metrics')
+
+    @property
+    def async_redis_connection(self):
+        if self._async_redis_connection is None:
+            self._async_redis_connection = get_async_redis_connection(redis_hostname,
+                                                max_connections=self.backends.redis_max_connections)
+        return self._async_redis_connection
+
+    async def __call__(self, scope, receive, send) -> None:
+        if scope['type'] == 'lifespan':
+            await self._handle_lifespan(receive, send)
+            return
+        if scope['type'] != 'http':
+            return
+
+        route = self.routes.get(scope['path'])
+        if route is None:
+            await self._send_json(send, 404, {'error': 'Not Found'})
+            return
+        if scope['method'] != route[0]:
+            await self._send_json(send, 405, {'error': 'Method Not Allowed'}, [(b'allow', route[0].encode())])
+            return
+
+        if route[1].__name__ in TIMED_ENDPOINTS and not self._get_health_probe_name(scope):
+            stage_recorder.start_request(route[1].__name__)
+        try:
+            await self._handle_request(scope, receive, send, route)
+        except Exception:
+            stage_recorder.finish_request('error')
+            raise
+
+    def _get_health_probe_name(self, scope) -> Optional[str]:
+        raw_headers = dict(scope['headers'])
+        content_length = raw_headers.get(b'content-length', b'')
+        return get_health_probe_name(raw_headers.get(b'user-agent', b'').decode('latin-1'),
+                                        int(content_length) if content_length.isdigit() else None)
+
+    async def _handle_request(self, scope, receive, send, route) -> None:
+        headers = Headers([(name.decode('latin-1'), value.decode('latin-1'))
+                            for name, value in scope['headers']])
+        max_bytes = route[2]
+        content_length = headers.get('Content-Length', type=int)
+        error_dict = check_payload_size(content_length, max_bytes)
+        body_chunks = []
+        body_length = 0
+        more_body = error_dict is None
+        with timed_stage('read_body'):
+            while more_body:
+                message = await receive()
+                body_chunks.append(message.get('body', b''))
+                body_length += len(body_chunks[-1])
+                more_body = message.get('more_body', False)
+                if body_length > max_bytes: # Stop reading (e.g., without a Content-Length header)
+                    error_dict = check_payload_size(body_length, max_bytes)
+                    break
+        if error_dict:
+            self.backends.stats_client.incr(f'{enqueue_job_stats_prefix}.{route[3]}.too_large')
+            error_dict['status'] = 'invalid'
+            logger.error(f"{prefixed_our_name} ignored oversized POST; responding with {error_dict}\n")
+            await self._send_json(send, 413, error_dict)
+            stage_recorder.finish_request('413')
+            return
+        request = ASGIRequest(scope['method'], scope['path'], headers, b''.join(body_chunks))
+        # Like Flask views, handlers return (status code, response object[, headers dict])
+        handler_result:Tuple[Any, ...] = await route[1](request)
+        status_code, response_object = handler_result[:2]
+        extra_headers = [(name.lower().encode('latin-1'), value.encode('latin-1'))
+                            for headers_dict in handler_result[2:] for name, value in headers_dict.items()]
+        if isinstance(response_object, str): # e.g., Prometheus metrics
+            await self._send_body(send, status_code, response_object.encode('utf-8'), extra_headers)
+        else:
+            await self._send_json(send, status_code, response_object, extra_headers)
+        stage_recorder.finish_request(str(status_code))
+
+    async def _handle_lifespan(self, receive, send) -> None:
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                self.backends.stats_client # Do the statsd DNS lookup now (rather than during a request)
+                self.backends.start() # Our background threads (rather than when a request first needs Redis)
+                if self.http_client is None:
+                    import httpx
+                    self.http_client = httpx.AsyncClient(timeout=DCS_TIMEOUT_SECONDS)
+                    self._own_http_client = True
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                if self._async_redis_connection is not None:
+                    await self._async_redis_connection.aclose()
+                if self._own_http_client:
+                    await self.http_client.aclose()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def _send_json(self, send, status_code:int, response_object:Any,
+                                extra_headers:Optional[List[Tuple[bytes,bytes]]]=None) -> None:
+        body = json.dumps(response_object, default=json_default, sort_keys=True).encode('utf-8')
+        await self._send_body(send, status_code, body, [(b'content-type', b'application/json')] + (extra_headers or []))
+
+    async def _send_body(self, send, status_code:int, body:bytes, headers:List[Tuple[bytes,bytes]]) -> None:
+        await send({'type': 'http.response.start', 'status': status_code,
+                    'headers': [(b'content-length', str(len(body)).encode())] + headers})
+        await send({'type': 'http.response.body', 'body': body})
+
+    async def _prefetch_dcs_user(self, payload_json:Any) -> None:
+        """
+        Look up the DCS user token (if any) without blocking
+            so that the (synchronous) payload check finds it in the cache.
+
+        NOTE: The payload check only looks in the cache (get_cached_dcs_user)
+            so a failed lookup here makes it say it's unable to check the token.
+        """
+        if isinstance(payload_json, dict) and isinstance(payload_json.get('user_token'), str) \
+        and len(payload_json['user_token']) == 40:
+            with timed_stage('dcs_lookup'):
+                await dcs_user_cache.get_user_async(payload_json['user_token'], self.http_client)
+
+    async def job_receiver(self, request:ASGIRequest) -> Tuple[Any, ...]:
+        """
+        Accepts POST requests and checks the (json) payload
+
+        Queues the approved jobs (just like job_receiver in tx_enqueue_main.py).
+        """
+        stats_client = self.backends.stats_client
+        # Answer health probes (e.g., Nagios pings) before doing anything else
+        probe_name = get_health_probe_name(request.headers.get('User-Agent'), len(request.data))
+        if probe_name and is_probe_body(request.data):
+            stats_client.incr(f'{enqueue_job_stats_prefix}.probes.{probe_name}')
+            status_code, status_dict = await self._check_ready_cached()
+            return 400 if status_code == 200 else 503, {'error': NAGIOS_PING_MESSAGE, 'status': 'invalid',
+                                                        'ready': status_dict['ready']}
+        stats_client.incr(f'{enqueue_job_stats_prefix}.posts.attempted')
+        logger.info(f"tX {'('+prefix+')' if prefix else ''} enqueue received request: {request}")
+
+        if request.data:
+            try:
+                await self._prefetch_dcs_user(request.get_json())
+            except ValueError:
+                stats_client.incr(f'{enqueue_job_stats_prefix}.posts.invalid')
+                return 400, {'error': 'Payload is not valid JSON', 'status': 'invalid'}
+
+        response_ok_flag, response_dict = check_posted_tx_payload(request, logger, get_user=get_cached_dcs_user)
+        if not response_ok_flag:
+            stats_client.incr(f'{enqueue_job_stats_prefix}.posts.invalid')
+            response_dict['status'] = 'invalid'
+            logger.error(f"{prefixed_our_name} ignored invalid payload; responding with {response_dict}\n", extra={'payload_dump': True})
+            return 400, response_dict
+
+        our_adjusted_queue_name = get_our_queue_name(response_dict)
+        # The latest metrics from the background sampler
+        queue_metrics = self.backends.metrics_sampler.get_metrics(our_adjusted_queue_name)
+        our_response_dict = build_our_response_dict(response_dict, our_adjusted_queue_name, queue_metrics)
+        rq_job_id = f"{our_adjusted_queue_name}_{our_response_dict['job_id']}"
+
+        # Callers retry (and webhooks can be re-fired) so return the original job if there is one
+        with timed_stage('dedup'):
+            dedup_outcome, original_response_dict = await job_deduplicator.claim_async(self.async_redis_connection,
+                                                                            rq_job_id, our_response_dict)
+        if original_response_dict is not None:
+            logger.info(f"{prefixed_our_name} didn't queue {dedup_outcome} job {rq_job_id}; " \
+                        f"responding with original job {original_response_dict['job_id']}\n")
+            stats_client.incr(f'{enqueue_job_stats_prefix}.posts.{dedup_outcome}')
+            return 200, original_response_dict
+        logger.debug(f"About to queue job: {our_response_dict}", extra={'payload_dump': True})
+
+        # Log (and alert) using the latest metrics from the background sampler
+        queue1_worker_count = queue_metrics.get('worker_count')
+        if queue1_worker_count is not None and queue1_worker_count < 1:
+            logger.critical(f"{prefixed_our_name} has no job handler workers running!")
+        # Go ahead and queue the job anyway for when a worker is restarted
+        #   (unless the queue is already too deep, or this submitter has sent too many jobs)
+        with timed_stage('admission'):
+            rejection_dict = admission_controller.check_queue_depth(queue_metrics) \
+                        or (await admission_controller.take_tokens_async(self.async_redis_connection,
+                                                            [(get_submitter_keys(our_response_dict), 1)]))[0]
+        if rejection_dict:
+            await job_deduplicator.release_async(self.async_redis_connection, [rq_job_id])
+            stats_client.incr(f"{enqueue_job_stats_prefix}.posts.shed.{rejection_dict['reason']}")
+            logger.warning(f"{prefixed_our_name} shed job {rq_job_id}; responding with {rejection_dict}\n")
+            return 429, rejection_dict, {'Retry-After': str(rejection_dict['retry_after'])}
+
+        prefetch_source(our_response_dict)
+        our_queue = Queue(our_adjusted_queue_name, connection=self.backends.redis_connection)
+        job = create_job(our_queue, our_response_dict, timeout=JOB_TIMEOUT, job_id=rq_job_id,
+                            result_ttl=JOB_RESULT_TTL, failure_ttl=FAILED_JOB_TTL)
+        try:
+            with timed_stage('enqueue'):
+                len_our_queue, = await enqueue_jobs_async(self.async_redis_connection, [(our_queue, job)])
+        except Exception:
+            await job_deduplicator.release_async(self.async_redis_connection, [rq_job_id])
+            raise
+
+        logger.info(f"{prefixed_our_name} queued valid job to {our_adjusted_queue_name} queue " \
+                    f"({len_our_queue} jobs now " \
+                        f"for {'?' if queue1_worker_count is None else queue1_worker_count} workers, " \
+                    f"{queue_metrics.get('failed_length', '?')} failed jobs)\n")
+        stats_client.incr(f'{enqueue_job_stats_prefix}.posts.succeeded')
+        scaling_advisor.record_arrivals(our_adjusted_queue_name)
+        return 200, our_response_dict
+
+    async def batch_job_receiver(self, request:ASGIRequest) -> Tuple[Any, ...]:
+        """
+        Accepts POST requests containing a JSON array of job payloads
+            (just like batch_job_receiver in tx_enqueue_main.py).
+        """
+        stats_client = self.backends.stats_client
+        stats_client.incr(f'{enqueue_job_stats_prefix}.batches.attempted')
+        logger.info(f"tX {'('+prefix+')' if prefix else ''} enqueue received batch request: {request}")
+
+        payload_list = request.get_json(silent=True)
+        if not isinstance(payload_list, list) or not payload_list:
+            stats_client.incr(f'{enqueue_job_stats_prefix}.batches.invalid')
+            return 400, {'error': 'Expected a non-empty JSON array of job payloads', 'status': 'invalid'}
+        if len(payload_list) > MAX_BATCH_SIZE:
+            stats_client.incr(f'{enqueue_job_stats_prefix}.batches.invalid')
+            return 400, {'error': f'Too many job payloads ({len(payload_list)}) — maximum is {MAX_BATCH_SIZE}', 'status': 'invalid'}
+
+        results_list:List[Dict[str,Any]] = []
+        valid_jobs = [] # (results_list index, queue name, rq job id, response dict)
+        for payload_dict in payload_list:
+            await self._prefetch_dcs_user(payload_dict)
+            response_ok_flag, response_dict = check_tx_payload(payload_dict, request.headers, logger,
+                                                                get_user=get_cached_dcs_user)
+            if not response_ok_flag:
+                response_dict['status'] = 'invalid'
+                results_list.append(response_dict)
+                continue
+            our_adjusted_queue_name = get_our_queue_name(response_dict)
+            our_response_dict = build_our_response_dict(response_dict, our_adjusted_queue_name,
+                                                        self.backends.metrics_sampler.get_metrics(our_adjusted_queue_name))
+            valid_jobs.append((len(results_list), our_adjusted_queue_name,
+                                f"{our_adjusted_queue_name}_{our_response_dict['job_id']}", our_response_dict))
+            results_list.append(our_response_dict)
+
+        new_jobs = [] # Valid jobs which haven't already been queued
+        num_deduplicated = 0
+        if valid_jobs:
+            with timed_stage('dedup'):
+                dedup_results = await job_deduplicator.claim_many_async(self.async_redis_connection,
+                                    [(rq_job_id, our_response_dict) for _index, _queue_name, rq_job_id, our_response_dict in valid_jobs])
+            for valid_job, (dedup_outcome, original_response_dict) in zip(valid_jobs, dedup_results):
+                if original_response_dict is None:
+                    new_jobs.append(valid_job)
+                    continue
+                stats_client.incr(f'{enqueue_job_stats_prefix}.posts.{dedup_outcome}')
+                results_list[valid_job[0]] = original_response_dict
+                num_deduplicated += 1
+
+        # Shed the jobs for queues which are too deep, or from submitters who have sent too many
+        with timed_stage('admission'):
+            rejection_dicts = admission_controller.check_queue_depths([queue_name for _index, queue_name, _rq_job_id, _our_response_dict in new_jobs],
+                                                                        self.backends.metrics_sampler.get_metrics)
+            unrejected_jobs = [new_job for new_job, rejection_dict in zip(new_jobs, rejection_dicts) if rejection_dict is None]
+            if unrejected_jobs:
+                token_rejection_dicts = iter(await admission_controller.take_tokens_async(self.async_redis_connection,
+                                [(get_submitter_keys(our_response_dict), 1) for _index, _queue_name, _rq_job_id, our_response_dict in unrejected_jobs]))
+                rejection_dicts = [next(token_rejection_dicts) if rejection_dict is None else rejection_dict
+                                    for rejection_dict in rejection_dicts]
+        queue_jobs, rejected_rq_job_ids = [], []
+        for (index, our_adjusted_queue_name, rq_job_id, our_response_dict), rejection_dict in zip(new_jobs, rejection_dicts):
+            if rejection_dict:
+                stats_client.incr(f"{enqueue_job_stats_prefix}.posts.shed.{rejection_dict['reason']}")
+                results_list[index] = rejection_dict
+                rejected_rq_job_ids.append(rq_job_id)
+                continue
+            prefetch_source(our_response_dict) # NOTE: Also updates the dict in results_list
+            our_queue = Queue(our_adjusted_queue_name, connection=self.backends.redis_connection)
+            queue_jobs.append((our_queue, create_job(our_queue, our_response_dict, timeout=JOB_TIMEOUT,
+                                    job_id=rq_job_id, result_ttl=JOB_RESULT_TTL, failure_ttl=FAILED_JOB_TTL)))
+        if rejected_rq_job_ids:
+            await job_deduplicator.release_async(self.async_redis_connection, rejected_rq_job_ids)
+
+        if queue_jobs:
+            try:
+                with timed_stage('enqueue'):
+                    await enqueue_jobs_async(self.async_redis_connection, queue_jobs)
+            except Exception:
+                await job_deduplicator.release_async(self.async_redis_connection, [job.id for _queue, job in queue_jobs])
+                raise
+
+        for our_queue, _job in queue_jobs:
+            scaling_advisor.record_arrivals(our_queue.name)
+        num_queued, num_invalid = len(queue_jobs), len(payload_list) - len(valid_jobs)
+        num_rejected = len(rejected_rq_job_ids)
+        stats_client.incr(f'{enqueue_job_stats_prefix}.posts.attempted', len(payload_list))
+        stats_client.incr(f'{enqueue_job_stats_prefix}.posts.succeeded', num_queued)
+        stats_client.incr(f'{enqueue_job_stats_prefix}.posts.invalid', num_invalid)
+        logger.info(f"{prefixed_our_name} queued {num_queued} valid job(s) from batch of {len(payload_list)} " \
+                    f"({num_deduplicated} already queued, {num_rejected} shed)\n")
+        batch_response = {'queued': num_queued, 'deduplicated': num_deduplicated, 'rejected': num_rejected,
+                            'invalid': num_invalid, 'results': results_list}
+        if num_rejected and num_rejected + num_invalid == len(payload_list): # Nothing was accepted
+            retry_after = max(result['retry_after'] for result in results_list if 'retry_after' in result)
+            return 429, batch_response, {'Retry-After': str(retry_after)}
+        return 200 if valid_jobs else 400, batch_response
+
+    async def readiness_check(self, request:ASGIRequest) -> Tuple[int, Dict[str,Any]]:
+        """
+        Returns 200 if Redis is responding, else 503.
+        """
+        status_dict:Dict[str,Any] = {'uptime_seconds': round(time() - self.backends.created_at, 3)}
+        try:
+            await self.async_redis_connection.ping()
+            status_dict['redis'] = 'connected'
+        except Exception as e:
+            status_dict['redis'] = f'unavailable: {e}'
+        status_dict['ready'] = status_dict['redis'] == 'connected'
+        status_dict['shed'] = dict(admission_controller.shed_counts)
+        return 200 if status_dict['ready'] else 503, status_dict
+
+    async def _check_ready_cached(self) -> Tuple[int, Dict[str,Any]]:
+        """
+        Returns the result of readiness_check() from within the last HEALTH_CACHE_SECONDS
+            (so that frequent health probes don't each use Redis).
+        """
+        if self._health_result is None or time() - self._health_checked_at > HEALTH_CACHE_SECONDS:
+            self._health_result, self._health_checked_at = await self.readiness_check(None), time() # type: ignore[arg-type]
+        status_code, status_dict = self._health_result
+        return status_code, dict(status_dict, checked_seconds_ago=round(time() - self._health_checked_at, 3))
+
+    async def health_check(self, request:ASGIRequest) -> Tuple[int, Dict[str,Any]]:
+        """
+        Returns 200 if Redis was responding within the last few seconds, else 503.
+        """
+        self.backends.stats_client.incr(f'{enqueue_job_stats_prefix}.probes.health')
+        return await self._check_ready_cached()
+
+    async def scaling_advice(self, request:ASGIRequest) -> Tuple[Any, ...]:
+        """
+        Returns the latest recommended worker count for each of our queues (or 503 if there's no advice yet).
+        """
+        self.backends.start() # The advisor thread (in case lifespan startup didn't happen)
+        advice_dict = scaling_advisor.get_advice()
+        if advice_dict['advised_at'] is None:
+            return 503, {'error': "No scaling advice yet", 'retry_after': SCALING_INTERVAL_SECONDS}, \
+                        {'Retry-After': str(SCALING_INTERVAL_SECONDS)}
+        return 200, advice_dict
+
+    async def prometheus_metrics(self, request:ASGIRequest) -> Tuple[Any, ...]:
+        """
+        Returns our request stage histograms in the Prometheus text format (if PROMETHEUS_METRICS is set).
+        """
+        return 200, stage_recorder.render_prometheus(), {'Content-Type': PROMETHEUS_CONTENT_TYPE}
+# end of EnqueueASGIApp class
+
+
+app = EnqueueASGIApp()
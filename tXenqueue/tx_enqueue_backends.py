@@ -0,0 +1,251 @@
+# Added so that importing tx_enqueue_main (and booting gunicorn workers) doesn't connect to anything
+
+"""
+tX Enqueue backends
+
+Holds our connections to Redis and Graphite (statsd)
+    and the background threads which use them.
+
+Nothing is connected until start() is called (once the app is in its worker process)
+    or until it's first needed (or until check_ready() is called, e.g., by the readiness endpoint).
+"""
+
+# Python imports
+from typing import Any, Dict, List, Optional, Tuple
+from time import time
+from os import getpid
+import threading
+
+# Local imports
+from tx_enqueue_redis import REDIS_MAX_CONNECTIONS, get_redis_connection
+from tx_enqueue_failed import start_failed_job_sweeper
+from tx_enqueue_metrics import METRICS_SAMPLE_INTERVAL_SECONDS, QueueMetricsSampler
+from tx_enqueue_dcs import dcs_user_cache
+from tx_enqueue_timing import stage_recorder, start_trace_rate_refresher
+from tx_enqueue_lanes import RUN_TIME_SAMPLE_INTERVAL_SECONDS, job_run_times, start_run_time_sampler
+from tx_enqueue_spool import JobSpool, start_spool_replayer
+from tx_enqueue_shards import ShardRing, get_shard_key
+from tx_enqueue_retry import JobRetrier, start_job_retrier
+from tx_enqueue_scaling import ScalingAdvisor, start_scaling_advisor
+from tx_enqueue_health import HEALTH_CACHE_SECONDS
+
+
+STATSD_PORT = 8125
+
+
+class EnqueueBackends:
+    """
+    Lazily created Redis connection, statsd client, and metrics sampler.
+
+    Pass in redis_connection and/or stats_client to use those instead
+        (e.g., for testing), and start_background_threads=False
+        to not run the failed job sweeper and metrics sampler.
+
+    Give lane_queue_names (a dict of lane to queue name) to also sample the job run times for lane routing,
+        an (enabled) spool to also replay its spooled jobs into Redis,
+        an (enabled) job_retrier to also retry our failed jobs (on each shard),
+        and a scaling_advisor to also keep its recommended worker counts up to date.
+
+    Give redis_shard_hostnames (or shard_connections for testing) to put jobs into several Redis shards
+        (see tx_enqueue_shards). Otherwise the one Redis connection is also the only shard.
+
+    The stats client is also given to the DCS user cache, job run times, stage recorder, spool, job retrier
+        and scaling advisor
+        (and any other stats_users).
+    """
+
+    def __init__(self, redis_hostname:str, queue_names:List[str], stats_prefix:str, logger,
+                        graphite_hostname:str='localhost', redis_connection=None, stats_client=None,
+                        redis_max_connections:int=REDIS_MAX_CONNECTIONS,
+                        metrics_interval:float=METRICS_SAMPLE_INTERVAL_SECONDS,
+                        share_dcs_user_cache:bool=False, start_background_threads:bool=True,
+                        stats_users:Optional[List[Any]]=None, lane_queue_names:Optional[Dict[str,str]]=None,
+                        spool:Optional[JobSpool]=None, redis_shard_hostnames:Optional[List[str]]=None,
+                        shard_connections:Optional[List[Any]]=None, job_retrier:Optional[JobRetrier]=None,
+                        scaling_advisor:Optional[ScalingAdvisor]=None) -> None:
+        self.redis_hostname = redis_hostname
+        self.redis_shard_hostnames = list(redis_shard_hostnames or [])
+        self.shard_ring:Optional[ShardRing] = None
+        if self.redis_shard_hostnames or shard_connections:
+            self.shard_ring = ShardRing(self.redis_shard_hostnames
+                                        or [f'shard{n}' for n in range(len(shard_connections or []))])
+        self.queue_names = list(queue_names)
+        self.stats_prefix = stats_prefix
+        self.logger = logger
+        self.graphite_hostname = graphite_hostname
+        self.redis_max_connections = redis_max_connections
+        self.metrics_interval = metrics_interval
+        self.share_dcs_user_cache = share_dcs_user_cache
+        self.start_background_threads = start_background_threads
+        # Objects with stats_client and stats_prefix attributes to be set when we have a stats client
+        self.stats_users = [dcs_user_cache, job_run_times, stage_recorder] + (stats_users or [])
+        self.lane_queue_names = lane_queue_names
+        self.spool = spool
+        if spool is not None:
+            self.stats_users.append(spool)
+        self.job_retrier = job_retrier
+        if job_retrier is not None:
+            self.stats_users.append(job_retrier)
+        self.scaling_advisor = scaling_advisor
+        if scaling_advisor is not None:
+            self.stats_users.append(scaling_advisor)
+        self.created_at = time()
+        self._redis_connection = redis_connection
+        self._shard_connections = shard_connections
+        self._stats_client = stats_client
+        self._stats_users_set = False
+        self._metrics_sampler:Optional[QueueMetricsSampler] = None
+        self._background_pid:Optional[int] = None # The process that our background threads were started in
+        self._lock = threading.RLock()
+        self._ready_result:Optional[Tuple[bool, Dict[str,Any]]] = None # The latest check_ready_cached()
+        self._ready_checked_at = 0.0
+        self._ready_lock = threading.Lock()
+
+    @property
+    def stats_client(self):
+        if not self._stats_users_set:
+            with self._lock:
+                if self._stats_client is None:
+                    # NOTE: Imported here because StatsClient() does a DNS lookup
+                    from statsd import StatsClient # Graphite front-end
+                    self.logger.info(f"graphite_url is '{self.graphite_hostname}'")
+                    self._stats_client = StatsClient(host=self.graphite_hostname, port=STATSD_PORT)
+                for stats_user in self.stats_users:
+                    stats_user.stats_client, stats_user.stats_prefix = self._stats_client, self.stats_prefix
+                self._stats_users_set = True
+        return self._stats_client
+
+    @property
+    def redis_connection(self):
+        if self._redis_connection is None or self._background_pid != getpid():
+            self.start() # In case nothing started us (in this process)
+        return self._redis_connection
+
+    def start(self) -> None:
+        """
+        Connects to Redis and starts our background threads
+            (unless start_background_threads is False).
+
+        Call this once the app is in the process that serves requests,
+            i.e., in each gunicorn worker (see gunicorn.conf.py) rather than in a preloading master.
+
+        NOTE: Threads don't survive a fork so if they were started in another process,
+                they're started again in this one.
+        """
+        with self._lock:
+            if self._redis_connection is None:
+                self.logger.info(f"redis_hostname is '{self.redis_hostname}'")
+                self._redis_connection = get_redis_connection(self.redis_hostname,
+                                                max_connections=self.redis_max_connections)
+            if self._background_pid != getpid():
+                self._background_pid = getpid()
+                self._metrics_sampler = None # Its thread (if any) belongs to the other process
+                self._start_background(self._redis_connection)
+
+    @property
+    def shard_connections(self) -> List[Any]:
+        redis_connection = self.redis_connection # Also starts the background threads
+        if self.shard_ring is None:
+            return [redis_connection]
+        if self._shard_connections is None:
+            with self._lock:
+                if self._shard_connections is None:
+                    self.logger.info(f"redis_shard_hostnames are {self.redis_shard_hostnames}")
+                    self._shard_connections = [get_redis_connection(redis_shard_hostname,
+                                                        max_connections=self.redis_max_connections)
+                                                for redis_shard_hostname in self.redis_shard_hostnames]
+        return self._shard_connections
+
+    def get_shard_index(self, payload_dict:Dict[str,Any]) -> int:
+        """
+        Returns the index (into shard_connections) of the shard for the given job.
+        """
+        return 0 if self.shard_ring is None else self.shard_ring.get_shard_index(get_shard_key(payload_dict))
+
+    def get_job_connection(self, payload_dict:Dict[str,Any]):
+        """
+        Returns the Redis connection of the shard for the given job.
+        """
+        return self.shard_connections[self.get_shard_index(payload_dict)]
+
+    @property
+    def metrics_sampler(self) -> QueueMetricsSampler:
+        if self._metrics_sampler is None:
+            with self._lock:
+                if self._metrics_sampler is None:
+                    self._metrics_sampler = QueueMetricsSampler(self.redis_connection, self.queue_names,
+                                                self.stats_client, self.stats_prefix, self.logger,
+                                                interval=self.metrics_interval,
+                                                shard_connections=self.shard_connections if self.shard_ring else None)
+        return self._metrics_sampler
+
+    def _start_background(self, redis_connection) -> None:
+        """
+        Called once we have a Redis connection.
+        """
+        if self.share_dcs_user_cache:
+            dcs_user_cache.connection = redis_connection
+        if self.start_background_threads:
+            # Prune expired failed jobs and sample our queue metrics in the background (rather than on every POST)
+            shard_connections = self.shard_connections if self.shard_ring else None
+            for shard_connection in shard_connections or [redis_connection]:
+                start_failed_job_sweeper(self.queue_names, shard_connection, self.logger)
+            self.metrics_sampler.start()
+            start_trace_rate_refresher(stage_recorder, redis_connection, self.logger)
+            if self.lane_queue_names:
+                self.stats_client # Sets job_run_times.stats_client (before its first sample)
+                start_run_time_sampler(job_run_times, redis_connection, self.lane_queue_names, self.logger,
+                                        interval=RUN_TIME_SAMPLE_INTERVAL_SECONDS, shard_connections=shard_connections)
+            if self.spool is not None and self.spool.enabled:
+                self.stats_client # Sets spool.stats_client (for the spool depth gauges)
+                start_spool_replayer(self.spool, redis_connection, self.logger,
+                                        get_job_connection=self.get_job_connection if self.shard_ring else None)
+            if self.job_retrier is not None and self.job_retrier.enabled:
+                self.stats_client # Sets job_retrier.stats_client
+                for shard_connection in shard_connections or [redis_connection]:
+                    start_job_retrier(self.job_retrier, shard_connection, self.queue_names, self.logger)
+            if self.scaling_advisor is not None:
+                self.stats_client # Sets scaling_advisor.stats_client
+                start_scaling_advisor(self.scaling_advisor, redis_connection, self.metrics_sampler.get_metrics, self.logger)
+
+    def check_ready(self) -> Tuple[bool, Dict[str,Any]]:
+        """
+        Connects (if necessary) and checks that Redis (and each shard) is responding.
+
+        Returns a 2-tuple:
+            True or False if we're ready to accept jobs
+            A dict describing the state of each dependency
+        """
+        status_dict:Dict[str,Any] = {'uptime_seconds': round(time() - self.created_at, 3)}
+        spool_flag = self.spool is not None and self.spool.enabled
+        if spool_flag:
+            status_dict['spool'] = self.spool.get_depth() # type: ignore[union-attr]
+        try:
+            self.redis_connection.ping()
+            status_dict['redis'] = 'connected'
+            if self.shard_ring is not None:
+                status_dict['redis_shards'] = {}
+                for shard_name, shard_connection in zip(self.shard_ring.shard_names, self.shard_connections):
+                    shard_connection.ping()
+                    status_dict['redis_shards'][shard_name] = 'connected'
+        except Exception as e:
+            status_dict['redis'] = f'unavailable: {e}'
+            # We can still accept jobs (into the spool) while it has room
+            return spool_flag and self.spool.has_room(), status_dict # type: ignore[union-attr]
+        return True, status_dict
+
+    def check_ready_cached(self, max_age:float=HEALTH_CACHE_SECONDS) -> Tuple[bool, Dict[str,Any]]:
+        """
+        Returns the result of check_ready() from within the last max_age seconds
+            (calling it if necessary, but only from one thread at a time)
+            so that frequent health probes don't each use Redis.
+
+        The status dict also says how many seconds ago it was checked.
+        """
+        with self._ready_lock:
+            if self._ready_result is None or time() - self._ready_checked_at > max_age:
+                self._ready_result, self._ready_checked_at = self.check_ready(), time()
+            ready_flag, status_dict = self._ready_result
+            checked_seconds_ago = round(time() - self._ready_checked_at, 3)
+        return ready_flag, dict(status_dict, checked_seconds_ago=checked_seconds_ago)
+# end of EnqueueBackends class
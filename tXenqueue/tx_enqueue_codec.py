@@ -0,0 +1,134 @@
+# Added because every queued job held (and rq pickled) our full response dict
+#   which is then kept in Redis for a day after the job has run
+
+"""
+tX Enqueue compact job encoding
+
+By default (an empty encoding) the job dict is queued for webhook.job as it is (and pickled by rq).
+
+With JOB_ENCODING set to 'json' or 'msgpack', the job dict is queued as bytes instead:
+    a 3-byte magic number, a 1-byte version, a 1-byte flags (FLAG_MSGPACK)
+    and then the JSON or msgpack of [fields, derived fieldnames, datetime fieldnames].
+Fields with a constant or derived value (e.g., success, status, expires_at) are left out
+    (and listed as derived fieldnames) and datetimes are sent as ISO 8601 strings,
+    so that decode_job_dict() returns exactly the original job dict.
+
+NOTE: There's no compression here because rq already zlib compresses the job data
+        (which also takes care of the job_id repeated in identifier and the output URL).
+
+NOTE: tx_job_handler must call decode_job_dict() (or a copy of it)
+        on the argument of webhook.job before JOB_ENCODING is turned on.
+"""
+
+# Python imports
+from typing import Any, Callable, Dict
+from datetime import datetime, timedelta
+import json
+
+
+JOB_ENCODING = '' # i.e., the job dict (pickled by rq)
+JOB_ENCODINGS = '', 'json', 'msgpack'
+
+ENCODED_JOB_MAGIC = b'TXJ'
+ENCODED_JOB_VERSION = 1
+FLAG_MSGPACK = 1 # else JSON
+HEADER_LENGTH = len(ENCODED_JOB_MAGIC) + 2
+
+DATETIME_FIELDNAMES = 'tx_job_queued_at', 'expires_at', 'eta', 'eta_earliest', 'eta_latest'
+# Functions returning the value of each derived field from the (decoded) job dict
+DERIVED_FIELDS:Dict[str,Callable[[Dict[str,Any]],Any]] = {
+    'success': lambda job_dict: True,
+    'status': lambda job_dict: 'queued',
+    'identifier': lambda job_dict: job_dict.get('job_id'),
+    'expires_at': lambda job_dict: job_dict['tx_job_queued_at'] + timedelta(days=1),
+    }
+
+
+class JobCodec:
+    """
+    Encodes job dicts for the job queues (see above).
+    """
+
+    def __init__(self, encoding:str=JOB_ENCODING) -> None:
+        self.encoding = encoding
+
+    @property
+    def encoding(self) -> str:
+        return self._encoding
+
+    @encoding.setter
+    def encoding(self, encoding:str) -> None:
+        if encoding not in JOB_ENCODINGS:
+            raise ValueError(f"Unknown job encoding '{encoding}' — expected one of {JOB_ENCODINGS}")
+        if encoding == 'msgpack':
+            import msgpack # NOTE: Imported here (so that it fails at startup) because it's only needed if turned on
+        self._encoding = encoding
+
+    def encode(self, job_dict:Dict[str,Any]) -> Any:
+        """
+        Returns the job dict itself, or its compact encoding (bytes).
+        """
+        if not self._encoding:
+            return job_dict
+        fields = dict(job_dict)
+        derived_fieldnames = [fieldname for fieldname, derive in DERIVED_FIELDS.items()
+                                if fieldname in job_dict and is_same(get_derived_value(derive, job_dict), job_dict[fieldname])]
+        for fieldname in derived_fieldnames:
+            del fields[fieldname]
+        datetime_fieldnames = [fieldname for fieldname in DATETIME_FIELDNAMES
+                                if isinstance(fields.get(fieldname), datetime)]
+        for fieldname in datetime_fieldnames:
+            fields[fieldname] = fields[fieldname].isoformat()
+        body = [fields, derived_fieldnames, datetime_fieldnames]
+        if self._encoding == 'msgpack':
+            import msgpack
+            flags, encoded_body = FLAG_MSGPACK, msgpack.packb(body)
+        else:
+            flags, encoded_body = 0, json.dumps(body, separators=(',', ':')).encode('utf-8')
+        return ENCODED_JOB_MAGIC + bytes((ENCODED_JOB_VERSION, flags)) + encoded_body
+# end of JobCodec class
+
+
+def is_same(value:Any, other_value:Any) -> bool:
+    return type(value) is type(other_value) and value == other_value # e.g., so True isn't the same as 1
+# end of is_same function
+
+
+def get_derived_value(derive:Callable[[Dict[str,Any]],Any], job_dict:Dict[str,Any]) -> Any:
+    try:
+        return derive(job_dict)
+    except (KeyError, TypeError): # Can't be derived from this job dict
+        return None
+# end of get_derived_value function
+
+
+def decode_job_dict(job_arg:Any) -> Dict[str,Any]:
+    """
+    Returns the job dict from the argument of a queued job (either a job dict or encoded by JobCodec).
+
+    Raises ValueError for bytes which weren't encoded by JobCodec (or by a newer version).
+    """
+    if not isinstance(job_arg, bytes):
+        return job_arg
+    if job_arg[:len(ENCODED_JOB_MAGIC)] != ENCODED_JOB_MAGIC or len(job_arg) < HEADER_LENGTH:
+        raise ValueError("Not an encoded tX job")
+    version, flags = job_arg[len(ENCODED_JOB_MAGIC)], job_arg[len(ENCODED_JOB_MAGIC)+1]
+    if version != ENCODED_JOB_VERSION:
+        raise ValueError(f"Unknown tX job encoding version {version}")
+    encoded_body = job_arg[HEADER_LENGTH:]
+    if flags & FLAG_MSGPACK:
+        import msgpack
+        body = msgpack.unpackb(encoded_body)
+    else:
+        body = json.loads(encoded_body)
+    job_dict:Dict[str,Any]
+    job_dict, derived_fieldnames, datetime_fieldnames = body
+    for fieldname in datetime_fieldnames:
+        job_dict[fieldname] = datetime.fromisoformat(job_dict[fieldname])
+    for fieldname in derived_fieldnames:
+        job_dict[fieldname] = DERIVED_FIELDS[fieldname](job_dict)
+    return job_dict
+# end of decode_job_dict function
+
+
+job_codec = JobCodec()
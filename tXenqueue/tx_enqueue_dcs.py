@@ -0,0 +1,263 @@
+# Added to avoid a blocking DCS API call for every POST that includes a user_token
+
+"""
+tX Enqueue DCS user lookups
+
+Resolves a 40-character DCS (Gitea) user token to the DCS user,
+    always at the configured DCS URL (DCS_URL) and never at the dcs_domain in the payload
+    (else callers could point that at a server of their own which accepts any token),
+    caching the results in a bounded, thread-safe LRU cache with a TTL.
+
+Unknown tokens are also cached (negative caching) but with a much shorter TTL.
+
+Optionally, results can also be shared between (gunicorn worker) processes via Redis.
+    NOTE: Tokens are hashed before being used as cache keys.
+
+get_user_async() does the lookup with httpx (for tx_enqueue_asgi.py)
+    and stores the result in the same (local) cache,
+    where the payload check then finds it with get_cached_dcs_user() (which never blocks).
+"""
+
+# Python imports
+from typing import Any, Dict, Optional
+from collections import OrderedDict
+from hashlib import sha256
+from time import monotonic
+import json
+import logging
+import threading
+from urllib.error import HTTPError, URLError
+from urllib.request import Request, urlopen
+
+
+DEFAULT_DCS_DOMAIN = 'https://git.door43.org'
+DCS_USER_API_PATH = '/api/v1/user'
+DCS_TIMEOUT_SECONDS = 10
+
+DCS_USER_CACHE_SIZE = 1000 # Max number of tokens remembered per process
+DCS_USER_CACHE_TTL_SECONDS = 10 * 60
+DCS_USER_NEGATIVE_TTL_SECONDS = 30 # How long we remember unknown tokens
+DCS_USER_REDIS_KEY_PREFIX = 'tx:dcs_user:'
+
+
+def fetch_dcs_user(user_token:str, dcs_domain:str=DEFAULT_DCS_DOMAIN) -> Dict[str,Any]:
+    """
+    Ask the DCS (Gitea) API who owns the given user token.
+
+    Returns the user dict, or an empty dict if DCS doesn't recognise the token.
+    Raises URLError (or OSError) if DCS couldn't be reached,
+        or ValueError if it didn't answer with a JSON object.
+    """
+    dcs_request = Request(f"{dcs_domain.rstrip('/')}{DCS_USER_API_PATH}",
+                            headers={'Authorization': f'token {user_token}',
+                                    'Accept': 'application/json'})
+    try:
+        with urlopen(dcs_request, timeout=DCS_TIMEOUT_SECONDS) as dcs_response:
+            user = json.loads(dcs_response.read().decode('utf-8'))
+    except HTTPError as e:
+        if e.code in (401, 403, 404):
+            return {}
+        raise
+    if not isinstance(user, dict):
+        raise ValueError(f"Expected a JSON object but got {type(user).__name__}")
+    return user
+# end of fetch_dcs_user function
+
+
+async def fetch_dcs_user_async(user_token:str, dcs_domain:str=DEFAULT_DCS_DOMAIN, http_client=None) -> Dict[str,Any]:
+    """
+    asyncio version of fetch_dcs_user using httpx (an optional dependency).
+
+    Raises OSError (or httpx.HTTPError) if DCS couldn't be reached.
+    """
+    import httpx
+    headers = {'Authorization': f'token {user_token}', 'Accept': 'application/json'}
+    url = f"{dcs_domain.rstrip('/')}{DCS_USER_API_PATH}"
+    if http_client is None:
+        async with httpx.AsyncClient(timeout=DCS_TIMEOUT_SECONDS) as new_http_client:
+            dcs_response = await new_http_client.get(url, headers=headers)
+    else:
+        dcs_response = await http_client.get(url, headers=headers)
+    if dcs_response.status_code in (401, 403, 404):
+        return {}
+    dcs_response.raise_for_status()
+    user = dcs_response.json()
+    if not isinstance(user, dict):
+        raise ValueError(f"Expected a JSON object but got {type(user).__name__}")
+    return user
+# end of fetch_dcs_user_async function
+
+
+class DCSUserCache:
+    """
+    Bounded, thread-safe LRU cache (with TTLs) of DCS user token lookups.
+
+    User tokens are checked at dcs_url.
+    Set connection to a Redis connection to share results between processes,
+        and stats_client (with stats_prefix) to send hit/miss counters and lookup timings.
+    """
+
+    def __init__(self, dcs_url:str=DEFAULT_DCS_DOMAIN, max_size:int=DCS_USER_CACHE_SIZE, ttl:float=DCS_USER_CACHE_TTL_SECONDS,
+                        negative_ttl:float=DCS_USER_NEGATIVE_TTL_SECONDS, connection=None,
+                        stats_client=None, stats_prefix:str='', logger=logging) -> None:
+        self.dcs_url = dcs_url
+        self.max_size = max_size
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.connection = connection
+        self.stats_client = stats_client
+        self.stats_prefix = stats_prefix
+        self.logger = logger
+        self.counts = {'hits':0, 'negative_hits':0, 'shared_hits':0, 'misses':0, 'errors':0}
+        self._entries:OrderedDict = OrderedDict() # token hash: (expiry time, user dict)
+        self._lock = threading.Lock()
+
+    def _count(self, count_name:str) -> None:
+        with self._lock:
+            self.counts[count_name] += 1
+        if self.stats_client is not None:
+            self.stats_client.incr(f'{self.stats_prefix}.dcs_user_cache.{count_name}')
+
+    def _get_local(self, token_hash:str) -> Optional[Dict[str,Any]]:
+        with self._lock:
+            entry = self._entries.get(token_hash)
+            if entry is None:
+                return None
+            if entry[0] <= monotonic():
+                del self._entries[token_hash]
+                return None
+            self._entries.move_to_end(token_hash)
+            return entry[1]
+
+    def _set_local(self, token_hash:str, user:Dict[str,Any], ttl:float) -> None:
+        with self._lock:
+            self._entries[token_hash] = (monotonic() + ttl, user)
+            self._entries.move_to_end(token_hash)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def _get_shared(self, token_hash:str) -> Optional[Dict[str,Any]]:
+        if self.connection is None:
+            return None
+        try:
+            cached_json = self.connection.get(f'{DCS_USER_REDIS_KEY_PREFIX}{token_hash}')
+        except Exception as e: # Redis problems mustn't stop us from checking the token
+            self.logger.warning(f"Unable to read shared DCS user cache: {e}")
+            return None
+        return None if cached_json is None else json.loads(cached_json)
+
+    def _set_shared(self, token_hash:str, user:Dict[str,Any], ttl:float) -> None:
+        if self.connection is None:
+            return
+        try:
+            self.connection.set(f'{DCS_USER_REDIS_KEY_PREFIX}{token_hash}', json.dumps(user), ex=max(1, int(ttl)))
+        except Exception as e:
+            self.logger.warning(f"Unable to write shared DCS user cache: {e}")
+
+    def _get_token_hash(self, user_token:str) -> str:
+        return sha256(f'{self.dcs_url} {user_token}'.encode('utf-8')).hexdigest()
+
+    def _get_cached(self, token_hash:str, check_shared:bool=True) -> Optional[Dict[str,Any]]:
+        user = self._get_local(token_hash)
+        if user is not None:
+            self._count('hits' if user else 'negative_hits')
+            return user
+        if check_shared:
+            user = self._get_shared(token_hash)
+            if user is not None:
+                self._count('shared_hits')
+                self._set_local(token_hash, user, self.ttl if user else self.negative_ttl)
+                return user
+        return None
+
+    def _lookup_failed(self, e:Exception) -> None:
+        self._count('errors')
+        self.logger.error(f"Unable to look up DCS user token at {self.dcs_url}: {e}")
+
+    def _send_timing(self, start_time:float) -> None:
+        if self.stats_client is not None:
+            self.stats_client.timing(f'{self.stats_prefix}.dcs_user_cache.lookup', 1000 * (monotonic() - start_time))
+
+    def get_user(self, user_token:str) -> Optional[Dict[str,Any]]:
+        """
+        Returns the DCS user dict for the given token
+            or an empty dict if the token is unknown to DCS
+            or None if DCS couldn't be reached (not cached).
+        """
+        token_hash = self._get_token_hash(user_token)
+        user = self._get_cached(token_hash)
+        if user is not None:
+            return user
+
+        self._count('misses')
+        start_time = monotonic()
+        try:
+            user = fetch_dcs_user(user_token, self.dcs_url)
+        except (URLError, OSError, ValueError) as e:
+            self._lookup_failed(e)
+            return None
+        finally:
+            self._send_timing(start_time)
+        ttl = self.ttl if user else self.negative_ttl
+        self._set_local(token_hash, user, ttl)
+        self._set_shared(token_hash, user, ttl)
+        return user
+
+    async def get_user_async(self, user_token:str, http_client=None) -> Optional[Dict[str,Any]]:
+        """
+        asyncio version of get_user()
+
+        NOTE: The (synchronous) shared Redis cache is not used here.
+        """
+        token_hash = self._get_token_hash(user_token)
+        user = self._get_cached(token_hash, check_shared=False)
+        if user is not None:
+            return user
+
+        self._count('misses')
+        start_time = monotonic()
+        try:
+            user = await fetch_dcs_user_async(user_token, self.dcs_url, http_client)
+        except Exception as e: # httpx errors don't derive from OSError
+            self._lookup_failed(e)
+            return None
+        finally:
+            self._send_timing(start_time)
+        self._set_local(token_hash, user, self.ttl if user else self.negative_ttl)
+        return user
+
+    def get_cached_user(self, user_token:str) -> Optional[Dict[str,Any]]:
+        """
+        Returns the (local) cached result of get_user() or get_user_async() for the given token
+            or None if it's not cached (without ever asking DCS or Redis).
+        """
+        return self._get_local(self._get_token_hash(user_token))
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+# end of DCSUserCache class
+
+
+# The cache used by check_posted_tx_payload
+#   (tx_enqueue_main sets the dcs_url, connection and stats_client)
+dcs_user_cache = DCSUserCache()
+
+
+def get_dcs_user(user_token:str) -> Optional[Dict[str,Any]]:
+    """
+    Returns the DCS user dict for the given user token (or a falsey value if unknown).
+    """
+    return dcs_user_cache.get_user(user_token)
+# end of get_dcs_user function
+
+
+def get_cached_dcs_user(user_token:str) -> Optional[Dict[str,Any]]:
+    """
+    Returns the DCS user dict for the given user token if it's already cached, else None.
+
+    Used by tx_enqueue_asgi.py (after get_user_async()) so that a failed lookup
+        isn't retried with a blocking call inside the event loop.
+    """
+    return dcs_user_cache.get_cached_user(user_token)
+# end of get_cached_dcs_user function
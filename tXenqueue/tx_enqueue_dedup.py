@@ -0,0 +1,203 @@
+# Added because callers retry on timeouts (and door43 can re-fire webhooks)
+#   and each duplicate job costs a full conversion in tx_job_handler
+
+"""
+tX Enqueue job de-duplication
+
+Within the de-duplication window:
+    a POST for the same (rq) job id gets back the original response dict
+        instead of a new job being queued (a "duplicate"),
+    and a POST for the same repo_owner/repo_name/commit_hash/output_format
+        (and the same resource_type, input_format, source, callback, options and dcs_domain, if any)
+        gets back the response dict of the equivalent job (a "coalesced" job)
+        but only while that job is still queued (i.e., not yet started).
+
+The stored (and returned) response dicts don't include the user_token
+    because a coalesced job can be returned to a different submitter.
+
+Jobs are claimed atomically in Redis (SET NX in a transaction)
+    so concurrent POSTs (even from different processes) can't both queue the same job.
+
+The claim logic is written as a generator which yields Redis commands
+    so that it can be run by both claim_many() and claim_many_async().
+"""
+
+# Python imports
+from typing import Any, Dict, Generator, List, Optional, Tuple
+from hashlib import sha256
+import json
+
+# Library (PyPI) imports
+from rq.job import Job, JobStatus
+
+# Local imports
+from tx_enqueue_helpers import json_default
+
+
+DEDUP_WINDOW_SECONDS = 10 * 60 # Set to zero to turn off de-duplication
+DEDUP_KEY_PREFIX = 'tx:dedup:'
+COALESCE_FIELDNAMES = 'repo_owner', 'repo_name', 'commit_hash', 'output_format'
+# Optional fields which must also match (else the job handler would do something different)
+COALESCE_OPTIONAL_FIELDNAMES = 'resource_type', 'input_format', 'source', 'callback', 'options', 'dcs_domain'
+UNSTORED_FIELDNAMES = 'user_token', # Not stored in (nor returned from) our claims
+
+NEW_JOB, DUPLICATE_JOB, COALESCED_JOB = 'new', 'duplicate', 'coalesced'
+
+# A Redis command (method name, args, kwargs) as yielded by JobDeduplicator._claim_steps()
+Command = Tuple[str, tuple, Dict[str,Any]]
+
+
+def get_coalesce_key(payload_dict:Dict[str,Any]) -> Optional[str]:
+    """
+    Returns the Redis key identifying equivalent jobs,
+        or None if the payload doesn't have all of the COALESCE_FIELDNAMES.
+
+    Any COALESCE_OPTIONAL_FIELDNAMES are also part of the key.
+    """
+    field_values:List[Any] = [payload_dict.get(fieldname) for fieldname in COALESCE_FIELDNAMES]
+    if not all(field_value and isinstance(field_value, str) for field_value in field_values):
+        return None
+    optional_fields = {fieldname: payload_dict[fieldname] for fieldname in COALESCE_OPTIONAL_FIELDNAMES
+                                                                if fieldname in payload_dict}
+    # NOTE: Canonical JSON so that the order of (e.g.) the options doesn't matter
+    content_json = json.dumps([field_values, optional_fields], sort_keys=True, default=json_default)
+    # NOTE: Hashed to bound the key length
+    return f"{DEDUP_KEY_PREFIX}content:{sha256(content_json.encode('utf-8')).hexdigest()}"
+# end of get_coalesce_key function
+
+
+class JobDeduplicator:
+    """
+    Claims rq job ids (and equivalent job contents) in Redis for window seconds.
+    """
+
+    def __init__(self, window:int=DEDUP_WINDOW_SECONDS) -> None:
+        self.window = window
+
+    def _claim_steps(self, jobs:List[Tuple[str, Dict[str,Any]]]) \
+                            -> Generator[List[Command], List[Any], List[Tuple[str, Optional[Dict[str,Any]]]]]:
+        """
+        Yields lists of Redis commands (to be run in a pipeline) and receives their results.
+
+        Returns the outcome (and original response dict if not NEW_JOB) for each job.
+        """
+        claims = []
+        commands:List[Command] = []
+        for rq_job_id, response_dict in jobs:
+            job_key = f'{DEDUP_KEY_PREFIX}job:{rq_job_id}'
+            coalesce_key = get_coalesce_key(response_dict)
+            stored_response_dict = {fieldname: value for fieldname, value in response_dict.items()
+                                                        if fieldname not in UNSTORED_FIELDNAMES}
+            claim_json = json.dumps({'rq_job_id': rq_job_id, 'response': stored_response_dict}, default=json_default)
+            claims.append((job_key, coalesce_key, claim_json))
+            commands.append(('set', (job_key, claim_json), {'nx': True, 'ex': self.window}))
+            commands.append(('get', (job_key,), {}))
+            if coalesce_key:
+                commands.append(('set', (coalesce_key, claim_json), {'nx': True, 'ex': self.window}))
+                commands.append(('get', (coalesce_key,), {}))
+        results = iter((yield commands))
+
+        outcomes:List[Tuple[str, Optional[Dict[str,Any]]]] = []
+        coalesce_candidates = [] # (index, job_key, coalesce_key, our claim, their claim)
+        for job_key, coalesce_key, claim_json in claims:
+            job_claimed, job_json = next(results), next(results)
+            coalesce_claimed, coalesce_json = (next(results), next(results)) if coalesce_key else (True, b'')
+            if not job_claimed:
+                outcomes.append((DUPLICATE_JOB, json.loads(job_json)['response']))
+                continue
+            outcomes.append((NEW_JOB, None))
+            if not coalesce_claimed:
+                coalesce_candidates.append((len(outcomes)-1, job_key, coalesce_key, claim_json, json.loads(coalesce_json)))
+        if not coalesce_candidates:
+            return outcomes
+
+        # Only coalesce with jobs which haven't been started yet
+        results = iter((yield [('hget', (Job.key_for(their_claim['rq_job_id']), 'status'), {})
+                                        for _index, _job_key, _coalesce_key, _claim_json, their_claim in coalesce_candidates]))
+        commands = []
+        for index, job_key, coalesce_key, claim_json, their_claim in coalesce_candidates:
+            job_status = next(results)
+            if job_status is not None and job_status.decode() == JobStatus.QUEUED:
+                # Retries of this job id will now also get the equivalent job
+                commands.append(('set', (job_key, json.dumps(their_claim)), {'ex': self.window}))
+                outcomes[index] = (COALESCED_JOB, their_claim['response'])
+            else: # Our job becomes the one to coalesce with
+                commands.append(('set', (coalesce_key, claim_json), {'ex': self.window}))
+        yield commands
+        return outcomes
+
+    def _run_pipeline(self, connection, commands:List[Command]) -> List[Any]:
+        with connection.pipeline() as pipeline:
+            for method_name, args, kwargs in commands:
+                getattr(pipeline, method_name)(*args, **kwargs)
+            return pipeline.execute()
+
+    async def _run_pipeline_async(self, async_connection, commands:List[Command]) -> List[Any]:
+        async with async_connection.pipeline() as pipeline:
+            for method_name, args, kwargs in commands:
+                getattr(pipeline, method_name)(*args, **kwargs)
+            return await pipeline.execute()
+
+    def claim_many(self, connection, jobs:List[Tuple[str, Dict[str,Any]]]) -> List[Tuple[str, Optional[Dict[str,Any]]]]:
+        """
+        Tries to claim each of the given (rq job id, response dict) pairs.
+
+        Returns a list of 2-tuples (in the same order):
+            NEW_JOB, DUPLICATE_JOB or COALESCED_JOB
+            None for a NEW_JOB (which the caller should now queue)
+                else the response dict of the original job
+        """
+        if self.window <= 0 or not jobs:
+            return [(NEW_JOB, None) for _job in jobs]
+        steps = self._claim_steps(jobs)
+        try:
+            commands = next(steps)
+            while True:
+                commands = steps.send(self._run_pipeline(connection, commands))
+        except StopIteration as stop:
+            return stop.value
+
+    async def claim_many_async(self, async_connection, jobs:List[Tuple[str, Dict[str,Any]]]) \
+                                        -> List[Tuple[str, Optional[Dict[str,Any]]]]:
+        """
+        asyncio version of claim_many()
+        """
+        if self.window <= 0 or not jobs:
+            return [(NEW_JOB, None) for _job in jobs]
+        steps = self._claim_steps(jobs)
+        try:
+            commands = next(steps)
+            while True:
+                commands = steps.send(await self._run_pipeline_async(async_connection, commands))
+        except StopIteration as stop:
+            return stop.value
+
+    def claim(self, connection, rq_job_id:str, response_dict:Dict[str,Any]) -> Tuple[str, Optional[Dict[str,Any]]]:
+        """
+        Tries to claim a single job (see claim_many).
+        """
+        return self.claim_many(connection, [(rq_job_id, response_dict)])[0]
+
+    async def claim_async(self, async_connection, rq_job_id:str, response_dict:Dict[str,Any]) \
+                                        -> Tuple[str, Optional[Dict[str,Any]]]:
+        """
+        asyncio version of claim()
+        """
+        return (await self.claim_many_async(async_connection, [(rq_job_id, response_dict)]))[0]
+
+    def release(self, connection, rq_job_ids:List[str]) -> None:
+        """
+        Forget our claims, e.g., if the jobs couldn't be queued after all.
+
+        NOTE: Any coalesce keys are left (they're only used while their job is queued).
+        """
+        if self.window > 0 and rq_job_ids:
+            connection.delete(*[f'{DEDUP_KEY_PREFIX}job:{rq_job_id}' for rq_job_id in rq_job_ids])
+
+    async def release_async(self, async_connection, rq_job_ids:List[str]) -> None:
+        """
+        asyncio version of release()
+        """
+        if self.window > 0 and rq_job_ids:
+            await async_connection.delete(*[f'{DEDUP_KEY_PREFIX}job:{rq_job_id}' for rq_job_id in rq_job_ids])
+# end of JobDeduplicator class
@@ -0,0 +1,139 @@
+# Added because callers poll the CDN output URL from our eta
+#   (which used to always be five minutes, whatever the queue)
+
+"""
+tX Enqueue ETA estimation
+
+Keeps exponentially weighted (moving) means and variances of the durations of finished jobs
+    for each job type (resource_type/output_format) and for each lane
+    in a Redis hash (updated by the job run time sampler in tx_enqueue_lanes).
+
+The ETA of a new job is then:
+    the jobs ahead of it in its queue (from the sampled queue metrics)
+        times the mean duration of jobs in that lane, divided between the workers,
+    plus the mean duration of jobs of its type.
+If there are enough samples, a confidence interval is also given
+    (assuming that the job durations are independent).
+"""
+
+# Python imports
+from typing import Any, Dict, List, NamedTuple, Optional, Tuple
+from math import sqrt
+import json
+
+# Library (PyPI) imports
+from rq.utils import as_text
+
+
+DEFAULT_JOB_SECONDS = 5 * 60 # Until we've seen some finished jobs
+ETA_EWMA_WEIGHT = 0.1 # Weight of the newest job duration
+ETA_CONFIDENCE_Z = 1.645 # i.e., a 90% confidence interval
+MIN_INTERVAL_SAMPLES = 5 # Samples needed before we give a confidence interval
+JOB_DURATIONS_KEY = 'tx:eta:durations' # Redis hash of job type or lane to DurationStats JSON
+
+
+class DurationStats(NamedTuple):
+    mean: float
+    variance: float
+    num_samples: int
+
+
+def get_job_type_key(payload_dict:Dict[str,Any]) -> str:
+    """
+    Returns the field name used in JOB_DURATIONS_KEY for the type of the given job payload.
+    """
+    return f"type:{payload_dict.get('resource_type', '')}/{payload_dict.get('output_format', '')}"
+# end of get_job_type_key function
+
+
+def update_duration_stats(duration_stats:Optional[DurationStats], duration:float, weight:float) -> DurationStats:
+    """
+    Adds a new duration to the exponentially weighted mean and variance.
+    """
+    if duration_stats is None:
+        return DurationStats(duration, 0.0, 1)
+    difference = duration - duration_stats.mean
+    increment = weight * difference
+    return DurationStats(duration_stats.mean + increment,
+                         (1 - weight) * (duration_stats.variance + difference * increment),
+                         duration_stats.num_samples + 1)
+# end of update_duration_stats function
+
+
+class EtaEstimator:
+    """
+    Estimates when a new job will be finished (see above).
+
+    Our local copy of the duration stats is refreshed by the job run time sampler
+        so estimating doesn't need Redis.
+    """
+
+    def __init__(self, ewma_weight:float=ETA_EWMA_WEIGHT, default_job_seconds:float=DEFAULT_JOB_SECONDS,
+                        confidence_z:float=ETA_CONFIDENCE_Z, min_interval_samples:int=MIN_INTERVAL_SAMPLES) -> None:
+        self.ewma_weight = ewma_weight
+        self.default_job_seconds = default_job_seconds
+        self.confidence_z = confidence_z
+        self.min_interval_samples = min_interval_samples
+        self._duration_stats:Dict[str,DurationStats] = {}
+
+    def record_durations(self, connection, lane:str, job_durations:List[Tuple[Dict[str,Any], float]]) -> None:
+        """
+        Adds the durations of the given (payload dict, seconds) finished jobs from the given lane.
+
+        NOTE: Only one process at a time should call this (see JobRunTimes.sample).
+        """
+        durations:Dict[str,List[float]] = {f'lane:{lane}': [duration for _payload_dict, duration in job_durations]}
+        for payload_dict, duration in job_durations:
+            durations.setdefault(get_job_type_key(payload_dict), []).append(duration)
+        stats_keys = list(durations)
+        stats_mapping = {}
+        for stats_key, stats_json in zip(stats_keys, connection.hmget(JOB_DURATIONS_KEY, stats_keys)):
+            duration_stats = DurationStats(*json.loads(stats_json)) if stats_json else None
+            for duration in durations[stats_key]:
+                duration_stats = update_duration_stats(duration_stats, duration, self.ewma_weight)
+            stats_mapping[stats_key] = json.dumps(duration_stats)
+        connection.hset(JOB_DURATIONS_KEY, mapping=stats_mapping)
+
+    def refresh(self, connection) -> Dict[str,DurationStats]:
+        """
+        Refreshes (and returns) our local copy of the duration stats.
+        """
+        self._duration_stats = {as_text(stats_key): DurationStats(*json.loads(stats_json))
+                                    for stats_key, stats_json in connection.hgetall(JOB_DURATIONS_KEY).items()}
+        return self._duration_stats
+
+    def get_lane_seconds(self, lane:str) -> Optional[float]:
+        """
+        Returns the mean duration of the jobs in the given lane (or None if none have been sampled).
+        """
+        lane_stats = self._duration_stats.get(f'lane:{lane}')
+        return lane_stats.mean if lane_stats else None
+
+    def estimate(self, payload_dict:Dict[str,Any], lane:str, queue_metrics:Dict[str,Any]) \
+                                        -> Tuple[float, Optional[Tuple[float, float]]]:
+        """
+        Given a checked job payload, its lane, and the latest sampled metrics of its queue
+
+        Returns a 2-tuple:
+            estimated seconds until the job is finished
+            None, or a 2-tuple of the earliest and latest seconds (of the confidence interval)
+        """
+        job_stats = self._duration_stats.get(get_job_type_key(payload_dict))
+        lane_stats = self._duration_stats.get(f'lane:{lane}')
+        job_seconds = job_stats.mean if job_stats else lane_stats.mean if lane_stats else self.default_job_seconds
+        jobs_ahead = queue_metrics.get('queue_length') or 0
+        # NOTE: If there are no workers, we assume that one will be restarted
+        num_workers = max(1, queue_metrics.get('worker_count') or 0)
+        wait_seconds = jobs_ahead * (lane_stats.mean if lane_stats else job_seconds) / num_workers
+        eta_seconds = wait_seconds + job_seconds
+
+        if job_stats is None or job_stats.num_samples < self.min_interval_samples \
+        or (jobs_ahead and (lane_stats is None or lane_stats.num_samples < self.min_interval_samples)):
+            return eta_seconds, None
+        variance = job_stats.variance + (jobs_ahead * lane_stats.variance / num_workers**2 if jobs_ahead and lane_stats else 0)
+        margin_seconds = self.confidence_z * sqrt(variance)
+        return eta_seconds, (max(0.0, eta_seconds - margin_seconds), eta_seconds + margin_seconds)
+# end of EtaEstimator class
+
+
+eta_estimator = EtaEstimator()
@@ -0,0 +1,102 @@
+# Added to avoid scanning every failed rq job on each POST
+
+"""
+tX Enqueue Failed Job Index
+
+rq (since v1.0) maintains a FailedJobRegistry for each queue.
+    This is a Redis sorted set keyed by the origin queue name
+        and scored by the time that the failed entry expires
+        (i.e., time of failure plus the job's failure_ttl).
+
+We use that as our per-origin index of failed jobs, so:
+    counting our failed jobs is a single ZCARD,
+    pruning is a bounded ZRANGEBYSCORE plus a pipelined delete,
+    and the expiry sweep runs in a background thread (not in the request path).
+"""
+
+# Python imports
+from typing import List
+from datetime import timedelta
+import threading
+
+# Library (PyPI) imports
+from rq.job import Job
+from rq.registry import FailedJobRegistry
+from rq.utils import current_timestamp
+
+
+FAILED_JOB_TTL = int(timedelta(weeks=2).total_seconds()) # Passed as failure_ttl (in seconds) when we enqueue jobs
+SWEEP_BATCH_SIZE = 100 # Max number of expired failed jobs deleted per queue per sweep
+SWEEP_INTERVAL_SECONDS = 15 * 60
+
+
+def get_failed_registry_key(queue_name:str) -> str:
+    """
+    Returns the Redis key of the sorted set indexing failed jobs from the given queue.
+    """
+    return FailedJobRegistry.key_template.format(queue_name)
+# end of get_failed_registry_key function
+
+
+def count_failed_jobs(queue_name:str, connection) -> int:
+    """
+    Returns the number of failed jobs that originated from the given queue.
+
+    NOTE: This doesn't prune expired entries first (unlike rq's registry.count)
+            so it stays O(1) in the request path.
+    """
+    return connection.zcard(get_failed_registry_key(queue_name))
+# end of count_failed_jobs function
+
+
+def prune_failed_jobs(queue_name:str, connection, logger, max_count:int=SWEEP_BATCH_SIZE) -> int:
+    """
+    Permanently delete (up to max_count) expired failed jobs from the given queue.
+
+    Returns the number of jobs deleted.
+    """
+    registry_key = get_failed_registry_key(queue_name)
+    expired_job_ids = connection.zrangebyscore(registry_key, '-inf', current_timestamp(),
+                                                start=0, num=max_count)
+    if not expired_job_ids:
+        return 0
+
+    with connection.pipeline() as pipeline:
+        for job_id in expired_job_ids:
+            job_id = job_id.decode() if isinstance(job_id, bytes) else job_id
+            # NOTE: rq normally lets Redis expire the job hash itself (after failure_ttl)
+            #           but older jobs may have been queued with a longer failure_ttl
+            pipeline.delete(Job.key_for(job_id), Job.dependents_key_for(job_id))
+        pipeline.zrem(registry_key, *expired_job_ids)
+        pipeline.execute()
+    logger.info(f"Deleted {len(expired_job_ids)} expired '{queue_name}' failed job(s)")
+    return len(expired_job_ids)
+# end of prune_failed_jobs function
+
+
+def start_failed_job_sweeper(queue_names:List[str], connection, logger,
+                            interval:float=SWEEP_INTERVAL_SECONDS) -> threading.Event:
+    """
+    Starts a daemon thread which periodically prunes expired failed jobs
+        from each of the given queues.
+
+    Returns an Event which can be set to stop the thread.
+    """
+    stop_event = threading.Event()
+
+    def sweep_failed_jobs() -> None:
+        while not stop_event.is_set():
+            for queue_name in queue_names:
+                try:
+                    # Keep going (in batches) until this queue has no more expired jobs
+                    while prune_failed_jobs(queue_name, connection, logger) == SWEEP_BATCH_SIZE \
+                    and not stop_event.is_set():
+                        pass
+                except Exception as e: # Don't let a Redis hiccup kill the thread
+                    logger.error(f"Failed to prune '{queue_name}' failed jobs: {e}")
+            stop_event.wait(interval)
+
+    sweeper_thread = threading.Thread(target=sweep_failed_jobs, name='failed_job_sweeper', daemon=True)
+    sweeper_thread.start()
+    return stop_event
+# end of start_failed_job_sweeper function
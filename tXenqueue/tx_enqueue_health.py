@@ -0,0 +1,48 @@
+# Added because Nagios pings went through the whole job pipeline
+#   (parsing, payload logging, and the attempted/invalid POST counts) before being recognised
+
+"""
+tX Enqueue health probes
+
+Health probes (i.e., Nagios pings, recognised by their User-Agent and empty body)
+    are answered by job_receiver before the payload is parsed or logged,
+    and are counted (as probes.<name>) rather than as attempted and invalid POSTs.
+
+Probes (and GETs of /health/) are answered from a cached readiness check
+    (see EnqueueBackends.check_ready_cached) so that frequent probes don't each use Redis.
+Unlike /health/, /ready/ still checks Redis (and each shard) every time.
+"""
+
+# Python imports
+from typing import Optional
+
+
+HEALTH_CACHE_SECONDS = 5 # Max age of the cached readiness check
+HEALTH_PROBE_USER_AGENTS = {'nagios-plugins': 'nagios'} # User-Agent substring: probe (stats) name
+MAX_PROBE_BODY_BYTES = 16
+EMPTY_PROBE_BODIES = b'', b'{}', b'null'
+NAGIOS_PING_MESSAGE = "This appears to be a Nagios ping for service availability testing."
+
+
+def get_health_probe_name(user_agent:Optional[str], content_length:Optional[int]) -> Optional[str]:
+    """
+    Returns the name of the health probe which sent a request with the given headers
+        (or None if it's not from one, or has too big a body to be a probe).
+
+    NOTE: The body should also be checked with is_probe_body().
+    """
+    if not user_agent or (content_length or 0) > MAX_PROBE_BODY_BYTES:
+        return None
+    for user_agent_part, probe_name in HEALTH_PROBE_USER_AGENTS.items():
+        if user_agent_part in user_agent:
+            return probe_name
+    return None
+# end of get_health_probe_name function
+
+
+def is_probe_body(body:bytes) -> bool:
+    """
+    Returns True if the (short) body is empty (like those of health probes).
+    """
+    return len(body) <= MAX_PROBE_BODY_BYTES and body.strip() in EMPTY_PROBE_BODIES
+# end of is_probe_body function
@@ -1,6 +1,9 @@
 import hashlib
-from datetime import datetime
+from datetime import date, datetime
 import logging
+from typing import Any
+
+from werkzeug.http import http_date
 
 
 def get_unique_job_id() -> str:
@@ -13,3 +16,13 @@ def get_unique_job_id() -> str:
         #job_id = hashlib.sha256(datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S.%f').encode('utf-8')).hexdigest()
     return job_id
 # end of get_unique_job_id()
+
+
+def json_default(some_object:Any) -> Any:
+    """
+    For json.dumps(): formats dates (e.g., tx_job_queued_at) the same way as Flask's jsonify().
+    """
+    if isinstance(some_object, date):
+        return http_date(some_object)
+    raise TypeError(f"Object of type {type(some_object).__name__} is not JSON serializable")
+# end of json_default()
@@ -0,0 +1,296 @@
+# Added so that quick jobs (e.g., an OBS HTML render) aren't stuck behind multi-hour conversions
+
+"""
+tX Enqueue lane routing
+
+Each checked job payload is routed into a lane, i.e., one of our three queues:
+    light (the _priority queue): master branch (or tag) builds of quick resources
+    heavy (the main queue): slow resources and repos, and all other branches
+    pdf (the _pdf queue): PDF jobs
+NOTE: The queue names MUST match those listened to by tx_job_handler.
+
+The lane rules are a list of dicts (see DEFAULT_LANE_RULES) which can be replaced
+    by the JSON in the LANE_RULES environment variable. Each rule has:
+        lane: the lane to use if the rule matches
+        fieldname: a list of values that the payload field must have
+        fieldname!: a list of values that the payload field (if present) must NOT have
+        min_run_seconds: the repo's jobs must have (recently) taken at least this long
+The first matching rule wins (else the default lane).
+Rules are checked and compiled when the router is created (i.e., at startup).
+
+The repo run times come from the durations of finished (and failed) jobs
+    which are sampled (by one process at a time) in a background thread
+    and kept as an exponentially weighted moving average in a Redis hash.
+The sampler also sends the wait times of each lane to Graphite
+    and gives the durations of finished jobs to the ETA estimator.
+"""
+
+# Python imports
+from typing import Any, Dict, FrozenSet, List, NamedTuple, Optional, Tuple
+from datetime import datetime
+import json
+import threading
+
+# Library (PyPI) imports
+from rq import Queue
+from rq.job import Job
+from rq.registry import FinishedJobRegistry
+from rq.utils import as_text, utcparse
+
+# Local imports
+from tx_enqueue_failed import get_failed_registry_key
+from tx_enqueue_eta import EtaEstimator, eta_estimator
+from tx_enqueue_codec import decode_job_dict
+
+
+LIGHT_LANE, HEAVY_LANE, PDF_LANE = 'light', 'heavy', 'pdf'
+LANE_QUEUE_SUFFIXES = {HEAVY_LANE: '', LIGHT_LANE: '_priority', PDF_LANE: '_pdf'}
+
+HEAVY_RUN_SECONDS = 15 * 60 # Repos whose jobs take longer than this go into the heavy lane
+DEFAULT_LANE_RULES:List[Dict[str,Any]] = [
+    {'lane': PDF_LANE, 'output_format': ['pdf']},
+    {'lane': HEAVY_LANE, 'min_run_seconds': HEAVY_RUN_SECONDS},
+    # Whole Bibles and Translation Notes (e.g., T4T) can take hours to lint and convert
+    {'lane': HEAVY_LANE, 'resource_type': ['Bible', 'Aligned_Bible', 'Greek_New_Testament', 'Hebrew_Old_Testament',
+                                            'Translation_Notes', 'TSV_Translation_Notes']},
+    {'lane': LIGHT_LANE, 'repo_ref_type': ['branch'], 'repo_ref': ['master']},
+    {'lane': LIGHT_LANE, 'repo_ref_type!': ['branch']}, # e.g., tags
+    ]
+
+RUN_TIME_EWMA_WEIGHT = 0.3 # Weight of the newest job duration
+RUN_TIMES_KEY = 'tx:lanes:run_seconds' # Redis hash of owner/repo to smoothed job duration
+RUN_TIME_CURSOR_KEY_PREFIX = 'tx:lanes:cursor:' # Highest registry score (and its job ids) already sampled
+RUN_TIME_SAMPLER_LOCK_KEY = 'tx:lanes:sampler_lock'
+RUN_TIME_SAMPLE_INTERVAL_SECONDS = 60
+MAX_SAMPLED_JOBS = 200 # Per registry per sample
+
+
+class LaneRule(NamedTuple):
+    lane: str
+    conditions: Tuple[Tuple[str, FrozenSet[str], bool], ...] # (fieldname, values, negated)
+    min_run_seconds: Optional[float]
+
+
+def compile_lane_rules(rules:List[Dict[str,Any]]) -> List[LaneRule]:
+    """
+    Checks and compiles the given lane rules (see above).
+
+    Raises ValueError if a rule isn't valid.
+    """
+    lane_rules = []
+    for rule in rules:
+        if not isinstance(rule, dict) or rule.get('lane') not in LANE_QUEUE_SUFFIXES:
+            raise ValueError(f"Lane rule needs a lane of {'/'.join(LANE_QUEUE_SUFFIXES)}: {rule}")
+        conditions, min_run_seconds = [], None
+        for fieldname, values in rule.items():
+            if fieldname == 'lane':
+                continue
+            if fieldname == 'min_run_seconds':
+                if not isinstance(values, (int, float)):
+                    raise ValueError(f"Lane rule min_run_seconds must be a number: {rule}")
+                min_run_seconds = float(values)
+                continue
+            if not isinstance(values, list) or not all(isinstance(value, str) for value in values):
+                raise ValueError(f"Lane rule '{fieldname}' must be a list of strings: {rule}")
+            negated = fieldname.endswith('!')
+            conditions.append((fieldname.rstrip('!'), frozenset(values), negated))
+        lane_rules.append(LaneRule(rule['lane'], tuple(conditions), min_run_seconds))
+    return lane_rules
+# end of compile_lane_rules function
+
+
+def get_repo_key(payload_dict:Dict[str,Any]) -> str:
+    """
+    Returns the field name used in RUN_TIMES_KEY for the repo of the given payload.
+    """
+    return f"{payload_dict.get('repo_owner', '')}/{payload_dict.get('repo_name', '')}".lower()
+# end of get_repo_key function
+
+
+class LaneRouter:
+    """
+    Decides which lane (see above) a checked job payload should go into.
+    """
+
+    def __init__(self, rules:Optional[List[Dict[str,Any]]]=None, default_lane:str=HEAVY_LANE,
+                        run_times:Optional['JobRunTimes']=None) -> None:
+        if default_lane not in LANE_QUEUE_SUFFIXES:
+            raise ValueError(f"Unknown default lane: '{default_lane}'")
+        self.rules = compile_lane_rules(DEFAULT_LANE_RULES if rules is None else rules)
+        self.default_lane = default_lane
+        self.run_times = run_times
+
+    def route(self, payload_dict:Dict[str,Any]) -> str:
+        """
+        Returns the lane of the first matching rule (else the default lane).
+        """
+        for rule in self.rules:
+            for fieldname, values, negated in rule.conditions:
+                value = payload_dict.get(fieldname)
+                if not isinstance(value, str): # e.g., missing, or a list (which isn't hashable)
+                    break # Neither matches nor doesn't match
+                if (value in values) == negated:
+                    break
+            else: # All conditions matched
+                if rule.min_run_seconds is None:
+                    return rule.lane
+                run_seconds = self.run_times.get_run_seconds(payload_dict) if self.run_times else None
+                if run_seconds is not None and run_seconds >= rule.min_run_seconds:
+                    return rule.lane
+        return self.default_lane
+# end of LaneRouter class
+
+
+class JobRunTimes:
+    """
+    Samples the durations of finished (and failed) jobs into RUN_TIMES_KEY
+        and keeps a local copy of it (so routing doesn't need Redis).
+
+    Sends the time that sampled jobs waited in each lane (as Graphite timers)
+        and how long the oldest job in each lane has been waiting (as gauges).
+
+    The durations of finished jobs are also recorded by the (optional) ETA estimator.
+    """
+
+    def __init__(self, ewma_weight:float=RUN_TIME_EWMA_WEIGHT, eta_estimator:Optional[EtaEstimator]=None) -> None:
+        self.ewma_weight = ewma_weight
+        self.eta_estimator = eta_estimator
+        self.stats_client = None # Set by EnqueueBackends
+        self.stats_prefix = ''
+        self._run_seconds:Dict[str,float] = {}
+
+    def get_run_seconds(self, payload_dict:Dict[str,Any]) -> Optional[float]:
+        """
+        Returns the smoothed job duration for the repo of the given payload
+            (or None if none of its jobs have been sampled).
+        """
+        return self._run_seconds.get(get_repo_key(payload_dict))
+
+    def _send_wait_time(self, lane:str, milliseconds:float) -> None:
+        if self.stats_client is not None:
+            self.stats_client.timing(f'{self.stats_prefix}.lanes.{lane}.wait', milliseconds)
+
+    def _sample_registry(self, connection, registry_key:str, lane:str) -> List[Tuple[Dict[str,Any], float]]:
+        """
+        Returns the (payload dict, duration) of the jobs added to the registry since the last sample.
+        """
+        cursor_key = f'{RUN_TIME_CURSOR_KEY_PREFIX}{registry_key}'
+        cursor_json = connection.get(cursor_key)
+        # NOTE: Several jobs can have the same score so we also remember the ones already sampled at that score
+        cursor_score, cursor_job_ids = json.loads(cursor_json) if cursor_json else (None, [])
+        job_ids_and_scores = [(as_text(job_id), score) for job_id, score in
+                                connection.zrangebyscore(registry_key, '-inf' if cursor_score is None else cursor_score, '+inf',
+                                            start=0, num=MAX_SAMPLED_JOBS + len(cursor_job_ids), withscores=True)]
+        job_ids = [job_id for job_id, score in job_ids_and_scores
+                    if score != cursor_score or job_id not in cursor_job_ids]
+        if not job_ids:
+            return []
+        last_score = job_ids_and_scores[-1][1]
+        connection.set(cursor_key, json.dumps([last_score,
+                            [job_id for job_id, score in job_ids_and_scores if score == last_score]]))
+        job_durations = []
+        for job in Job.fetch_many(job_ids, connection=connection):
+            if job is None or job.started_at is None or job.ended_at is None:
+                continue # Expired (or never ran)
+            if job.enqueued_at is not None:
+                self._send_wait_time(lane, 1000 * (job.started_at - job.enqueued_at).total_seconds())
+            try:
+                payload_dict = decode_job_dict(job.args[0])
+            except Exception: # Not one of our jobs
+                continue
+            if isinstance(payload_dict, dict):
+                job_durations.append((payload_dict, (job.ended_at - job.started_at).total_seconds()))
+        return job_durations
+
+    def _send_oldest_waits(self, connections:List[Any], queue_names_by_lane:Dict[str,str]) -> None:
+        now = datetime.utcnow()
+        oldest_wait_seconds_by_lane = {lane: 0.0 for lane in queue_names_by_lane}
+        for connection in connections:
+            with connection.pipeline(transaction=False) as pipeline:
+                for queue_name in queue_names_by_lane.values():
+                    pipeline.lindex(Queue.redis_queue_namespace_prefix + queue_name, 0) # Workers take from the left
+                oldest_job_ids = pipeline.execute()
+            with connection.pipeline(transaction=False) as pipeline:
+                for job_id in oldest_job_ids:
+                    if job_id:
+                        pipeline.hget(Job.key_for(as_text(job_id)), 'enqueued_at')
+                enqueued_ats = iter(pipeline.execute())
+            for lane, job_id in zip(queue_names_by_lane, oldest_job_ids):
+                enqueued_at = next(enqueued_ats) if job_id else None
+                if enqueued_at:
+                    oldest_wait_seconds_by_lane[lane] = max(oldest_wait_seconds_by_lane[lane],
+                                                            (now - utcparse(as_text(enqueued_at))).total_seconds())
+        if self.stats_client is not None:
+            for lane, oldest_wait_seconds in oldest_wait_seconds_by_lane.items():
+                self.stats_client.gauge(f'{self.stats_prefix}.lanes.{lane}.oldest_wait_seconds', round(oldest_wait_seconds))
+
+    def sample(self, connection, queue_names_by_lane:Dict[str,str],
+                        lock_seconds:float=RUN_TIME_SAMPLE_INTERVAL_SECONDS,
+                        shard_connections:Optional[List[Any]]=None) -> Dict[str,float]:
+        """
+        Samples our registries (unless another process did so within lock_seconds)
+            and then refreshes our local copy of the run times.
+
+        If shard_connections are given, the registries (and queues) on each of them are sampled instead
+            (but the run times are still kept on connection).
+
+        Returns the run times (indexed by repo key).
+        """
+        if connection.set(RUN_TIME_SAMPLER_LOCK_KEY, 1, nx=True, ex=max(1, int(lock_seconds))):
+            registry_connections = shard_connections or [connection]
+            self._send_oldest_waits(registry_connections, queue_names_by_lane)
+            durations:Dict[str,List[float]] = {}
+            for registry_connection in registry_connections:
+                for lane, queue_name in queue_names_by_lane.items():
+                    finished_job_durations = self._sample_registry(registry_connection,
+                                            FinishedJobRegistry(queue_name, connection=registry_connection).key, lane)
+                    if finished_job_durations and self.eta_estimator is not None:
+                        self.eta_estimator.record_durations(connection, lane, finished_job_durations)
+                    # NOTE: Failed jobs (e.g., timeouts) still tell us how slow a repo is
+                    for payload_dict, duration in finished_job_durations \
+                                    + self._sample_registry(registry_connection, get_failed_registry_key(queue_name), lane):
+                        durations.setdefault(get_repo_key(payload_dict), []).append(duration)
+            if durations:
+                repo_keys = list(durations)
+                run_seconds_mapping = {}
+                for repo_key, run_seconds in zip(repo_keys, connection.hmget(RUN_TIMES_KEY, repo_keys)):
+                    run_seconds = float(run_seconds) if run_seconds else None
+                    for duration in durations[repo_key]:
+                        run_seconds = duration if run_seconds is None \
+                                        else self.ewma_weight * duration + (1 - self.ewma_weight) * run_seconds
+                    run_seconds_mapping[repo_key] = run_seconds
+                connection.hset(RUN_TIMES_KEY, mapping=run_seconds_mapping)
+        self._run_seconds = {as_text(repo_key): float(run_seconds)
+                                for repo_key, run_seconds in connection.hgetall(RUN_TIMES_KEY).items()}
+        if self.eta_estimator is not None:
+            self.eta_estimator.refresh(connection)
+        return self._run_seconds
+# end of JobRunTimes class
+
+
+def start_run_time_sampler(run_times:JobRunTimes, connection, queue_names_by_lane:Dict[str,str], logger,
+                            interval:float=RUN_TIME_SAMPLE_INTERVAL_SECONDS,
+                            shard_connections:Optional[List[Any]]=None) -> threading.Event:
+    """
+    Starts a daemon thread which periodically samples our job run times.
+
+    Returns an Event which can be set to stop the thread.
+    """
+    stop_event = threading.Event()
+
+    def sample_run_times() -> None:
+        while not stop_event.is_set():
+            try:
+                run_times.sample(connection, queue_names_by_lane, lock_seconds=interval,
+                                    shard_connections=shard_connections)
+            except Exception as e: # Don't let a Redis hiccup kill the thread
+                logger.error(f"Failed to sample job run times: {e}")
+            stop_event.wait(interval)
+
+    sampler_thread = threading.Thread(target=sample_run_times, name='run_time_sampler', daemon=True)
+    sampler_thread.start()
+    return stop_event
+# end of start_run_time_sampler function
+
+
+job_run_times = JobRunTimes(eta_estimator=eta_estimator)
@@ -0,0 +1,160 @@
+# Added so that a slow (or unreachable) AWS CloudWatch never delays job_receiver
+
+"""
+tX Enqueue non-blocking logging
+
+AsyncLogHandler puts log records onto a bounded in-memory queue
+    and a background thread passes them in batches to the real
+    (slow) handler, e.g., a watchtower CloudWatchLogHandler.
+If the queue is full, records are dropped (and counted) rather than waiting.
+
+The real handler is created lazily (in the background thread)
+    so that connecting to AWS isn't done at import time either.
+
+PayloadDumpFilter samples and truncates the (potentially large) payload dumps.
+    Log these with extra={'payload_dump': True}.
+"""
+
+# Python imports
+from typing import Callable, List, Optional
+from random import random
+import logging
+import queue
+import sys
+import threading
+
+
+LOG_QUEUE_SIZE = 10_000 # records
+LOG_BATCH_SIZE = 500 # records
+LOG_FLUSH_INTERVAL_SECONDS = 2.0
+LOG_PAYLOAD_SAMPLE_RATE = 1.0 # i.e., log all payload dumps
+LOG_MAX_PAYLOAD_LENGTH = 4_000 # characters
+
+
+class PayloadDumpFilter(logging.Filter):
+    """
+    Samples (and truncates) log records marked as payload dumps
+        leaving all other records alone.
+    """
+
+    def __init__(self, sample_rate:float=LOG_PAYLOAD_SAMPLE_RATE,
+                        max_length:int=LOG_MAX_PAYLOAD_LENGTH) -> None:
+        super().__init__()
+        self.sample_rate = sample_rate
+        self.max_length = max_length
+        self.sampled_out_count = 0
+
+    def filter(self, record:logging.LogRecord) -> bool:
+        if not getattr(record, 'payload_dump', False):
+            return True
+        if self.sample_rate < 1 and random() >= self.sample_rate:
+            self.sampled_out_count += 1
+            return False
+        message = record.getMessage()
+        if len(message) > self.max_length:
+            record.msg = f"{message[:self.max_length]}… ({len(message)-self.max_length:,} more characters)"
+            record.args = None
+        return True
+# end of PayloadDumpFilter class
+
+
+class AsyncLogHandler(logging.Handler):
+    """
+    Queues log records (without ever blocking) for a background thread
+        which passes them in batches to the handler made by target_factory.
+
+    dropped_count is the number of records discarded because the queue was full
+        (or because the target handler couldn't be created).
+    """
+
+    def __init__(self, target_factory:Callable[[], logging.Handler], max_queue_size:int=LOG_QUEUE_SIZE,
+                        batch_size:int=LOG_BATCH_SIZE, flush_interval:float=LOG_FLUSH_INTERVAL_SECONDS,
+                        stats_client=None, stats_prefix:str='') -> None:
+        super().__init__()
+        self.target_factory = target_factory
+        self.target_handler:Optional[logging.Handler] = None
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.stats_client = stats_client
+        self.stats_prefix = stats_prefix
+        self.dropped_count = 0
+        self.records:queue.Queue = queue.Queue(maxsize=max_queue_size)
+        self._drop_lock = threading.Lock()
+        self._stop_event = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='async_log_flusher', daemon=True)
+        self._thread.start()
+
+    def _count_dropped(self, num_records:int) -> None:
+        with self._drop_lock:
+            self.dropped_count += num_records
+        if self.stats_client is not None:
+            self.stats_client.incr(f'{self.stats_prefix}.logging.dropped', num_records)
+
+    def prepare(self, record:logging.LogRecord) -> logging.LogRecord:
+        """
+        Format the message now (like logging.handlers.QueueHandler)
+            so that the record no longer refers to (possibly mutable) arguments.
+        """
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def emit(self, record:logging.LogRecord) -> None:
+        try:
+            self.records.put_nowait(self.prepare(record))
+        except queue.Full:
+            self._count_dropped(1)
+        except Exception:
+            self.handleError(record)
+
+    def _get_batch(self, timeout:float) -> List[logging.LogRecord]:
+        try:
+            batch = [self.records.get(timeout=timeout)]
+        except queue.Empty:
+            return []
+        while len(batch) < self.batch_size:
+            try:
+                batch.append(self.records.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _write_batch(self, batch:List[logging.LogRecord]) -> None:
+        if self.target_handler is None:
+            try:
+                self.target_handler = self.target_factory()
+            except Exception as e:
+                print(f"Unable to create log handler: {e}", file=sys.stderr)
+                self._count_dropped(len(batch))
+                return
+        for record in batch:
+            self.target_handler.handle(record)
+        self.target_handler.flush()
+
+    def _run(self) -> None:
+        while not self._stop_event.is_set():
+            batch = self._get_batch(self.flush_interval)
+            if batch:
+                try:
+                    self._write_batch(batch)
+                except Exception as e: # Keep the thread alive whatever happens
+                    print(f"Unable to write {len(batch)} log record(s): {e}", file=sys.stderr)
+                    self._count_dropped(len(batch))
+
+    def close(self, timeout:float=5.0) -> None:
+        """
+        Stop the background thread after (trying to) write any queued records.
+        """
+        self._stop_event.set()
+        self._thread.join(timeout)
+        batch = self._get_batch(0)
+        while batch:
+            self._write_batch(batch)
+            batch = self._get_batch(0)
+        if self.target_handler is not None:
+            self.target_handler.close()
+        super().close()
+# end of AsyncLogHandler class
@@ -2,7 +2,8 @@
 #   The main change was to add some vetting of the json payload before allowing the job to be queued.
 #   Updated Sept 2018 to add callback service
 
-# TODO: We don't currently have any way to clear the failed queue
+#   Updated 2026 to use rq's per-queue failed job registries (see tx_enqueue_failed.py)
+#       and to retry failed jobs after a delay (see tx_enqueue_retry.py)
 
 """
 tX Enqueue Job Main
@@ -33,28 +34,50 @@ A JSON response dict is immediately returned as a response to the caller:
         output: URL of zipfile or PDF where converted output will be able to be downloaded from
         expires_at: date & time when above output link may become invalid (one day later)
         eta: date & time when output is expected (5 minutes later)
-        tx_retry_count: 0
+        source_cache_path: optional—path of the prefetched source zip (see tx_enqueue_prefetch.py)
+        tx_retry_count: 0 (incremented each time that the job is retried after failing)
 """
 
 # Python imports
-from os import getenv, environ
+from typing import Any, Dict, List, Optional, Tuple
+from os import getenv
+from time import perf_counter
 import sys
+import json
 from datetime import datetime, timedelta
 import logging
-import boto3
-import watchtower
 
 # Library (PyPI) imports
-from flask import Flask, request, jsonify
-# NOTE: We use StrictRedis() because we don't need the backwards compatibility of Redis()
-from redis import StrictRedis
-from rq import Queue, Worker
-from statsd import StatsClient # Graphite front-end
+from flask import Blueprint, Flask, current_app, request, jsonify
+from rq import Queue
 from urllib.parse import urlparse
 
 # Local imports
-from check_posted_tx_payload import check_posted_tx_payload #, check_posted_callback_payload
+from check_posted_tx_payload import MAX_PAYLOAD_BYTES, check_payload_size, \
+                                    check_posted_tx_payload, check_tx_payload #, check_posted_callback_payload
 from tx_enqueue_helpers import get_unique_job_id
+from tx_enqueue_dcs import DEFAULT_DCS_DOMAIN, dcs_user_cache
+from tx_enqueue_failed import FAILED_JOB_TTL
+from tx_enqueue_redis import REDIS_MAX_CONNECTIONS, enqueue_job_dict
+from tx_enqueue_metrics import METRICS_SAMPLE_INTERVAL_SECONDS
+from tx_enqueue_backends import EnqueueBackends
+from tx_enqueue_dedup import DEDUP_WINDOW_SECONDS, JobDeduplicator
+from tx_enqueue_admission import ADMISSION_RATE_PER_MINUTE, ADMISSION_BURST, MAX_QUEUE_DEPTH, \
+                                    MAX_QUEUE_DEPTH_WITHOUT_WORKERS, AdmissionController, get_submitter_keys
+from tx_enqueue_lanes import LANE_QUEUE_SUFFIXES, LaneRouter, job_run_times
+from tx_enqueue_eta import eta_estimator
+from tx_enqueue_timing import TRACE_SAMPLE_RATE, PROMETHEUS_CONTENT_TYPE, stage_recorder, timed_stage
+from tx_enqueue_codec import JOB_ENCODING, job_codec
+from tx_enqueue_shards import parse_redis_shard_hostnames
+from tx_enqueue_retry import MAX_JOB_RETRIES, RETRY_BASE_DELAY_SECONDS, job_retrier
+from tx_enqueue_prefetch import PREFETCH_MAX_CONCURRENT, PREFETCH_MAX_ARCHIVE_BYTES, PREFETCH_MAX_CACHE_BYTES, \
+                                SourcePrefetcher
+from tx_enqueue_scaling import SCALING_INTERVAL_SECONDS, SCALING_TARGET_WAIT_SECONDS, SCALING_MAX_WORKERS, ScalingAdvisor
+from tx_enqueue_health import NAGIOS_PING_MESSAGE, get_health_probe_name, is_probe_body
+from tx_enqueue_spool import SPOOL_MAX_BYTES, SPOOL_LATENCY_BUDGET_SECONDS, REDIS_ERRORS, \
+                                JobSpool, SpooledJob, SpoolFullError
+from tx_enqueue_logging import LOG_QUEUE_SIZE, LOG_PAYLOAD_SAMPLE_RATE, LOG_MAX_PAYLOAD_LENGTH, \
+                                AsyncLogHandler, PayloadDumpFilter
 
 
 OUR_NAME = 'tx_job_handler' # Becomes the (perhaps prefixed) queue name (and graphite name)
@@ -65,14 +88,24 @@ DEV_PREFIX = 'dev-'
 # NOTE: The following strings if not empty, MUST have a trailing slash but NOT a leading one.
 WEBHOOK_URL_SEGMENT = '' # Leaving this blank will cause the service to run at '/'
 #CALLBACK_URL_SEGMENT = WEBHOOK_URL_SEGMENT + 'callback/'
+BATCH_URL_SEGMENT = WEBHOOK_URL_SEGMENT + 'batch/'
+READY_URL_SEGMENT = WEBHOOK_URL_SEGMENT + 'ready/'
+METRICS_URL_SEGMENT = WEBHOOK_URL_SEGMENT + 'metrics/' # Only if PROMETHEUS_METRICS is set
+SCALING_URL_SEGMENT = WEBHOOK_URL_SEGMENT + 'scaling/'
+HEALTH_URL_SEGMENT = WEBHOOK_URL_SEGMENT + 'health/'
+MAX_BATCH_SIZE = 500 # Max number of job payloads accepted in one batch POST
+MAX_BATCH_BYTES = 4 * 1024 * 1024 # Larger batch POSTs are rejected before the JSON is parsed
 
 # Look at relevant environment variables
 prefix = getenv('QUEUE_PREFIX', '') # Gets (optional) QUEUE_PREFIX environment variable—set to 'dev-' for development
 prefixed_our_name = prefix + OUR_NAME
 
+JOB_RESULT_TTL = 60 * 60 * 24 # seconds
 JOB_TIMEOUT = '10800s' # Then a running job (taken out of the queue) will be considered to have failed
     # NOTE: This is the time until webhook.py returns after running the jobs.
     #       T4T is definitely one of our largest/slowest resources to lint and convert
+SPOOLED_JOB_KWARGS = {'timeout': JOB_TIMEOUT, 'result_ttl': JOB_RESULT_TTL, 'failure_ttl': FAILED_JOB_TTL}
+SPOOL_FULL_RETRY_AFTER_SECONDS = 60
 
 # Get the redis URL from the environment, otherwise use a local test instance
 redis_hostname = getenv('REDIS_HOSTNAME', 'redis')
@@ -85,10 +118,8 @@ logger = logging.getLogger(prefixed_our_name)
 sh = logging.StreamHandler(sys.stdout)
 sh.setFormatter(logging.Formatter('%(asctime)s - %(levelname)s: %(message)s'))
 logger.addHandler(sh)
-aws_access_key_id = environ['AWS_ACCESS_KEY_ID']
-boto3_client = boto3.client("logs", aws_access_key_id=aws_access_key_id,
-                        aws_secret_access_key=environ['AWS_SECRET_ACCESS_KEY'],
-                        region_name='us-west-2')
+aws_access_key_id = getenv('AWS_ACCESS_KEY_ID', '')
+aws_secret_access_key = getenv('AWS_SECRET_ACCESS_KEY', '')
 test_mode_flag = getenv('TEST_MODE', '')
 travis_flag = getenv('TRAVIS_BRANCH', '')
 log_group_name = f"{'' if test_mode_flag or travis_flag else prefix}tX" \
@@ -97,11 +128,35 @@ log_group_name = f"{'' if test_mode_flag or travis_flag else prefix}tX" \
                  f"{'_TravisCI' if travis_flag else ''}"
 # Enable DEBUG logging for dev- instances (but less logging for production)
 logger.setLevel(logging.DEBUG if prefix else logging.INFO)
-watchtower_log_handler = watchtower.CloudWatchLogHandler(boto3_client=boto3_client,
+# Sample (and truncate) the large payload dumps
+logger.addFilter(PayloadDumpFilter(sample_rate=float(getenv('LOG_PAYLOAD_SAMPLE_RATE', LOG_PAYLOAD_SAMPLE_RATE)),
+                                    max_length=int(getenv('LOG_MAX_PAYLOAD_LENGTH', LOG_MAX_PAYLOAD_LENGTH))))
+
+# Send our logs to AWS CloudWatch via a bounded queue and a background thread
+def create_watchtower_log_handler() -> logging.Handler:
+    """
+    Called (once) from the background logging thread
+        so that importing boto3 and connecting to AWS CloudWatch
+        never delays startup or a request.
+    """
+    import boto3
+    import watchtower
+    boto3_client = boto3.client("logs", aws_access_key_id=aws_access_key_id,
+                            aws_secret_access_key=aws_secret_access_key,
+                            region_name='us-west-2')
+    return watchtower.CloudWatchLogHandler(boto3_client=boto3_client,
                                             log_group_name=log_group_name,
                                             stream_name=prefixed_our_name)
-logger.addHandler(watchtower_log_handler)
-logger.debug(f"Logging to AWS CloudWatch group '{log_group_name}' using key '…{aws_access_key_id[-2:]}'.")
+# end of create_watchtower_log_handler function
+
+cloudwatch_log_handler:Optional[AsyncLogHandler] = None
+if aws_access_key_id and aws_secret_access_key:
+    cloudwatch_log_handler = AsyncLogHandler(create_watchtower_log_handler,
+                                    max_queue_size=int(getenv('LOG_QUEUE_SIZE', LOG_QUEUE_SIZE)))
+    logger.addHandler(cloudwatch_log_handler)
+    logger.debug(f"Logging to AWS CloudWatch group '{log_group_name}' using key '…{aws_access_key_id[-2:]}'.")
+else:
+    logger.warning("No AWS_ACCESS_KEY_ID and AWS_SECRET_ACCESS_KEY so not logging to AWS CloudWatch")
 
 # Setup queue variables
 QUEUE_NAME_SUFFIX = '' # Used to switch to a different queue, e.g., '_1'
@@ -111,65 +166,235 @@ if prefix:
     our_adjusted_convert_queue_name = prefix + OUR_NAME + QUEUE_NAME_SUFFIX # Will become our main queue name
 else:
     our_adjusted_convert_queue_name = OUR_NAME + QUEUE_NAME_SUFFIX # Will become our main queue name
+our_lane_queue_names = {lane: our_adjusted_convert_queue_name + lane_suffix
+                            for lane, lane_suffix in LANE_QUEUE_SUFFIXES.items()}
+our_queue_names = list(our_lane_queue_names.values())
+our_lanes_by_queue_name = {queue_name: lane for lane, queue_name in our_lane_queue_names.items()}
 # NOTE: The prefixed version must also listen at a different port (specified in gunicorn run command)
 #our_callback_name = our_adjusted_convert_queue_name + CALLBACK_SUFFIX
 
 prefix_string = f" with prefix '{prefix}'" if prefix else ""
 logger.info(f"tx_enqueue_main.py{prefix_string}{test_string} running on Python v{sys.version}")
 
-# Connect to Redis now so it fails at import time if no Redis instance available
-logger.info(f"redis_hostname is '{redis_hostname}'")
-logger.debug(f"{prefixed_our_name} connecting to Redis…")
-redis_connection = StrictRedis(host=redis_hostname)
-logger.debug("Getting total worker count in order to verify working Redis connection…")
-total_rq_worker_count = Worker.count(connection=redis_connection)
-logger.debug(f"Total rq workers = {total_rq_worker_count}")
-
 # Get the Graphite URL from the environment, otherwise use a local test instance
 graphite_url = getenv('GRAPHITE_HOSTNAME', 'localhost')
-logger.info(f"graphite_url is '{graphite_url}'")
 tx_stats_prefix = f"tx.{'dev' if prefix else 'prod'}"
 enqueue_job_stats_prefix = f"{tx_stats_prefix}.enqueue-job"
-stats_client = StatsClient(host=graphite_url, port=8125)
 
 TX_JOB_CDN_BUCKET = f'https://{prefix}cdn.door43.org/tx/job/'
 PDF_CDN_BUCKET = f'https://{prefix}cdn.door43.org/u/'
 
-app = Flask(__name__)
-# Not sure that we need this Flask logging
-# app.logger.addHandler(watchtower_log_handler)
-# logging.getLogger('werkzeug').addHandler(watchtower_log_handler)
-logger.info(f"{prefixed_our_name} is up and ready to go")
+# Check user tokens at our own DCS (never at the dcs_domain given in the payload)
+dcs_user_cache.dcs_url = getenv('DCS_URL', DEFAULT_DCS_DOMAIN)
+# Don't queue the same job (or an equivalent one) again within this window
+job_deduplicator = JobDeduplicator(window=int(getenv('DEDUP_WINDOW_SECONDS', DEDUP_WINDOW_SECONDS)))
+# Shed load rather than let our queues grow beyond what the job handlers can process
+admission_controller = AdmissionController(
+            rate_per_minute=float(getenv('ADMISSION_RATE_PER_MINUTE', ADMISSION_RATE_PER_MINUTE)),
+            burst=int(getenv('ADMISSION_BURST', ADMISSION_BURST)),
+            max_queue_depth=int(getenv('MAX_QUEUE_DEPTH', MAX_QUEUE_DEPTH)),
+            max_queue_depth_without_workers=int(getenv('MAX_QUEUE_DEPTH_WITHOUT_WORKERS', MAX_QUEUE_DEPTH_WITHOUT_WORKERS)))
+# Time the stages of each POST (and trace a sample of them)
+stage_recorder.logger = logger
+stage_recorder.default_trace_sample_rate = stage_recorder.trace_sample_rate = \
+                                                float(getenv('TRACE_SAMPLE_RATE', TRACE_SAMPLE_RATE))
+TIMED_ENDPOINTS = 'job_receiver', 'batch_job_receiver'
+prometheus_metrics_flag = bool(getenv('PROMETHEUS_METRICS', ''))
+# Keep quick jobs out of the queue of slow ones (NOTE: Bad LANE_RULES JSON stops us starting)
+lane_rules_json = getenv('LANE_RULES')
+lane_router = LaneRouter(rules=json.loads(lane_rules_json) if lane_rules_json else None, run_times=job_run_times)
+# Keep accepting jobs (onto local disk) if Redis is unavailable or slow (NOTE: Off unless SPOOL_DIRECTORY is set)
+job_spool = JobSpool(getenv('SPOOL_DIRECTORY', ''), max_bytes=int(getenv('SPOOL_MAX_BYTES', SPOOL_MAX_BYTES)),
+                    latency_budget=float(getenv('SPOOL_LATENCY_BUDGET', SPOOL_LATENCY_BUDGET_SECONDS)), logger=logger)
+job_spool.deduplicator, job_spool.max_queue_depth = job_deduplicator, admission_controller.max_queue_depth # For replaying
+# Queue smaller (opt-in) encodings of our jobs (NOTE: tx_job_handler must be able to decode them first)
+job_codec.encoding = getenv('JOB_ENCODING', JOB_ENCODING)
+# Requeue failed jobs (with exponential backoff) in case they failed from a transient error
+job_retrier.max_retries = int(getenv('MAX_JOB_RETRIES', MAX_JOB_RETRIES))
+job_retrier.base_delay = float(getenv('RETRY_BASE_DELAY', RETRY_BASE_DELAY_SECONDS))
+# Download source zips (only from DCS_URL) while their jobs are queued (NOTE: Off unless PREFETCH_DIRECTORY is set)
+source_prefetcher = SourcePrefetcher(getenv('PREFETCH_DIRECTORY', ''),
+                    max_concurrent=int(getenv('PREFETCH_MAX_CONCURRENT', PREFETCH_MAX_CONCURRENT)),
+                    max_archive_bytes=int(getenv('PREFETCH_MAX_ARCHIVE_BYTES', PREFETCH_MAX_ARCHIVE_BYTES)),
+                    max_cache_bytes=int(getenv('PREFETCH_MAX_CACHE_BYTES', PREFETCH_MAX_CACHE_BYTES)),
+                    dcs_url=dcs_user_cache.dcs_url, logger=logger)
+# Recommend how many workers each queue needs (for the orchestrator)
+scaling_advisor = ScalingAdvisor(our_lane_queue_names, eta_estimator,
+                    target_wait_seconds=float(getenv('SCALING_TARGET_WAIT', SCALING_TARGET_WAIT_SECONDS)),
+                    max_workers=int(getenv('SCALING_MAX_WORKERS', SCALING_MAX_WORKERS)))
+
+enqueue_blueprint = Blueprint('tx_enqueue', __name__)
+
+
+def create_backends() -> EnqueueBackends:
+    """
+    Creates our (lazily connected) backends as configured by the environment.
+    """
+    return EnqueueBackends(redis_hostname, our_queue_names, enqueue_job_stats_prefix, logger,
+                graphite_hostname=graphite_url,
+                redis_max_connections=int(getenv('REDIS_MAX_CONNECTIONS', REDIS_MAX_CONNECTIONS)),
+                metrics_interval=float(getenv('METRICS_SAMPLE_INTERVAL', METRICS_SAMPLE_INTERVAL_SECONDS)),
+                share_dcs_user_cache=bool(getenv('DCS_USER_CACHE_SHARED', '')),
+                stats_users=[source_prefetcher] + ([cloudwatch_log_handler] if cloudwatch_log_handler else []),
+                lane_queue_names=our_lane_queue_names,
+                spool=job_spool,
+                redis_shard_hostnames=parse_redis_shard_hostnames(getenv('REDIS_SHARD_HOSTNAMES', '')),
+                job_retrier=job_retrier,
+                scaling_advisor=scaling_advisor)
+# end of create_backends function
+
+
+def create_app(backends:Optional[EnqueueBackends]=None) -> Flask:
+    """
+    Creates our Flask app
+        and starts its backends (the Redis connection and background threads)
+        unless we're being loaded by gunicorn
+        (which might be in its master process, i.e., before forking the workers,
+        so gunicorn.conf.py starts them in each worker instead).
+
+    NOTE: Graphite is not connected to until first needed
+            and the backends of tests don't start any background threads.
+    """
+    if backends is None:
+        backends = create_backends()
+    flask_app = Flask(__name__)
+    # Also limits bodies sent without a Content-Length (which the routes can't check in advance)
+    flask_app.config['MAX_CONTENT_LENGTH'] = MAX_BATCH_BYTES
+    flask_app.extensions['tx_enqueue_backends'] = backends
+    if not getenv('SERVER_SOFTWARE', '').startswith('gunicorn/'):
+        backends.start()
+    flask_app.register_blueprint(enqueue_blueprint)
+    flask_app.before_request(start_request_timer)
+    flask_app.after_request(finish_request_timer)
+    flask_app.teardown_request(abandon_request_timer)
+    if prometheus_metrics_flag:
+        flask_app.add_url_rule('/'+METRICS_URL_SEGMENT, view_func=prometheus_metrics, methods=['GET'])
+    # Not sure that we need this Flask logging
+    # flask_app.logger.addHandler(cloudwatch_log_handler)
+    # logging.getLogger('werkzeug').addHandler(cloudwatch_log_handler)
+    return flask_app
+# end of create_app function
+
+
+def start_request_timer() -> None:
+    """
+    Called by Flask before each request.
+    """
+    endpoint = (request.endpoint or '').rsplit('.', 1)[-1]
+    if endpoint in TIMED_ENDPOINTS \
+    and not get_health_probe_name(request.headers.get('User-Agent'), request.content_length):
+        stage_recorder.start_request(endpoint)
+# end of start_request_timer function
+
 
-def handle_failed_queue(our_queue_name:str) -> int:
+def finish_request_timer(response):
+    """
+    Called by Flask after each (successful) request.
     """
-    Go through the failed queue, and see how many entries originated from our queue.
+    stage_recorder.finish_request(str(response.status_code))
+    return response
+# end of finish_request_timer function
 
-    Of those, permanently delete any that are older than two weeks old.
+
+def abandon_request_timer(_error) -> None:
+    """
+    Called by Flask after each request (even if it raised an exception).
     """
-    failed_queue = Queue('failed', connection=redis_connection)
-    len_failed_queue = len(failed_queue)
-    if len_failed_queue:
-        logger.debug(f"There are {len_failed_queue} total jobs in failed queue")
+    stage_recorder.finish_request('error') # Does nothing if already finished
+# end of abandon_request_timer function
 
-    len_our_failed_queue = 0
-    for failed_job in failed_queue.jobs.copy():
-        if failed_job.origin == our_queue_name:
-            failed_duration = datetime.utcnow() - failed_job.enqueued_at
-            if failed_duration >= timedelta(weeks=2):
-                logger.info(f"Deleting expired '{our_queue_name}' failed job from {failed_job.enqueued_at}")
-                failed_job.delete() # .cancel() doesn't delete the Redis hash
-            else:
-                len_our_failed_queue += 1
 
-    if len_our_failed_queue:
-        logger.info(f"Have {len_our_failed_queue} of our jobs in failed queue")
-    return len_our_failed_queue
-# end of handle_failed_queue function
+def get_backends() -> EnqueueBackends:
+    """
+    Returns the backends of the current Flask app.
+    """
+    return current_app.extensions['tx_enqueue_backends']
+# end of get_backends function
+
+
+def get_our_queue_name(payload_dict:Dict[str,Any]) -> str:
+    """
+    Decide which of our three queues (lanes) a checked job payload should go into.
+    """
+    return our_lane_queue_names[lane_router.route(payload_dict)]
+# end of get_our_queue_name function
+
+
+def build_our_response_dict(payload_dict:Dict[str,Any], our_adjusted_queue_name:str,
+                            queue_metrics:Optional[Dict[str,Any]]=None) -> Dict[str,Any]:
+    """
+    Extend the given (checked) payload dict to add our required fields.
+
+    The eta is estimated from the latest sampled metrics of the queue (if given)
+        and the source archive is prefetched (if PREFETCH_DIRECTORY is set).
+
+    The result is both queued (for the job handler) and returned to the caller.
+    """
+    our_job_id = payload_dict['job_id'] if 'job_id' in payload_dict \
+                    else get_unique_job_id()
+    expected_output_URL = f"{TX_JOB_CDN_BUCKET}{our_job_id}.zip"
+
+    our_response_dict = dict(payload_dict)
+    our_response_dict.update({ \
+                        'success': True,
+                        'status': 'queued',
+                        'queue_name': our_adjusted_queue_name,
+                        'tx_job_queued_at': datetime.utcnow(),
+                        })
+    if 'job_id' not in our_response_dict:
+        our_response_dict['job_id'] = our_job_id
+    if 'identifier' not in our_response_dict:
+        our_response_dict['identifier'] = our_job_id
+    our_response_dict['output'] = expected_output_URL
+    our_response_dict['expires_at'] = our_response_dict['tx_job_queued_at'] + timedelta(days=1)
+    eta_seconds, eta_interval = eta_estimator.estimate(payload_dict, our_lanes_by_queue_name[our_adjusted_queue_name],
+                                                        queue_metrics or {})
+    our_response_dict['eta'] = our_response_dict['tx_job_queued_at'] + timedelta(seconds=round(eta_seconds))
+    if eta_interval is not None:
+        our_response_dict['eta_earliest'], our_response_dict['eta_latest'] = \
+            [our_response_dict['tx_job_queued_at'] + timedelta(seconds=round(seconds)) for seconds in eta_interval]
+    our_response_dict['tx_retry_count'] = 0
+    return our_response_dict
+# end of build_our_response_dict function
+
+
+def prefetch_source(our_response_dict:Dict[str,Any]) -> None:
+    """
+    Starts prefetching the source zip of a job which is about to be queued (or spooled)
+        and adds its source_cache_path (if any) to the response dict.
+
+    NOTE: Only call this once the job has been claimed and admitted
+            so that duplicate and shed POSTs don't start (large) downloads.
+    """
+    source_cache_path = source_prefetcher.prefetch(our_response_dict)
+    if source_cache_path is not None:
+        our_response_dict['source_cache_path'] = source_cache_path
+# end of prefetch_source function
+
+
+def payload_too_large(error_dict:Dict[str,Any], stats_name:str):
+    """
+    Returns the 413 response for an oversized POST (and counts it).
+    """
+    get_backends().stats_client.incr(f'{enqueue_job_stats_prefix}.{stats_name}.too_large')
+    error_dict['status'] = 'invalid'
+    logger.error(f"{prefixed_our_name} ignored oversized POST; responding with {error_dict}\n")
+    return jsonify(error_dict), 413
+# end of payload_too_large function
+
+
+@enqueue_blueprint.app_errorhandler(413)
+def request_entity_too_large(_error):
+    """
+    Flask rejects bodies larger than MAX_CONTENT_LENGTH (without a Content-Length header) here.
+    """
+    return payload_too_large({'error': f'Payload too large — maximum is {MAX_BATCH_BYTES:,} bytes'}, 'posts')
+# end of request_entity_too_large function
+
 
 # This is the main workhorse part of this code
 #   rq automatically returns a "Method Not Allowed" error for a GET, etc.
-@app.route('/'+WEBHOOK_URL_SEGMENT, methods=['POST'])
+@enqueue_blueprint.route('/'+WEBHOOK_URL_SEGMENT, methods=['POST'])
 def job_receiver():
     """
     Accepts POST requests and checks the (json) payload
@@ -177,8 +402,13 @@ def job_receiver():
     Queues the approved jobs at redis instance at global redis_hostname:6379.
     Queue name is our_adjusted_convert_queue_name (may have been prefixed).
     """
-    global our_adjusted_convert_queue_name
     #assert request.method == 'POST'
+    backends = get_backends()
+    stats_client = backends.stats_client
+    # Answer health probes (e.g., Nagios pings) before doing anything else
+    probe_name = get_health_probe_name(request.headers.get('User-Agent'), request.content_length)
+    if probe_name and is_probe_body(request.get_data()):
+        return answer_health_probe(backends, probe_name)
     stats_client.incr(f'{enqueue_job_stats_prefix}.posts.attempted')
     logger.info(f"tX {'('+prefix+')' if prefix else ''} enqueue received request: {request}")
 
@@ -196,93 +426,375 @@ def job_receiver():
     #     data['repo_data_url'] = data['release']['zipball_url']
     #     data['dcs_domain'] = '{uri.scheme}://{uri.netloc}'.format(uri=urlparse(data['source']))
 
+    error_dict = check_payload_size(request.content_length, MAX_PAYLOAD_BYTES)
+    if error_dict:
+        return payload_too_large(error_dict, 'posts')
+
     response_ok_flag, response_dict = check_posted_tx_payload(request, logger)
     # response_dict is json payload if successful, else error info
     if response_ok_flag:
         logger.debug("tx-enqueue-job processing good payload…")
 
-        our_adjusted_queue_name = our_adjusted_convert_queue_name
-        if response_dict["output_format"] == "pdf":
-            our_adjusted_queue_name += "_pdf"
-        elif 'repo_ref_type' in response_dict and 'repo_ref' in response_dict and \
-              (response_dict['repo_ref_type'] == "branch" and response_dict['repo_ref'] == "master") or \
-                (response_dict['repo_ref_type'] != "branch"):
-                our_adjusted_queue_name += "_priority"
-
-        # Collect and log some helpful information for all three queues
-        queue = Queue(our_adjusted_queue_name, connection=redis_connection)
-        len_queue = len(queue)
-        stats_client.gauge(f'{enqueue_job_stats_prefix}.queue.{our_adjusted_queue_name}.length.current', len_queue)
-        len_failed_queue = handle_failed_queue(our_adjusted_queue_name)
-        stats_client.gauge(f'{enqueue_job_stats_prefix}.queue.{our_adjusted_queue_name}.length.failed', len_failed_queue)
-
-        # Find out how many workers we have
-        total_worker_count = Worker.count(connection=redis_connection)
-        logger.debug(f"Total rq workers = {total_worker_count}")
-        queue1_worker_count = Worker.count(queue=queue)
-        logger.debug(f"Our {our_adjusted_queue_name} queue workers = {queue1_worker_count}")
-        stats_client.gauge(f'{enqueue_job_stats_prefix}.workers.{our_adjusted_queue_name}.available', queue1_worker_count)
-        if queue1_worker_count < 1:
-            logger.critical(f"{prefixed_our_name} has no job handler workers running!")
-        # Go ahead and queue the job anyway for when a worker is restarted
-
-        our_job_id = response_dict['job_id'] if 'job_id' in response_dict \
-                        else get_unique_job_id()
-
-        our_queue = queue
-        expected_output_URL = f"{TX_JOB_CDN_BUCKET}{our_job_id}.zip"
-
-        # Extend the given payload (dict) to add our required fields
-        #logger.debug("Building our response dict…")
-        our_response_dict = dict(response_dict)
-        our_response_dict.update({ \
-                            'success': True,
-                            'status': 'queued',
-                            'queue_name': our_adjusted_queue_name,
-                            'tx_job_queued_at': datetime.utcnow(),
-                            })
-        if 'job_id' not in our_response_dict:
-            our_response_dict['job_id'] = our_job_id
-        if 'identifier' not in our_response_dict:
-            our_response_dict['identifier'] = our_job_id
-        our_response_dict['output'] = expected_output_URL
-        our_response_dict['expires_at'] = our_response_dict['tx_job_queued_at'] + timedelta(days=1)
-        our_response_dict['eta'] = our_response_dict['tx_job_queued_at'] + timedelta(minutes=5)
-        our_response_dict['tx_retry_count'] = 0
-        logger.debug(f"About to queue job: {our_response_dict}")
-
-        # NOTE: No ttl specified on the next line—this seems to cause unrun jobs to be just silently dropped
-        #           (For now at least, we prefer them to just stay in the queue if they're not getting processed.)
-        #       The timeout value determines the max run time of the worker once the job is accessed
-        our_queue.enqueue('webhook.job', our_response_dict, job_timeout=JOB_TIMEOUT, job_id=f'{our_queue.name}_{our_job_id}', result_ttl=(60*60*24)) # A function named webhook.job will be called by the worker
-        # NOTE: The above line can return a result from the webhook.job function. (By default, the result remains available for 500s.)
-
-        # Find out who our workers are
-        #workers = Worker.all(connection=redis_connection) # Returns the actual worker objects
-        #logger.debug(f"Total rq workers ({len(workers)}): {workers}")
-        #our_queue_workers = Worker.all(queue=our_queue)
-        #logger.debug(f"Our {our_adjusted_queue_name} queue workers ({len(our_queue_workers)}): {our_queue_workers}")
-
-        # Find out how many workers we have
-        #worker_count = Worker.count(connection=redis_connection)
-        #logger.debug(f"Total rq workers = {worker_count}")
-        #our_queue_worker_count = Worker.count(queue=our_queue)
-        #logger.debug(f"Our {our_adjusted_queue_name} queue workers = {our_queue_worker_count}")
-
-        len_our_queue = len(our_queue) # Update
-        logger.info(f"{prefixed_our_name} queued valid job to {our_adjusted_queue_name} queue " \
-                    f"({len_our_queue} jobs now " \
-                        f"for {Worker.count(queue=our_queue)} workers, " \
-                    f"{len_failed_queue} failed jobs), " \
-                    f"at {datetime.utcnow()}\n")
-        stats_client.incr(f'{enqueue_job_stats_prefix}.posts.succeeded')
-        return jsonify(our_response_dict)
+        our_adjusted_queue_name = get_our_queue_name(response_dict)
+        # The latest metrics from the background sampler
+        queue_metrics = backends.metrics_sampler.get_metrics(our_adjusted_queue_name)
+
+        our_response_dict = build_our_response_dict(response_dict, our_adjusted_queue_name, queue_metrics)
+        rq_job_id = f"{our_adjusted_queue_name}_{our_response_dict['job_id']}"
+
+        if job_spool.should_spool(): # Redis is unavailable (or we're still replaying earlier spooled jobs)
+            return spool_jobs([(our_adjusted_queue_name, rq_job_id, our_response_dict)], 'posts')
+        try:
+            return queue_job(backends, our_adjusted_queue_name, rq_job_id, our_response_dict, queue_metrics)
+        except REDIS_ERRORS as e:
+            if not job_spool.enabled:
+                raise
+            job_spool.note_redis_failure(f"failed: {e}")
+            return spool_jobs([(our_adjusted_queue_name, rq_job_id, our_response_dict)], 'posts')
     else:
         stats_client.incr(f'{enqueue_job_stats_prefix}.posts.invalid')
         response_dict['status'] = 'invalid'
-        logger.error(f"{prefixed_our_name} ignored invalid payload; responding with {response_dict}\n")
+        logger.error(f"{prefixed_our_name} ignored invalid payload; responding with {response_dict}\n", extra={'payload_dump': True})
         return jsonify(response_dict), 400
 # end of job_receiver()
 
+
+def answer_health_probe(backends:EnqueueBackends, probe_name:str):
+    """
+    Returns the response to a health probe POSTed to job_receiver (from the cached readiness check).
+
+    NOTE: The response (a 400, or a 503 if we're not ready) is what Nagios has always been sent.
+    """
+    backends.stats_client.incr(f'{enqueue_job_stats_prefix}.probes.{probe_name}')
+    ready_flag, _status_dict = backends.check_ready_cached()
+    response_dict = {'error': NAGIOS_PING_MESSAGE, 'status': 'invalid', 'ready': ready_flag}
+    return jsonify(response_dict), 400 if ready_flag else 503
+# end of answer_health_probe function
+
+
+def queue_job(backends:EnqueueBackends, our_adjusted_queue_name:str, rq_job_id:str,
+                our_response_dict:Dict[str,Any], queue_metrics:Dict[str,Any]):
+    """
+    Queues a checked job (unless it's a duplicate or it's shed) for job_receiver.
+
+    Returns the Flask response.
+    """
+    stats_client = backends.stats_client
+    # NOTE: The job and its de-duplication claims are on its Redis shard (the only one unless sharded)
+    job_connection = backends.get_job_connection(our_response_dict)
+    our_queue = Queue(our_adjusted_queue_name, connection=job_connection)
+    # Callers retry (and webhooks can be re-fired) so return the original job if there is one
+    with timed_stage('dedup'):
+        dedup_outcome, original_response_dict = job_deduplicator.claim(job_connection,
+                                                                rq_job_id, our_response_dict)
+    if original_response_dict is not None:
+        logger.info(f"{prefixed_our_name} didn't queue {dedup_outcome} job {rq_job_id}; " \
+                    f"responding with original job {original_response_dict['job_id']}\n")
+        stats_client.incr(f'{enqueue_job_stats_prefix}.posts.{dedup_outcome}')
+        return jsonify(original_response_dict)
+    logger.debug(f"About to queue job: {our_response_dict}", extra={'payload_dump': True})
+
+    # Log (and alert) using the latest metrics from the background sampler
+    len_failed_queue = queue_metrics.get('failed_length', '?')
+    queue1_worker_count = queue_metrics.get('worker_count')
+    if queue1_worker_count is not None:
+        logger.debug(f"Our {our_adjusted_queue_name} queue workers = {queue1_worker_count}")
+        if queue1_worker_count < 1:
+            logger.critical(f"{prefixed_our_name} has no job handler workers running!")
+    # Go ahead and queue the job anyway for when a worker is restarted
+    #   (unless the queue is already too deep, or this submitter has sent too many jobs)
+    with timed_stage('admission'):
+        rejection_dict = admission_controller.check_queue_depth(queue_metrics) \
+                    or admission_controller.take_tokens(backends.redis_connection,
+                                                        [(get_submitter_keys(our_response_dict), 1)])[0]
+    if rejection_dict:
+        job_deduplicator.release(job_connection, [rq_job_id])
+        stats_client.incr(f"{enqueue_job_stats_prefix}.posts.shed.{rejection_dict['reason']}")
+        logger.warning(f"{prefixed_our_name} shed job {rq_job_id}; responding with {rejection_dict}\n")
+        return jsonify(rejection_dict), 429, {'Retry-After': str(rejection_dict['retry_after'])}
+
+    # NOTE: No ttl specified on the next line—this seems to cause unrun jobs to be just silently dropped
+    #           (For now at least, we prefer them to just stay in the queue if they're not getting processed.)
+    #       The timeout value determines the max run time of the worker once the job is accessed
+    prefetch_source(our_response_dict)
+    try:
+        with timed_stage('enqueue'):
+            enqueue_start_time = perf_counter()
+            _job, len_our_queue = enqueue_job_dict(our_queue, our_response_dict,
+                                    timeout=JOB_TIMEOUT, job_id=rq_job_id,
+                                    result_ttl=JOB_RESULT_TTL, failure_ttl=FAILED_JOB_TTL) # A function named webhook.job will be called by the worker
+            job_spool.note_enqueue_seconds(perf_counter() - enqueue_start_time) # Spool the next jobs if Redis is slow
+    except Exception:
+        job_deduplicator.release(job_connection, [rq_job_id])
+        raise
+    # NOTE: The above job can return a result from the webhook.job function. (By default, the result remains available for 500s.)
+
+    logger.info(f"{prefixed_our_name} queued valid job to {our_adjusted_queue_name} queue " \
+                f"({len_our_queue} jobs now " \
+                    f"for {'?' if queue1_worker_count is None else queue1_worker_count} workers, " \
+                f"{len_failed_queue} failed jobs), " \
+                f"at {datetime.utcnow()}\n")
+    stats_client.incr(f'{enqueue_job_stats_prefix}.posts.succeeded')
+    scaling_advisor.record_arrivals(our_adjusted_queue_name)
+    return jsonify(our_response_dict)
+# end of queue_job function
+
+
+def spool_jobs(queue_jobs:List[Tuple[str, str, Dict[str,Any]]], stats_name:str,
+                results_list:Optional[List[Dict[str,Any]]]=None, num_invalid:int=0):
+    """
+    Appends the given (queue name, rq job id, response dict) checked jobs to our disk spool
+        (to be replayed into Redis when it recovers).
+
+    Give the results_list (with num_invalid) of a batch to get the batch response.
+
+    Returns the Flask response, or the 503 response if the spool is full.
+    """
+    stats_client = get_backends().stats_client
+    for _queue_name, _rq_job_id, our_response_dict in queue_jobs:
+        prefetch_source(our_response_dict)
+    try:
+        with timed_stage('spool'):
+            job_spool.append([SpooledJob(queue_name, rq_job_id, our_response_dict, SPOOLED_JOB_KWARGS)
+                                for queue_name, rq_job_id, our_response_dict in queue_jobs])
+    except SpoolFullError as e:
+        stats_client.incr(f'{enqueue_job_stats_prefix}.{stats_name}.spool_full')
+        error_dict = {'error': "Unable to queue jobs at present — please try again later", 'status': 'unavailable',
+                        'retry_after': SPOOL_FULL_RETRY_AFTER_SECONDS}
+        logger.critical(f"{prefixed_our_name} couldn't spool {len(queue_jobs)} job(s) ({e}); responding with {error_dict}\n")
+        return jsonify(error_dict), 503, {'Retry-After': str(SPOOL_FULL_RETRY_AFTER_SECONDS)}
+    stats_client.incr(f'{enqueue_job_stats_prefix}.posts.spooled', len(queue_jobs))
+    for queue_name, _rq_job_id, _our_response_dict in queue_jobs:
+        scaling_advisor.record_arrivals(queue_name)
+    logger.warning(f"{prefixed_our_name} spooled {len(queue_jobs)} valid job(s) for {sorted({queue_name for queue_name, _rq_job_id, _our_response_dict in queue_jobs})}\n")
+    # NOTE: The spooled flag is only in the response (not the spooled job)
+    spooled_response_dicts = [dict(our_response_dict, spooled=True) for _queue_name, _rq_job_id, our_response_dict in queue_jobs]
+    if results_list is None:
+        return jsonify(spooled_response_dicts[0])
+    spooled_response_dicts.reverse()
+    results_list = [result if result.get('status') == 'invalid' else spooled_response_dicts.pop()
+                    for result in results_list]
+    return jsonify({'queued': 0, 'spooled': len(queue_jobs), 'deduplicated': 0, 'rejected': 0,
+                    'invalid': num_invalid, 'results': results_list})
+# end of spool_jobs function
+
+
+@enqueue_blueprint.route('/'+BATCH_URL_SEGMENT, methods=['POST'])
+def batch_job_receiver():
+    """
+    Accepts POST requests containing a JSON array of job payloads
+
+    Each payload is checked individually, and all of the valid ones
+        are queued (possibly across several of our queues) in one Redis pipeline.
+
+    Returns a dict containing a results list with one entry per given payload
+        (in the same order) so that partial failures can be reported.
+    """
+    backends = get_backends()
+    stats_client = backends.stats_client
+    stats_client.incr(f'{enqueue_job_stats_prefix}.batches.attempted')
+    logger.info(f"tX {'('+prefix+')' if prefix else ''} enqueue received batch request: {request}")
+
+    error_dict = check_payload_size(request.content_length, MAX_BATCH_BYTES)
+    if error_dict:
+        return payload_too_large(error_dict, 'batches')
+
+    try:
+        with timed_stage('parse'):
+            payload_list = request.get_json(silent=True) if request.data else None
+    except RecursionError:
+        payload_list = None
+    if not isinstance(payload_list, list) or not payload_list:
+        stats_client.incr(f'{enqueue_job_stats_prefix}.batches.invalid')
+        error_dict = {'error': 'Expected a non-empty JSON array of job payloads', 'status': 'invalid'}
+        logger.error(f"{prefixed_our_name} ignored invalid batch; responding with {error_dict}\n")
+        return jsonify(error_dict), 400
+    if len(payload_list) > MAX_BATCH_SIZE:
+        stats_client.incr(f'{enqueue_job_stats_prefix}.batches.invalid')
+        error_dict = {'error': f'Too many job payloads ({len(payload_list)}) — maximum is {MAX_BATCH_SIZE}', 'status': 'invalid'}
+        logger.error(f"{prefixed_our_name} ignored oversized batch; responding with {error_dict}\n")
+        return jsonify(error_dict), 400
+
+    results_list:List[Dict[str,Any]] = []
+    valid_jobs = [] # (results_list index, queue name, rq job id, response dict)
+    for payload_dict in payload_list:
+        response_ok_flag, response_dict = check_tx_payload(payload_dict, request.headers, logger)
+        if not response_ok_flag:
+            response_dict['status'] = 'invalid'
+            results_list.append(response_dict)
+            continue
+        our_adjusted_queue_name = get_our_queue_name(response_dict)
+        our_response_dict = build_our_response_dict(response_dict, our_adjusted_queue_name,
+                                                    backends.metrics_sampler.get_metrics(our_adjusted_queue_name))
+        valid_jobs.append((len(results_list), our_adjusted_queue_name,
+                            f"{our_adjusted_queue_name}_{our_response_dict['job_id']}", our_response_dict))
+        results_list.append(our_response_dict)
+
+    num_invalid = len(payload_list) - len(valid_jobs)
+    queue_jobs = [(queue_name, rq_job_id, our_response_dict) for _index, queue_name, rq_job_id, our_response_dict in valid_jobs]
+    if queue_jobs and job_spool.should_spool(): # Redis is unavailable (or we're still replaying earlier spooled jobs)
+        stats_client.incr(f'{enqueue_job_stats_prefix}.posts.attempted', len(payload_list))
+        stats_client.incr(f'{enqueue_job_stats_prefix}.posts.invalid', num_invalid)
+        return spool_jobs(queue_jobs, 'batches', results_list, num_invalid)
+    try:
+        return queue_batch_jobs(backends, len(payload_list), list(results_list), valid_jobs)
+    except REDIS_ERRORS as e:
+        if not job_spool.enabled:
+            raise
+        job_spool.note_redis_failure(f"failed: {e}")
+        stats_client.incr(f'{enqueue_job_stats_prefix}.posts.attempted', len(payload_list))
+        stats_client.incr(f'{enqueue_job_stats_prefix}.posts.invalid', num_invalid)
+        return spool_jobs(queue_jobs, 'batches', results_list, num_invalid)
+# end of batch_job_receiver()
+
+
+def queue_batch_jobs(backends:EnqueueBackends, num_payloads:int, results_list:List[Dict[str,Any]],
+                        valid_jobs:List[Tuple[int, str, str, Dict[str,Any]]]):
+    """
+    Queues the checked jobs of a batch (except duplicates and shed ones) in one Redis pipeline
+        for batch_job_receiver.
+
+    Returns the Flask response.
+    """
+    stats_client = backends.stats_client
+    new_jobs = [] # Valid jobs which haven't already been queued
+    num_deduplicated = 0
+    if valid_jobs:
+        redis_connection = backends.redis_connection
+        # NOTE: The jobs and their de-duplication claims are on their Redis shards (the only one unless sharded)
+        shard_connections = backends.shard_connections
+        valid_jobs_by_shard:Dict[int,list] = {}
+        for valid_job in valid_jobs:
+            valid_jobs_by_shard.setdefault(backends.get_shard_index(valid_job[3]), []).append(valid_job)
+        with timed_stage('dedup'):
+            for shard_index, shard_valid_jobs in valid_jobs_by_shard.items():
+                dedup_results = job_deduplicator.claim_many(shard_connections[shard_index],
+                                    [(rq_job_id, our_response_dict) for _index, _queue_name, rq_job_id, our_response_dict in shard_valid_jobs])
+                for valid_job, (dedup_outcome, original_response_dict) in zip(shard_valid_jobs, dedup_results):
+                    if original_response_dict is None:
+                        new_jobs.append(valid_job)
+                        continue
+                    stats_client.incr(f'{enqueue_job_stats_prefix}.posts.{dedup_outcome}')
+                    results_list[valid_job[0]] = original_response_dict
+                    num_deduplicated += 1
+        new_jobs.sort(key=lambda new_job: new_job[0]) # Back into the order they were POSTed
+
+    # Shed the jobs for queues which are too deep, or from submitters who have sent too many
+    with timed_stage('admission'):
+        rejection_dicts = admission_controller.check_queue_depths([queue_name for _index, queue_name, _rq_job_id, _our_response_dict in new_jobs],
+                                                                    backends.metrics_sampler.get_metrics)
+        unrejected_jobs = [new_job for new_job, rejection_dict in zip(new_jobs, rejection_dicts) if rejection_dict is None]
+        if unrejected_jobs:
+            token_rejection_dicts = iter(admission_controller.take_tokens(redis_connection,
+                                [(get_submitter_keys(our_response_dict), 1) for _index, _queue_name, _rq_job_id, our_response_dict in unrejected_jobs]))
+            rejection_dicts = [next(token_rejection_dicts) if rejection_dict is None else rejection_dict
+                                for rejection_dict in rejection_dicts]
+    job_datas_by_shard:Dict[int,Dict[str,list]] = {} # Shard index: queue name: job datas
+    new_rq_job_ids_by_shard:Dict[int,List[str]] = {}
+    rejected_rq_job_ids_by_shard:Dict[int,List[str]] = {}
+    for (index, our_adjusted_queue_name, rq_job_id, our_response_dict), rejection_dict in zip(new_jobs, rejection_dicts):
+        shard_index = backends.get_shard_index(our_response_dict)
+        if rejection_dict:
+            stats_client.incr(f"{enqueue_job_stats_prefix}.posts.shed.{rejection_dict['reason']}")
+            results_list[index] = rejection_dict
+            rejected_rq_job_ids_by_shard.setdefault(shard_index, []).append(rq_job_id)
+            continue
+        prefetch_source(our_response_dict) # NOTE: Also updates the dict in results_list
+        job_datas_by_shard.setdefault(shard_index, {}).setdefault(our_adjusted_queue_name, []).append(
+            Queue.prepare_data('webhook.job', args=(job_codec.encode(our_response_dict),), timeout=JOB_TIMEOUT, job_id=rq_job_id,
+                        result_ttl=JOB_RESULT_TTL, failure_ttl=FAILED_JOB_TTL))
+        new_rq_job_ids_by_shard.setdefault(shard_index, []).append(rq_job_id)
+    for shard_index, rejected_rq_job_ids in rejected_rq_job_ids_by_shard.items():
+        job_deduplicator.release(shard_connections[shard_index], rejected_rq_job_ids)
+
+    # One pipeline per shard
+    for shard_index, job_datas_by_queue in job_datas_by_shard.items():
+        shard_connection = shard_connections[shard_index]
+        try:
+            with timed_stage('enqueue'), shard_connection.pipeline() as pipeline:
+                enqueue_start_time = perf_counter()
+                for our_adjusted_queue_name, job_datas in job_datas_by_queue.items():
+                    Queue(our_adjusted_queue_name, connection=shard_connection) \
+                        .enqueue_many(job_datas, pipeline=pipeline)
+                pipeline.execute()
+                job_spool.note_enqueue_seconds(perf_counter() - enqueue_start_time)
+        except Exception:
+            job_deduplicator.release(shard_connection, new_rq_job_ids_by_shard[shard_index])
+            raise
+        for our_adjusted_queue_name, job_datas in job_datas_by_queue.items():
+            scaling_advisor.record_arrivals(our_adjusted_queue_name, len(job_datas))
+
+    num_queued = sum(len(new_rq_job_ids) for new_rq_job_ids in new_rq_job_ids_by_shard.values())
+    rejected_rq_job_ids = [rq_job_id for shard_rq_job_ids in rejected_rq_job_ids_by_shard.values() for rq_job_id in shard_rq_job_ids]
+    queue_names = sorted({queue_name for job_datas_by_queue in job_datas_by_shard.values() for queue_name in job_datas_by_queue})
+    num_invalid, num_rejected = num_payloads - len(valid_jobs), len(rejected_rq_job_ids)
+    stats_client.incr(f'{enqueue_job_stats_prefix}.posts.attempted', num_payloads)
+    stats_client.incr(f'{enqueue_job_stats_prefix}.posts.succeeded', num_queued)
+    stats_client.incr(f'{enqueue_job_stats_prefix}.posts.invalid', num_invalid)
+    logger.info(f"{prefixed_our_name} queued {num_queued} valid job(s) from batch of {num_payloads} " \
+                f"into {queue_names} ({num_deduplicated} already queued, {num_rejected} shed) at {datetime.utcnow()}\n")
+    batch_response = jsonify({'queued': num_queued, 'deduplicated': num_deduplicated, 'rejected': num_rejected,
+                                'invalid': num_invalid, 'results': results_list})
+    if num_rejected and num_rejected + num_invalid == num_payloads: # Nothing was accepted
+        retry_after = max(result['retry_after'] for result in results_list if 'retry_after' in result)
+        return batch_response, 429, {'Retry-After': str(retry_after)}
+    return batch_response, 200 if valid_jobs else 400
+# end of queue_batch_jobs function
+
+
+@enqueue_blueprint.route('/'+READY_URL_SEGMENT, methods=['GET'])
+def readiness_check():
+    """
+    Returns 200 if our dependencies (i.e., Redis) are connected, else 503.
+    """
+    ready_flag, status_dict = get_backends().check_ready()
+    status_dict['ready'] = ready_flag
+    status_dict['shed'] = dict(admission_controller.shed_counts) # Jobs rejected by this process
+    return jsonify(status_dict), 200 if ready_flag else 503
+# end of readiness_check()
+
+
+@enqueue_blueprint.route('/'+HEALTH_URL_SEGMENT, methods=['GET'])
+def health_check():
+    """
+    Returns 200 if our dependencies were connected within the last few seconds, else 503
+        (without using Redis on every call, unlike readiness_check).
+    """
+    backends = get_backends()
+    backends.stats_client.incr(f'{enqueue_job_stats_prefix}.probes.health')
+    ready_flag, status_dict = backends.check_ready_cached()
+    status_dict['ready'] = ready_flag
+    return jsonify(status_dict), 200 if ready_flag else 503
+# end of health_check()
+
+
+@enqueue_blueprint.route('/'+SCALING_URL_SEGMENT, methods=['GET'])
+def scaling_advice():
+    """
+    Returns the latest recommended worker count (and its inputs) for each of our queues
+        (see tx_enqueue_scaling.py), or 503 if there's no advice yet.
+    """
+    get_backends().start() # The advisor thread (in case this process hasn't started it yet)
+    advice_dict = scaling_advisor.get_advice()
+    if advice_dict['advised_at'] is None:
+        error_dict = {'error': "No scaling advice yet", 'retry_after': SCALING_INTERVAL_SECONDS}
+        return jsonify(error_dict), 503, {'Retry-After': str(SCALING_INTERVAL_SECONDS)}
+    return jsonify(advice_dict)
+# end of scaling_advice()
+
+
+def prometheus_metrics():
+    """
+    Returns our request stage histograms in the Prometheus text format.
+
+    NOTE: Only routed if PROMETHEUS_METRICS is set (and only covers this process).
+    """
+    return stage_recorder.render_prometheus(), 200, {'Content-Type': PROMETHEUS_CONTENT_TYPE}
+# end of prometheus_metrics()
+
+
+app = create_app()
+logger.info(f"{prefixed_our_name} is up and ready to go")
+
 if __name__ == '__main__':
     app.run()
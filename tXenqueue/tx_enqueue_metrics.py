@@ -0,0 +1,145 @@
+# Added to move the queue and worker gauges out of the request path
+
+"""
+tX Enqueue Metrics Sampler
+
+A background thread which periodically reads the length, failed length
+    and available worker count of each of our queues (in one pipelined
+    Redis round trip), sends them to Graphite as gauges, and caches them
+    so that job_receiver can log (and alert) without asking Redis.
+
+Gauges therefore keep flowing even when no jobs are being POSTed.
+"""
+
+# Python imports
+from typing import Any, Dict, List, Optional
+from time import time
+import threading
+
+# Library (PyPI) imports
+from rq import Queue
+from rq.worker_registration import REDIS_WORKER_KEYS, WORKERS_BY_QUEUE_KEY
+
+# Local imports
+from tx_enqueue_failed import get_failed_registry_key
+
+
+METRICS_SAMPLE_INTERVAL_SECONDS = 10
+
+
+def read_queue_metrics(connection, queue_names:List[str]) -> Dict[str,Dict[str,int]]:
+    """
+    Reads the metrics for each of the given queues in one pipelined round trip.
+
+    Returns a dict (indexed by queue name) of dicts containing:
+        queue_length: number of jobs waiting in the queue
+        failed_length: number of failed jobs that originated from the queue
+        worker_count: number of rq workers listening to the queue
+        total_worker_count: number of rq workers (for all queues)
+    """
+    with connection.pipeline(transaction=False) as pipeline:
+        pipeline.scard(REDIS_WORKER_KEYS)
+        for queue_name in queue_names:
+            pipeline.llen(Queue.redis_queue_namespace_prefix + queue_name)
+            pipeline.zcard(get_failed_registry_key(queue_name))
+            pipeline.scard(WORKERS_BY_QUEUE_KEY % queue_name)
+        results = pipeline.execute()
+
+    total_worker_count = results[0]
+    queue_metrics = {}
+    for n, queue_name in enumerate(queue_names):
+        queue_length, failed_length, worker_count = results[1+3*n:4+3*n]
+        queue_metrics[queue_name] = {'queue_length': queue_length,
+                                    'failed_length': failed_length,
+                                    'worker_count': worker_count,
+                                    'total_worker_count': total_worker_count,
+                                    }
+    return queue_metrics
+# end of read_queue_metrics function
+
+
+def read_sharded_queue_metrics(connections:List[Any], queue_names:List[str]) -> Dict[str,Dict[str,int]]:
+    """
+    Reads the metrics for each of the given queues from each shard (see tx_enqueue_shards)
+        and adds them together.
+    """
+    queue_metrics:Dict[str,Dict[str,int]] = {queue_name: {} for queue_name in queue_names}
+    for connection in connections:
+        for queue_name, metrics in read_queue_metrics(connection, queue_names).items():
+            for metric_name, value in metrics.items():
+                queue_metrics[queue_name][metric_name] = queue_metrics[queue_name].get(metric_name, 0) + value
+    return queue_metrics
+# end of read_sharded_queue_metrics function
+
+
+class QueueMetricsSampler:
+    """
+    Periodically samples our queue metrics in a daemon thread
+        and sends them to Graphite.
+
+    The latest sample for each queue is available (without any Redis access)
+        from get_metrics(queue_name).
+
+    If shard_connections are given, the metrics of each queue are totalled across them (instead).
+    """
+
+    def __init__(self, connection, queue_names:List[str], stats_client, stats_prefix:str,
+                        logger, interval:float=METRICS_SAMPLE_INTERVAL_SECONDS,
+                        shard_connections:Optional[List[Any]]=None) -> None:
+        self.connection = connection
+        self.shard_connections = shard_connections
+        self.queue_names = list(queue_names)
+        self.stats_client = stats_client
+        self.stats_prefix = stats_prefix
+        self.logger = logger
+        self.interval = interval
+        self.sampled_at:Optional[float] = None # time() of last successful sample
+        self._metrics:Dict[str,Dict[str,int]] = {}
+        self._lock = threading.Lock()
+        self._stop_event = threading.Event()
+        self._thread:Optional[threading.Thread] = None
+
+    def sample(self) -> Dict[str,Dict[str,int]]:
+        """
+        Read, cache, and send the metrics for all of our queues once.
+        """
+        queue_metrics = read_sharded_queue_metrics(self.shard_connections, self.queue_names) if self.shard_connections \
+                            else read_queue_metrics(self.connection, self.queue_names)
+        with self._lock:
+            self._metrics = queue_metrics
+            self.sampled_at = time()
+        for queue_name, metrics in queue_metrics.items():
+            self.stats_client.gauge(f'{self.stats_prefix}.queue.{queue_name}.length.current', metrics['queue_length'])
+            self.stats_client.gauge(f'{self.stats_prefix}.queue.{queue_name}.length.failed', metrics['failed_length'])
+            self.stats_client.gauge(f'{self.stats_prefix}.workers.{queue_name}.available', metrics['worker_count'])
+        return queue_metrics
+
+    def get_metrics(self, queue_name:str) -> Dict[str,Any]:
+        """
+        Returns the cached metrics for the given queue
+            (an empty dict if there hasn't been a successful sample yet).
+        """
+        with self._lock:
+            return dict(self._metrics.get(queue_name, {}))
+
+    def start(self) -> None:
+        """
+        Starts the background sampling thread (which takes the first sample immediately).
+        """
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self._run, name='queue_metrics_sampler', daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stop_event.set()
+
+    def _run(self) -> None:
+        while not self._stop_event.is_set():
+            try:
+                self.sample()
+            except Exception as e: # Don't let a Redis hiccup kill the thread
+                self.logger.error(f"Failed to sample queue metrics: {e}")
+            self._stop_event.wait(self.interval)
+# end of QueueMetricsSampler class
@@ -0,0 +1,239 @@
+# Added because tx_job_handler starts every job by downloading the source zip
+#   (a large part of the run time of big repos) even though we know its URL minutes earlier
+
+"""
+tX Enqueue source archive prefetch
+
+If PREFETCH_DIRECTORY is set (to a directory shared with the tx_job_handler workers),
+    the source zip of each accepted job with a commit_hash
+        (i.e., not a duplicate or shed job, see prefetch_source in tx_enqueue_main) is downloaded into it in the background
+    while the job waits in its queue, and its cache path is added to the job dict as source_cache_path.
+Only source URLs on the host of dcs_url (DCS_URL in tx_enqueue_main) are fetched
+    (and redirects off that host aren't followed) so that a payload can't make us fetch from anywhere else.
+
+The cache is content addressed: each archive is named by the commit hash
+    (plus a digest of the source URL, as the commit hash may be abbreviated),
+    so the jobs of the same commit (e.g., retries and re-fired webhooks) share one download.
+Archives are written to a temporary file and then renamed, so an archive is complete if it exists.
+    (tx_job_handler should still download the source itself if source_cache_path doesn't exist yet.)
+
+Downloads are limited to max_concurrent at a time (with at most max_pending waiting,
+    else the job just isn't prefetched) and archives larger than max_archive_bytes are abandoned.
+The cache is kept within max_cache_bytes by deleting the least recently used archives
+    (an archive's modification time is updated whenever another job uses it).
+"""
+
+# Python imports
+from typing import Any, Dict, Optional
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+from hashlib import sha256
+from pathlib import Path
+from time import perf_counter
+import os
+import re
+import threading
+from urllib.error import HTTPError
+from urllib.parse import urlsplit
+from urllib.request import HTTPRedirectHandler, Request, build_opener
+
+# Local imports
+from tx_enqueue_dcs import DEFAULT_DCS_DOMAIN
+
+
+PREFETCH_MAX_CONCURRENT = 4 # Downloads at a time (per process)
+PREFETCH_MAX_PENDING = 100 # Downloads waiting for one of the above (per process)
+PREFETCH_MAX_ARCHIVE_BYTES = 512 * 1024 * 1024
+PREFETCH_MAX_CACHE_BYTES = 8 * 1024 * 1024 * 1024
+PREFETCH_TIMEOUT_SECONDS = 60 # For each socket operation (not the whole download)
+PREFETCH_CHUNK_BYTES = 1024 * 1024
+ARCHIVE_SUFFIX = '.zip'
+PARTIAL_SUFFIX = '.part'
+COMMIT_HASH_REGEX = re.compile('[0-9a-f]{7,64}')
+
+
+class ArchiveTooLargeError(Exception):
+    pass
+
+
+def get_url_host(url:str) -> Optional[str]:
+    """
+    Returns the (lower case) host[:port] of the given http(s) URL, or None if it's not one.
+    """
+    url_parts = urlsplit(url)
+    return url_parts.netloc.lower() if url_parts.scheme in ('https', 'http') and url_parts.netloc else None
+# end of get_url_host function
+
+
+class SameHostRedirectHandler(HTTPRedirectHandler):
+    """
+    Follows redirects only if they stay on the given host (else raises HTTPError).
+    """
+
+    def __init__(self, host:Optional[str]) -> None:
+        self.host = host
+
+    def redirect_request(self, req, fp, code, msg, headers, newurl):
+        if get_url_host(newurl) != self.host:
+            raise HTTPError(newurl, code, f"Refused redirect off {self.host}", headers, fp)
+        return super().redirect_request(req, fp, code, msg, headers, newurl)
+# end of SameHostRedirectHandler class
+
+
+class SourcePrefetcher:
+    """
+    Downloads job source archives into a shared cache directory (see above).
+
+    An empty cache directory turns prefetching off.
+    Only sources on the host of dcs_url are fetched.
+    """
+
+    def __init__(self, cache_directory:str, max_concurrent:int=PREFETCH_MAX_CONCURRENT,
+                        max_pending:int=PREFETCH_MAX_PENDING, max_archive_bytes:int=PREFETCH_MAX_ARCHIVE_BYTES,
+                        max_cache_bytes:int=PREFETCH_MAX_CACHE_BYTES, timeout:float=PREFETCH_TIMEOUT_SECONDS,
+                        dcs_url:str=DEFAULT_DCS_DOMAIN, logger=None) -> None:
+        self.cache_directory = Path(cache_directory) if cache_directory else None
+        self.dcs_url = dcs_url
+        self.max_concurrent = max_concurrent
+        self.max_pending = max_pending
+        self.max_archive_bytes = max_archive_bytes
+        self.max_cache_bytes = max_cache_bytes
+        self.timeout = timeout
+        self.logger = logger
+        self.stats_client = None # Set by EnqueueBackends
+        self.stats_prefix = ''
+        self._executor:Optional[ThreadPoolExecutor] = None
+        self._in_flight:Dict[Path,Future] = {} # Cache path: download
+        self._lock = threading.Lock()
+        self._evict_lock = threading.Lock()
+
+    @property
+    def enabled(self) -> bool:
+        return self.cache_directory is not None
+
+    def _incr(self, stat_name:str) -> None:
+        if self.stats_client is not None:
+            self.stats_client.incr(f'{self.stats_prefix}.prefetch.{stat_name}')
+
+    def get_cache_path(self, payload_dict:Dict[str,Any]) -> Optional[Path]:
+        """
+        Returns the cache path of the source archive of the given (checked) payload
+            (or None if prefetching is off or the payload has no (valid) commit_hash
+            or its source isn't on the host of dcs_url).
+        """
+        source_url, commit_hash = payload_dict.get('source'), str(payload_dict.get('commit_hash') or '').lower()
+        if self.cache_directory is None or not isinstance(source_url, str) \
+        or get_url_host(source_url) != get_url_host(self.dcs_url) \
+        or not COMMIT_HASH_REGEX.fullmatch(commit_hash):
+            return None
+        url_digest = sha256(source_url.encode('utf-8')).hexdigest()[:16]
+        return self.cache_directory / f'{commit_hash}-{url_digest}{ARCHIVE_SUFFIX}'
+
+    def prefetch(self, payload_dict:Dict[str,Any]) -> Optional[str]:
+        """
+        Starts downloading the source archive of the given (checked) payload into the cache
+            (unless it's already there or being downloaded).
+
+        Returns the cache path (for source_cache_path) or None if it's not being prefetched.
+        """
+        cache_path = self.get_cache_path(payload_dict)
+        if cache_path is None:
+            return None
+        with self._lock:
+            if cache_path in self._in_flight:
+                self._incr('in_flight')
+                return str(cache_path)
+            try:
+                os.utime(cache_path) # Now recently used
+                self._incr('hits')
+                return str(cache_path)
+            except FileNotFoundError:
+                pass
+            if len(self._in_flight) >= self.max_concurrent + self.max_pending:
+                self._incr('skipped')
+                return None
+            if self._executor is None: # NOTE: Created here (rather than in __init__) so that it's after any fork
+                self._executor = ThreadPoolExecutor(max_workers=self.max_concurrent, thread_name_prefix='source_prefetch')
+            self._in_flight[cache_path] = self._executor.submit(self._fetch, payload_dict['source'], cache_path)
+        return str(cache_path)
+
+    def _fetch(self, source_url:str, cache_path:Path) -> None:
+        """
+        Downloads the archive into the cache (run by the executor threads).
+        """
+        partial_path = cache_path.with_name(f'{cache_path.name}.{os.getpid()}.{threading.get_ident()}{PARTIAL_SUFFIX}')
+        start_time = perf_counter()
+        try:
+            cache_path.parent.mkdir(parents=True, exist_ok=True)
+            opener = build_opener(SameHostRedirectHandler(get_url_host(self.dcs_url)))
+            with opener.open(Request(source_url, headers={'User-Agent': 'tX-enqueue-prefetch'}), timeout=self.timeout) as response:
+                if int(response.headers.get('Content-Length') or 0) > self.max_archive_bytes:
+                    raise ArchiveTooLargeError(f"{response.headers['Content-Length']} bytes")
+                num_bytes = 0
+                with open(partial_path, 'wb') as partial_file:
+                    while chunk := response.read(PREFETCH_CHUNK_BYTES):
+                        num_bytes += len(chunk)
+                        if num_bytes > self.max_archive_bytes:
+                            raise ArchiveTooLargeError(f"over {self.max_archive_bytes:,} bytes")
+                        partial_file.write(chunk)
+            os.replace(partial_path, cache_path)
+            self._incr('fetched')
+            if self.stats_client is not None:
+                self.stats_client.timing(f'{self.stats_prefix}.prefetch.fetch', 1000 * (perf_counter() - start_time))
+                self.stats_client.incr(f'{self.stats_prefix}.prefetch.bytes', num_bytes)
+            self.evict()
+        except ArchiveTooLargeError as e:
+            self._incr('too_large')
+            if self.logger:
+                self.logger.warning(f"Didn't prefetch {source_url}: archive too large ({e})")
+        except Exception as e: # e.g., HTTPError, URLError, timeout, disk full
+            self._incr('failed')
+            if self.logger:
+                self.logger.error(f"Failed to prefetch {source_url}: {e}")
+        finally:
+            partial_path.unlink(missing_ok=True)
+            with self._lock:
+                del self._in_flight[cache_path]
+
+    def evict(self) -> int:
+        """
+        Deletes the least recently used archives until the cache is within max_cache_bytes
+            (also counting the archives which are still being downloaded).
+
+        Returns the number of archives deleted.
+        """
+        if self.cache_directory is None:
+            return 0
+        with self._evict_lock:
+            archive_stats, cache_bytes = [], 0
+            for entry in os.scandir(self.cache_directory):
+                try:
+                    entry_stat = entry.stat()
+                except FileNotFoundError: # e.g., deleted by another process
+                    continue
+                cache_bytes += entry_stat.st_size
+                if entry.name.endswith(ARCHIVE_SUFFIX):
+                    archive_stats.append((entry_stat.st_mtime, entry_stat.st_size, entry.path))
+            num_deleted = 0
+            for _mtime, archive_bytes, archive_path in sorted(archive_stats):
+                if cache_bytes <= self.max_cache_bytes:
+                    break
+                try:
+                    os.unlink(archive_path)
+                    num_deleted += 1
+                except FileNotFoundError:
+                    pass
+                cache_bytes -= archive_bytes
+            if self.stats_client is not None:
+                self.stats_client.gauge(f'{self.stats_prefix}.prefetch.cache_bytes', cache_bytes)
+                if num_deleted:
+                    self.stats_client.incr(f'{self.stats_prefix}.prefetch.evicted', num_deleted)
+        return num_deleted
+
+    def wait(self, timeout:Optional[float]=None) -> None:
+        """
+        Waits for the current downloads to finish (e.g., for testing).
+        """
+        with self._lock:
+            futures = list(self._in_flight.values())
+        wait(futures, timeout=timeout)
+# end of SourcePrefetcher class
@@ -0,0 +1,128 @@
+# Added to reduce the number of Redis round trips per POST
+
+"""
+tX Enqueue Redis helpers
+
+Creates our Redis connection (with an explicitly configured connection pool)
+    and enqueues a job together with reading the new queue length,
+    all in a single pipelined round trip.
+
+There are also asyncio versions (using redis.asyncio) for tx_enqueue_asgi.py.
+"""
+
+# Python imports
+from typing import Any, Dict, List, Tuple
+
+# Library (PyPI) imports
+# NOTE: We use StrictRedis() because we don't need the backwards compatibility of Redis()
+from redis import StrictRedis, BlockingConnectionPool
+from rq import Queue
+from rq.job import Job, JobStatus
+from rq.utils import utcnow
+
+# Local imports
+from tx_enqueue_codec import job_codec
+
+
+REDIS_PORT = 6379
+REDIS_MAX_CONNECTIONS = 20 # Per (gunicorn worker) process
+REDIS_POOL_TIMEOUT = 5 # seconds to wait for a free connection from the pool
+REDIS_SOCKET_TIMEOUT = 5 # seconds
+
+
+def split_redis_hostname(redis_hostname:str) -> Tuple[str, int]:
+    """
+    Returns the host and port of the given host (or host:port) name.
+    """
+    host, _colon, port = redis_hostname.partition(':')
+    return host, int(port) if port else REDIS_PORT
+# end of split_redis_hostname function
+
+
+def get_redis_connection(redis_hostname:str, max_connections:int=REDIS_MAX_CONNECTIONS,
+                            socket_timeout:float=REDIS_SOCKET_TIMEOUT) -> StrictRedis:
+    """
+    Returns a Redis connection using a bounded, blocking connection pool
+        (so that a Redis stall makes callers wait for at most REDIS_POOL_TIMEOUT
+        rather than opening ever more connections).
+
+    The redis_hostname can also include a port (e.g., for the shards in tx_enqueue_shards).
+    """
+    host, port = split_redis_hostname(redis_hostname)
+    connection_pool = BlockingConnectionPool(host=host, port=port,
+                                max_connections=max_connections, timeout=REDIS_POOL_TIMEOUT,
+                                socket_timeout=socket_timeout, socket_connect_timeout=socket_timeout,
+                                socket_keepalive=True, health_check_interval=30)
+    return StrictRedis(connection_pool=connection_pool)
+# end of get_redis_connection function
+
+
+def create_job(queue:Queue, job_dict:Dict[str,Any], **job_kwargs) -> Job:
+    """
+    Creates (but doesn't save) an rq job to call 'webhook.job' (in tx_job_handler) with job_dict
+        (encoded by tx_enqueue_codec.job_codec).
+
+    NOTE: This doesn't use the Redis connection.
+    """
+    # NOTE: We don't use queue.enqueue(pipeline=…) because that calls pipeline.multi()
+    #           which fails if other commands have already been added to the pipeline
+    return queue.create_job('webhook.job', args=(job_codec.encode(job_dict),), **job_kwargs)
+# end of create_job function
+
+
+def enqueue_job_dict(queue:Queue, job_dict:Dict[str,Any], **job_kwargs) -> Tuple[Job, int]:
+    """
+    Enqueues job_dict for the 'webhook.job' function (in tx_job_handler)
+        and reads the new queue length in the same pipelined transaction.
+
+    job_kwargs are passed through to rq's Queue.create_job (e.g., job_id, timeout).
+
+    Returns the job and the number of jobs now in the queue.
+
+    NOTE: The other queue and worker metrics are read in the background
+            by tx_enqueue_metrics.QueueMetricsSampler.
+    """
+    job = create_job(queue, job_dict, **job_kwargs)
+    with queue.connection.pipeline() as pipeline:
+        queue.enqueue_job(job, pipeline=pipeline)
+        pipeline.llen(queue.key)
+        results = pipeline.execute()
+    return job, results[-1]
+# end of enqueue_job_dict function
+
+
+def get_async_redis_connection(redis_hostname:str, max_connections:int=REDIS_MAX_CONNECTIONS,
+                                socket_timeout:float=REDIS_SOCKET_TIMEOUT):
+    """
+    Returns an asyncio Redis connection using a bounded, blocking connection pool.
+    """
+    # NOTE: Imported here because only tx_enqueue_asgi.py needs it
+    from redis.asyncio import StrictRedis as AsyncStrictRedis, BlockingConnectionPool as AsyncBlockingConnectionPool
+    host, port = split_redis_hostname(redis_hostname)
+    connection_pool = AsyncBlockingConnectionPool(host=host, port=port,
+                                max_connections=max_connections, timeout=REDIS_POOL_TIMEOUT,
+                                socket_timeout=socket_timeout, socket_connect_timeout=socket_timeout,
+                                socket_keepalive=True, health_check_interval=30)
+    return AsyncStrictRedis(connection_pool=connection_pool)
+# end of get_async_redis_connection function
+
+
+async def enqueue_jobs_async(async_connection, queue_jobs:List[Tuple[Queue, Job]]) -> List[int]:
+    """
+    Enqueues the jobs (from create_job) into their queues using the asyncio Redis connection
+        in the same way as rq's Queue.enqueue_job (but all in one pipelined transaction).
+
+    Returns the number of jobs now in the queue after each job was added.
+    """
+    async with async_connection.pipeline(transaction=True) as pipeline:
+        for queue, job in queue_jobs:
+            job.origin = queue.name
+            job.enqueued_at = utcnow()
+            job._status = JobStatus.QUEUED # Saved by to_dict() below (rather than by set_status())
+            pipeline.sadd(queue.redis_queues_keys, queue.key)
+            pipeline.hset(job.key, mapping=job.to_dict())
+            pipeline.rpush(queue.key, job.id)
+            pipeline.llen(queue.key)
+        results = await pipeline.execute()
+    return results[3::4]
+# end of enqueue_jobs_async function
@@ -0,0 +1,203 @@
+# Added because failed jobs just sat in the failed job registries (until pruned two weeks later)
+#   so jobs which failed from a transient error (e.g., a DCS or CDN timeout) had to be resubmitted by hand
+
+"""
+tX Enqueue delayed job retries
+
+A background thread finds the jobs which have failed in our queues since it last looked
+    (using the same kind of cursor as the job run time sampler in tx_enqueue_lanes)
+    and schedules each of them for a retry in a Redis sorted set (RETRY_DUE_KEY) scored by its due time.
+The delay grows exponentially with the job's tx_retry_count (from RETRY_BASE_DELAY_SECONDS up to
+    RETRY_MAX_DELAY_SECONDS), with "equal jitter" so that the jobs which failed together
+    (e.g., during an incident) aren't all retried together.
+
+When a retry is due, tx_retry_count in the job dict is incremented
+    and the job is requeued (with the same rq job id) into the queue that it failed in.
+
+Jobs which have already been retried max_retries times, or which timed out
+    (as they'll most likely time out again), are given up on and left in the failed job registry.
+
+The numbers of scheduled, requeued and given up jobs are sent to Graphite,
+    along with the number of jobs waiting to be retried.
+"""
+
+# Python imports
+from typing import Dict, List
+from random import uniform
+import threading
+
+# Library (PyPI) imports
+from rq.exceptions import InvalidJobOperation
+from rq.job import Job
+from rq.registry import FailedJobRegistry
+from rq.utils import as_text, current_timestamp
+
+# Local imports
+from tx_enqueue_codec import decode_job_dict, job_codec
+from tx_enqueue_failed import FAILED_JOB_TTL
+
+
+# NOTE: Retries are off by default as a requeued job repeats all of its (possibly non-idempotent) work,
+#   e.g., its callback and CDN uploads -- set MAX_JOB_RETRIES (e.g., to 2) to turn them on
+MAX_JOB_RETRIES = 0 # Number of times that a failed job is retried (0 turns retries off)
+RETRY_BASE_DELAY_SECONDS = 60 # Delay before the first retry (doubled for each later retry)
+RETRY_MAX_DELAY_SECONDS = 60 * 60
+RETRY_INTERVAL_SECONDS = 15
+RETRY_MAX_FAILURE_AGE_SECONDS = 15 * 60 # Jobs which failed longer ago than this (e.g., before we started) aren't retried
+RETRY_BATCH_SIZE = 100 # Max number of failed jobs scheduled (and retries requeued) per queue per interval
+RETRY_DUE_KEY = 'tx:retry:due'
+RETRY_CURSOR_KEY_PREFIX = 'tx:retry:cursor:'
+RETRY_LOCK_KEY = 'tx:retry:scheduler_lock'
+NON_RETRYABLE_ERRORS = ('JobTimeoutException',) # Found in the exc_info of failed jobs
+
+
+class JobRetrier:
+    """
+    Schedules (and later requeues) retries of our failed jobs (see above).
+    """
+
+    def __init__(self, max_retries:int=MAX_JOB_RETRIES, base_delay:float=RETRY_BASE_DELAY_SECONDS,
+                        max_delay:float=RETRY_MAX_DELAY_SECONDS) -> None:
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.stats_client = None # Set by EnqueueBackends
+        self.stats_prefix = ''
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_retries > 0
+
+    def get_delay(self, retry_count:int) -> float:
+        """
+        Returns the (jittered) seconds to wait before the retry after the given number of retries.
+        """
+        delay = min(self.max_delay, self.base_delay * 2 ** retry_count)
+        return delay / 2 + uniform(0, delay / 2)
+
+    def _incr(self, stat_name:str, count:int) -> None:
+        if count and self.stats_client is not None:
+            self.stats_client.incr(f'{self.stats_prefix}.retries.{stat_name}', count)
+
+    def _get_new_failed_job_ids(self, connection, queue_name:str) -> List[str]:
+        """
+        Returns (up to RETRY_BATCH_SIZE of) the ids of the jobs which failed in the queue since the last call.
+        """
+        registry_key = FailedJobRegistry(queue_name, connection=connection).key
+        cursor_key = f'{RETRY_CURSOR_KEY_PREFIX}{registry_key}'
+        # NOTE: The failed job registry is scored by the time of failure plus the failure_ttl
+        #           and several jobs can have the same score so we also remember the ones already seen at that score
+        cursor_score, cursor_job_ids = None, []
+        cursor_values = connection.hmget(cursor_key, ['score', 'job_ids'])
+        if cursor_values[0] is not None:
+            cursor_score, cursor_job_ids = float(cursor_values[0]), as_text(cursor_values[1]).split(',')
+        min_score = current_timestamp() + FAILED_JOB_TTL - RETRY_MAX_FAILURE_AGE_SECONDS
+        if cursor_score is not None and cursor_score > min_score:
+            min_score = cursor_score
+        job_ids_and_scores = [(as_text(job_id), score) for job_id, score in
+                                connection.zrangebyscore(registry_key, min_score, '+inf',
+                                            start=0, num=RETRY_BATCH_SIZE + len(cursor_job_ids), withscores=True)]
+        job_ids = [job_id for job_id, score in job_ids_and_scores
+                    if score != cursor_score or job_id not in cursor_job_ids]
+        if job_ids:
+            last_score = job_ids_and_scores[-1][1]
+            connection.hset(cursor_key, mapping={'score': last_score,
+                    'job_ids': ','.join(job_id for job_id, score in job_ids_and_scores if score == last_score)})
+        return job_ids
+
+    def schedule_failed_jobs(self, connection, queue_name:str, logger) -> int:
+        """
+        Schedules retries of the jobs which failed in the queue since the last call
+            (or gives up on them).
+
+        Returns the number of retries scheduled.
+        """
+        due_mapping:Dict[str,float] = {}
+        num_given_up = 0
+        now = current_timestamp()
+        for job in Job.fetch_many(self._get_new_failed_job_ids(connection, queue_name), connection=connection):
+            if job is None: # Expired
+                continue
+            try:
+                payload_dict = decode_job_dict(job.args[0])
+                retry_count = int(payload_dict.get('tx_retry_count', 0))
+            except Exception: # Not one of our jobs
+                continue
+            if retry_count >= self.max_retries \
+            or any(error_name in (job.exc_info or '') for error_name in NON_RETRYABLE_ERRORS):
+                logger.info(f"Giving up on failed job {job.id} after {retry_count} retries")
+                num_given_up += 1
+            else:
+                due_mapping[job.id] = now + self.get_delay(retry_count)
+        num_scheduled = connection.zadd(RETRY_DUE_KEY, due_mapping, nx=True) if due_mapping else 0
+        self._incr('scheduled', num_scheduled)
+        self._incr('gave_up', num_given_up)
+        return num_scheduled
+
+    def requeue_due_jobs(self, connection, logger) -> int:
+        """
+        Requeues (up to RETRY_BATCH_SIZE of) the jobs whose retries are due.
+
+        Returns the number of jobs requeued.
+        """
+        num_requeued = 0
+        for job_id in connection.zrangebyscore(RETRY_DUE_KEY, '-inf', current_timestamp(), start=0, num=RETRY_BATCH_SIZE):
+            job_id = as_text(job_id)
+            if not connection.zrem(RETRY_DUE_KEY, job_id): # Another process got to it first
+                continue
+            job = Job.fetch_many([job_id], connection=connection)[0]
+            if job is None: # Expired (or deleted)
+                continue
+            try:
+                payload_dict = dict(decode_job_dict(job.args[0]))
+            except Exception: # Shouldn't happen (as it was scheduled)
+                continue
+            payload_dict['tx_retry_count'] = int(payload_dict.get('tx_retry_count', 0)) + 1
+            job.args = (job_codec.encode(payload_dict),)
+            try:
+                FailedJobRegistry(job.origin, connection=connection).requeue(job)
+            except InvalidJobOperation: # No longer failed (e.g., requeued by hand)
+                continue
+            logger.info(f"Requeued failed job {job_id} into '{job.origin}' (retry {payload_dict['tx_retry_count']})")
+            num_requeued += 1
+        self._incr('requeued', num_requeued)
+        return num_requeued
+
+    def run(self, connection, queue_names:List[str], logger, lock_seconds:float=RETRY_INTERVAL_SECONDS) -> None:
+        """
+        Schedules the retries of newly failed jobs in our queues (unless another process did so within lock_seconds)
+            and requeues the ones that are due.
+        """
+        if connection.set(RETRY_LOCK_KEY, 1, nx=True, ex=max(1, int(lock_seconds))):
+            for queue_name in queue_names:
+                self.schedule_failed_jobs(connection, queue_name, logger)
+        self.requeue_due_jobs(connection, logger)
+        if self.stats_client is not None:
+            self.stats_client.gauge(f'{self.stats_prefix}.retries.pending', connection.zcard(RETRY_DUE_KEY))
+# end of JobRetrier class
+
+
+def start_job_retrier(retrier:JobRetrier, connection, queue_names:List[str], logger,
+                        interval:float=RETRY_INTERVAL_SECONDS) -> threading.Event:
+    """
+    Starts a daemon thread which periodically retries our failed jobs.
+
+    Returns an Event which can be set to stop the thread.
+    """
+    stop_event = threading.Event()
+
+    def retry_failed_jobs() -> None:
+        while not stop_event.is_set():
+            try:
+                retrier.run(connection, queue_names, logger, lock_seconds=interval)
+            except Exception as e: # Don't let a Redis hiccup kill the thread
+                logger.error(f"Failed to retry failed jobs: {e}")
+            stop_event.wait(interval)
+
+    retrier_thread = threading.Thread(target=retry_failed_jobs, name='job_retrier', daemon=True)
+    retrier_thread.start()
+    return stop_event
+# end of start_job_retrier function
+
+
+job_retrier = JobRetrier()
@@ -0,0 +1,226 @@
+# Added because the tx_job_handler workers were sized by hand
+#   (and the only signal was a critical log message when a queue had no workers)
+
+"""
+tX Enqueue worker autoscaling advice
+
+The jobs accepted into each of our queues are counted (in memory, so not in the request path)
+    and a background thread adds the counts into sliding window counters in Redis
+    (one hash per ARRIVAL_BUCKET_SECONDS bucket, shared by all of our processes).
+The arrival rate of each queue is then its count over the last window_seconds.
+
+Each queue is treated as an M/M/c queue with:
+    λ = the arrival rate, and
+    1/μ = the mean duration of the jobs in its lane (from tx_enqueue_eta, else DEFAULT_JOB_SECONDS),
+so the recommended number of workers for the queue is the smallest c which:
+    keeps the utilization (λ/cμ) at most target_utilization,
+    keeps the expected wait for a worker (from the Erlang C formula) within target_wait_seconds, and
+    has enough spare workers to also clear the jobs already queued within drain_seconds,
+limited to between min_workers and max_workers.
+
+The latest advice is sent to Graphite as gauges and served (as JSON) at /scaling/.
+"""
+
+# Python imports
+from typing import Any, Callable, Dict, Optional
+from collections import Counter
+from math import ceil
+from time import time
+import threading
+
+# Library (PyPI) imports
+from rq.utils import as_text
+
+# Local imports
+from tx_enqueue_eta import DEFAULT_JOB_SECONDS, EtaEstimator
+
+
+SCALING_INTERVAL_SECONDS = 10
+ARRIVAL_BUCKET_SECONDS = 10
+ARRIVAL_WINDOW_SECONDS = 5 * 60
+ARRIVAL_KEY_PREFIX = 'tx:scaling:arrivals:' # Redis hash (for each bucket) of queue name to count
+SCALING_TARGET_UTILIZATION = 0.8
+SCALING_TARGET_WAIT_SECONDS = 60
+SCALING_DRAIN_SECONDS = 10 * 60
+SCALING_MIN_WORKERS = 1
+SCALING_MAX_WORKERS = 50
+
+
+def get_erlang_c(num_servers:int, offered_load:float) -> float:
+    """
+    Returns the probability that a job has to wait for one of num_servers
+        given the offered load (λ/μ, which must be less than num_servers).
+    """
+    erlang_b = 1.0
+    for k in range(1, num_servers + 1): # The (numerically stable) Erlang B recursion
+        erlang_b = offered_load * erlang_b / (k + offered_load * erlang_b)
+    return num_servers * erlang_b / (num_servers - offered_load * (1 - erlang_b))
+# end of get_erlang_c function
+
+
+def get_expected_wait(num_servers:int, arrival_rate:float, service_seconds:float) -> float:
+    """
+    Returns the mean seconds that a job waits for one of num_servers (of an M/M/c queue).
+    """
+    offered_load = arrival_rate * service_seconds
+    if not offered_load:
+        return 0.0
+    if offered_load >= num_servers:
+        return float('inf')
+    return get_erlang_c(num_servers, offered_load) * service_seconds / (num_servers - offered_load)
+# end of get_expected_wait function
+
+
+class ScalingAdvisor:
+    """
+    Recommends the number of workers for each of our queues (see above).
+
+    Give lane_queue_names as a dict of lane to queue name.
+    """
+
+    def __init__(self, lane_queue_names:Dict[str,str], eta_estimator:Optional[EtaEstimator]=None,
+                        window_seconds:float=ARRIVAL_WINDOW_SECONDS,
+                        target_utilization:float=SCALING_TARGET_UTILIZATION,
+                        target_wait_seconds:float=SCALING_TARGET_WAIT_SECONDS,
+                        drain_seconds:float=SCALING_DRAIN_SECONDS,
+                        min_workers:int=SCALING_MIN_WORKERS, max_workers:int=SCALING_MAX_WORKERS) -> None:
+        self.lane_queue_names = dict(lane_queue_names)
+        self.eta_estimator = eta_estimator
+        self.window_seconds = window_seconds
+        self.target_utilization = target_utilization
+        self.target_wait_seconds = target_wait_seconds
+        self.drain_seconds = drain_seconds
+        self.min_workers = min_workers
+        self.max_workers = max_workers
+        self.stats_client = None # Set by EnqueueBackends
+        self.stats_prefix = ''
+        self.advised_at:Optional[float] = None # time() of the latest advice
+        self._pending_arrivals:Counter = Counter() # Queue name: jobs not yet added into Redis
+        self._advice:Dict[str,Dict[str,Any]] = {}
+        self._lock = threading.Lock()
+
+    def record_arrivals(self, queue_name:str, count:int=1) -> None:
+        """
+        Counts jobs accepted into the given queue (without using Redis).
+        """
+        with self._lock:
+            self._pending_arrivals[queue_name] += count
+
+    def flush_arrivals(self, connection, now:Optional[float]=None) -> Dict[str,float]:
+        """
+        Adds our pending arrival counts into the current bucket in Redis
+            and reads the arrival counts of the buckets in the window.
+
+        Returns the arrival rate (jobs per second) for each of our queues.
+        """
+        now = time() if now is None else now
+        with self._lock:
+            pending_arrivals, self._pending_arrivals = self._pending_arrivals, Counter()
+        current_bucket = int(now // ARRIVAL_BUCKET_SECONDS)
+        num_buckets = max(1, ceil(self.window_seconds / ARRIVAL_BUCKET_SECONDS))
+        queue_names = list(self.lane_queue_names.values())
+        try:
+            with connection.pipeline(transaction=False) as pipeline:
+                if pending_arrivals:
+                    current_key = f'{ARRIVAL_KEY_PREFIX}{current_bucket}'
+                    for queue_name, count in pending_arrivals.items():
+                        pipeline.hincrby(current_key, queue_name, count)
+                    pipeline.expire(current_key, int(self.window_seconds) + 2 * ARRIVAL_BUCKET_SECONDS)
+                for bucket in range(current_bucket - num_buckets + 1, current_bucket + 1):
+                    pipeline.hmget(f'{ARRIVAL_KEY_PREFIX}{bucket}', queue_names)
+                results = pipeline.execute()
+        except Exception:
+            with self._lock: # Try again next time
+                self._pending_arrivals.update(pending_arrivals)
+            raise
+        arrival_counts:Counter = Counter()
+        for bucket_counts in results[-num_buckets:]:
+            for queue_name, count in zip(queue_names, bucket_counts):
+                if count:
+                    arrival_counts[queue_name] += int(as_text(count))
+        return {queue_name: arrival_counts[queue_name] / (num_buckets * ARRIVAL_BUCKET_SECONDS)
+                    for queue_name in queue_names}
+
+    def get_service_seconds(self, lane:str) -> float:
+        """
+        Returns the mean duration of the jobs in the given lane.
+        """
+        lane_seconds = self.eta_estimator.get_lane_seconds(lane) if self.eta_estimator is not None else None
+        return lane_seconds or DEFAULT_JOB_SECONDS
+
+    def recommend_workers(self, arrival_rate:float, service_seconds:float, queue_length:int) -> int:
+        """
+        Returns the recommended number of workers for a queue (see above).
+        """
+        offered_load = arrival_rate * service_seconds
+        # Enough workers for the arrivals…
+        num_workers = max(1, ceil(offered_load / self.target_utilization))
+        while num_workers < self.max_workers \
+        and get_expected_wait(num_workers, arrival_rate, service_seconds) > self.target_wait_seconds:
+            num_workers += 1
+        # …and enough more to clear the backlog in time
+        num_workers += ceil(queue_length * service_seconds / self.drain_seconds)
+        if not offered_load and not queue_length:
+            num_workers = 0
+        return min(self.max_workers, max(self.min_workers, num_workers))
+
+    def advise(self, connection, get_queue_metrics:Callable[[str],Dict[str,Any]]) -> Dict[str,Dict[str,Any]]:
+        """
+        Updates (and returns) the advice for each of our queues
+            using the latest arrival rates and (sampled) queue metrics.
+        """
+        arrival_rates = self.flush_arrivals(connection)
+        advice = {}
+        for lane, queue_name in self.lane_queue_names.items():
+            queue_metrics = get_queue_metrics(queue_name)
+            arrival_rate, service_seconds = arrival_rates[queue_name], self.get_service_seconds(lane)
+            queue_length = queue_metrics.get('queue_length') or 0
+            recommended_workers = self.recommend_workers(arrival_rate, service_seconds, queue_length)
+            advice[queue_name] = {'lane': lane,
+                                'arrivals_per_minute': round(60 * arrival_rate, 3),
+                                'service_seconds': round(service_seconds, 1),
+                                'queue_length': queue_length,
+                                'worker_count': queue_metrics.get('worker_count'),
+                                'recommended_workers': recommended_workers,
+                                'utilization': round(arrival_rate * service_seconds / recommended_workers, 3)
+                                                if recommended_workers else 0.0,
+                                }
+            if self.stats_client is not None:
+                self.stats_client.gauge(f'{self.stats_prefix}.scaling.{queue_name}.recommended_workers', recommended_workers)
+                self.stats_client.gauge(f'{self.stats_prefix}.scaling.{queue_name}.arrivals_per_minute',
+                                        advice[queue_name]['arrivals_per_minute'])
+        with self._lock:
+            self._advice, self.advised_at = advice, time()
+        return advice
+
+    def get_advice(self) -> Dict[str,Any]:
+        """
+        Returns the latest advice (without using Redis), e.g., for the /scaling/ endpoint.
+        """
+        with self._lock:
+            return {'advised_at': self.advised_at, 'window_seconds': self.window_seconds,
+                    'queues': {queue_name: dict(queue_advice) for queue_name, queue_advice in self._advice.items()}}
+# end of ScalingAdvisor class
+
+
+def start_scaling_advisor(advisor:ScalingAdvisor, connection, get_queue_metrics:Callable[[str],Dict[str,Any]], logger,
+                            interval:float=SCALING_INTERVAL_SECONDS) -> threading.Event:
+    """
+    Starts a daemon thread which periodically updates the scaling advice.
+
+    Returns an Event which can be set to stop the thread.
+    """
+    stop_event = threading.Event()
+
+    def advise_scaling() -> None:
+        while not stop_event.is_set():
+            try:
+                advisor.advise(connection, get_queue_metrics)
+            except Exception as e: # Don't let a Redis hiccup kill the thread
+                logger.error(f"Failed to update the scaling advice: {e}")
+            stop_event.wait(interval)
+
+    advisor_thread = threading.Thread(target=advise_scaling, name='scaling_advisor', daemon=True)
+    advisor_thread.start()
+    return stop_event
+# end of start_scaling_advisor function
@@ -0,0 +1,76 @@
+# Added because all of our queues (and so their throughput and memory) were limited to one Redis node
+
+"""
+tX Enqueue queue sharding
+
+If REDIS_SHARD_HOSTNAMES is set, each job goes to one of several Redis instances (shards):
+    its queue entry, rq job hash and de-duplication claims are all kept on its shard.
+(Admission control, ETA and run time stats, etc. stay on the REDIS_HOSTNAME instance.)
+
+The shard is chosen by consistent hashing of the repo_owner/repo_name
+    so all the jobs of a repo go to the same shard (and so can be coalesced).
+When a shard is added, only about 1/N of the repos move to it
+    and any jobs already queued stay on their old shard until a worker takes them,
+    so tx_job_handler workers must listen to the queues on every shard.
+(A shard should only be removed after its queues are empty.)
+"""
+
+# Python imports
+from typing import Any, Dict, List
+from bisect import bisect
+from hashlib import md5
+
+
+SHARD_VIRTUAL_NODES = 160 # Points on the ring for each shard (evens out the share of each shard)
+
+
+def get_hash(key:str) -> int:
+    return int.from_bytes(md5(key.encode('utf-8')).digest()[:8], 'big')
+# end of get_hash function
+
+
+def get_shard_key(payload_dict:Dict[str,Any]) -> str:
+    """
+    Returns the key used to choose the shard of the given job
+        (the job_id if it doesn't have a repo_owner and repo_name).
+    """
+    repo_owner, repo_name = payload_dict.get('repo_owner'), payload_dict.get('repo_name')
+    if not repo_owner or not repo_name:
+        return f"job:{payload_dict.get('job_id', '')}"
+    return f'{repo_owner}/{repo_name}'.lower()
+# end of get_shard_key function
+
+
+class ShardRing:
+    """
+    Consistent hash ring of the given shard names (e.g., Redis host:port).
+
+    NOTE: The order of the names doesn't matter.
+    """
+
+    def __init__(self, shard_names:List[str], virtual_nodes:int=SHARD_VIRTUAL_NODES) -> None:
+        if not shard_names:
+            raise ValueError("Need at least one shard")
+        if len(set(shard_names)) != len(shard_names):
+            raise ValueError(f"Duplicate shard names: {shard_names}")
+        self.shard_names = list(shard_names)
+        ring_points = sorted((get_hash(f'{shard_name}#{n}'), shard_index)
+                                for shard_index, shard_name in enumerate(shard_names) for n in range(virtual_nodes))
+        self._point_hashes = [point_hash for point_hash, _shard_index in ring_points]
+        self._point_shard_indexes = [shard_index for _point_hash, shard_index in ring_points]
+
+    def get_shard_index(self, shard_key:str) -> int:
+        """
+        Returns the index (into shard_names) of the shard for the given key.
+        """
+        point_index = bisect(self._point_hashes, get_hash(shard_key)) % len(self._point_hashes)
+        return self._point_shard_indexes[point_index]
+# end of ShardRing class
+
+
+def parse_redis_shard_hostnames(redis_shard_hostnames:str) -> List[str]:
+    """
+    Returns the list of Redis host (or host:port) names from the comma separated string.
+    """
+    return [hostname.strip() for hostname in redis_shard_hostnames.split(',') if hostname.strip()]
+# end of parse_redis_shard_hostnames function
@@ -0,0 +1,484 @@
+# Added because a Redis stall or failover used to either block the gunicorn worker
+#   or lose the caller's job (with a 500 response)
+
+"""
+tX Enqueue disk spool
+
+When Redis is unavailable (or an enqueue takes longer than our latency budget)
+    accepted jobs are appended to a local spool on disk instead
+    and a background replayer moves them into their rq queues (in order) once Redis recovers.
+While any of our jobs are still spooled, new jobs are also spooled (so that they can't overtake them).
+
+Spooled jobs are checked (as far as they can be without Redis) before being spooled, and when replayed:
+    they're claimed with the deduplicator (if set) so that duplicates, and equivalent jobs which are already queued,
+        are dropped (as their callers' jobs are already queued),
+    and replaying waits while a job's queue already has max_queue_depth (if set) jobs
+        (so that a backlog goes into the queues as the workers take jobs, and isn't lost).
+    NOTE: The per-submitter rate limits of tx_enqueue_admission aren't applied to spooled jobs.
+
+Each process writes into its own writer directory (locked with flock while the process lives)
+    as a series of append-only segment files of records:
+        4-byte length, 4-byte CRC32, then the pickled (queue name, rq job id, job dict, job kwargs).
+    Concurrent appends share fsyncs (a group commit) so each caller waits for at most one fsync.
+    The replay position is kept in a cursor file (replaced atomically) so after a crash
+        at most one batch is replayed again, and a job which is already in Redis is skipped.
+    The writer directories of dead processes are replayed (and then removed) by the next replayer to lock them.
+
+Disk usage of each process's spool is bounded by max_bytes (then SpoolFullError is raised).
+"""
+
+# Python imports
+from typing import Any, Callable, Dict, Iterator, List, NamedTuple, Optional, Tuple
+from pathlib import Path
+from time import time
+from zlib import crc32
+import fcntl
+import os
+import pickle
+import struct
+import threading
+
+# Library (PyPI) imports
+from redis.exceptions import ConnectionError as RedisConnectionError, TimeoutError as RedisTimeoutError
+from rq import Queue
+from rq.job import Job
+
+# Local imports
+from tx_enqueue_redis import create_job
+from tx_enqueue_dedup import JobDeduplicator
+
+
+SPOOL_MAX_BYTES = 256 * 1024 * 1024 # Per process
+SPOOL_SEGMENT_BYTES = 4 * 1024 * 1024 # A new segment file is started after this
+SPOOL_LATENCY_BUDGET_SECONDS = 0.5 # Slower enqueues make us spool for a while
+REDIS_RETRY_SECONDS = 5 # After a Redis failure, jobs are spooled (without trying Redis) for this long
+REPLAY_BATCH_SIZE = 100
+REPLAY_INTERVAL_SECONDS = 1
+REDIS_ERRORS = RedisConnectionError, RedisTimeoutError # NOTE: Includes a connection pool timeout
+
+RECORD_HEADER = struct.Struct('>II') # Length and CRC32 of the record
+WRITER_DIRECTORY_PREFIX = 'writer-'
+SEGMENT_SUFFIX = '.spool'
+CURSOR_FILENAME = 'replay.cursor'
+LOCK_FILENAME = 'lock'
+
+
+class SpoolFullError(Exception):
+    pass
+
+
+class CorruptRecordError(Exception):
+    pass
+
+
+class SpooledJob(NamedTuple):
+    queue_name: str
+    job_id: str # The rq job id
+    job_dict: Dict[str,Any]
+    job_kwargs: Dict[str,Any] # e.g., timeout, result_ttl, failure_ttl
+
+
+def encode_record(spooled_job:SpooledJob) -> bytes:
+    """
+    Returns the spool record (header and pickled data) for the given job.
+    """
+    record_data = pickle.dumps(tuple(spooled_job), protocol=pickle.HIGHEST_PROTOCOL)
+    return RECORD_HEADER.pack(len(record_data), crc32(record_data)) + record_data
+# end of encode_record function
+
+
+def read_records(segment_path:Path, offset:int) -> Iterator[Tuple[SpooledJob, int]]:
+    """
+    Yields each complete (spooled job, offset after it) in the segment file from offset.
+
+    Stops at an incomplete record (e.g., one still being written, or torn by a crash)
+        and raises CorruptRecordError if a record doesn't match its CRC.
+    """
+    with open(segment_path, 'rb') as segment_file:
+        segment_file.seek(offset)
+        while True:
+            header = segment_file.read(RECORD_HEADER.size)
+            if len(header) < RECORD_HEADER.size:
+                return
+            record_length, record_crc = RECORD_HEADER.unpack(header)
+            record_data = segment_file.read(record_length)
+            if len(record_data) < record_length:
+                return
+            if crc32(record_data) != record_crc:
+                raise CorruptRecordError(f"Bad spool record at {segment_path.name}:{offset}")
+            offset += RECORD_HEADER.size + record_length
+            yield SpooledJob(*pickle.loads(record_data)), offset
+# end of read_records function
+
+
+def enqueue_spooled_jobs(connection, spooled_jobs:List[SpooledJob],
+                            get_job_connection:Optional[Callable[[Dict[str,Any]],Any]]=None,
+                            deduplicator:Optional[JobDeduplicator]=None) -> int:
+    """
+    Enqueues the spooled jobs (which aren't already in Redis) into their rq queues in one pipeline
+        (or one per shard, given get_job_connection for the job dicts, see tx_enqueue_shards).
+
+    Given a deduplicator, the jobs are claimed first and any duplicate or coalesced jobs are dropped.
+
+    Returns the number of jobs enqueued.
+    """
+    if get_job_connection is not None:
+        spooled_jobs_by_connection:Dict[Any,List[SpooledJob]] = {}
+        for spooled_job in spooled_jobs:
+            spooled_jobs_by_connection.setdefault(get_job_connection(spooled_job.job_dict), []).append(spooled_job)
+        return sum(enqueue_spooled_jobs(job_connection, shard_spooled_jobs, deduplicator=deduplicator)
+                    for job_connection, shard_spooled_jobs in spooled_jobs_by_connection.items())
+    with connection.pipeline() as pipeline:
+        for spooled_job in spooled_jobs:
+            pipeline.exists(Job.key_for(spooled_job.job_id))
+        existing_flags = pipeline.execute()
+    # e.g., replayed before a crash, or the enqueue timed out but actually succeeded
+    new_jobs = [spooled_job for spooled_job, existing_flag in zip(spooled_jobs, existing_flags) if not existing_flag]
+    if deduplicator is not None:
+        dedup_results = deduplicator.claim_many(connection, [(spooled_job.job_id, spooled_job.job_dict)
+                                                                for spooled_job in new_jobs])
+        new_jobs = [spooled_job for spooled_job, (_dedup_outcome, original_response_dict) in zip(new_jobs, dedup_results)
+                    if original_response_dict is None]
+    try:
+        with connection.pipeline() as pipeline:
+            for spooled_job in new_jobs:
+                queue = Queue(spooled_job.queue_name, connection=connection)
+                job = create_job(queue, spooled_job.job_dict, job_id=spooled_job.job_id, **spooled_job.job_kwargs)
+                queue.enqueue_job(job, pipeline=pipeline)
+            pipeline.execute()
+    except Exception:
+        if deduplicator is not None:
+            deduplicator.release(connection, [spooled_job.job_id for spooled_job in new_jobs])
+        raise
+    return len(new_jobs)
+# end of enqueue_spooled_jobs function
+
+
+def get_replayable_count(connection, spooled_jobs:List[SpooledJob], max_queue_depth:int,
+                            get_job_connection:Optional[Callable[[Dict[str,Any]],Any]]=None) -> int:
+    """
+    Returns how many of the (oldest) spooled jobs can be enqueued
+        before one of their queues would have more than max_queue_depth jobs.
+    """
+    queue_lengths:Dict[Tuple[int,str],int] = {} # (id of the job connection, queue name): jobs in the queue
+    for replayable_count, spooled_job in enumerate(spooled_jobs):
+        job_connection = connection if get_job_connection is None else get_job_connection(spooled_job.job_dict)
+        queue_key = id(job_connection), spooled_job.queue_name
+        if queue_key not in queue_lengths:
+            queue_lengths[queue_key] = Queue(spooled_job.queue_name, connection=job_connection).count
+        if queue_lengths[queue_key] >= max_queue_depth:
+            return replayable_count
+        queue_lengths[queue_key] += 1
+    return len(spooled_jobs)
+# end of get_replayable_count function
+
+
+def get_segment_number(segment_path:Path) -> int:
+    return int(segment_path.stem)
+
+
+class JobSpool:
+    """
+    Append-only disk spool of jobs waiting for Redis (see above).
+
+    An empty directory turns spooling off.
+    Nothing is written to disk until the first job is spooled.
+    """
+
+    def __init__(self, directory:str, max_bytes:int=SPOOL_MAX_BYTES, segment_bytes:int=SPOOL_SEGMENT_BYTES,
+                        latency_budget:float=SPOOL_LATENCY_BUDGET_SECONDS,
+                        redis_retry_seconds:float=REDIS_RETRY_SECONDS, logger=None) -> None:
+        self.directory = Path(directory) if directory else None
+        self.max_bytes = max_bytes
+        self.segment_bytes = segment_bytes
+        self.latency_budget = latency_budget
+        self.redis_retry_seconds = redis_retry_seconds
+        self.logger = logger
+        self.stats_client = None # Set by EnqueueBackends
+        self.stats_prefix = ''
+        self.deduplicator:Optional[JobDeduplicator] = None # Set by tx_enqueue_main
+        self.max_queue_depth:Optional[int] = None # Set by tx_enqueue_main
+        self.spooled_count = self.replayed_count = 0
+        self._redis_unavailable_until = 0.0
+        self._pid:Optional[int] = None
+        self._writer_directory:Optional[Path] = None
+        self._lock_files:Dict[Path,Any] = {} # Writer directory: open (and flocked) lock file
+        self._segment_file:Any = None
+        self._segment_number = 0
+        self._segment_bytes_written = 0
+        self._disk_bytes = 0 # In our writer directory
+        self._pending_count = 0 # Our jobs which haven't been replayed yet
+        self._write_count = self._synced_count = 0
+        self._lock = threading.Lock()
+        self._sync_lock = threading.Lock()
+
+    @property
+    def enabled(self) -> bool:
+        return self.directory is not None
+
+    def should_spool(self) -> bool:
+        """
+        Returns True if new jobs should be spooled (rather than enqueued).
+        """
+        return self.enabled and (self._pending_count > 0 or time() < self._redis_unavailable_until)
+
+    def note_redis_failure(self, reason:Any) -> None:
+        """
+        Spool (without trying Redis) for the next redis_retry_seconds.
+        """
+        if self.logger is not None and not self.should_spool():
+            self.logger.error(f"Spooling jobs for {self.redis_retry_seconds}s because Redis {reason}")
+        self._redis_unavailable_until = time() + self.redis_retry_seconds
+
+    def note_enqueue_seconds(self, seconds:float) -> None:
+        if self.enabled and seconds > self.latency_budget:
+            self.note_redis_failure(f"took {seconds:.3f}s to enqueue (budget is {self.latency_budget}s)")
+
+    def has_room(self) -> bool:
+        return self._disk_bytes < self.max_bytes
+
+    def append(self, spooled_jobs:List[SpooledJob]) -> None:
+        """
+        Appends the jobs to the spool and returns once they're fsynced.
+
+        Raises SpoolFullError (without writing anything) if that would exceed max_bytes.
+        """
+        records = b''.join(encode_record(spooled_job) for spooled_job in spooled_jobs)
+        with self._lock:
+            if self._pid != os.getpid(): # i.e., the first job (or we've been forked)
+                self._open_writer_directory()
+            if self._disk_bytes + len(records) > self.max_bytes:
+                raise SpoolFullError(f"Spool is full ({self._disk_bytes:,} bytes)")
+            if self._segment_file is None or self._segment_bytes_written >= self.segment_bytes:
+                self._start_segment()
+            self._segment_file.write(records)
+            self._segment_file.flush()
+            self._segment_bytes_written += len(records)
+            self._disk_bytes += len(records)
+            self._pending_count += len(spooled_jobs)
+            self.spooled_count += len(spooled_jobs)
+            self._write_count += 1
+            write_count = self._write_count
+        # Group commit: whoever gets the sync lock fsyncs the writes of everyone waiting
+        with self._sync_lock:
+            if self._synced_count < write_count:
+                with self._lock:
+                    if self._segment_file is not None: # NOTE: A closed segment was fsynced first
+                        os.fsync(self._segment_file.fileno())
+                    self._synced_count = self._write_count
+
+    def _open_writer_directory(self) -> None:
+        """
+        Creates (and locks) a new writer directory for this process.
+        """
+        assert self.directory is not None
+        self._pid = os.getpid()
+        self._writer_directory = self.directory / f'{WRITER_DIRECTORY_PREFIX}{int(1000*time()):015d}-{self._pid}'
+        self._writer_directory.mkdir(parents=True)
+        lock_file = open(self._writer_directory / LOCK_FILENAME, 'w')
+        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        self._lock_files = {self._writer_directory: lock_file} # NOTE: Any inherited locks aren't ours
+        self._segment_file, self._segment_number = None, 0
+        self._disk_bytes = self._pending_count = 0
+
+    def _start_segment(self) -> None:
+        assert self._writer_directory is not None
+        self._close_segment()
+        self._segment_number += 1
+        self._segment_file = open(self._writer_directory / f'{self._segment_number:09d}{SEGMENT_SUFFIX}', 'ab')
+        self._segment_bytes_written = 0
+        fsync_directory(self._writer_directory) # So that the new segment file survives a crash
+
+    def _close_segment(self) -> None:
+        if self._segment_file is not None:
+            os.fsync(self._segment_file.fileno())
+            self._segment_file.close()
+            self._segment_file = None
+
+    def get_depth(self) -> Dict[str,int]:
+        """
+        Returns the number of our jobs (and the bytes of all jobs) waiting to be replayed.
+        """
+        spool_bytes = 0
+        if self.directory is not None and self.directory.is_dir():
+            for writer_directory in self.directory.glob(f'{WRITER_DIRECTORY_PREFIX}*'):
+                replayed_segment_number, replayed_offset = read_cursor(writer_directory)
+                for segment_path in writer_directory.glob(f'*{SEGMENT_SUFFIX}'):
+                    try:
+                        segment_size = segment_path.stat().st_size
+                    except FileNotFoundError: # Just replayed
+                        continue
+                    segment_number = get_segment_number(segment_path)
+                    if segment_number > replayed_segment_number:
+                        spool_bytes += segment_size
+                    elif segment_number == replayed_segment_number:
+                        spool_bytes += max(0, segment_size - replayed_offset)
+        return {'jobs': self._pending_count, 'bytes': spool_bytes}
+
+    def replay(self, connection, max_count:int=REPLAY_BATCH_SIZE,
+                        get_job_connection:Optional[Callable[[Dict[str,Any]],Any]]=None) -> int:
+        """
+        Enqueues (up to max_count of) the oldest spooled jobs
+            from our writer directory or those of dead processes
+            (into the Redis shard of each job, if get_job_connection is given).
+
+        Returns the number of spooled jobs replayed
+            (zero when there are none left, or when their queues are too deep to replay any now).
+
+        NOTE: Only the background replayer thread should call this.
+        """
+        if self.directory is None or not self.directory.is_dir():
+            return 0
+        # NOTE: Directory names start with the time so the oldest are replayed first
+        for writer_directory in sorted(self.directory.glob(f'{WRITER_DIRECTORY_PREFIX}*')):
+            if writer_directory not in self._lock_files and not self._lock_orphan(writer_directory):
+                continue # Still being written by a live process
+            replayed_count = self._replay_writer_directory(connection, writer_directory, max_count, get_job_connection)
+            if replayed_count:
+                return replayed_count
+        return 0
+
+    def _lock_orphan(self, writer_directory:Path) -> bool:
+        """
+        Returns True if we locked the writer directory of a dead process (to replay it).
+        """
+        try:
+            lock_file = open(writer_directory / LOCK_FILENAME, 'a')
+        except FileNotFoundError: # Just removed by another replayer
+            return False
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            lock_file.close()
+            return False
+        if not writer_directory.is_dir(): # Removed while we were locking it
+            lock_file.close()
+            return False
+        self._lock_files[writer_directory] = lock_file
+        return True
+
+    def _replay_writer_directory(self, connection, writer_directory:Path, max_count:int,
+                                    get_job_connection:Optional[Callable[[Dict[str,Any]],Any]]) -> int:
+        our_directory_flag = writer_directory == self._writer_directory
+        replayed_segment_number, replayed_offset = read_cursor(writer_directory)
+        for segment_path in sorted(writer_directory.glob(f'*{SEGMENT_SUFFIX}')):
+            segment_number = get_segment_number(segment_path)
+            offset = replayed_offset if segment_number == replayed_segment_number else 0
+            if segment_number >= replayed_segment_number:
+                spooled_jobs, offsets, corrupt_flag = [], [], False
+                try:
+                    for spooled_job, offset in read_records(segment_path, offset):
+                        spooled_jobs.append(spooled_job)
+                        offsets.append(offset)
+                        if len(spooled_jobs) >= max_count:
+                            break
+                except CorruptRecordError as e:
+                    corrupt_flag = True
+                    if self.logger is not None:
+                        self.logger.critical(f"Dropping the rest of spool segment {segment_path}: {e}")
+                if spooled_jobs and self.max_queue_depth is not None:
+                    replayable_count = get_replayable_count(connection, spooled_jobs, self.max_queue_depth,
+                                                            get_job_connection)
+                    if not replayable_count: # Leave them (in order) until the workers catch up
+                        return 0
+                    spooled_jobs, offsets = spooled_jobs[:replayable_count], offsets[:replayable_count]
+                if spooled_jobs:
+                    offset = offsets[-1]
+                    enqueue_spooled_jobs(connection, spooled_jobs, get_job_connection, self.deduplicator)
+                    write_cursor(writer_directory, segment_number, offset)
+                    self.replayed_count += len(spooled_jobs)
+                    if our_directory_flag:
+                        with self._lock:
+                            self._pending_count -= len(spooled_jobs)
+                    return len(spooled_jobs)
+                if our_directory_flag:
+                    with self._lock:
+                        if segment_number == self._segment_number and self._segment_file is not None:
+                            if offset < self._segment_bytes_written and not corrupt_flag:
+                                return 0 # The rest of the record is still being written
+                            self._close_segment() # The next job will start a new segment
+            # This segment is finished with
+            with self._lock:
+                if our_directory_flag:
+                    self._disk_bytes -= segment_path.stat().st_size
+                segment_path.unlink()
+        if not our_directory_flag:
+            self._remove_orphan(writer_directory)
+        else:
+            with self._lock:
+                if self._segment_file is None: # i.e., no new jobs since we finished
+                    self._pending_count = 0 # (even if some were corrupt)
+        return 0
+
+    def _remove_orphan(self, writer_directory:Path) -> None:
+        for leftover_path in writer_directory.iterdir():
+            leftover_path.unlink()
+        writer_directory.rmdir()
+        self._lock_files.pop(writer_directory).close()
+        if self.logger is not None:
+            self.logger.info(f"Finished replaying spool {writer_directory.name}")
+# end of JobSpool class
+
+
+def fsync_directory(directory:Path) -> None:
+    directory_fd = os.open(directory, os.O_RDONLY)
+    try:
+        os.fsync(directory_fd)
+    finally:
+        os.close(directory_fd)
+# end of fsync_directory function
+
+
+def read_cursor(writer_directory:Path) -> Tuple[int, int]:
+    """
+    Returns the segment number and offset which have been replayed up to.
+    """
+    try:
+        segment_number, offset = (writer_directory / CURSOR_FILENAME).read_text().split()
+    except (FileNotFoundError, ValueError):
+        return 0, 0
+    return int(segment_number), int(offset)
+# end of read_cursor function
+
+
+def write_cursor(writer_directory:Path, segment_number:int, offset:int) -> None:
+    cursor_path = writer_directory / CURSOR_FILENAME
+    new_cursor_path = cursor_path.with_suffix('.new')
+    with open(new_cursor_path, 'w') as cursor_file:
+        cursor_file.write(f'{segment_number} {offset}')
+        cursor_file.flush()
+        os.fsync(cursor_file.fileno())
+    new_cursor_path.replace(cursor_path)
+# end of write_cursor function
+
+
+def start_spool_replayer(spool:JobSpool, connection, logger,
+                            interval:float=REPLAY_INTERVAL_SECONDS,
+                            get_job_connection:Optional[Callable[[Dict[str,Any]],Any]]=None) -> threading.Event:
+    """
+    Starts a daemon thread which replays spooled jobs into Redis (as soon as it responds)
+        and sends the spool depth to Graphite.
+
+    Returns an Event which can be set to stop the thread.
+    """
+    stop_event = threading.Event()
+
+    def replay_spool() -> None:
+        while not stop_event.is_set():
+            try:
+                while spool.replay(connection, get_job_connection=get_job_connection) and not stop_event.is_set():
+                    pass
+                if spool.stats_client is not None:
+                    spool_depth = spool.get_depth()
+                    spool.stats_client.gauge(f'{spool.stats_prefix}.spool.jobs', spool_depth['jobs'])
+                    spool.stats_client.gauge(f'{spool.stats_prefix}.spool.bytes', spool_depth['bytes'])
+            except REDIS_ERRORS as e: # Still down, so try again later
+                spool.note_redis_failure(f"is unavailable: {e}")
+            except Exception as e: # Don't let anything else kill the thread
+                logger.error(f"Failed to replay spooled jobs: {e}")
+            stop_event.wait(interval)
+
+    replayer_thread = threading.Thread(target=replay_spool, name='spool_replayer', daemon=True)
+    replayer_thread.start()
+    return stop_event
+# end of start_spool_replayer function
@@ -0,0 +1,201 @@
+# Added so that we can tell where the time of a slow POST went
+
+"""
+tX Enqueue request stage timing
+
+Each POST is timed (by the Flask or ASGI app) with a RequestTimer
+    and the code of each stage (parsing, validating, DCS lookup, dedup, admission, enqueue)
+    is wrapped in timed_stage(stage_name) which adds to the timer of the current request
+    (found via a context variable, so it works for both threads and asyncio tasks).
+A stage can be entered several times in one request (e.g., for each job in a batch).
+
+When the request finishes, the time of each stage (and the total) is
+    sent to Graphite as a timer, e.g., tx.prod.enqueue-job.job_receiver.stages.parse
+    and added to a histogram which can be served in the Prometheus text format.
+
+A sample of requests can also be traced (i.e., logged with their stage times).
+    The sample rate is in the TRACE_SAMPLE_RATE_KEY in Redis (else the TRACE_SAMPLE_RATE environment variable)
+    so it can be changed without redeploying, e.g., redis-cli SET tx:trace:sample_rate 0.01
+"""
+
+# Python imports
+from typing import Dict, Iterator, List, Optional, Tuple
+from contextlib import contextmanager
+from contextvars import ContextVar
+from random import random
+from time import perf_counter
+import threading
+
+
+STAGE_BUCKETS_SECONDS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+TOTAL_STAGE = 'total'
+TRACE_SAMPLE_RATE = 0.0 # Fraction of requests to trace
+TRACE_SAMPLE_RATE_KEY = 'tx:trace:sample_rate'
+TRACE_RATE_REFRESH_SECONDS = 10
+PROMETHEUS_METRIC_NAME = 'tx_enqueue_stage_seconds'
+PROMETHEUS_CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+_current_request_timer:ContextVar[Optional['RequestTimer']] = ContextVar('tx_enqueue_request_timer', default=None)
+
+
+class StageHistogram:
+    """
+    Cumulative histogram of stage times (in seconds) like a Prometheus one.
+    """
+
+    def __init__(self, buckets:Tuple[float, ...]=STAGE_BUCKETS_SECONDS) -> None:
+        self.buckets = buckets
+        self.bucket_counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, seconds:float) -> None:
+        for n, bucket in enumerate(self.buckets):
+            if seconds <= bucket:
+                self.bucket_counts[n] += 1
+                break
+        self.count += 1
+        self.sum += seconds
+# end of StageHistogram class
+
+
+class RequestTimer:
+    """
+    Adds up the time spent in each stage of one request.
+    """
+
+    def __init__(self, recorder:'StageRecorder', endpoint:str, traced:bool) -> None:
+        self.recorder = recorder
+        self.endpoint = endpoint
+        self.traced = traced
+        self.stage_seconds:Dict[str,float] = {}
+        self._start_time = perf_counter()
+
+    def add(self, stage_name:str, seconds:float) -> None:
+        self.stage_seconds[stage_name] = self.stage_seconds.get(stage_name, 0.0) + seconds
+
+    def finish(self, outcome:str='') -> Dict[str,float]:
+        """
+        Sends (and returns) the stage times, including the total.
+        """
+        self.stage_seconds[TOTAL_STAGE] = perf_counter() - self._start_time
+        self.recorder.record(self, outcome)
+        return self.stage_seconds
+# end of RequestTimer class
+
+
+@contextmanager
+def timed_stage(stage_name:str) -> Iterator[None]:
+    """
+    Adds the time spent in the with block to the given stage of the current request (if any).
+    """
+    request_timer = _current_request_timer.get()
+    if request_timer is None:
+        yield
+        return
+    start_time = perf_counter()
+    try:
+        yield
+    finally:
+        request_timer.add(stage_name, perf_counter() - start_time)
+# end of timed_stage function
+
+
+class StageRecorder:
+    """
+    Starts and records the RequestTimers of each request (see above).
+    """
+
+    def __init__(self, trace_sample_rate:float=TRACE_SAMPLE_RATE, logger=None) -> None:
+        self.default_trace_sample_rate = self.trace_sample_rate = trace_sample_rate
+        self.logger = logger
+        self.stats_client = None # Set by EnqueueBackends
+        self.stats_prefix = ''
+        self._histograms:Dict[Tuple[str,str],StageHistogram] = {}
+        self._lock = threading.Lock()
+
+    def start_request(self, endpoint:str) -> RequestTimer:
+        """
+        Starts timing a request (in the current context).
+        """
+        request_timer = RequestTimer(self, endpoint, traced=random() < self.trace_sample_rate)
+        _current_request_timer.set(request_timer)
+        return request_timer
+
+    def finish_request(self, outcome:str='') -> Optional[Dict[str,float]]:
+        """
+        Finishes timing the request of the current context (if any).
+        """
+        request_timer = _current_request_timer.get()
+        if request_timer is None:
+            return None
+        _current_request_timer.set(None)
+        return request_timer.finish(outcome)
+
+    def record(self, request_timer:RequestTimer, outcome:str) -> None:
+        with self._lock:
+            for stage_name, seconds in request_timer.stage_seconds.items():
+                histogram_key = request_timer.endpoint, stage_name
+                if histogram_key not in self._histograms:
+                    self._histograms[histogram_key] = StageHistogram()
+                self._histograms[histogram_key].observe(seconds)
+        if self.stats_client is not None:
+            for stage_name, seconds in request_timer.stage_seconds.items():
+                self.stats_client.timing(f'{self.stats_prefix}.{request_timer.endpoint}.stages.{stage_name}', 1000 * seconds)
+        if request_timer.traced and self.logger is not None:
+            self.logger.info(f"Trace of {request_timer.endpoint}{' ('+outcome+')' if outcome else ''}: "
+                             + ', '.join(f'{stage_name}={1000*seconds:.2f}ms'
+                                         for stage_name, seconds in request_timer.stage_seconds.items()))
+
+    def refresh_trace_sample_rate(self, connection) -> float:
+        """
+        Reads the trace sample rate from Redis (else uses our default).
+        """
+        sample_rate = connection.get(TRACE_SAMPLE_RATE_KEY)
+        self.trace_sample_rate = float(sample_rate) if sample_rate is not None else self.default_trace_sample_rate
+        return self.trace_sample_rate
+
+    def render_prometheus(self) -> str:
+        """
+        Returns our histograms in the Prometheus text exposition format.
+        """
+        lines:List[str] = [f'# HELP {PROMETHEUS_METRIC_NAME} Time spent in each stage of handling a request',
+                           f'# TYPE {PROMETHEUS_METRIC_NAME} histogram']
+        with self._lock:
+            for (endpoint, stage_name), histogram in sorted(self._histograms.items()):
+                labels = f'endpoint="{endpoint}",stage="{stage_name}"'
+                cumulative_count = 0
+                for bucket, bucket_count in zip(histogram.buckets, histogram.bucket_counts):
+                    cumulative_count += bucket_count
+                    lines.append(f'{PROMETHEUS_METRIC_NAME}_bucket{{{labels},le="{bucket}"}} {cumulative_count}')
+                lines.append(f'{PROMETHEUS_METRIC_NAME}_bucket{{{labels},le="+Inf"}} {histogram.count}')
+                lines.append(f'{PROMETHEUS_METRIC_NAME}_sum{{{labels}}} {histogram.sum}')
+                lines.append(f'{PROMETHEUS_METRIC_NAME}_count{{{labels}}} {histogram.count}')
+        return '\n'.join(lines) + '\n'
+# end of StageRecorder class
+
+
+def start_trace_rate_refresher(recorder:StageRecorder, connection, logger,
+                                interval:float=TRACE_RATE_REFRESH_SECONDS) -> threading.Event:
+    """
+    Starts a daemon thread which periodically refreshes the trace sample rate from Redis.
+
+    Returns an Event which can be set to stop the thread.
+    """
+    stop_event = threading.Event()
+
+    def refresh_trace_rate() -> None:
+        while not stop_event.is_set():
+            try:
+                recorder.refresh_trace_sample_rate(connection)
+            except Exception as e: # Don't let a Redis hiccup kill the thread
+                logger.error(f"Failed to refresh the trace sample rate: {e}")
+            stop_event.wait(interval)
+
+    refresher_thread = threading.Thread(target=refresh_trace_rate, name='trace_rate_refresher', daemon=True)
+    refresher_thread.start()
+    return stop_event
+# end of start_trace_rate_refresher function
+
+
+stage_recorder = StageRecorder()
@@ -0,0 +1,79 @@
+from unittest import TestCase, IsolatedAsyncioTestCase
+from unittest.mock import patch
+
+from fakeredis import FakeStrictRedis, FakeAsyncRedis
+
+from tXenqueue.tx_enqueue_admission import RATE_LIMITED, QUEUE_FULL, AdmissionController, get_submitter_keys
+
+
+PAYLOAD_DICT = {'job_id': 'job1', 'repo_owner': 'unfoldingWord', 'user_token': 'a'*40}
+
+
+class TestAdmissionController(TestCase):
+
+    def setUp(self):
+        self.connection = FakeStrictRedis()
+        self.controller = AdmissionController(rate_per_minute=60, burst=2, max_queue_depth=10,
+                                                max_queue_depth_without_workers=2)
+
+    def test_submitter_keys(self):
+        owner_key, token_key = get_submitter_keys(PAYLOAD_DICT)
+        self.assertEqual(owner_key, 'tx:admission:owner:unfoldingword')
+        self.assertNotIn('a'*40, token_key)
+        self.assertEqual(len(get_submitter_keys({'repo_owner': 'someone'})), 1)
+
+    def test_burst_then_rate_limited(self):
+        keys = get_submitter_keys(PAYLOAD_DICT)
+        self.assertEqual(self.controller.take_tokens(self.connection, [(keys, 1), (keys, 1)]), [None, None])
+        rejection_dict, = self.controller.take_tokens(self.connection, [(keys, 1)])
+        self.assertEqual((rejection_dict['status'], rejection_dict['reason']), ('rejected', RATE_LIMITED))
+        self.assertEqual(rejection_dict['retry_after'], 1) # One token per second
+        self.assertEqual(self.controller.shed_counts[RATE_LIMITED], 1)
+        # Other submitters aren't affected
+        self.assertEqual(self.controller.take_tokens(self.connection, [(['tx:admission:owner:other'], 1)]), [None])
+
+    def test_tokens_refill(self):
+        keys = get_submitter_keys(PAYLOAD_DICT)
+        with patch('tXenqueue.tx_enqueue_admission.time', return_value=1000.0):
+            self.controller.take_tokens(self.connection, [(keys, 2)])
+        with patch('tXenqueue.tx_enqueue_admission.time', return_value=1001.5):
+            self.assertEqual(self.controller.take_tokens(self.connection, [(keys, 1)]), [None])
+            self.assertIsNotNone(self.controller.take_tokens(self.connection, [(keys, 1)])[0])
+
+    def test_no_tokens_taken_if_any_bucket_empty(self):
+        owner_key, token_key = get_submitter_keys(PAYLOAD_DICT)
+        self.controller.take_tokens(self.connection, [([token_key], 2)])
+        self.assertIsNotNone(self.controller.take_tokens(self.connection, [([owner_key, token_key], 1)])[0])
+        self.assertEqual(self.controller.take_tokens(self.connection, [([owner_key], 2)]), [None])
+
+    def test_zero_rate_turns_off_rate_limiting(self):
+        controller = AdmissionController(rate_per_minute=0, burst=0)
+        self.assertEqual(controller.take_tokens(self.connection, [(get_submitter_keys(PAYLOAD_DICT), 1)]), [None])
+        self.assertEqual(self.connection.keys(), [])
+
+    def test_queue_depth(self):
+        self.assertIsNone(self.controller.check_queue_depth({}))
+        self.assertIsNone(self.controller.check_queue_depth({'queue_length': 9, 'worker_count': 1}))
+        rejection_dict = self.controller.check_queue_depth({'queue_length': 10, 'worker_count': 1})
+        self.assertEqual(rejection_dict['reason'], QUEUE_FULL)
+        self.assertIsNotNone(self.controller.check_queue_depth({'queue_length': 2, 'worker_count': 0}))
+        self.assertIsNone(self.controller.check_queue_depth({'queue_length': 2, 'worker_count': None}))
+
+    def test_queue_depths_for_batch(self):
+        metrics = {'q1': {'queue_length': 8, 'worker_count': 1}, 'q2': {'queue_length': 0, 'worker_count': 1}}
+        rejection_dicts = self.controller.check_queue_depths(['q1', 'q2', 'q1', 'q1'], metrics.__getitem__)
+        self.assertEqual([rejection_dict is None for rejection_dict in rejection_dicts], [True, True, True, False])
+        self.assertEqual(self.controller.shed_counts[QUEUE_FULL], 1)
+# end of class TestAdmissionController
+
+
+class TestAdmissionControllerAsync(IsolatedAsyncioTestCase):
+
+    async def test_burst_then_rate_limited(self):
+        async_connection = FakeAsyncRedis()
+        controller = AdmissionController(rate_per_minute=60, burst=1)
+        keys = get_submitter_keys(PAYLOAD_DICT)
+        self.assertEqual(await controller.take_tokens_async(async_connection, [(keys, 1)]), [None])
+        self.assertEqual((await controller.take_tokens_async(async_connection, [(keys, 1)]))[0]['reason'], RATE_LIMITED)
+        await async_connection.aclose()
+# end of class TestAdmissionControllerAsync
@@ -0,0 +1,180 @@
+from unittest import IsolatedAsyncioTestCase
+from unittest.mock import Mock, patch
+import json
+import logging
+from tempfile import TemporaryDirectory
+
+from fakeredis import FakeServer, FakeStrictRedis, FakeAsyncRedis
+import httpx
+from rq import Queue
+from rq.job import Job
+
+# NOTE: This import doesn't need a working Redis instance
+from tXenqueue.tx_enqueue_asgi import EnqueueASGIApp
+import tXenqueue.tx_enqueue_asgi
+from tXenqueue.tx_enqueue_main import OUR_NAME, WEBHOOK_URL_SEGMENT, BATCH_URL_SEGMENT, \
+                                        READY_URL_SEGMENT, HEALTH_URL_SEGMENT, SCALING_URL_SEGMENT, \
+                                        our_queue_names, our_lane_queue_names, enqueue_job_stats_prefix
+from tXenqueue.tx_enqueue_backends import EnqueueBackends
+from tXenqueue.tx_enqueue_admission import AdmissionController
+from tXenqueue.tx_enqueue_spool import JobSpool
+from tXenqueue.tx_enqueue_scaling import ScalingAdvisor
+from tXenqueue.check_posted_tx_payload import MAX_PAYLOAD_BYTES
+
+
+DOOR43_HEADERS = {'Content-type': 'application/json', 'Host': 'git.door43.org'}
+
+
+class TestEnqueueASGI(IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        redis_server = FakeServer()
+        self.redis_connection = FakeStrictRedis(server=redis_server)
+        self.async_redis_connection = FakeAsyncRedis(server=redis_server)
+        self.stats_client = Mock()
+        backends = EnqueueBackends('redis', our_queue_names, enqueue_job_stats_prefix, logging,
+                                   redis_connection=self.redis_connection, stats_client=self.stats_client,
+                                   start_background_threads=False)
+        app = EnqueueASGIApp(backends, async_redis_connection=self.async_redis_connection)
+        self.client = httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url='http://git.door43.org')
+        with open('tests/Resources/tx_payload.json', 'rt') as json_file:
+            self.payload_json = json.load(json_file)
+
+    async def asyncTearDown(self):
+        await self.client.aclose()
+        await self.async_redis_connection.aclose()
+
+    async def test_invalid_url(self):
+        response = await self.client.get('/whatever/')
+        self.assertEqual(response.status_code, 404)
+
+    async def test_invalid_webhook_get(self):
+        response = await self.client.get('/'+WEBHOOK_URL_SEGMENT)
+        self.assertEqual(response.status_code, 405)
+
+    async def test_webhook_with_empty_payload(self):
+        response = await self.client.post('/'+WEBHOOK_URL_SEGMENT)
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.headers['Content-Type'], 'application/json')
+        expected_dict = {'error': 'No payload found. You must submit a POST request', 'status':'invalid'}
+        self.assertEqual(response.json(), expected_dict)
+        self.stats_client.incr.assert_called_with(f'{enqueue_job_stats_prefix}.posts.invalid')
+
+    async def test_webhook_with_bad_payload(self):
+        payload_json = {'something': 'anything',}
+        response = await self.client.post('/'+WEBHOOK_URL_SEGMENT, content=json.dumps(payload_json), headers=DOOR43_HEADERS)
+        self.assertEqual(response.status_code, 400)
+        self.assertTrue(response.json()['error'].startswith('Missing job_id'))
+
+    async def test_webhook_with_oversized_payload(self):
+        payload_json = dict(self.payload_json, identifier='x'*MAX_PAYLOAD_BYTES)
+        response = await self.client.post('/'+WEBHOOK_URL_SEGMENT, content=json.dumps(payload_json), headers=DOOR43_HEADERS)
+        self.assertEqual(response.status_code, 413)
+        self.stats_client.incr.assert_called_with(f'{enqueue_job_stats_prefix}.posts.too_large')
+
+    async def test_webhook_with_deeply_nested_payload(self):
+        response = await self.client.post('/'+WEBHOOK_URL_SEGMENT, content='['*50_000, headers=DOOR43_HEADERS)
+        self.assertEqual(response.status_code, 400)
+
+    async def test_webhook_with_typical_json_payload(self):
+        response = await self.client.post('/'+WEBHOOK_URL_SEGMENT, content=json.dumps(self.payload_json), headers=DOOR43_HEADERS)
+        self.assertEqual(response.status_code, 200)
+        response_dict = response.json()
+        self.assertEqual(response_dict['status'], 'queued')
+        self.assertEqual(response_dict['queue_name'], f'{OUR_NAME}_priority')
+        # The job must be readable by (synchronous) rq workers
+        queue = Queue(f'{OUR_NAME}_priority', connection=self.redis_connection)
+        job_id = f"{OUR_NAME}_priority_{self.payload_json['job_id']}"
+        self.assertEqual(queue.job_ids, [job_id])
+        job = Job.fetch(job_id, connection=self.redis_connection)
+        self.assertEqual(job.func_name, 'webhook.job')
+        self.assertEqual(job.get_status(), 'queued')
+        self.assertEqual(job.origin, queue.name)
+        self.assertEqual(job.args[0]['job_id'], self.payload_json['job_id'])
+
+    async def test_webhook_stage_timings(self):
+        await self.client.post('/'+WEBHOOK_URL_SEGMENT, content=json.dumps(self.payload_json), headers=DOOR43_HEADERS)
+        timed_stages = [timing_call[0][0].rsplit('.', 1)[-1] for timing_call in self.stats_client.timing.call_args_list
+                            if '.job_receiver.stages.' in timing_call[0][0]]
+        self.assertEqual(timed_stages, ['read_body', 'parse', 'validate', 'dedup', 'admission', 'enqueue', 'total'])
+
+    async def test_webhook_retry_gets_original_job(self):
+        first_response = await self.client.post('/'+WEBHOOK_URL_SEGMENT, content=json.dumps(self.payload_json), headers=DOOR43_HEADERS)
+        second_response = await self.client.post('/'+WEBHOOK_URL_SEGMENT, content=json.dumps(self.payload_json), headers=DOOR43_HEADERS)
+        self.assertEqual(second_response.json(), first_response.json())
+        self.assertEqual(len(Queue(f'{OUR_NAME}_priority', connection=self.redis_connection)), 1)
+
+    async def test_webhook_rate_limited(self):
+        with patch('tXenqueue.tx_enqueue_asgi.admission_controller', AdmissionController(rate_per_minute=30, burst=1)):
+            await self.client.post('/'+WEBHOOK_URL_SEGMENT, content=json.dumps(self.payload_json), headers=DOOR43_HEADERS)
+            payload_json = dict(self.payload_json, job_id='another_job', commit_hash='another_commit')
+            response = await self.client.post('/'+WEBHOOK_URL_SEGMENT, content=json.dumps(payload_json), headers=DOOR43_HEADERS)
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(response.json()['reason'], 'rate_limited')
+        self.assertGreaterEqual(int(response.headers['Retry-After']), 1)
+        self.assertEqual(len(Queue(f'{OUR_NAME}_priority', connection=self.redis_connection)), 1)
+
+    async def test_batch_all_rate_limited(self):
+        with patch('tXenqueue.tx_enqueue_asgi.admission_controller', AdmissionController(rate_per_minute=30, burst=1)):
+            response = await self.client.post('/'+BATCH_URL_SEGMENT, headers=DOOR43_HEADERS,
+                                    content=json.dumps([dict(self.payload_json, job_id=f'job_{n}', commit_hash=f'commit_{n}')
+                                                        for n in range(3)]))
+            self.assertEqual(response.json()['rejected'], 2)
+            response = await self.client.post('/'+BATCH_URL_SEGMENT, headers=DOOR43_HEADERS,
+                                    content=json.dumps([dict(self.payload_json, job_id='job_3', commit_hash='commit_3')]))
+        self.assertEqual(response.status_code, 429)
+        self.assertIn('Retry-After', response.headers)
+
+    async def test_batch_with_partial_failure(self):
+        pdf_payload_json = dict(self.payload_json, job_id='pdf_job', output_format='pdf')
+        response = await self.client.post('/'+BATCH_URL_SEGMENT, headers=DOOR43_HEADERS,
+                                    content=json.dumps([self.payload_json, {'something': 'anything'}, pdf_payload_json]))
+        self.assertEqual(response.status_code, 200)
+        response_dict = response.json()
+        self.assertEqual((response_dict['queued'], response_dict['invalid']), (2, 1))
+        self.assertEqual(len(Queue(f'{OUR_NAME}_priority', connection=self.redis_connection)), 1)
+        self.assertEqual(len(Queue(f'{OUR_NAME}_pdf', connection=self.redis_connection)), 1)
+
+    async def test_unreachable_dcs_not_retried_blocking(self):
+        dcs_user_cache = tXenqueue.tx_enqueue_asgi.dcs_user_cache
+        payload_json = dict(self.payload_json, user_token='a' * 40)
+        with patch.object(dcs_user_cache, 'dcs_url', 'http://127.0.0.1:1'), \
+                patch.object(dcs_user_cache, 'get_user', side_effect=AssertionError('blocking DCS lookup')):
+            response = await self.client.post('/'+WEBHOOK_URL_SEGMENT, content=json.dumps(payload_json), headers=DOOR43_HEADERS)
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json()['error'], 'Unable to check DCS user token')
+
+    async def test_readiness(self):
+        response = await self.client.get('/'+READY_URL_SEGMENT)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['redis'], 'connected')
+
+    async def test_health_probes_cached(self):
+        with patch.object(self.async_redis_connection, 'ping', wraps=self.async_redis_connection.ping) as mock_ping:
+            response = await self.client.get('/'+HEALTH_URL_SEGMENT)
+            self.assertEqual(response.status_code, 200)
+            response = await self.client.post('/'+WEBHOOK_URL_SEGMENT,
+                                                headers={'User-Agent': 'check_http/v2.3.3 (nagios-plugins 2.3.3)'})
+        self.assertEqual(mock_ping.call_count, 1)
+        self.assertEqual(response.status_code, 400)
+        self.assertTrue(response.json()['ready'])
+        self.stats_client.incr.assert_called_with(f'{enqueue_job_stats_prefix}.probes.nagios')
+
+    async def test_no_scaling_advice_yet(self):
+        advisor = ScalingAdvisor(our_lane_queue_names)
+        with patch.object(tXenqueue.tx_enqueue_asgi, 'scaling_advisor', advisor):
+            response = await self.client.get('/'+SCALING_URL_SEGMENT)
+            self.assertEqual(response.status_code, 503)
+            advisor.advise(self.redis_connection, lambda queue_name: {})
+            response = await self.client.get('/'+SCALING_URL_SEGMENT)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(set(response.json()['queues']), set(our_lane_queue_names.values()))
+
+    async def test_spool_not_supported(self):
+        with TemporaryDirectory() as spool_directory:
+            backends = EnqueueBackends('redis', our_queue_names, enqueue_job_stats_prefix, logging,
+                                       redis_connection=self.redis_connection, stats_client=self.stats_client,
+                                       start_background_threads=False, spool=JobSpool(spool_directory))
+            with self.assertRaises(ValueError):
+                EnqueueASGIApp(backends)
+# end of class TestEnqueueASGI
@@ -0,0 +1,64 @@
+from unittest import TestCase
+from unittest.mock import patch
+from datetime import datetime, timedelta
+import json
+
+from fakeredis import FakeStrictRedis
+from rq import Queue
+from rq.job import Job
+
+from tXenqueue.tx_enqueue_codec import ENCODED_JOB_MAGIC, FLAG_MSGPACK, JobCodec, decode_job_dict
+from tXenqueue.tx_enqueue_redis import enqueue_job_dict
+
+
+def make_response_dict(payload_dict):
+    queued_at = datetime(2026, 1, 2, 3, 4, 5, 678)
+    return dict(payload_dict, success=True, status='queued', queue_name='tx_job_handler_priority',
+                tx_job_queued_at=queued_at, expires_at=queued_at + timedelta(days=1), eta=queued_at + timedelta(seconds=300),
+                output=f"https://cdn.door43.org/tx/job/{payload_dict['job_id']}.zip", tx_retry_count=0)
+
+
+class TestJobCodec(TestCase):
+
+    def setUp(self):
+        with open('tests/Resources/tx_payload.json', 'rt') as json_file:
+            self.response_dict = make_response_dict(json.load(json_file))
+
+    def test_off_by_default(self):
+        self.assertIs(JobCodec().encode(self.response_dict), self.response_dict)
+        self.assertIs(decode_job_dict(self.response_dict), self.response_dict)
+
+    def test_round_trip(self):
+        for encoding in ('json', 'msgpack'):
+            encoded_job = JobCodec(encoding).encode(self.response_dict)
+            self.assertTrue(encoded_job.startswith(ENCODED_JOB_MAGIC))
+            self.assertEqual(bool(encoded_job[4] & FLAG_MSGPACK), encoding == 'msgpack')
+            self.assertEqual(decode_job_dict(encoded_job), self.response_dict)
+
+    def test_only_derived_values_are_left_out(self):
+        response_dict = dict(self.response_dict, success=1, identifier='unfoldingWord/en_obs/master',
+                                expires_at=self.response_dict['expires_at'] + timedelta(hours=1))
+        decoded_dict = decode_job_dict(JobCodec('json').encode(response_dict))
+        self.assertEqual(decoded_dict, response_dict)
+        self.assertIs(type(decoded_dict['success']), int)
+        response_dict = dict(self.response_dict, tx_job_queued_at='not a datetime')
+        self.assertEqual(decode_job_dict(JobCodec('json').encode(response_dict)), response_dict)
+
+    def test_smaller_than_pickled_dict(self):
+        connection = FakeStrictRedis()
+        queue = Queue('tx_job_handler', connection=connection)
+        enqueue_job_dict(queue, self.response_dict, job_id='pickled')
+        with patch('tXenqueue.tx_enqueue_redis.job_codec', JobCodec('json')):
+            enqueue_job_dict(queue, self.response_dict, job_id='encoded')
+        pickled_length, encoded_length = [len(connection.hget(Job.key_for(job_id), 'data')) for job_id in ('pickled', 'encoded')]
+        self.assertLess(encoded_length, pickled_length)
+        self.assertEqual(decode_job_dict(Job.fetch('encoded', connection=connection).args[0]), self.response_dict)
+
+    def test_bad_encoding(self):
+        with self.assertRaises(ValueError):
+            JobCodec('pickle')
+        with self.assertRaises(ValueError):
+            decode_job_dict(b'something else')
+        with self.assertRaises(ValueError):
+            decode_job_dict(ENCODED_JOB_MAGIC + bytes((99, 0)) + b'[]')
+# end of class TestJobCodec
@@ -0,0 +1,129 @@
+from unittest import TestCase
+from unittest.mock import Mock
+from http.server import BaseHTTPRequestHandler, HTTPServer
+import json
+import logging
+import threading
+import time
+
+from fakeredis import FakeStrictRedis
+
+from tXenqueue.tx_enqueue_dcs import DCSUserCache
+from tXenqueue.check_posted_tx_payload import check_tx_payload
+
+
+GOOD_TOKEN = 'a' * 40
+BAD_TOKEN = 'b' * 40
+LIST_TOKEN = 'c' * 40 # Answered with a JSON array
+
+
+class StubDCSHandler(BaseHTTPRequestHandler):
+    """
+    Answers /api/v1/user like Gitea does (but only knows GOOD_TOKEN).
+    """
+    request_count = 0
+
+    def do_GET(self):
+        StubDCSHandler.request_count += 1
+        if self.path == '/api/v1/user' and self.headers['Authorization'] == f'token {GOOD_TOKEN}':
+            body = json.dumps({'id': 1, 'login': 'tx-test'}).encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.end_headers()
+            self.wfile.write(body)
+        elif self.headers['Authorization'] == f'token {LIST_TOKEN}':
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.end_headers()
+            self.wfile.write(b'["tx-test"]')
+        else:
+            self.send_response(401)
+            self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+class TestDCSUserCache(TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.server = HTTPServer(('127.0.0.1', 0), StubDCSHandler)
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+        cls.dcs_domain = f'http://127.0.0.1:{cls.server.server_port}'
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def setUp(self):
+        StubDCSHandler.request_count = 0
+
+    def test_known_token_is_cached(self):
+        stats_client = Mock()
+        cache = DCSUserCache(self.dcs_domain, stats_client=stats_client, stats_prefix='tx.dev.enqueue-job')
+        self.assertEqual(cache.get_user(GOOD_TOKEN)['login'], 'tx-test')
+        self.assertEqual(cache.get_user(GOOD_TOKEN)['login'], 'tx-test')
+        self.assertEqual(StubDCSHandler.request_count, 1)
+        self.assertEqual(cache.counts['misses'], 1)
+        self.assertEqual(cache.counts['hits'], 1)
+        stats_client.incr.assert_any_call('tx.dev.enqueue-job.dcs_user_cache.hits')
+        stats_client.timing.assert_called_once()
+
+    def test_unknown_token_is_negatively_cached(self):
+        cache = DCSUserCache(self.dcs_domain, negative_ttl=0.2)
+        self.assertEqual(cache.get_user(BAD_TOKEN), {})
+        self.assertEqual(cache.get_user(BAD_TOKEN), {})
+        self.assertEqual(StubDCSHandler.request_count, 1)
+        self.assertEqual(cache.counts['negative_hits'], 1)
+        time.sleep(0.3)
+        self.assertEqual(cache.get_user(BAD_TOKEN), {})
+        self.assertEqual(StubDCSHandler.request_count, 2)
+
+    def test_cache_is_bounded(self):
+        cache = DCSUserCache(self.dcs_domain, max_size=1)
+        cache.get_user(GOOD_TOKEN)
+        cache.get_user(BAD_TOKEN)
+        cache.get_user(GOOD_TOKEN)
+        self.assertEqual(StubDCSHandler.request_count, 3)
+
+    def test_shared_between_processes(self):
+        connection = FakeStrictRedis()
+        DCSUserCache(self.dcs_domain, connection=connection).get_user(GOOD_TOKEN)
+        other_cache = DCSUserCache(self.dcs_domain, connection=connection)
+        self.assertEqual(other_cache.get_user(GOOD_TOKEN)['login'], 'tx-test')
+        self.assertEqual(StubDCSHandler.request_count, 1)
+        self.assertEqual(other_cache.counts['shared_hits'], 1)
+        self.assertFalse(any(GOOD_TOKEN.encode() in key for key in connection.keys()))
+
+    def test_unreachable_dcs_is_not_cached(self):
+        cache = DCSUserCache('http://127.0.0.1:1', logger=logging)
+        self.assertIsNone(cache.get_user(GOOD_TOKEN))
+        self.assertEqual(cache.counts['errors'], 1)
+        cache.dcs_url = self.dcs_domain # Now reachable
+        self.assertEqual(cache.get_user(GOOD_TOKEN)['login'], 'tx-test')
+
+    def test_not_an_object_is_not_cached(self):
+        cache = DCSUserCache(self.dcs_domain, logger=logging)
+        self.assertIsNone(cache.get_user(LIST_TOKEN))
+        self.assertIsNone(cache.get_user(LIST_TOKEN))
+        self.assertEqual(cache.counts['errors'], 2)
+
+    def test_payload_dcs_domain_not_used(self):
+        with open('tests/Resources/tx_payload.json', 'rt') as json_file:
+            payload_json = json.load(json_file)
+        cache = DCSUserCache(self.dcs_domain)
+        # A server of the caller's which would accept any token
+        for dcs_domain in ('http://127.0.0.1:1', 'https://evil.example.com'):
+            ok_flag, response_dict = check_tx_payload(dict(payload_json, user_token=BAD_TOKEN, dcs_domain=dcs_domain),
+                                                        {}, logging, cache.get_user)
+            self.assertFalse(ok_flag)
+            self.assertEqual(response_dict, {'error': "Unknown DCS user token 'bbbbbb…'"}) # Not the whole token
+        self.assertTrue(check_tx_payload(dict(payload_json, user_token=GOOD_TOKEN, dcs_domain='http://127.0.0.1:1'),
+                                            {}, logging, cache.get_user)[0])
+        ok_flag, response_dict = check_tx_payload(dict(payload_json, user_token=LIST_TOKEN), {}, logging, cache.get_user)
+        self.assertFalse(ok_flag)
+        self.assertEqual(response_dict, {'error': 'Unable to check DCS user token'})
+        self.assertEqual(StubDCSHandler.request_count, 3)
+# end of class TestDCSUserCache
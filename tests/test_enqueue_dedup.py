@@ -0,0 +1,104 @@
+from unittest import TestCase, IsolatedAsyncioTestCase
+from datetime import datetime
+
+from fakeredis import FakeServer, FakeStrictRedis, FakeAsyncRedis
+from rq.job import Job
+
+from tXenqueue.tx_enqueue_dedup import NEW_JOB, DUPLICATE_JOB, COALESCED_JOB, JobDeduplicator, get_coalesce_key
+
+
+def make_response_dict(job_id, commit_hash='93829a566c', output_format='html'):
+    return {'job_id': job_id, 'repo_owner': 'unfoldingWord', 'repo_name': 'en_obs', 'commit_hash': commit_hash,
+            'output_format': output_format, 'tx_job_queued_at': datetime(2026, 1, 2, 3, 4, 5)}
+
+
+def set_job_status(connection, rq_job_id, status):
+    connection.hset(Job.key_for(rq_job_id), 'status', status)
+
+
+class TestJobDeduplicator(TestCase):
+
+    def setUp(self):
+        self.connection = FakeStrictRedis()
+        self.deduplicator = JobDeduplicator(window=60)
+
+    def test_coalesce_key(self):
+        self.assertIsNotNone(get_coalesce_key(make_response_dict('job1')))
+        self.assertIsNone(get_coalesce_key(make_response_dict('job1', commit_hash=None)))
+        self.assertNotEqual(get_coalesce_key(make_response_dict('job1')),
+                            get_coalesce_key(make_response_dict('job1', output_format='pdf')))
+        self.assertEqual(get_coalesce_key(make_response_dict('job1')),
+                            get_coalesce_key(dict(make_response_dict('job2'), user_token='b'*40)))
+        with_options = dict(make_response_dict('job1'), options={'page_size': 'A4', 'columns': 2})
+        self.assertEqual(get_coalesce_key(with_options),
+                            get_coalesce_key(dict(with_options, options={'columns': 2, 'page_size': 'A4'})))
+        for fieldname, value in (('options', {'page_size': 'A5'}), ('callback', 'https://example.com/done'),
+                                    ('resource_type', 'Bible')):
+            self.assertNotEqual(get_coalesce_key(with_options), get_coalesce_key(dict(with_options, **{fieldname: value})))
+
+    def test_duplicate_gets_original_response(self):
+        self.assertEqual(self.deduplicator.claim(self.connection, 'q_job1', make_response_dict('job1')), (NEW_JOB, None))
+        outcome, original_response_dict = self.deduplicator.claim(self.connection, 'q_job1', make_response_dict('job1'))
+        self.assertEqual(outcome, DUPLICATE_JOB)
+        self.assertEqual(original_response_dict['tx_job_queued_at'], 'Fri, 02 Jan 2026 03:04:05 GMT')
+        self.assertLessEqual(self.connection.ttl('tx:dedup:job:q_job1'), 60)
+
+    def test_user_token_not_stored(self):
+        self.deduplicator.claim(self.connection, 'q_job1', dict(make_response_dict('job1'), user_token='a'*40))
+        self.assertNotIn(b'a'*40, self.connection.get('tx:dedup:job:q_job1'))
+        set_job_status(self.connection, 'q_job1', 'queued')
+        for rq_job_id, job_id in (('q_job1', 'job1'), ('q_job2', 'job2')): # A duplicate, then a coalesced job
+            outcome, original_response_dict = self.deduplicator.claim(self.connection, rq_job_id,
+                                                        dict(make_response_dict(job_id), user_token='b'*40))
+            self.assertEqual(original_response_dict['job_id'], 'job1')
+            self.assertNotIn('user_token', original_response_dict)
+
+    def test_coalesce_while_queued(self):
+        self.deduplicator.claim(self.connection, 'q_job1', make_response_dict('job1'))
+        set_job_status(self.connection, 'q_job1', 'queued')
+        outcome, original_response_dict = self.deduplicator.claim(self.connection, 'q_job2', make_response_dict('job2'))
+        self.assertEqual((outcome, original_response_dict['job_id']), (COALESCED_JOB, 'job1'))
+        # A retry of the coalesced job gets the same answer
+        outcome, original_response_dict = self.deduplicator.claim(self.connection, 'q_job2', make_response_dict('job2'))
+        self.assertEqual((outcome, original_response_dict['job_id']), (DUPLICATE_JOB, 'job1'))
+
+    def test_no_coalesce_once_started(self):
+        self.deduplicator.claim(self.connection, 'q_job1', make_response_dict('job1'))
+        set_job_status(self.connection, 'q_job1', 'started')
+        self.assertEqual(self.deduplicator.claim(self.connection, 'q_job2', make_response_dict('job2')), (NEW_JOB, None))
+        # The new job is now the one to coalesce with
+        set_job_status(self.connection, 'q_job2', 'queued')
+        outcome, original_response_dict = self.deduplicator.claim(self.connection, 'q_job3', make_response_dict('job3'))
+        self.assertEqual((outcome, original_response_dict['job_id']), (COALESCED_JOB, 'job2'))
+
+    def test_claim_many(self):
+        outcomes = self.deduplicator.claim_many(self.connection, [('q_job1', make_response_dict('job1')),
+                                                    ('q_job2', make_response_dict('job2', commit_hash='abc')),
+                                                    ('q_job1', make_response_dict('job1'))])
+        self.assertEqual([outcome for outcome, _response_dict in outcomes], [NEW_JOB, NEW_JOB, DUPLICATE_JOB])
+
+    def test_release(self):
+        self.deduplicator.claim(self.connection, 'q_job1', make_response_dict('job1'))
+        self.deduplicator.release(self.connection, ['q_job1'])
+        self.assertEqual(self.deduplicator.claim(self.connection, 'q_job1', make_response_dict('job1')), (NEW_JOB, None))
+
+    def test_disabled(self):
+        deduplicator = JobDeduplicator(window=0)
+        for _ in range(2):
+            self.assertEqual(deduplicator.claim(self.connection, 'q_job1', make_response_dict('job1')), (NEW_JOB, None))
+        self.assertEqual(self.connection.keys(), [])
+# end of class TestJobDeduplicator
+
+
+class TestJobDeduplicatorAsync(IsolatedAsyncioTestCase):
+
+    async def test_shared_with_sync_claims(self):
+        redis_server = FakeServer()
+        connection, async_connection = FakeStrictRedis(server=redis_server), FakeAsyncRedis(server=redis_server)
+        deduplicator = JobDeduplicator(window=60)
+        deduplicator.claim(connection, 'q_job1', make_response_dict('job1'))
+        set_job_status(connection, 'q_job1', 'queued')
+        outcome, original_response_dict = await deduplicator.claim_async(async_connection, 'q_job2', make_response_dict('job2'))
+        self.assertEqual((outcome, original_response_dict['job_id']), (COALESCED_JOB, 'job1'))
+        await async_connection.aclose()
+# end of class TestJobDeduplicatorAsync
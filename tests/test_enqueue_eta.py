@@ -0,0 +1,48 @@
+from unittest import TestCase
+
+from fakeredis import FakeStrictRedis
+
+from tXenqueue.tx_enqueue_eta import DEFAULT_JOB_SECONDS, DurationStats, EtaEstimator, update_duration_stats
+
+
+OBS_HTML = {'resource_type': 'Open_Bible_Stories', 'output_format': 'html'}
+BIBLE_HTML = {'resource_type': 'Bible', 'output_format': 'html'}
+
+
+class TestEtaEstimator(TestCase):
+
+    def setUp(self):
+        self.connection = FakeStrictRedis()
+        self.estimator = EtaEstimator(ewma_weight=0.5, min_interval_samples=2)
+
+    def test_update_duration_stats(self):
+        duration_stats = update_duration_stats(None, 10, 0.5)
+        self.assertEqual(duration_stats, DurationStats(10, 0, 1))
+        duration_stats = update_duration_stats(duration_stats, 20, 0.5)
+        self.assertEqual(duration_stats, DurationStats(15, 25, 2))
+
+    def test_default_estimate(self):
+        self.assertEqual(self.estimator.estimate(OBS_HTML, 'light', {}), (DEFAULT_JOB_SECONDS, None))
+        # Without any stats, each job ahead is assumed to take as long as ours
+        self.assertEqual(self.estimator.estimate(OBS_HTML, 'light', {'queue_length': 4, 'worker_count': 2}),
+                         (3 * DEFAULT_JOB_SECONDS, None))
+
+    def test_estimate_from_recorded_durations(self):
+        self.estimator.record_durations(self.connection, 'light', [(OBS_HTML, 10), (OBS_HTML, 20)])
+        self.estimator.record_durations(self.connection, 'heavy', [(BIBLE_HTML, 3600)])
+        # Not used until refreshed (e.g., by another process)
+        self.assertEqual(self.estimator.estimate(OBS_HTML, 'light', {})[0], DEFAULT_JOB_SECONDS)
+        self.assertEqual(EtaEstimator().refresh(self.connection)['type:Bible/html'], DurationStats(3600, 0, 1))
+        self.estimator.refresh(self.connection)
+
+        eta_seconds, eta_interval = self.estimator.estimate(OBS_HTML, 'light', {'queue_length': 0, 'worker_count': 1})
+        self.assertEqual(eta_seconds, 15)
+        self.assertAlmostEqual(eta_interval[1] - eta_seconds, 1.645 * 5)
+        eta_seconds, eta_interval = self.estimator.estimate(OBS_HTML, 'light', {'queue_length': 4, 'worker_count': 2})
+        self.assertEqual(eta_seconds, 15 + 4 * 15 / 2)
+        self.assertIsNotNone(eta_interval)
+        # Too few samples for an interval
+        self.assertEqual(self.estimator.estimate(BIBLE_HTML, 'heavy', {}), (3600, None))
+        # Unknown job types use the lane
+        self.assertEqual(self.estimator.estimate(dict(BIBLE_HTML, output_format='docx'), 'heavy', {}), (3600, None))
+# end of class TestEtaEstimator
@@ -0,0 +1,82 @@
+from unittest import TestCase
+from unittest.mock import Mock, patch
+import json
+import logging
+
+from fakeredis import FakeStrictRedis
+
+from tXenqueue.tx_enqueue_health import NAGIOS_PING_MESSAGE, get_health_probe_name, is_probe_body
+from tXenqueue.tx_enqueue_main import create_app, WEBHOOK_URL_SEGMENT, HEALTH_URL_SEGMENT, \
+                                        our_queue_names, enqueue_job_stats_prefix
+from tXenqueue.tx_enqueue_backends import EnqueueBackends
+
+
+NAGIOS_HEADERS = {'User-Agent': 'check_http/v2.3.3 (nagios-plugins 2.3.3)'}
+
+
+class TestProbeRecognition(TestCase):
+
+    def test_get_health_probe_name(self):
+        self.assertEqual(get_health_probe_name(NAGIOS_HEADERS['User-Agent'], None), 'nagios')
+        self.assertEqual(get_health_probe_name(NAGIOS_HEADERS['User-Agent'], 2), 'nagios')
+        self.assertIsNone(get_health_probe_name(NAGIOS_HEADERS['User-Agent'], 1000)) # Too big to be a ping
+        self.assertIsNone(get_health_probe_name('GiteaServer', None))
+        self.assertIsNone(get_health_probe_name(None, None))
+
+    def test_is_probe_body(self):
+        for body in (b'', b'{}', b' null\n'):
+            self.assertTrue(is_probe_body(body))
+        for body in (b'{"a":1}', b'[]', b' ' * 100):
+            self.assertFalse(is_probe_body(body))
+# end of class TestProbeRecognition
+
+
+class TestHealthEndpoints(TestCase):
+
+    def setUp(self):
+        self.redis_connection = FakeStrictRedis()
+        self.stats_client = Mock()
+        self.backends = EnqueueBackends('redis', our_queue_names, enqueue_job_stats_prefix, logging,
+                                        redis_connection=self.redis_connection, stats_client=self.stats_client,
+                                        start_background_threads=False)
+        self.client = create_app(self.backends).test_client()
+
+    def get_incr_names(self):
+        return [call_args[0][0] for call_args in self.stats_client.incr.call_args_list]
+
+    def test_nagios_ping_answered_without_parsing(self):
+        with patch('tXenqueue.tx_enqueue_main.check_posted_tx_payload') as mock_check:
+            response = self.client.post('/'+WEBHOOK_URL_SEGMENT, headers=NAGIOS_HEADERS)
+        mock_check.assert_not_called()
+        self.assertEqual(response.status_code, 400) # What Nagios has always been sent
+        self.assertEqual(response.get_json(), {'error': NAGIOS_PING_MESSAGE, 'status': 'invalid', 'ready': True})
+        self.assertEqual(self.get_incr_names(), [f'{enqueue_job_stats_prefix}.probes.nagios'])
+
+    def test_nagios_ping_with_payload_still_checked(self):
+        response = self.client.post('/'+WEBHOOK_URL_SEGMENT, data=json.dumps({'something': 'anything'}),
+                                    headers=dict(NAGIOS_HEADERS, **{'Content-type': 'application/json'}))
+        self.assertEqual(response.status_code, 400)
+        self.assertNotIn('ready', response.get_json())
+        self.assertIn(f'{enqueue_job_stats_prefix}.posts.attempted', self.get_incr_names())
+
+    def test_health_cached(self):
+        with patch.object(self.redis_connection, 'ping', wraps=self.redis_connection.ping) as mock_ping:
+            for _n in range(3):
+                response = self.client.get('/'+HEALTH_URL_SEGMENT)
+                self.assertEqual(response.status_code, 200)
+                self.client.post('/'+WEBHOOK_URL_SEGMENT, headers=NAGIOS_HEADERS)
+        self.assertEqual(mock_ping.call_count, 1)
+        self.assertEqual(response.get_json()['redis'], 'connected')
+        self.assertTrue(response.get_json()['ready'])
+        self.assertIn('checked_seconds_ago', response.get_json())
+        self.assertEqual(self.get_incr_names().count(f'{enqueue_job_stats_prefix}.probes.health'), 3)
+
+    def test_not_ready(self):
+        with patch.object(self.redis_connection, 'ping', side_effect=ConnectionError('down')):
+            response = self.client.get('/'+HEALTH_URL_SEGMENT)
+            self.assertEqual(response.status_code, 503)
+            self.assertFalse(response.get_json()['ready'])
+            response = self.client.post('/'+WEBHOOK_URL_SEGMENT, headers=NAGIOS_HEADERS)
+        self.assertEqual(response.status_code, 503)
+        self.assertFalse(response.get_json()['ready'])
+# end of class TestHealthEndpoints
@@ -0,0 +1,117 @@
+from unittest import TestCase
+from unittest.mock import Mock
+from datetime import datetime, timedelta
+import json
+
+from fakeredis import FakeStrictRedis
+from rq import Queue
+from rq.registry import FinishedJobRegistry
+
+from tXenqueue.tx_enqueue_lanes import LIGHT_LANE, HEAVY_LANE, PDF_LANE, RUN_TIMES_KEY, RUN_TIME_SAMPLER_LOCK_KEY, \
+                                        LaneRouter, JobRunTimes, compile_lane_rules
+from tXenqueue.tx_enqueue_eta import EtaEstimator
+
+
+LANE_QUEUE_NAMES = {HEAVY_LANE: 'tx_job_handler', LIGHT_LANE: 'tx_job_handler_priority', PDF_LANE: 'tx_job_handler_pdf'}
+
+
+def add_finished_job(connection, queue_name, job_id, payload_dict, wait_seconds, run_seconds):
+    job = Queue(queue_name, connection=connection).enqueue('webhook.job', payload_dict, job_id=job_id)
+    job.started_at = job.enqueued_at + timedelta(seconds=wait_seconds)
+    job.ended_at = job.started_at + timedelta(seconds=run_seconds)
+    job.save()
+    FinishedJobRegistry(queue_name, connection=connection).add(job, 60)
+    connection.lrem(f'rq:queue:{queue_name}', 0, job_id)
+
+
+class TestLaneRouter(TestCase):
+
+    def setUp(self):
+        with open('tests/Resources/tx_payload.json', 'rt') as json_file:
+            self.payload_json = json.load(json_file)
+        self.router = LaneRouter()
+
+    def test_default_rules(self):
+        self.assertEqual(self.router.route(self.payload_json), LIGHT_LANE) # OBS master branch
+        self.assertEqual(self.router.route(dict(self.payload_json, output_format='pdf')), PDF_LANE)
+        self.assertEqual(self.router.route(dict(self.payload_json, repo_ref='my_branch')), HEAVY_LANE)
+        self.assertEqual(self.router.route(dict(self.payload_json, repo_ref_type='tag', repo_ref='v1')), LIGHT_LANE)
+        self.assertEqual(self.router.route(dict(self.payload_json, resource_type='Bible')), HEAVY_LANE)
+
+    def test_missing_repo_ref_type(self):
+        # Used to raise KeyError (due to the and/or precedence in the old condition)
+        payload_json = dict(self.payload_json)
+        del payload_json['repo_ref_type']
+        self.assertEqual(self.router.route(payload_json), HEAVY_LANE)
+
+    def test_non_string_fields(self):
+        # Optional fields aren't type checked so used to raise TypeError (unhashable type: 'list')
+        self.assertEqual(self.router.route(dict(self.payload_json, repo_ref_type=['branch'])), HEAVY_LANE)
+        self.assertEqual(self.router.route(dict(self.payload_json, repo_ref_type={'type': 'branch'})), HEAVY_LANE)
+        self.assertEqual(LaneRouter(rules=[{'lane': 'pdf', 'repo_ref_type!': ['branch']}])
+                            .route(dict(self.payload_json, repo_ref_type=['branch'])), HEAVY_LANE)
+
+    def test_slow_repo(self):
+        run_times = Mock(**{'get_run_seconds.return_value': 3600})
+        self.assertEqual(LaneRouter(run_times=run_times).route(self.payload_json), HEAVY_LANE)
+        run_times.get_run_seconds.return_value = 60
+        self.assertEqual(LaneRouter(run_times=run_times).route(self.payload_json), LIGHT_LANE)
+
+    def test_custom_rules(self):
+        router = LaneRouter(rules=[{'lane': 'light', 'resource_type': ['Translation_Words'], 'output_format!': ['pdf']}],
+                            default_lane=PDF_LANE)
+        self.assertEqual(router.route(dict(self.payload_json, resource_type='Translation_Words')), LIGHT_LANE)
+        self.assertEqual(router.route(self.payload_json), PDF_LANE)
+
+    def test_invalid_rules(self):
+        for rules in ([{'lane': 'fast'}], [{'lane': 'light', 'resource_type': 'Bible'}],
+                      [{'lane': 'light', 'min_run_seconds': 'long'}], ['light']):
+            with self.assertRaises(ValueError):
+                compile_lane_rules(rules)
+        with self.assertRaises(ValueError):
+            LaneRouter(default_lane='fast')
+# end of class TestLaneRouter
+
+
+class TestJobRunTimes(TestCase):
+
+    def setUp(self):
+        self.connection = FakeStrictRedis()
+        self.run_times = JobRunTimes(ewma_weight=0.5)
+        self.run_times.stats_client, self.run_times.stats_prefix = Mock(), 'tx.dev.enqueue-job'
+        self.payload_dict = {'repo_owner': 'unfoldingWord', 'repo_name': 'en_ult'}
+
+    def test_sample(self):
+        add_finished_job(self.connection, 'tx_job_handler', 'job1', self.payload_dict, wait_seconds=30, run_seconds=1000)
+        self.assertEqual(self.run_times.sample(self.connection, LANE_QUEUE_NAMES), {'unfoldingword/en_ult': 1000})
+        self.assertEqual(self.run_times.get_run_seconds(dict(self.payload_dict, repo_owner='UNFOLDINGWORD')), 1000)
+        self.run_times.stats_client.timing.assert_called_once_with('tx.dev.enqueue-job.lanes.heavy.wait', 30_000)
+        self.run_times.stats_client.gauge.assert_any_call('tx.dev.enqueue-job.lanes.light.oldest_wait_seconds', 0)
+
+        # The same jobs aren't sampled twice
+        self.connection.delete(RUN_TIME_SAMPLER_LOCK_KEY)
+        add_finished_job(self.connection, 'tx_job_handler', 'job2', self.payload_dict, wait_seconds=0, run_seconds=200)
+        self.assertEqual(self.run_times.sample(self.connection, LANE_QUEUE_NAMES), {'unfoldingword/en_ult': 600})
+
+    def test_finished_durations_go_to_eta_estimator(self):
+        self.run_times.eta_estimator = EtaEstimator()
+        add_finished_job(self.connection, 'tx_job_handler_priority', 'job1', self.payload_dict, wait_seconds=0, run_seconds=40)
+        self.connection.zadd('rq:failed:tx_job_handler', {'missing_job': 1})
+        self.run_times.sample(self.connection, LANE_QUEUE_NAMES)
+        self.assertEqual(self.run_times.eta_estimator.estimate(self.payload_dict, LIGHT_LANE, {}), (40, None))
+
+    def test_only_one_process_samples(self):
+        add_finished_job(self.connection, 'tx_job_handler', 'job1', self.payload_dict, wait_seconds=0, run_seconds=10)
+        self.connection.set(RUN_TIME_SAMPLER_LOCK_KEY, 1)
+        self.connection.hset(RUN_TIMES_KEY, 'someone/something', 5)
+        # But the run times (sampled by the other process) are still read
+        self.assertEqual(self.run_times.sample(self.connection, LANE_QUEUE_NAMES), {'someone/something': 5})
+
+    def test_oldest_wait(self):
+        queue = Queue('tx_job_handler_priority', connection=self.connection)
+        job = queue.enqueue('webhook.job', self.payload_dict)
+        job.enqueued_at = datetime.utcnow() - timedelta(seconds=120)
+        job.save()
+        self.run_times.sample(self.connection, LANE_QUEUE_NAMES)
+        self.run_times.stats_client.gauge.assert_any_call('tx.dev.enqueue-job.lanes.light.oldest_wait_seconds', 120)
+# end of class TestJobRunTimes
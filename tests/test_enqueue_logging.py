@@ -0,0 +1,99 @@
+from unittest import TestCase
+from unittest.mock import Mock
+import logging
+import threading
+import time
+
+from tXenqueue.tx_enqueue_logging import AsyncLogHandler, PayloadDumpFilter
+
+
+class FakeLogSink(logging.Handler):
+    """
+    Collects log messages (optionally waiting until released, like an unreachable CloudWatch).
+    """
+    def __init__(self, release_event=None):
+        super().__init__()
+        self.messages = []
+        self.flush_count = 0
+        self.release_event = release_event
+
+    def emit(self, record):
+        if self.release_event is not None:
+            self.release_event.wait()
+        self.messages.append(record.getMessage())
+
+    def flush(self):
+        self.flush_count += 1
+
+
+def get_test_logger(name, handler):
+    logger = logging.getLogger(name)
+    logger.propagate = False
+    logger.setLevel(logging.DEBUG)
+    logger.handlers = [handler]
+    return logger
+
+
+class TestAsyncLogHandler(TestCase):
+
+    def test_records_reach_sink_in_batches(self):
+        sink = FakeLogSink()
+        handler = AsyncLogHandler(lambda: sink, batch_size=100, flush_interval=0.05)
+        logger = get_test_logger('test_batches', handler)
+        for n in range(10):
+            logger.info("Message %d", n)
+        handler.close()
+        self.assertEqual(sink.messages, [f"Message {n}" for n in range(10)])
+        self.assertLess(sink.flush_count, 10)
+        self.assertEqual(handler.dropped_count, 0)
+
+    def test_slow_sink_never_blocks(self):
+        release_event = threading.Event()
+        stats_client = Mock()
+        handler = AsyncLogHandler(lambda: FakeLogSink(release_event), max_queue_size=5,
+                                  flush_interval=0.05, stats_client=stats_client, stats_prefix='tx')
+        logger = get_test_logger('test_slow_sink', handler)
+        start_time = time.monotonic()
+        for n in range(100):
+            logger.info("Message %d", n)
+        self.assertLess(time.monotonic() - start_time, 1)
+        self.assertGreaterEqual(handler.dropped_count, 100 - 5 - 1)
+        stats_client.incr.assert_called_with('tx.logging.dropped', 1)
+        release_event.set()
+        handler.close()
+
+    def test_sink_creation_failure(self):
+        def broken_factory():
+            raise RuntimeError("No AWS credentials")
+        handler = AsyncLogHandler(broken_factory, flush_interval=0.05)
+        logger = get_test_logger('test_broken_sink', handler)
+        logger.info("Lost")
+        for _ in range(50):
+            if handler.dropped_count:
+                break
+            time.sleep(0.01)
+        self.assertEqual(handler.dropped_count, 1)
+        handler._stop_event.set()
+
+
+class TestPayloadDumpFilter(TestCase):
+
+    def test_truncates_payload_dumps_only(self):
+        sink = FakeLogSink()
+        logger = get_test_logger('test_truncate', sink)
+        logger.filters = [PayloadDumpFilter(max_length=10)]
+        logger.info("tX payload is %s", 'x' * 100, extra={'payload_dump': True})
+        logger.info("Not a payload %s", 'y' * 100)
+        self.assertEqual(sink.messages[0], "tX payload… (104 more characters)")
+        self.assertEqual(sink.messages[1], "Not a payload " + 'y' * 100)
+
+    def test_samples_payload_dumps(self):
+        sink = FakeLogSink()
+        logger = get_test_logger('test_sample', sink)
+        payload_filter = PayloadDumpFilter(sample_rate=0)
+        logger.filters = [payload_filter]
+        logger.info("tX payload is {}", extra={'payload_dump': True})
+        logger.info("Job queued")
+        self.assertEqual(sink.messages, ["Job queued"])
+        self.assertEqual(payload_filter.sampled_out_count, 1)
+# end of class TestPayloadDumpFilter
@@ -1,98 +1,228 @@
-from os import getenv
 from unittest import TestCase
-#from unittest.mock import Mock
+from unittest.mock import Mock, patch
 import json
+import logging
+import runpy
+from tempfile import TemporaryDirectory
+from datetime import timedelta
+from email.utils import parsedate_to_datetime
 
-from flask import Flask, request
-from redis import exceptions as redis_exceptions
-
-# NOTE: This import will fail if we don't have a working Redis instance
-#from tXenqueue.tx_enqueue_main import app, OUR_NAME, WEBHOOK_URL_SEGMENT, redis_hostname
-
-
-#app.config['TESTING'] = True
-#client = app.test_client()
-
-
-#class TestEnqueueMain(TestCase):
-
-    #def test_invalid_url(self):
-        #response = client.get('/whatever/')
-        #self.assertEqual(response.status_code, 404)
-
-    #def test_invalid_webhook_get(self):
-        #response = client.get('/'+WEBHOOK_URL_SEGMENT)
-        #self.assertEqual(response.status_code, 405)
-
-    #def test_webhook_with_empty_payload(self):
-        #if redis_hostname == 'redis': # Using a (missing) local instance so won't all work
-            #with self.assertRaises(redis_exceptions.ConnectionError):
-                #response = client.post('/'+WEBHOOK_URL_SEGMENT)
-        #else: # non-local  instance of redis so it should all work and we should get a page back
-            #response = client.post('/'+WEBHOOK_URL_SEGMENT)
-            #self.assertEqual(response.status_code, 400)
-            #self.assertEqual(response.headers['Content-Type'], 'application/json' )
-            #response_dict = json.loads(response.data)
-            #expected_dict = {'error': 'No payload found. You must submit a POST request', 'status':'failed'}
-            #self.assertEqual(response_dict, expected_dict)
-
-    #def test_webhook_with_bad_headers(self):
-        #headers = {'Content-type': 'application/json', 'Accept': 'text/plain'}
-        #payload_json = {'something': 'anything',}
-        #if redis_hostname == 'redis': # Using a (missing) local instance so won't all work
-            #with self.assertRaises(redis_exceptions.ConnectionError):
-                #response = client.post('/'+WEBHOOK_URL_SEGMENT, data=json.dumps(payload_json), headers=headers)
-        #else: # non-local  instance of redis so it should all work and we should get a page back
-            #response = client.post('/'+WEBHOOK_URL_SEGMENT, data=json.dumps(payload_json), headers=headers)
-            #self.assertEqual(response.status_code, 400)
-            #self.assertEqual(response.headers['Content-Type'], 'application/json' )
-            #response_dict = json.loads(response.data)
-            #expected_dict = {'error': 'No payload found. You must submit a POST request', 'status':'failed'}
-            #self.assertEqual(response_dict, expected_dict)
-
-    #def test_webhook_with_bad_payload(self):
-        #headers = {'Content-type': 'application/json'}
-        #payload_json = {'something': 'anything',}
-        #if redis_hostname == 'redis': # Using a (missing) local instance so won't all work
-            #with self.assertRaises(redis_exceptions.ConnectionError):
-                #response = client.post('/'+WEBHOOK_URL_SEGMENT, data=json.dumps(payload_json), headers=headers)
-        #else: # non-local  instance of redis so it should all work and we should get a page back
-            #response = client.post('/'+WEBHOOK_URL_SEGMENT, data=json.dumps(payload_json), headers=headers)
-            #self.assertEqual(response.status_code, 400)
-            #self.assertEqual(response.headers['Content-Type'], 'application/json' )
-            #expected = "tx ignored invalid payload; responding with {'error': 'No repo URL specified.'}"
-            #self.assertEqual(response.data, expected.encode())
-
-    ##def test_webhook_with_minimal_json_payload(self):
-        ##headers = {'Content-type': 'application/json'}
-        ##payload_json = {
-            ##'user_token': 'fredfredfredfredfredfredfredfredfredfred',
-            ##'resource_type': 'obs',
-            ##'input_format': 'md',
-            ##'output_format': 'pdf',
-            ##'source': 'https://git.door43.org/unfoldingWord/en_obs/archive/v4.zip'
-            ##}
-        ##if redis_hostname == 'redis': # Using a (missing) local instance so won't all work
-            ##with self.assertRaises(redis_exceptions.ConnectionError):
-                ##response = client.post('/'+WEBHOOK_URL_SEGMENT, data=json.dumps(payload_json), headers=headers)
-        ##else: # non-local  instance of redis so it should all work and we should get a page back
-            ##response = client.post('/'+WEBHOOK_URL_SEGMENT, data=json.dumps(payload_json), headers=headers)
-            ##self.assertEqual(response.status_code, 200)
-            ##self.assertEqual(response.headers['Content-Type'], 'application/json' )
-            ##response_dict = json.loads(response.data)
-            ##self.assertEqual(response_dict['success'], True)
-            ##self.assertEqual(response_dict['status'], 'queued')
-
-    ##def test_webhook_with_typical_full_json_payload(self):
-        ##headers = {'Content-type': 'application/json'}
-        ##with open( 'tests/Resources/webhook_post.json', 'rt' ) as json_file:
-            ##payload_json = json.load(json_file)
-        ##if redis_hostname == 'redis': # Using a (missing) local instance so won't all work
-            ##with self.assertRaises(redis_exceptions.ConnectionError):
-                ##response = client.post('/'+WEBHOOK_URL_SEGMENT, data=json.dumps(payload_json), headers=headers)
-        ##else: # non-local  instance of redis so it should all work and we should get a page back
-            ##response = client.post('/'+WEBHOOK_URL_SEGMENT, data=json.dumps(payload_json), headers=headers)
-            ##self.assertEqual(response.status_code, 200)
-            ##self.assertEqual(response.headers['Content-Type'], 'application/json' )
-            ##self.assertTrue('queued valid job to' in response.data.decode())
-            ### After job has run, should update https://dev.tx.org/u/tx-manager-test-data/en-obs-rc-0.2/93829a566c/
+from fakeredis import FakeServer, FakeStrictRedis
+from rq import Queue
+
+# NOTE: This import no longer needs a working Redis instance (or AWS credentials)
+from tXenqueue.tx_enqueue_main import create_app, OUR_NAME, WEBHOOK_URL_SEGMENT, BATCH_URL_SEGMENT, \
+                                        READY_URL_SEGMENT, METRICS_URL_SEGMENT, our_queue_names, enqueue_job_stats_prefix
+from tXenqueue.tx_enqueue_backends import EnqueueBackends
+from tXenqueue.tx_enqueue_admission import AdmissionController
+from tXenqueue.tx_enqueue_spool import JobSpool
+from tXenqueue.check_posted_tx_payload import MAX_PAYLOAD_BYTES
+
+
+DOOR43_HEADERS = {'Content-type': 'application/json', 'Host': 'git.door43.org'}
+
+
+class TestEnqueueMain(TestCase):
+
+    def setUp(self):
+        self.redis_connection = FakeStrictRedis()
+        self.stats_client = Mock()
+        self.backends = EnqueueBackends('redis', our_queue_names, enqueue_job_stats_prefix, logging,
+                                   redis_connection=self.redis_connection, stats_client=self.stats_client,
+                                   start_background_threads=False)
+        app = create_app(self.backends)
+        app.config['TESTING'] = True
+        self.client = app.test_client()
+        with open('tests/Resources/tx_payload.json', 'rt') as json_file:
+            self.payload_json = json.load(json_file)
+
+    def test_invalid_url(self):
+        response = self.client.get('/whatever/')
+        self.assertEqual(response.status_code, 404)
+
+    def test_invalid_webhook_get(self):
+        response = self.client.get('/'+WEBHOOK_URL_SEGMENT)
+        self.assertEqual(response.status_code, 405)
+
+    def test_webhook_with_empty_payload(self):
+        response = self.client.post('/'+WEBHOOK_URL_SEGMENT)
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.headers['Content-Type'], 'application/json')
+        expected_dict = {'error': 'No payload found. You must submit a POST request', 'status':'invalid'}
+        self.assertEqual(response.get_json(), expected_dict)
+        self.stats_client.incr.assert_called_with(f'{enqueue_job_stats_prefix}.posts.invalid')
+
+    def test_webhook_with_bad_payload(self):
+        payload_json = {'something': 'anything',}
+        response = self.client.post('/'+WEBHOOK_URL_SEGMENT, data=json.dumps(payload_json), headers=DOOR43_HEADERS)
+        self.assertEqual(response.status_code, 400)
+        self.assertTrue(response.get_json()['error'].startswith('Missing job_id'))
+
+    def test_webhook_with_oversized_payload(self):
+        payload_json = dict(self.payload_json, identifier='x'*MAX_PAYLOAD_BYTES)
+        response = self.client.post('/'+WEBHOOK_URL_SEGMENT, data=json.dumps(payload_json), headers=DOOR43_HEADERS)
+        self.assertEqual(response.status_code, 413)
+        self.assertEqual(response.get_json()['status'], 'invalid')
+        self.stats_client.incr.assert_called_with(f'{enqueue_job_stats_prefix}.posts.too_large')
+
+    def test_webhook_with_deeply_nested_payload(self):
+        response = self.client.post('/'+WEBHOOK_URL_SEGMENT, data='['*50_000, headers=DOOR43_HEADERS)
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.get_json()['error'], 'Payload is nested too deeply')
+
+    def test_webhook_with_typical_json_payload(self):
+        response = self.client.post('/'+WEBHOOK_URL_SEGMENT, data=json.dumps(self.payload_json), headers=DOOR43_HEADERS)
+        self.assertEqual(response.status_code, 200)
+        response_dict = response.get_json()
+        self.assertEqual(response_dict['success'], True)
+        self.assertEqual(response_dict['status'], 'queued')
+        self.assertEqual(response_dict['queue_name'], f'{OUR_NAME}_priority')
+        self.assertEqual(response_dict['output'], f"https://cdn.door43.org/tx/job/{self.payload_json['job_id']}.zip")
+        queue = Queue(f'{OUR_NAME}_priority', connection=self.redis_connection)
+        self.assertEqual(queue.job_ids, [f"{OUR_NAME}_priority_{self.payload_json['job_id']}"])
+
+    def test_webhook_eta_allows_for_queue(self):
+        for n in range(3):
+            Queue(f'{OUR_NAME}_priority', connection=self.redis_connection).enqueue('webhook.job', {'job_id': n})
+        self.backends.metrics_sampler.sample()
+        response = self.client.post('/'+WEBHOOK_URL_SEGMENT, data=json.dumps(self.payload_json), headers=DOOR43_HEADERS)
+        response_dict = response.get_json()
+        # Three jobs ahead (and no workers) at the default five minutes each, plus this one
+        self.assertEqual(parsedate_to_datetime(response_dict['eta']) - parsedate_to_datetime(response_dict['tx_job_queued_at']),
+                            timedelta(minutes=20))
+
+    def test_webhook_without_repo_ref_type(self):
+        payload_json = dict(self.payload_json)
+        del payload_json['repo_ref_type']
+        response = self.client.post('/'+WEBHOOK_URL_SEGMENT, data=json.dumps(payload_json), headers=DOOR43_HEADERS)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.get_json()['queue_name'], OUR_NAME)
+
+    def test_webhook_stage_timings(self):
+        self.client.post('/'+WEBHOOK_URL_SEGMENT, data=json.dumps(self.payload_json), headers=DOOR43_HEADERS)
+        timed_stages = [timing_call[0][0].rsplit('.', 1)[-1] for timing_call in self.stats_client.timing.call_args_list
+                            if '.job_receiver.stages.' in timing_call[0][0]]
+        self.assertEqual(timed_stages, ['parse', 'validate', 'dedup', 'admission', 'enqueue', 'total'])
+
+    def test_prometheus_metrics(self):
+        self.assertEqual(self.client.get('/'+METRICS_URL_SEGMENT).status_code, 404) # Not enabled
+        with patch('tXenqueue.tx_enqueue_main.prometheus_metrics_flag', True):
+            client = create_app(self.backends).test_client()
+        client.post('/'+WEBHOOK_URL_SEGMENT, data=json.dumps(self.payload_json), headers=DOOR43_HEADERS)
+        response = client.get('/'+METRICS_URL_SEGMENT)
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.content_type.startswith('text/plain'))
+        self.assertIn('endpoint="job_receiver",stage="enqueue"', response.get_data(as_text=True))
+
+    def test_webhook_retry_gets_original_job(self):
+        first_response = self.client.post('/'+WEBHOOK_URL_SEGMENT, data=json.dumps(self.payload_json), headers=DOOR43_HEADERS)
+        second_response = self.client.post('/'+WEBHOOK_URL_SEGMENT, data=json.dumps(self.payload_json), headers=DOOR43_HEADERS)
+        self.assertEqual(second_response.status_code, 200)
+        self.assertEqual(second_response.get_json(), first_response.get_json())
+        self.assertEqual(len(Queue(f'{OUR_NAME}_priority', connection=self.redis_connection)), 1)
+        self.stats_client.incr.assert_called_with(f'{enqueue_job_stats_prefix}.posts.duplicate')
+
+    def test_webhook_coalesces_equivalent_job(self):
+        self.client.post('/'+WEBHOOK_URL_SEGMENT, data=json.dumps(self.payload_json), headers=DOOR43_HEADERS)
+        payload_json = dict(self.payload_json, job_id='another_job')
+        response = self.client.post('/'+WEBHOOK_URL_SEGMENT, data=json.dumps(payload_json), headers=DOOR43_HEADERS)
+        self.assertEqual(response.get_json()['job_id'], self.payload_json['job_id'])
+        self.assertEqual(len(Queue(f'{OUR_NAME}_priority', connection=self.redis_connection)), 1)
+
+    def test_batch_with_partial_failure(self):
+        pdf_payload_json = dict(self.payload_json, job_id='pdf_job', output_format='pdf')
+        response = self.client.post('/'+BATCH_URL_SEGMENT, headers=DOOR43_HEADERS,
+                                    data=json.dumps([self.payload_json, {'something': 'anything'}, pdf_payload_json]))
+        self.assertEqual(response.status_code, 200)
+        response_dict = response.get_json()
+        self.assertEqual((response_dict['queued'], response_dict['invalid']), (2, 1))
+        self.assertEqual([result['status'] for result in response_dict['results']], ['queued', 'invalid', 'queued'])
+        response = self.client.post('/'+BATCH_URL_SEGMENT, headers=DOOR43_HEADERS, data=json.dumps([pdf_payload_json]))
+        self.assertEqual((response.status_code, response.get_json()['deduplicated']), (200, 1))
+        self.assertEqual(len(Queue(f'{OUR_NAME}_priority', connection=self.redis_connection)), 1)
+        self.assertEqual(len(Queue(f'{OUR_NAME}_pdf', connection=self.redis_connection)), 1)
+
+    def test_webhook_rate_limited(self):
+        with patch('tXenqueue.tx_enqueue_main.admission_controller', AdmissionController(rate_per_minute=30, burst=1)):
+            self.client.post('/'+WEBHOOK_URL_SEGMENT, data=json.dumps(self.payload_json), headers=DOOR43_HEADERS)
+            payload_json = dict(self.payload_json, job_id='another_job', commit_hash='another_commit')
+            response = self.client.post('/'+WEBHOOK_URL_SEGMENT, data=json.dumps(payload_json), headers=DOOR43_HEADERS)
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(response.get_json()['reason'], 'rate_limited')
+        self.assertGreaterEqual(int(response.headers['Retry-After']), 1)
+        self.stats_client.incr.assert_any_call(f'{enqueue_job_stats_prefix}.posts.shed.rate_limited')
+        self.assertEqual(len(Queue(f'{OUR_NAME}_priority', connection=self.redis_connection)), 1)
+        # The rejected job can be POSTed again later (it wasn't left claimed)
+        with patch('tXenqueue.tx_enqueue_main.admission_controller', AdmissionController(rate_per_minute=0)):
+            response = self.client.post('/'+WEBHOOK_URL_SEGMENT, data=json.dumps(payload_json), headers=DOOR43_HEADERS)
+        self.assertEqual(response.get_json()['status'], 'queued')
+
+    def test_batch_when_queue_full(self):
+        self.backends.metrics_sampler.sample() # The queue is empty and has no workers
+        with patch('tXenqueue.tx_enqueue_main.admission_controller', AdmissionController(max_queue_depth_without_workers=1)):
+            response = self.client.post('/'+BATCH_URL_SEGMENT, headers=DOOR43_HEADERS,
+                                    data=json.dumps([dict(self.payload_json, job_id=f'job_{n}', commit_hash=f'commit_{n}')
+                                                        for n in range(3)]))
+        self.assertEqual(response.status_code, 200)
+        response_dict = response.get_json()
+        self.assertEqual((response_dict['queued'], response_dict['rejected']), (1, 2))
+        self.assertEqual([result['status'] for result in response_dict['results']], ['queued', 'rejected', 'rejected'])
+
+    def test_webhook_spooled_while_redis_down(self):
+        server = FakeServer()
+        redis_connection = FakeStrictRedis(server=server)
+        backends = EnqueueBackends('redis', our_queue_names, enqueue_job_stats_prefix, logging,
+                                   redis_connection=redis_connection, stats_client=self.stats_client,
+                                   start_background_threads=False)
+        client = create_app(backends).test_client()
+        server.connected = False
+        with TemporaryDirectory() as spool_directory, \
+                patch('tXenqueue.tx_enqueue_main.job_spool', JobSpool(spool_directory)) as job_spool:
+            response = client.post('/'+WEBHOOK_URL_SEGMENT, data=json.dumps(self.payload_json), headers=DOOR43_HEADERS)
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual((response.get_json()['status'], response.get_json()['spooled']), ('queued', True))
+            self.stats_client.incr.assert_called_with(f'{enqueue_job_stats_prefix}.posts.spooled', 1)
+            batch_payload_json = [dict(self.payload_json, job_id='pdf_job', output_format='pdf'), {'something': 'anything'}]
+            response = client.post('/'+BATCH_URL_SEGMENT, data=json.dumps(batch_payload_json), headers=DOOR43_HEADERS)
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual([result['status'] for result in response.get_json()['results']], ['queued', 'invalid'])
+            self.assertEqual(response.get_json()['spooled'], 1)
+            server.connected = True
+            while job_spool.replay(redis_connection):
+                pass
+        self.assertEqual(Queue(f'{OUR_NAME}_priority', connection=redis_connection).job_ids,
+                            [f"{OUR_NAME}_priority_{self.payload_json['job_id']}"])
+        self.assertEqual(Queue(f'{OUR_NAME}_pdf', connection=redis_connection).job_ids, [f'{OUR_NAME}_pdf_pdf_job'])
+
+    def test_batch_must_be_a_list(self):
+        response = self.client.post('/'+BATCH_URL_SEGMENT, data=json.dumps(self.payload_json), headers=DOOR43_HEADERS)
+        self.assertEqual(response.status_code, 400)
+
+    def test_readiness(self):
+        response = self.client.get('/'+READY_URL_SEGMENT)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.get_json()['redis'], 'connected')
+
+    def test_not_ready_without_redis(self):
+        backends = EnqueueBackends('127.0.0.1', our_queue_names, enqueue_job_stats_prefix, logging,
+                                   redis_connection=Mock(**{'ping.side_effect': ConnectionError('refused')}),
+                                   stats_client=self.stats_client, start_background_threads=False)
+        response = create_app(backends).test_client().get('/'+READY_URL_SEGMENT)
+        self.assertEqual(response.status_code, 503)
+        self.assertFalse(response.get_json()['ready'])
+
+    def test_background_started_with_app(self):
+        backends = EnqueueBackends('redis', our_queue_names, enqueue_job_stats_prefix, logging,
+                                   redis_connection=FakeStrictRedis(), stats_client=self.stats_client, metrics_interval=3600)
+        create_app(backends)
+        self.assertTrue(backends._metrics_sampler._thread.is_alive()) # Without any request
+
+    def test_background_started_in_gunicorn_worker(self):
+        backends = EnqueueBackends('redis', our_queue_names, enqueue_job_stats_prefix, logging,
+                                   redis_connection=FakeStrictRedis(), stats_client=self.stats_client, metrics_interval=3600)
+        with patch.dict('os.environ', SERVER_SOFTWARE='gunicorn/20.1.0'):
+            app = create_app(backends) # Maybe in the (preloading) master
+        self.assertIsNone(backends._metrics_sampler)
+        runpy.run_path('tXenqueue/gunicorn.conf.py')['post_worker_init'](Mock(wsgi=app))
+        self.assertTrue(backends._metrics_sampler._thread.is_alive())
+# end of class TestEnqueueMain
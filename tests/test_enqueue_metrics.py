@@ -0,0 +1,53 @@
+from unittest import TestCase
+from unittest.mock import Mock, call
+import logging
+
+from fakeredis import FakeStrictRedis
+from rq import Queue
+
+from tXenqueue.tx_enqueue_metrics import read_queue_metrics, QueueMetricsSampler
+
+
+QUEUE_NAMES = ['tx_job_handler', 'tx_job_handler_priority', 'tx_job_handler_pdf']
+
+
+class TestEnqueueMetrics(TestCase):
+
+    def setUp(self):
+        self.connection = FakeStrictRedis()
+        queue = Queue('tx_job_handler_pdf', connection=self.connection)
+        queue.enqueue('webhook.job', {'job_id': 'one'})
+        queue.enqueue('webhook.job', {'job_id': 'two'})
+        self.connection.sadd('rq:workers', 'rq:worker:one', 'rq:worker:two')
+        self.connection.sadd('rq:workers:tx_job_handler_pdf', 'rq:worker:one')
+        self.connection.zadd('rq:failed:tx_job_handler', {'tx_job_handler_old': 1})
+
+    def test_read_queue_metrics(self):
+        metrics = read_queue_metrics(self.connection, QUEUE_NAMES)
+        self.assertEqual(metrics['tx_job_handler'], {'queue_length': 0, 'failed_length': 1,
+                                                     'worker_count': 0, 'total_worker_count': 2})
+        self.assertEqual(metrics['tx_job_handler_pdf'], {'queue_length': 2, 'failed_length': 0,
+                                                         'worker_count': 1, 'total_worker_count': 2})
+
+    def test_sampler_caches_and_sends_gauges(self):
+        stats_client = Mock()
+        sampler = QueueMetricsSampler(self.connection, QUEUE_NAMES, stats_client, 'tx.dev.enqueue-job', logging)
+        self.assertEqual(sampler.get_metrics('tx_job_handler_pdf'), {})
+        sampler.sample()
+        self.assertEqual(sampler.get_metrics('tx_job_handler_pdf')['queue_length'], 2)
+        self.assertIsNotNone(sampler.sampled_at)
+        stats_client.gauge.assert_has_calls([
+            call('tx.dev.enqueue-job.queue.tx_job_handler_pdf.length.current', 2),
+            call('tx.dev.enqueue-job.queue.tx_job_handler_pdf.length.failed', 0),
+            call('tx.dev.enqueue-job.workers.tx_job_handler_pdf.available', 1),
+            ])
+
+    def test_sampler_survives_redis_errors(self):
+        connection = Mock(**{'pipeline.side_effect': ConnectionError('Redis is down')})
+        sampler = QueueMetricsSampler(connection, QUEUE_NAMES, Mock(), 'tx.dev.enqueue-job', logging, interval=60)
+        sampler.start()
+        sampler.stop()
+        sampler._thread.join(timeout=5)
+        self.assertEqual(sampler.get_metrics('tx_job_handler'), {})
+        self.assertIsNone(sampler.sampled_at)
+# end of class TestEnqueueMetrics
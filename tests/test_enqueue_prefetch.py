@@ -0,0 +1,183 @@
+from unittest import TestCase
+from unittest.mock import Mock, patch
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from tempfile import TemporaryDirectory
+import json
+import logging
+import os
+import threading
+
+from fakeredis import FakeStrictRedis
+
+from tXenqueue.tx_enqueue_prefetch import SourcePrefetcher
+from tXenqueue.tx_enqueue_main import create_app, WEBHOOK_URL_SEGMENT, our_queue_names, enqueue_job_stats_prefix
+from tXenqueue.tx_enqueue_backends import EnqueueBackends
+from tXenqueue.tx_enqueue_admission import AdmissionController
+import tXenqueue.tx_enqueue_main
+
+
+class ArchiveHandler(BaseHTTPRequestHandler):
+    """
+    Serves /<size>.zip archives of that many bytes
+        (without a Content-Length for /chunked/<size>.zip)
+        and counts the requests for each path.
+
+    /redirect/<path> redirects to <path> on this host and /offsite/<path> to <path> on another host.
+    """
+    def do_GET(self):
+        self.server.request_counts[self.path] = self.server.request_counts.get(self.path, 0) + 1
+        self.server.release_event.wait(10)
+        if self.path.startswith(('/redirect/', '/offsite/')):
+            location_path = '/' + self.path.split('/', 2)[2]
+            self.send_response(302)
+            self.send_header('Location', location_path if self.path.startswith('/redirect/')
+                                            else f'http://localhost:{self.server.server_port}{location_path}')
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        if not self.path.endswith('.zip'):
+            self.send_error(404)
+            return
+        archive = b'PK' + b'x' * (int(self.path.rsplit('/', 1)[-1][:-4]) - 2)
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/zip')
+        if not self.path.startswith('/chunked/'):
+            self.send_header('Content-Length', str(len(archive)))
+        self.end_headers()
+        self.wfile.write(archive)
+
+    def log_message(self, *args):
+        pass
+# end of class ArchiveHandler
+
+
+class TestSourcePrefetcher(TestCase):
+
+    def setUp(self):
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), ArchiveHandler)
+        self.server.request_counts, self.server.release_event = {}, threading.Event()
+        self.server.release_event.set()
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.base_url = f'http://127.0.0.1:{self.server.server_port}'
+        self.temporary_directory = TemporaryDirectory()
+        self.cache_directory = Path(self.temporary_directory.name) / 'cache'
+        self.prefetcher = SourcePrefetcher(str(self.cache_directory), max_cache_bytes=10_000, dcs_url=self.base_url,
+                                            logger=logging)
+        self.prefetcher.stats_client, self.prefetcher.stats_prefix = Mock(), 'tx-enqueue'
+
+    def tearDown(self):
+        self.server.release_event.set()
+        self.prefetcher.wait(10)
+        self.server.shutdown()
+        self.server.server_close()
+        self.temporary_directory.cleanup()
+
+    def get_payload(self, path, commit_hash='93829a566c'):
+        return {'source': f'{self.base_url}{path}', 'commit_hash': commit_hash}
+
+    def prefetch(self, payload_dict):
+        cache_path = self.prefetcher.prefetch(payload_dict)
+        self.prefetcher.wait(10)
+        return cache_path
+
+    def test_fetched_once_per_commit(self):
+        cache_path = self.prefetch(self.get_payload('/1000.zip'))
+        self.assertEqual(Path(cache_path).parent, self.cache_directory)
+        self.assertTrue(Path(cache_path).name.startswith('93829a566c-'))
+        self.assertEqual(Path(cache_path).read_bytes(), b'PK' + b'x' * 998)
+        self.assertEqual(self.prefetch(self.get_payload('/1000.zip')), cache_path)
+        self.assertEqual(self.server.request_counts, {'/1000.zip': 1})
+        self.prefetcher.stats_client.incr.assert_called_with('tx-enqueue.prefetch.hits')
+        # A different commit is another download
+        self.assertNotEqual(self.prefetch(self.get_payload('/1000.zip', commit_hash='0123abcdef')), cache_path)
+        self.assertEqual(self.server.request_counts, {'/1000.zip': 2})
+        self.assertEqual(sorted(os.listdir(self.cache_directory)), sorted(Path(path).name for path in
+                            (cache_path, self.prefetcher.get_cache_path(self.get_payload('/1000.zip', commit_hash='0123abcdef')))))
+
+    def test_not_cacheable(self):
+        self.assertIsNone(self.prefetch({'source': f'{self.base_url}/1000.zip'}))
+        self.assertIsNone(self.prefetch(self.get_payload('/1000.zip', commit_hash='../../etc')))
+        self.assertIsNone(self.prefetch({'source': '/etc/passwd', 'commit_hash': '93829a566c'}))
+        self.assertIsNone(SourcePrefetcher('', dcs_url=self.base_url).prefetch(self.get_payload('/1000.zip')))
+        self.assertEqual(self.server.request_counts, {})
+
+    def test_only_fetched_from_dcs(self):
+        for source_url in (f'http://localhost:{self.server.server_port}/1000.zip', 'http://169.254.169.254/latest.zip',
+                            'file:///etc/passwd', 'ftp://127.0.0.1/1000.zip'):
+            self.assertIsNone(self.prefetch({'source': source_url, 'commit_hash': '93829a566c'}))
+        self.assertIsNone(SourcePrefetcher(str(self.cache_directory)).prefetch(self.get_payload('/1000.zip'))) # Not git.door43.org
+        self.assertEqual(self.server.request_counts, {})
+        self.assertTrue(Path(self.prefetch(self.get_payload('/redirect/1000.zip'))).exists())
+        self.assertFalse(Path(self.prefetch(self.get_payload('/offsite/2000.zip', commit_hash='0123abcdef'))).exists())
+        self.assertEqual(self.server.request_counts, {'/redirect/1000.zip': 1, '/1000.zip': 1, '/offsite/2000.zip': 1})
+        self.prefetcher.stats_client.incr.assert_any_call('tx-enqueue.prefetch.failed')
+
+    def test_failed_and_too_large(self):
+        self.prefetcher.max_archive_bytes = 5_000
+        for path in ('/missing', '/6000.zip', '/chunked/6000.zip'):
+            cache_path = self.prefetch(self.get_payload(path))
+            self.assertFalse(Path(cache_path).exists())
+        self.assertEqual(os.listdir(self.cache_directory), []) # No partial files left behind
+        self.prefetcher.stats_client.incr.assert_any_call('tx-enqueue.prefetch.failed')
+        self.assertEqual(self.prefetcher.stats_client.incr.call_args_list.count((('tx-enqueue.prefetch.too_large',),)), 2)
+        self.prefetch(self.get_payload('/chunked/4000.zip'))
+        self.assertEqual(len(os.listdir(self.cache_directory)), 1)
+
+    def test_least_recently_used_evicted(self):
+        cache_paths = [self.prefetch(self.get_payload('/4000.zip', commit_hash=f'{n}000000')) for n in range(2)]
+        os.utime(cache_paths[0], (1, 1))
+        os.utime(cache_paths[1], (2, 2))
+        self.prefetch(self.get_payload('/4000.zip', commit_hash='0000000')) # Used again
+        self.prefetch(self.get_payload('/4000.zip', commit_hash='2000000'))
+        self.assertTrue(Path(cache_paths[0]).exists())
+        self.assertFalse(Path(cache_paths[1]).exists())
+        self.assertEqual(len(os.listdir(self.cache_directory)), 2)
+        self.prefetcher.stats_client.incr.assert_any_call('tx-enqueue.prefetch.evicted', 1)
+
+    def test_concurrency_limits(self):
+        self.server.release_event.clear() # Downloads wait
+        prefetcher = SourcePrefetcher(str(self.cache_directory), max_concurrent=1, max_pending=1, dcs_url=self.base_url)
+        self.prefetcher = prefetcher # So that tearDown waits for it
+        cache_paths = [prefetcher.prefetch(self.get_payload('/1000.zip', commit_hash=f'{n}000000')) for n in range(3)]
+        self.assertIsNotNone(cache_paths[0])
+        self.assertIsNotNone(cache_paths[1])
+        self.assertIsNone(cache_paths[2]) # Too many already waiting
+        self.assertEqual(prefetcher.prefetch(self.get_payload('/1000.zip', commit_hash='1000000')), cache_paths[1])
+        self.server.release_event.set()
+        prefetcher.wait(10)
+        self.assertEqual(self.server.request_counts, {'/1000.zip': 2})
+        self.assertTrue(all(Path(cache_path).exists() for cache_path in cache_paths[:2]))
+
+    def test_cache_path_in_queued_job(self):
+        with open('tests/Resources/tx_payload.json', 'rt') as json_file:
+            payload_json = dict(json.load(json_file), source=f'{self.base_url}/1000.zip')
+        redis_connection = FakeStrictRedis()
+        backends = EnqueueBackends('redis', our_queue_names, enqueue_job_stats_prefix, logging,
+                                   redis_connection=redis_connection, stats_client=Mock(), start_background_threads=False)
+        with patch.object(tXenqueue.tx_enqueue_main, 'source_prefetcher', self.prefetcher):
+            response = create_app(backends).test_client().post('/'+WEBHOOK_URL_SEGMENT, data=json.dumps(payload_json),
+                                headers={'Content-type': 'application/json', 'Host': 'git.door43.org'})
+        self.prefetcher.wait(10)
+        cache_path = response.get_json()['source_cache_path']
+        self.assertEqual(cache_path, str(self.prefetcher.get_cache_path(payload_json)))
+        self.assertTrue(Path(cache_path).exists())
+        rq_job_data = redis_connection.lrange(f"rq:queue:{response.get_json()['queue_name']}", 0, -1)
+        self.assertEqual(len(rq_job_data), 1)
+
+    def test_not_fetched_for_duplicate_or_shed_jobs(self):
+        with open('tests/Resources/tx_payload.json', 'rt') as json_file:
+            payload_json = dict(json.load(json_file), source=f'{self.base_url}/1000.zip')
+        backends = EnqueueBackends('redis', our_queue_names, enqueue_job_stats_prefix, logging,
+                                   redis_connection=FakeStrictRedis(), stats_client=Mock(), start_background_threads=False)
+        with patch.object(tXenqueue.tx_enqueue_main, 'source_prefetcher', self.prefetcher), \
+                patch.object(tXenqueue.tx_enqueue_main, 'admission_controller', AdmissionController(rate_per_minute=30, burst=1)):
+            client = create_app(backends).test_client()
+            for job_id, commit_hash in (('job1', '93829a566c'), ('job1', '93829a566c'), ('job2', '0123abcdef')): # A duplicate, then one that's rate limited
+                response = client.post('/'+WEBHOOK_URL_SEGMENT, data=json.dumps(dict(payload_json, job_id=job_id, commit_hash=commit_hash)),
+                                        headers={'Content-type': 'application/json', 'Host': 'git.door43.org'})
+        self.prefetcher.wait(10)
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(self.server.request_counts, {'/1000.zip': 1})
+        self.assertEqual(os.listdir(self.cache_directory), [Path(self.prefetcher.get_cache_path(payload_json)).name])
+# end of class TestSourcePrefetcher
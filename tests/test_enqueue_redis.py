@@ -0,0 +1,30 @@
+from unittest import TestCase
+
+from fakeredis import FakeStrictRedis
+from rq import Queue
+from rq.job import Job
+
+from tXenqueue.tx_enqueue_redis import get_redis_connection, enqueue_job_dict
+
+
+class TestEnqueueRedis(TestCase):
+
+    def test_connection_pool_is_bounded(self):
+        connection = get_redis_connection('redis', max_connections=7)
+        self.assertEqual(connection.connection_pool.max_connections, 7)
+        self.assertEqual(connection.connection_pool.connection_kwargs['host'], 'redis')
+
+    def test_enqueue_job_dict(self):
+        connection = FakeStrictRedis()
+        queue = Queue('tx_job_handler', connection=connection)
+        queue.enqueue('webhook.job', {'job_id': 'earlier'}, job_id='tx_job_handler_earlier')
+
+        job, new_queue_length = enqueue_job_dict(queue, {'job_id': 'new'},
+                                            job_id='tx_job_handler_new', timeout='10800s')
+        self.assertEqual(new_queue_length, 2)
+        self.assertEqual(queue.job_ids, ['tx_job_handler_earlier', 'tx_job_handler_new'])
+        fetched_job = Job.fetch(job.id, connection=connection)
+        self.assertEqual(fetched_job.func_name, 'webhook.job')
+        self.assertEqual(fetched_job.args, ({'job_id': 'new'},))
+        self.assertEqual(fetched_job.timeout, 10800)
+# end of class TestEnqueueRedis
@@ -0,0 +1,106 @@
+from unittest import TestCase
+from unittest.mock import Mock, patch
+import json
+import logging
+
+from fakeredis import FakeStrictRedis
+from rq import Queue
+from rq.job import Job
+from rq.registry import FailedJobRegistry
+
+from tXenqueue.tx_enqueue_retry import RETRY_DUE_KEY, RETRY_LOCK_KEY, JobRetrier
+from tXenqueue.tx_enqueue_failed import FAILED_JOB_TTL
+from tXenqueue.tx_enqueue_codec import JobCodec, decode_job_dict
+from tXenqueue.tx_enqueue_redis import enqueue_job_dict
+
+
+QUEUE_NAME = 'tx_job_handler'
+
+
+class TestJobRetrier(TestCase):
+
+    def setUp(self):
+        self.connection = FakeStrictRedis()
+        self.queue = Queue(QUEUE_NAME, connection=self.connection)
+        self.registry = FailedJobRegistry(queue=self.queue)
+        self.retrier = JobRetrier(max_retries=2, base_delay=0)
+        self.retrier.stats_client, self.retrier.stats_prefix = Mock(), 'tx-enqueue'
+        with open('tests/Resources/tx_payload.json', 'rt') as json_file:
+            self.payload_json = dict(json.load(json_file), tx_retry_count=0)
+
+    def fail_job(self, job_id, exc_string='requests.exceptions.ConnectTimeout', ttl=FAILED_JOB_TTL):
+        job = Job.fetch(job_id, connection=self.connection)
+        self.queue.remove(job)
+        self.registry.add(job, ttl=ttl, exc_string=exc_string)
+
+    def run_retrier(self):
+        self.connection.delete(RETRY_LOCK_KEY)
+        self.retrier.run(self.connection, [QUEUE_NAME], logging)
+
+    def get_retry_count(self, job_id):
+        return decode_job_dict(Job.fetch(job_id, connection=self.connection).args[0])['tx_retry_count']
+
+    def test_delay_grows_with_jitter(self):
+        retrier = JobRetrier(base_delay=60, max_delay=600)
+        for retry_count, delay in ((0, 60), (1, 120), (2, 240), (3, 480), (4, 600), (10, 600)):
+            delays = [retrier.get_delay(retry_count) for _n in range(50)]
+            self.assertTrue(all(delay / 2 <= jittered_delay <= delay for jittered_delay in delays))
+            self.assertGreater(len(set(delays)), 1)
+
+    def test_failed_job_retried_until_given_up(self):
+        enqueue_job_dict(self.queue, self.payload_json, job_id='job1', failure_ttl=FAILED_JOB_TTL)
+        for retry_count in (1, 2):
+            self.fail_job('job1', ttl=FAILED_JOB_TTL + retry_count) # i.e., failed again later
+            self.run_retrier()
+            self.assertEqual(self.queue.job_ids, ['job1'])
+            self.assertEqual(self.registry.get_job_ids(), [])
+            self.assertEqual(self.get_retry_count('job1'), retry_count)
+        self.retrier.stats_client.incr.assert_any_call('tx-enqueue.retries.requeued', 1)
+        self.fail_job('job1', ttl=FAILED_JOB_TTL + 3)
+        self.run_retrier()
+        self.assertEqual(self.queue.job_ids, [])
+        self.assertEqual(self.registry.get_job_ids(), ['job1'])
+        self.retrier.stats_client.incr.assert_called_with('tx-enqueue.retries.gave_up', 1)
+        self.run_retrier() # Only given up on once
+        self.assertEqual(self.retrier.stats_client.incr.call_args_list.count((('tx-enqueue.retries.gave_up', 1),)), 1)
+
+    def test_retry_waits_until_due(self):
+        self.retrier.base_delay = 60
+        enqueue_job_dict(self.queue, self.payload_json, job_id='job1', failure_ttl=FAILED_JOB_TTL)
+        self.fail_job('job1')
+        self.run_retrier()
+        self.run_retrier() # Only scheduled once
+        self.assertEqual(self.queue.job_ids, [])
+        self.assertEqual(self.connection.zcard(RETRY_DUE_KEY), 1)
+        self.retrier.stats_client.incr.assert_called_once_with('tx-enqueue.retries.scheduled', 1)
+        self.retrier.stats_client.gauge.assert_called_with('tx-enqueue.retries.pending', 1)
+        self.connection.zadd(RETRY_DUE_KEY, {'job1': 0}) # Now due
+        self.run_retrier()
+        self.assertEqual(self.queue.job_ids, ['job1'])
+        self.assertEqual(self.connection.zcard(RETRY_DUE_KEY), 0)
+
+    def test_not_retried(self):
+        enqueue_job_dict(self.queue, self.payload_json, job_id='timed_out', failure_ttl=FAILED_JOB_TTL)
+        self.fail_job('timed_out', exc_string='rq.timeouts.JobTimeoutException: Task exceeded maximum timeout value')
+        enqueue_job_dict(self.queue, self.payload_json, job_id='long_ago', failure_ttl=FAILED_JOB_TTL)
+        self.fail_job('long_ago', ttl=FAILED_JOB_TTL - 24*60*60)
+        self.queue.enqueue('webhook.job', 'not a job dict', job_id='not_ours')
+        self.fail_job('not_ours')
+        self.run_retrier()
+        self.assertEqual(self.queue.job_ids, [])
+        self.assertEqual(sorted(self.registry.get_job_ids()), ['long_ago', 'not_ours', 'timed_out'])
+        self.retrier.stats_client.incr.assert_called_once_with('tx-enqueue.retries.gave_up', 1)
+
+    def test_encoded_job_retried(self):
+        with patch('tXenqueue.tx_enqueue_redis.job_codec', JobCodec('json')), \
+                patch('tXenqueue.tx_enqueue_retry.job_codec', JobCodec('json')):
+            enqueue_job_dict(self.queue, self.payload_json, job_id='job1', failure_ttl=FAILED_JOB_TTL)
+            self.fail_job('job1')
+            self.run_retrier()
+        self.assertIsInstance(Job.fetch('job1', connection=self.connection).args[0], bytes)
+        self.assertEqual(self.get_retry_count('job1'), 1)
+
+    def test_off(self):
+        self.assertFalse(JobRetrier(max_retries=0).enabled)
+        self.assertFalse(JobRetrier().enabled) # Unless MAX_JOB_RETRIES is set
+# end of class TestJobRetrier
@@ -0,0 +1,136 @@
+from unittest import TestCase
+from unittest.mock import Mock, patch
+from time import sleep
+import json
+import logging
+
+from fakeredis import FakeStrictRedis
+
+from tXenqueue.tx_enqueue_scaling import ARRIVAL_WINDOW_SECONDS, ScalingAdvisor, get_erlang_c, get_expected_wait
+from tXenqueue.tx_enqueue_eta import DEFAULT_JOB_SECONDS, EtaEstimator
+from tXenqueue.tx_enqueue_main import create_app, WEBHOOK_URL_SEGMENT, SCALING_URL_SEGMENT, \
+                                        our_queue_names, our_lane_queue_names, enqueue_job_stats_prefix
+from tXenqueue.tx_enqueue_backends import EnqueueBackends
+import tXenqueue.tx_enqueue_main
+
+
+LANE_QUEUE_NAMES = {'heavy': 'tx_job_handler', 'light': 'tx_job_handler_priority', 'pdf': 'tx_job_handler_pdf'}
+NOW = 1_800_000_000.0
+
+
+class TestQueueingModel(TestCase):
+
+    def test_erlang_c(self):
+        self.assertAlmostEqual(get_erlang_c(1, 0.5), 0.5) # i.e., the utilization for one server
+        self.assertAlmostEqual(get_erlang_c(2, 1.0), 1/3)
+        self.assertLess(get_erlang_c(20, 10.0), get_erlang_c(10, 5.0)) # Bigger pools wait less at the same utilization
+
+    def test_expected_wait(self):
+        self.assertAlmostEqual(get_expected_wait(1, 1/120, 60), 60) # M/M/1: ρ/(μ-λ)
+        self.assertEqual(get_expected_wait(3, 0, 60), 0)
+        self.assertEqual(get_expected_wait(2, 1/30, 60), float('inf'))
+# end of class TestQueueingModel
+
+
+class TestScalingAdvisor(TestCase):
+
+    def setUp(self):
+        self.connection = FakeStrictRedis()
+        self.advisor = ScalingAdvisor(LANE_QUEUE_NAMES, target_wait_seconds=60, max_workers=50)
+
+    def test_recommend_workers(self):
+        self.assertEqual(self.advisor.recommend_workers(0, 300, 0), 1) # min_workers
+        # 12 jobs per minute of 5 minutes each is 60 busy workers so that's capped
+        self.assertEqual(self.advisor.recommend_workers(12/60, 300, 0), 50)
+        # 1 job per minute of 5 minutes each is 5 busy workers
+        num_workers = self.advisor.recommend_workers(1/60, 300, 0)
+        self.assertGreaterEqual(num_workers, 5 / 0.8)
+        self.assertLessEqual(get_expected_wait(num_workers, 1/60, 300), 60)
+        self.assertGreater(get_expected_wait(num_workers - 1, 1/60, 300), 60)
+        # A backlog of 20 jobs needs 10 more workers to clear it in 10 minutes
+        self.assertEqual(self.advisor.recommend_workers(1/60, 300, 20), num_workers + 10)
+        self.assertEqual(self.advisor.recommend_workers(0, 300, 20), 11)
+
+    def test_sliding_window_shared_between_processes(self):
+        other_advisor = ScalingAdvisor(LANE_QUEUE_NAMES)
+        self.advisor.record_arrivals('tx_job_handler_pdf', 20)
+        self.advisor.flush_arrivals(self.connection, now=NOW - ARRIVAL_WINDOW_SECONDS) # Falls out of the window
+        self.advisor.record_arrivals('tx_job_handler_pdf', 6)
+        self.advisor.record_arrivals('tx_job_handler')
+        self.advisor.flush_arrivals(self.connection, now=NOW - 60)
+        other_advisor.record_arrivals('tx_job_handler_pdf', 4)
+        arrival_rates = other_advisor.flush_arrivals(self.connection, now=NOW)
+        self.assertEqual(arrival_rates, {'tx_job_handler': 1 / ARRIVAL_WINDOW_SECONDS,
+                                        'tx_job_handler_priority': 0.0,
+                                        'tx_job_handler_pdf': 10 / ARRIVAL_WINDOW_SECONDS})
+        self.assertEqual(self.advisor.flush_arrivals(self.connection, now=NOW), arrival_rates) # Nothing more pending
+
+    def test_arrivals_kept_if_redis_fails(self):
+        self.advisor.record_arrivals('tx_job_handler', 3)
+        with self.assertRaises(ConnectionError), \
+                patch.object(self.connection, 'pipeline', side_effect=ConnectionError):
+            self.advisor.flush_arrivals(self.connection, now=NOW)
+        self.assertEqual(self.advisor.flush_arrivals(self.connection, now=NOW)['tx_job_handler'], 3 / ARRIVAL_WINDOW_SECONDS)
+
+    def test_advise(self):
+        eta_estimator = EtaEstimator()
+        eta_estimator.record_durations(self.connection, 'pdf', [({}, 600.0)])
+        eta_estimator.refresh(self.connection)
+        self.advisor.eta_estimator = eta_estimator
+        self.advisor.stats_client, self.advisor.stats_prefix = Mock(), 'tx-enqueue'
+        self.advisor.record_arrivals('tx_job_handler_pdf', 5 * 5) # 5 per minute
+        queue_metrics = {'tx_job_handler_pdf': {'queue_length': 40, 'worker_count': 2}}
+        advice = self.advisor.advise(self.connection, lambda queue_name: queue_metrics.get(queue_name, {}))
+        self.assertEqual(advice['tx_job_handler_pdf']['service_seconds'], 600)
+        self.assertEqual(advice['tx_job_handler_pdf']['arrivals_per_minute'], 5)
+        self.assertEqual(advice['tx_job_handler_pdf']['worker_count'], 2)
+        self.assertEqual(advice['tx_job_handler_pdf']['recommended_workers'],
+                            self.advisor.recommend_workers(5/60, 600, 40))
+        self.assertEqual(advice['tx_job_handler']['service_seconds'], DEFAULT_JOB_SECONDS)
+        self.assertEqual(advice['tx_job_handler']['recommended_workers'], 1)
+        self.advisor.stats_client.gauge.assert_any_call('tx-enqueue.scaling.tx_job_handler_pdf.recommended_workers',
+                                                        advice['tx_job_handler_pdf']['recommended_workers'])
+        self.assertEqual(self.advisor.get_advice()['queues'], advice)
+# end of class TestScalingAdvisor
+
+
+class TestScalingEndpoint(TestCase):
+
+    def test_jobs_counted_and_advice_served(self):
+        redis_connection = FakeStrictRedis()
+        advisor = ScalingAdvisor(our_lane_queue_names)
+        backends = EnqueueBackends('redis', our_queue_names, enqueue_job_stats_prefix, logging,
+                                   redis_connection=redis_connection, stats_client=Mock(), start_background_threads=False)
+        with open('tests/Resources/tx_payload.json', 'rt') as json_file:
+            payload_json = json.load(json_file)
+        with patch.object(tXenqueue.tx_enqueue_main, 'scaling_advisor', advisor):
+            client = create_app(backends).test_client()
+            response = client.get('/'+SCALING_URL_SEGMENT)
+            self.assertEqual(response.status_code, 503) # No advice yet
+            self.assertEqual(response.headers['Retry-After'], '10')
+            response = client.post('/'+WEBHOOK_URL_SEGMENT, data=json.dumps(payload_json),
+                                    headers={'Content-type': 'application/json', 'Host': 'git.door43.org'})
+            queue_name = response.get_json()['queue_name']
+            backends.metrics_sampler.sample()
+            advisor.advise(redis_connection, backends.metrics_sampler.get_metrics)
+            queue_advice = client.get('/'+SCALING_URL_SEGMENT).get_json()['queues'][queue_name]
+        self.assertEqual(queue_advice['queue_length'], 1)
+        self.assertGreater(queue_advice['arrivals_per_minute'], 0)
+        self.assertGreaterEqual(queue_advice['recommended_workers'], 1)
+
+    def test_advisor_started_by_request(self):
+        advisor = ScalingAdvisor(our_lane_queue_names)
+        backends = EnqueueBackends('redis', our_queue_names, enqueue_job_stats_prefix, logging,
+                                   redis_connection=FakeStrictRedis(), stats_client=Mock(), metrics_interval=3600,
+                                   scaling_advisor=advisor)
+        with patch.object(tXenqueue.tx_enqueue_main, 'scaling_advisor', advisor), \
+                patch.dict('os.environ', SERVER_SOFTWARE='gunicorn/20.1.0'): # i.e., not started by create_app()
+            client = create_app(backends).test_client()
+            for _n in range(100): # The advisor thread advises straight away
+                response = client.get('/'+SCALING_URL_SEGMENT)
+                if response.status_code == 200:
+                    break
+                sleep(0.05)
+        self.assertEqual(response.status_code, 200)
+        self.assertIsNotNone(response.get_json()['advised_at'])
+# end of class TestScalingEndpoint
@@ -0,0 +1,189 @@
+from unittest import TestCase, skipUnless
+from unittest.mock import Mock
+from tempfile import TemporaryDirectory
+import json
+import logging
+import shutil
+import socket
+import subprocess
+import time
+
+from fakeredis import FakeServer, FakeStrictRedis
+from redis.exceptions import ConnectionError as RedisConnectionError
+from rq import Queue
+
+from tXenqueue.tx_enqueue_main import create_app, OUR_NAME, WEBHOOK_URL_SEGMENT, BATCH_URL_SEGMENT, \
+                                        READY_URL_SEGMENT, our_queue_names, enqueue_job_stats_prefix
+from tXenqueue.tx_enqueue_backends import EnqueueBackends
+from tXenqueue.tx_enqueue_shards import ShardRing, get_shard_key, parse_redis_shard_hostnames
+from tXenqueue.tx_enqueue_spool import JobSpool, SpooledJob
+from tXenqueue.tx_enqueue_redis import get_redis_connection
+
+
+DOOR43_HEADERS = {'Content-type': 'application/json', 'Host': 'git.door43.org'}
+REPO_KEYS = [f'owner{n % 17}/repo{n}' for n in range(2_000)]
+
+
+class TestShardRing(TestCase):
+
+    def test_shard_key(self):
+        self.assertEqual(get_shard_key({'repo_owner': 'unfoldingWord', 'repo_name': 'en_OBS', 'job_id': 'job1'}),
+                            'unfoldingword/en_obs')
+        self.assertEqual(get_shard_key({'job_id': 'job1'}), 'job:job1')
+
+    def test_parse_hostnames(self):
+        self.assertEqual(parse_redis_shard_hostnames(' redis1, redis2:6380,'), ['redis1', 'redis2:6380'])
+        self.assertEqual(parse_redis_shard_hostnames(''), [])
+
+    def test_balanced_and_independent_of_order(self):
+        ring = ShardRing(['redis1', 'redis2', 'redis3'])
+        reordered_ring = ShardRing(['redis3', 'redis1', 'redis2'])
+        shard_names = [ring.shard_names[ring.get_shard_index(repo_key)] for repo_key in REPO_KEYS]
+        self.assertEqual(shard_names, [reordered_ring.shard_names[reordered_ring.get_shard_index(repo_key)]
+                                        for repo_key in REPO_KEYS])
+        for shard_name in ring.shard_names:
+            self.assertGreater(shard_names.count(shard_name), len(REPO_KEYS) / 3 * 0.75)
+
+    def test_adding_a_shard_only_moves_keys_to_it(self):
+        ring, bigger_ring = ShardRing(['redis1', 'redis2', 'redis3']), ShardRing(['redis1', 'redis2', 'redis3', 'redis4'])
+        moved_count = 0
+        for repo_key in REPO_KEYS:
+            shard_name = ring.shard_names[ring.get_shard_index(repo_key)]
+            new_shard_name = bigger_ring.shard_names[bigger_ring.get_shard_index(repo_key)]
+            if new_shard_name != shard_name:
+                self.assertEqual(new_shard_name, 'redis4')
+                moved_count += 1
+        self.assertLess(abs(moved_count - len(REPO_KEYS) / 4), len(REPO_KEYS) / 16)
+
+    def test_bad_shard_names(self):
+        with self.assertRaises(ValueError):
+            ShardRing([])
+        with self.assertRaises(ValueError):
+            ShardRing(['redis1', 'redis1'])
+# end of class TestShardRing
+
+
+class TestShardedEnqueue(TestCase):
+
+    def setUp(self):
+        self.redis_connection = FakeStrictRedis()
+        self.shard_servers = [FakeServer() for _n in range(3)]
+        self.shard_connections = [FakeStrictRedis(server=shard_server) for shard_server in self.shard_servers]
+        self.stats_client = Mock()
+        self.backends = EnqueueBackends('redis', our_queue_names, enqueue_job_stats_prefix, logging,
+                                   redis_connection=self.redis_connection, stats_client=self.stats_client,
+                                   start_background_threads=False, shard_connections=self.shard_connections)
+        self.client = create_app(self.backends).test_client()
+        with open('tests/Resources/tx_payload.json', 'rt') as json_file:
+            self.payload_json = json.load(json_file)
+        self.payload_jsons = [dict(self.payload_json, job_id=f'job{n}', repo_name=f'repo{n}') for n in range(12)]
+
+    def get_queue_job_ids(self, shard_index):
+        return Queue(f'{OUR_NAME}_priority', connection=self.shard_connections[shard_index]).job_ids
+
+    def test_jobs_go_to_their_shards(self):
+        for payload_json in self.payload_jsons:
+            response = self.client.post('/'+WEBHOOK_URL_SEGMENT, data=json.dumps(payload_json), headers=DOOR43_HEADERS)
+            self.assertEqual(response.get_json()['status'], 'queued')
+        for payload_json in self.payload_jsons:
+            self.assertIn(f"{OUR_NAME}_priority_{payload_json['job_id']}",
+                            self.get_queue_job_ids(self.backends.get_shard_index(payload_json)))
+        self.assertEqual(sum(len(self.get_queue_job_ids(shard_index)) for shard_index in range(3)), 12)
+        self.assertTrue(all(self.get_queue_job_ids(shard_index) for shard_index in range(3)))
+        self.assertEqual(len(Queue(f'{OUR_NAME}_priority', connection=self.redis_connection)), 0)
+        # Retries are de-duplicated (on the job's shard)
+        response = self.client.post('/'+WEBHOOK_URL_SEGMENT, data=json.dumps(self.payload_jsons[0]), headers=DOOR43_HEADERS)
+        self.stats_client.incr.assert_called_with(f'{enqueue_job_stats_prefix}.posts.duplicate')
+        # The queue metrics are totalled across the shards
+        self.assertEqual(self.backends.metrics_sampler.sample()[f'{OUR_NAME}_priority']['queue_length'], 12)
+
+    def test_batch_across_shards(self):
+        response = self.client.post('/'+BATCH_URL_SEGMENT, data=json.dumps(self.payload_jsons), headers=DOOR43_HEADERS)
+        self.assertEqual(response.status_code, 200)
+        response_dict = response.get_json()
+        self.assertEqual(response_dict['queued'], 12)
+        self.assertEqual([result['job_id'] for result in response_dict['results']],
+                            [payload_json['job_id'] for payload_json in self.payload_jsons])
+        for shard_index in range(3):
+            self.assertEqual(self.get_queue_job_ids(shard_index),
+                                [f"{OUR_NAME}_priority_{payload_json['job_id']}" for payload_json in self.payload_jsons
+                                    if self.backends.get_shard_index(payload_json) == shard_index])
+        response = self.client.post('/'+BATCH_URL_SEGMENT, data=json.dumps(self.payload_jsons), headers=DOOR43_HEADERS)
+        self.assertEqual(response.get_json()['deduplicated'], 12)
+
+    def test_spooled_jobs_replayed_to_their_shards(self):
+        with TemporaryDirectory() as spool_directory:
+            spool = JobSpool(spool_directory)
+            spool.append([SpooledJob(f'{OUR_NAME}_priority', f"{OUR_NAME}_priority_{payload_json['job_id']}", payload_json, {})
+                            for payload_json in self.payload_jsons])
+            while spool.replay(self.redis_connection, get_job_connection=self.backends.get_job_connection):
+                pass
+        self.assertEqual(self.backends.metrics_sampler.sample()[f'{OUR_NAME}_priority']['queue_length'], 12)
+        self.assertEqual(len(Queue(f'{OUR_NAME}_priority', connection=self.redis_connection)), 0)
+
+    def test_not_ready_without_a_shard(self):
+        self.assertEqual(self.client.get('/'+READY_URL_SEGMENT).get_json()['redis_shards'],
+                            {'shard0': 'connected', 'shard1': 'connected', 'shard2': 'connected'})
+        self.shard_servers[1].connected = False
+        response = self.client.get('/'+READY_URL_SEGMENT)
+        self.assertEqual(response.status_code, 503)
+# end of class TestShardedEnqueue
+
+
+def get_free_port():
+    with socket.socket() as free_socket:
+        free_socket.bind(('127.0.0.1', 0))
+        return free_socket.getsockname()[1]
+
+
+@skipUnless(shutil.which('redis-server'), "Needs local redis-servers")
+class TestShardedEnqueueWithRedisServers(TestCase):
+
+    def setUp(self):
+        self.temporary_directory = TemporaryDirectory()
+        self.redis_servers = []
+
+    def tearDown(self):
+        for redis_server in self.redis_servers:
+            redis_server.kill()
+            redis_server.wait()
+        self.temporary_directory.cleanup()
+
+    def start_redis_server(self):
+        port = get_free_port()
+        self.redis_servers.append(subprocess.Popen(['redis-server', '--port', str(port), '--save', '',
+                                                    '--dir', self.temporary_directory.name], stdout=subprocess.DEVNULL))
+        redis_hostname = f'127.0.0.1:{port}'
+        connection = get_redis_connection(redis_hostname)
+        for _attempt in range(50):
+            try:
+                connection.ping()
+                return redis_hostname
+            except RedisConnectionError:
+                time.sleep(0.1)
+        self.fail("redis-server didn't start")
+
+    def create_client(self, redis_hostname, redis_shard_hostnames):
+        backends = EnqueueBackends(redis_hostname, our_queue_names, enqueue_job_stats_prefix, logging,
+                                   stats_client=Mock(), start_background_threads=False,
+                                   redis_shard_hostnames=redis_shard_hostnames)
+        return backends, create_app(backends).test_client()
+
+    def test_adding_a_shard_keeps_queued_jobs(self):
+        with open('tests/Resources/tx_payload.json', 'rt') as json_file:
+            payload_json = json.load(json_file)
+        redis_shard_hostnames = [self.start_redis_server() for _n in range(3)]
+        backends, client = self.create_client(redis_shard_hostnames[0], redis_shard_hostnames)
+        for n in range(30):
+            client.post('/'+WEBHOOK_URL_SEGMENT, data=json.dumps(dict(payload_json, job_id=f'job{n}', repo_name=f'repo{n}')),
+                        headers=DOOR43_HEADERS)
+        self.assertEqual(backends.metrics_sampler.sample()[f'{OUR_NAME}_priority']['queue_length'], 30)
+        backends, client = self.create_client(redis_shard_hostnames[0], redis_shard_hostnames + [self.start_redis_server()])
+        for n in range(30, 60):
+            client.post('/'+WEBHOOK_URL_SEGMENT, data=json.dumps(dict(payload_json, job_id=f'job{n}', repo_name=f'repo{n}')),
+                        headers=DOOR43_HEADERS)
+        queue_lengths = [len(Queue(f'{OUR_NAME}_priority', connection=shard_connection))
+                            for shard_connection in backends.shard_connections]
+        self.assertEqual(sum(queue_lengths), 60)
+        self.assertGreater(queue_lengths[3], 0)
+# end of class TestShardedEnqueueWithRedisServers
@@ -0,0 +1,215 @@
+from unittest import TestCase, skipUnless
+from unittest.mock import Mock
+from pathlib import Path
+from tempfile import TemporaryDirectory
+import shutil
+import socket
+import subprocess
+import time
+
+from fakeredis import FakeStrictRedis
+from redis import StrictRedis
+from redis.exceptions import ConnectionError as RedisConnectionError
+from rq import Queue
+from rq.job import Job
+
+from tXenqueue.tx_enqueue_spool import SEGMENT_SUFFIX, WRITER_DIRECTORY_PREFIX, \
+                                        JobSpool, SpooledJob, SpoolFullError, encode_record, read_cursor
+from tXenqueue.tx_enqueue_dedup import JobDeduplicator
+from tXenqueue.tx_enqueue_redis import create_job
+
+
+JOB_KWARGS = {'timeout': '10800s', 'result_ttl': 60, 'failure_ttl': 60}
+
+
+def make_spooled_job(n, queue_name='tx_job_handler'):
+    return SpooledJob(queue_name, f'{queue_name}_job{n}', {'job_id': f'job{n}', 'repo_name': 'en_obs'}, JOB_KWARGS)
+
+
+def get_queued_job_ids(connection, queue_name='tx_job_handler'):
+    return Queue(queue_name, connection=connection).get_job_ids()
+
+
+class TestJobSpool(TestCase):
+
+    def setUp(self):
+        self.temporary_directory = TemporaryDirectory()
+        self.spool_directory = Path(self.temporary_directory.name) / 'spool'
+        self.spool = JobSpool(str(self.spool_directory), segment_bytes=1000)
+        self.connection = FakeStrictRedis()
+
+    def tearDown(self):
+        self.temporary_directory.cleanup()
+
+    def test_disabled_without_directory(self):
+        spool = JobSpool('')
+        self.assertFalse(spool.enabled)
+        spool.note_redis_failure('is down')
+        self.assertFalse(spool.should_spool())
+        self.assertEqual(spool.replay(self.connection), 0)
+
+    def test_replays_in_order_across_queues_and_segments(self):
+        spooled_jobs = [make_spooled_job(n, 'tx_job_handler' if n % 3 else 'tx_job_handler_priority') for n in range(40)]
+        for spooled_job in spooled_jobs:
+            self.spool.append([spooled_job])
+        self.assertGreater(len(list(self.spool_directory.glob(f'*/*{SEGMENT_SUFFIX}'))), 1)
+        self.assertTrue(self.spool.should_spool()) # Until they're all replayed
+        self.assertEqual(self.spool.get_depth()['jobs'], 40)
+        while self.spool.replay(self.connection, max_count=7):
+            pass
+        self.assertEqual(self.spool.replay(self.connection), 0) # Finishes with the last segment
+        for queue_name in ('tx_job_handler', 'tx_job_handler_priority'):
+            self.assertEqual(get_queued_job_ids(self.connection, queue_name),
+                            [spooled_job.job_id for spooled_job in spooled_jobs if spooled_job.queue_name == queue_name])
+        job = Job.fetch('tx_job_handler_job1', connection=self.connection)
+        self.assertEqual(job.func_name, 'webhook.job')
+        self.assertEqual(job.args, ({'job_id': 'job1', 'repo_name': 'en_obs'},))
+        self.assertEqual(job.timeout, 10800)
+        self.assertFalse(self.spool.should_spool())
+        self.assertEqual(self.spool.get_depth(), {'jobs': 0, 'bytes': 0})
+        self.assertEqual(self.spool.replayed_count, 40)
+
+    def test_bounded_disk_usage(self):
+        spool = JobSpool(str(self.spool_directory), max_bytes=len(encode_record(make_spooled_job(1))) * 2)
+        spool.append([make_spooled_job(1), make_spooled_job(2)])
+        self.assertFalse(spool.has_room())
+        with self.assertRaises(SpoolFullError):
+            spool.append([make_spooled_job(3)])
+        while spool.replay(self.connection):
+            pass
+        spool.append([make_spooled_job(3)]) # There's room again
+        self.assertEqual(spool.get_depth()['jobs'], 1)
+
+    def test_duplicates_dropped_on_replay(self):
+        deduplicator = JobDeduplicator()
+        equivalent_dict = {'job_id': 'job0', 'repo_owner': 'unfoldingWord', 'repo_name': 'en_obs',
+                            'commit_hash': '93829a566c', 'output_format': 'html'}
+        # An equivalent job which was queued before Redis went away
+        queue = Queue('tx_job_handler', connection=self.connection)
+        deduplicator.claim(self.connection, 'tx_job_handler_job0', equivalent_dict)
+        queue.enqueue_job(create_job(queue, equivalent_dict, job_id='tx_job_handler_job0'))
+        self.spool.deduplicator = deduplicator
+        self.spool.append([make_spooled_job(1), make_spooled_job(1), # e.g., the caller retried
+                            SpooledJob('tx_job_handler', 'tx_job_handler_job2', dict(equivalent_dict, job_id='job2'), JOB_KWARGS)])
+        self.assertEqual(self.spool.replay(self.connection), 3)
+        self.assertEqual(get_queued_job_ids(self.connection), ['tx_job_handler_job0', 'tx_job_handler_job1'])
+
+    def test_replay_waits_for_deep_queue(self):
+        self.spool.max_queue_depth = 3
+        self.spool.append([make_spooled_job(n) for n in range(5)] + [make_spooled_job(5, 'tx_job_handler_priority')])
+        self.assertEqual(self.spool.replay(self.connection), 3)
+        self.assertEqual(self.spool.replay(self.connection), 0) # Not lost, just waiting
+        self.assertTrue(self.spool.should_spool())
+        self.assertEqual(self.spool.get_depth()['jobs'], 3)
+        Queue('tx_job_handler', connection=self.connection).remove('tx_job_handler_job0') # A worker took a job
+        self.assertEqual(self.spool.replay(self.connection), 1)
+        self.assertEqual(get_queued_job_ids(self.connection), [f'tx_job_handler_job{n}' for n in range(1, 4)])
+
+    def test_crash_after_replay_before_cursor(self):
+        self.spool.append([make_spooled_job(1), make_spooled_job(2)])
+        self.spool.replay(self.connection)
+        writer_directory, = self.spool_directory.iterdir()
+        (writer_directory / 'replay.cursor').unlink() # As if we crashed before saving the cursor
+        self.spool._pending_count = 2
+        self.assertEqual(self.spool.replay(self.connection), 2)
+        self.assertEqual(get_queued_job_ids(self.connection), ['tx_job_handler_job1', 'tx_job_handler_job2'])
+
+    def test_orphan_with_torn_record_is_replayed_and_removed(self):
+        self.spool.append([make_spooled_job(1), make_spooled_job(2)])
+        writer_directory, = self.spool_directory.iterdir()
+        segment_path, = writer_directory.glob(f'*{SEGMENT_SUFFIX}')
+        with open(segment_path, 'ab') as segment_file: # As if we crashed while writing the next job
+            segment_file.write(encode_record(make_spooled_job(3))[:-5])
+        other_spool = JobSpool(str(self.spool_directory))
+        self.assertEqual(other_spool.replay(self.connection), 0) # Still locked by the live process
+        self.spool._lock_files[writer_directory].close() # The process dies
+        self.assertEqual(other_spool.replay(self.connection), 2)
+        self.assertEqual(other_spool.replay(self.connection), 0)
+        self.assertEqual(get_queued_job_ids(self.connection), ['tx_job_handler_job1', 'tx_job_handler_job2'])
+        self.assertEqual(list(self.spool_directory.glob(f'{WRITER_DIRECTORY_PREFIX}*')), [])
+
+    def test_corrupt_record_is_dropped(self):
+        self.spool.append([make_spooled_job(1)])
+        writer_directory, = self.spool_directory.iterdir()
+        segment_path, = writer_directory.glob(f'*{SEGMENT_SUFFIX}')
+        with open(segment_path, 'r+b') as segment_file:
+            segment_file.seek(-3, 2)
+            segment_file.write(b'xyz')
+        logger = Mock()
+        self.spool.logger = logger
+        self.assertEqual(self.spool.replay(self.connection), 0)
+        logger.critical.assert_called_once()
+        self.assertFalse(self.spool.should_spool())
+
+    def test_redis_failure_and_latency_budget(self):
+        spool = JobSpool(str(self.spool_directory), latency_budget=0.5, redis_retry_seconds=0.05)
+        spool.note_enqueue_seconds(0.1)
+        self.assertFalse(spool.should_spool())
+        spool.note_enqueue_seconds(0.6)
+        self.assertTrue(spool.should_spool())
+        time.sleep(0.1)
+        self.assertFalse(spool.should_spool())
+
+    def test_replay_while_redis_is_down(self):
+        self.spool.append([make_spooled_job(1)])
+        broken_connection = Mock(**{'pipeline.side_effect': RedisConnectionError('Connection refused')})
+        with self.assertRaises(RedisConnectionError):
+            self.spool.replay(broken_connection)
+        self.assertEqual(read_cursor(next(self.spool_directory.iterdir())), (0, 0))
+        self.assertEqual(self.spool.replay(self.connection), 1)
+# end of TestJobSpool class
+
+
+def get_free_port():
+    with socket.socket() as free_socket:
+        free_socket.bind(('127.0.0.1', 0))
+        return free_socket.getsockname()[1]
+
+
+@skipUnless(shutil.which('redis-server'), "Needs a local redis-server that can be killed and restarted")
+class TestJobSpoolWithRedisServer(TestCase):
+
+    def setUp(self):
+        self.temporary_directory = TemporaryDirectory()
+        self.port = get_free_port()
+        self.redis_server = None
+
+    def tearDown(self):
+        self.stop_redis_server()
+        self.temporary_directory.cleanup()
+
+    def start_redis_server(self):
+        self.redis_server = subprocess.Popen(['redis-server', '--port', str(self.port), '--save', '', '--appendonly', 'yes',
+                                                '--dir', self.temporary_directory.name], stdout=subprocess.DEVNULL)
+        connection = StrictRedis(port=self.port, socket_timeout=1)
+        for _attempt in range(50):
+            try:
+                connection.ping()
+                return connection
+            except RedisConnectionError:
+                time.sleep(0.1)
+        self.fail("redis-server didn't start")
+
+    def stop_redis_server(self):
+        if self.redis_server is not None:
+            self.redis_server.kill()
+            self.redis_server.wait()
+            self.redis_server = None
+
+    def test_jobs_spooled_while_redis_is_killed_are_replayed_after_restart(self):
+        connection = self.start_redis_server()
+        spool = JobSpool(str(Path(self.temporary_directory.name) / 'spool'))
+        Queue('tx_job_handler', connection=connection).enqueue('webhook.job', {}, job_id='tx_job_handler_job0')
+        self.stop_redis_server()
+        spool.append([make_spooled_job(n) for n in range(1, 4)])
+        with self.assertRaises(RedisConnectionError):
+            spool.replay(connection)
+        # A new process replays the spool of the killed one
+        spool._lock_files.popitem()[1].close()
+        connection = self.start_redis_server()
+        other_spool = JobSpool(str(Path(self.temporary_directory.name) / 'spool'))
+        while other_spool.replay(connection):
+            pass
+        self.assertEqual(get_queued_job_ids(connection),
+                        ['tx_job_handler_job0', 'tx_job_handler_job1', 'tx_job_handler_job2', 'tx_job_handler_job3'])
+# end of TestJobSpoolWithRedisServer class
@@ -0,0 +1,83 @@
+from unittest import TestCase, IsolatedAsyncioTestCase
+from unittest.mock import Mock
+import asyncio
+
+from fakeredis import FakeStrictRedis
+
+from tXenqueue.tx_enqueue_timing import TOTAL_STAGE, TRACE_SAMPLE_RATE_KEY, StageRecorder, timed_stage
+
+
+class TestStageRecorder(TestCase):
+
+    def setUp(self):
+        self.logger = Mock()
+        self.recorder = StageRecorder(logger=self.logger)
+        self.recorder.stats_client, self.recorder.stats_prefix = Mock(), 'tx.dev.enqueue-job'
+
+    def test_no_current_request(self):
+        with timed_stage('parse'):
+            pass
+        self.assertIsNone(self.recorder.finish_request())
+        self.recorder.stats_client.timing.assert_not_called()
+
+    def test_stages_are_added_up(self):
+        self.recorder.start_request('job_receiver')
+        for _ in range(3):
+            with timed_stage('validate'):
+                pass
+        with timed_stage('enqueue'):
+            pass
+        stage_seconds = self.recorder.finish_request('200')
+        self.assertEqual(list(stage_seconds), ['validate', 'enqueue', TOTAL_STAGE])
+        self.assertGreaterEqual(stage_seconds[TOTAL_STAGE], stage_seconds['validate'] + stage_seconds['enqueue'])
+        self.recorder.stats_client.timing.assert_any_call('tx.dev.enqueue-job.job_receiver.stages.validate',
+                                                            1000 * stage_seconds['validate'])
+        self.logger.info.assert_not_called() # Not traced
+        # Only finished once
+        self.assertIsNone(self.recorder.finish_request('error'))
+
+    def test_stage_exception(self):
+        self.recorder.start_request('job_receiver')
+        with self.assertRaises(KeyError):
+            with timed_stage('dedup'):
+                raise KeyError('dedup')
+        self.assertIn('dedup', self.recorder.finish_request())
+
+    def test_trace(self):
+        connection = FakeStrictRedis()
+        self.assertEqual(self.recorder.refresh_trace_sample_rate(connection), 0)
+        connection.set(TRACE_SAMPLE_RATE_KEY, '1')
+        self.assertEqual(self.recorder.refresh_trace_sample_rate(connection), 1)
+        self.recorder.start_request('batch_job_receiver')
+        with timed_stage('parse'):
+            pass
+        self.recorder.finish_request('200')
+        trace_line = self.logger.info.call_args[0][0]
+        self.assertTrue(trace_line.startswith('Trace of batch_job_receiver (200): parse='))
+
+    def test_render_prometheus(self):
+        self.recorder.start_request('job_receiver')
+        with timed_stage('parse'):
+            pass
+        self.recorder.finish_request()
+        lines = self.recorder.render_prometheus().splitlines()
+        self.assertEqual(lines[1], '# TYPE tx_enqueue_stage_seconds histogram')
+        self.assertIn('tx_enqueue_stage_seconds_bucket{endpoint="job_receiver",stage="parse",le="+Inf"} 1', lines)
+        self.assertIn('tx_enqueue_stage_seconds_count{endpoint="job_receiver",stage="total"} 1', lines)
+# end of class TestStageRecorder
+
+
+class TestStageRecorderAsync(IsolatedAsyncioTestCase):
+
+    async def test_concurrent_requests(self):
+        recorder = StageRecorder()
+
+        async def handle_request(stage_name):
+            recorder.start_request('job_receiver')
+            with timed_stage(stage_name):
+                await asyncio.sleep(0.01)
+            return recorder.finish_request()
+
+        results = await asyncio.gather(handle_request('parse'), handle_request('enqueue'))
+        self.assertEqual([list(stage_seconds) for stage_seconds in results], [['parse', TOTAL_STAGE], ['enqueue', TOTAL_STAGE]])
+# end of class TestStageRecorderAsync
@@ -0,0 +1,60 @@
+from unittest import TestCase
+import logging
+import time
+
+from fakeredis import FakeStrictRedis
+from rq import Queue
+from rq.registry import FailedJobRegistry
+
+from tXenqueue.tx_enqueue_failed import count_failed_jobs, prune_failed_jobs, \
+                                        start_failed_job_sweeper
+
+
+class TestFailedJobs(TestCase):
+
+    def setUp(self):
+        self.connection = FakeStrictRedis()
+        self.queue = Queue('tx_job_handler', connection=self.connection)
+        self.registry = FailedJobRegistry(queue=self.queue)
+
+    def add_failed_job(self, job_id, ttl):
+        job = self.queue.enqueue('webhook.job', {'job_id': job_id}, job_id=job_id)
+        self.registry.add(job, ttl=ttl)
+
+    def test_count_is_per_origin(self):
+        self.add_failed_job('one', 1000)
+        self.add_failed_job('two', 1000)
+        other_queue = Queue('tx_job_handler_pdf', connection=self.connection)
+        FailedJobRegistry(queue=other_queue).add(
+            other_queue.enqueue('webhook.job', {}, job_id='three'), ttl=1000)
+        self.assertEqual(count_failed_jobs('tx_job_handler', self.connection), 2)
+        self.assertEqual(count_failed_jobs('tx_job_handler_pdf', self.connection), 1)
+        self.assertEqual(count_failed_jobs('tx_job_handler_priority', self.connection), 0)
+
+    def test_prune_only_deletes_expired(self):
+        self.add_failed_job('expired', -10) # Negative ttl is stored as the score itself (i.e., long ago)
+        self.add_failed_job('current', 1000)
+        self.assertEqual(prune_failed_jobs('tx_job_handler', self.connection, logging), 1)
+        self.assertEqual(count_failed_jobs('tx_job_handler', self.connection), 1)
+        self.assertFalse(self.connection.exists('rq:job:expired'))
+        self.assertTrue(self.connection.exists('rq:job:current'))
+        self.assertEqual(prune_failed_jobs('tx_job_handler', self.connection, logging), 0)
+
+    def test_prune_is_bounded(self):
+        for n in range(5):
+            self.add_failed_job(f'expired{n}', -10)
+        self.assertEqual(prune_failed_jobs('tx_job_handler', self.connection, logging, max_count=2), 2)
+        self.assertEqual(count_failed_jobs('tx_job_handler', self.connection), 3)
+
+    def test_sweeper_thread(self):
+        self.add_failed_job('expired', -10)
+        stop_event = start_failed_job_sweeper(['tx_job_handler'], self.connection, logging, interval=60)
+        try:
+            for _ in range(50):
+                if not count_failed_jobs('tx_job_handler', self.connection):
+                    break
+                time.sleep(0.01)
+            self.assertEqual(count_failed_jobs('tx_job_handler', self.connection), 0)
+        finally:
+            stop_event.set()
+# end of class TestFailedJobs
@@ -3,7 +3,8 @@ from unittest.mock import Mock
 import json
 import logging
 
-from tXenqueue.check_posted_tx_payload import check_posted_tx_payload
+from tXenqueue.check_posted_tx_payload import MAX_PAYLOAD_BYTES, MAX_PAYLOAD_WARNINGS, TxPayloadValidator, \
+                                                check_payload_size, check_posted_tx_payload, check_tx_payload
 
 
 class TestPayloadCheck(TestCase):
@@ -30,4 +31,82 @@ class TestPayloadCheck(TestCase):
             'error': 'Missing job_id, Missing resource_type, Missing input_format, Missing output_format, Missing source'
         }
         self.assertEqual(output, expected)
+
+
+    def test_batch_item_not_a_dict(self):
+        output = check_tx_payload(['job_id'], {}, logging)
+        expected = False, {
+            'error': 'Payload must be a JSON object'
+        }
+        self.assertEqual(output, expected)
+
+
+    def test_batch_item_from_door43(self):
+        headers = {'Host': 'git.door43.org'}
+        with open('tests/Resources/tx_payload.json', 'rt') as json_file:
+            payload_json = json.load(json_file)
+        output = check_tx_payload(payload_json, headers, logging)
+        self.assertEqual(output, (True, payload_json))
+
+
+    def test_batch_item_without_host_header(self):
+        with open('tests/Resources/tx_payload.json', 'rt') as json_file:
+            payload_json = json.load(json_file)
+        response_ok_flag, response_dict = check_tx_payload(payload_json, {}, logging)
+        self.assertFalse(response_ok_flag)
+        self.assertTrue(response_dict['error'].startswith('Missing Gitea user token'))
+
+
+    def test_deeply_nested_payload(self):
+        mock_request = Mock(**{'get_json.side_effect': RecursionError})
+        mock_request.data = '[' * 100_000
+        output = check_posted_tx_payload(mock_request, logging)
+        self.assertEqual(output, (False, {'error': 'Payload is nested too deeply'}))
+
+
+    def test_payload_size(self):
+        self.assertIsNone(check_payload_size(None))
+        self.assertIsNone(check_payload_size(MAX_PAYLOAD_BYTES))
+        self.assertIn('too large', check_payload_size(MAX_PAYLOAD_BYTES+1)['error'])
 # end of class TestPayloadCheck
+
+
+class TestTxPayloadValidator(TestCase):
+
+    def setUp(self):
+        self.validator = TxPayloadValidator()
+        with open('tests/Resources/tx_payload.json', 'rt') as json_file:
+            self.payload_json = json.load(json_file)
+
+    def test_valid_payload(self):
+        self.assertEqual(self.validator.validate(self.payload_json), ([], []))
+
+    def test_errors_are_in_field_order(self):
+        payload_json = dict(self.payload_json, output_format='', resource_type=['Bible'])
+        del payload_json['job_id']
+        errors, _warnings = self.validator.validate(payload_json)
+        self.assertEqual(errors, ['Missing job_id', 'Invalid resource_type field (expected a string)',
+                                    'Empty output_format field'])
+
+    def test_unknown_values_are_warnings(self):
+        payload_json = dict(self.payload_json, resource_type='Something_New', something='anything',
+                            options={'page_size': 'A4', 'colour': 'blue'})
+        errors, warnings = self.validator.validate(payload_json)
+        self.assertEqual(errors, [])
+        self.assertEqual(warnings, ["Unknown 'Something_New' resource type",
+                                    'Unexpected something field', 'Unexpected colour option field'])
+
+    def test_invalid_optional_fields(self):
+        payload_json = dict(self.payload_json, user_token=['x']*40, options='A4')
+        errors, _warnings = self.validator.validate(payload_json)
+        self.assertEqual(errors, ["Invalid DCS user token '['x', 'x', 'x', 'x', 'x', 'x', 'x', 'x',…'",
+                                    'Invalid options field (expected a JSON object)'])
+
+    def test_warnings_are_bounded(self):
+        payload_json = dict(self.payload_json, **{f'field_{n}_{"x"*100}': n for n in range(1000)})
+        errors, warnings = self.validator.validate(payload_json)
+        self.assertEqual(errors, [])
+        self.assertEqual(len(warnings), MAX_PAYLOAD_WARNINGS + 1)
+        self.assertEqual(warnings[-1], f'(and {1000-MAX_PAYLOAD_WARNINGS:,} more warnings)')
+        self.assertLess(max(len(warning) for warning in warnings), 100)
+# end of class TestTxPayloadValidator